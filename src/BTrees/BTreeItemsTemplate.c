@@ -40,6 +40,12 @@
  * Calling it with consecutive smaller positions is more efficient than if
  * a search finger weren't being used at all, but is still quadratic time
  * in the number of buckets in the slice.
+ *
+ * A slice of a counted BTree also holds a reference to the BTree in 'tree',
+ * with 'firstrank' the position in the BTree of the slice's first entry
+ * and 'length' the number of entries in the slice.  Seeks that leave the
+ * neighbourhood of the search finger then descend from the root instead,
+ * which takes time proportional to the depth of the tree.
  */
 typedef struct
 {
@@ -52,6 +58,9 @@ typedef struct
     int first;              /* Start offset in firstbucket    */
     int last;               /* End offset in lastbucket       */
     char kind;              /* 'k', 'v', 'i'                  */
+    BTree *tree;            /* Counted BTree, or NULL         */
+    Py_ssize_t firstrank;   /* Position of first in tree      */
+    Py_ssize_t length;      /* Number of entries, if tree     */
 } BTreeItems;
 
 #define ITEMS(O)((BTreeItems*)(O))
@@ -61,9 +70,13 @@ newBTreeItems(char kind,
               Bucket *lowbucket, int lowoffset,
               Bucket *highbucket, int highoffset);
 
+static int
+_BTree_seekPosition(BTree *self, Py_ssize_t pos, Bucket **bucket, int *offset);
+
 static void
 BTreeItems_dealloc(BTreeItems *self)
 {
+    Py_XDECREF(self->tree);
     Py_XDECREF(self->firstbucket);
     Py_XDECREF(self->lastbucket);
     Py_XDECREF(self->currentbucket);
@@ -80,6 +93,9 @@ BTreeItems_length_or_nonzero(BTreeItems *self, int nonzero)
     if (b == NULL)
         return 0;
 
+    if (self->tree)
+        return nonzero ? self->length > 0 : self->length;
+
     r = self->last + 1 - self->first;
 
     if (nonzero && r > 0)
@@ -147,6 +163,32 @@ BTreeItems_seek(BTreeItems *self, Py_ssize_t i)
         goto no_match;
 
     delta = i - pseudoindex;
+    if (self->tree && delta != 0)
+    {
+        /* Unless i is in the current bucket or the next one, descend from
+         * the root of the counted tree rather than walking the buckets.
+         */
+        int jump = -delta > currentoffset;
+        if (!jump && delta > 0)
+        {
+            PER_USE_OR_RETURN(currentbucket, -1);
+            jump = delta > currentbucket->len - currentoffset;
+            PER_UNUSE(currentbucket);
+        }
+        if (jump)
+        {
+            if (i < 0 || i >= self->length)
+                goto no_match;
+            if (_BTree_seekPosition(self->tree, self->firstrank + i,
+                                    &b, &currentoffset) < 0)
+                return -1;
+            Py_DECREF(self->currentbucket);
+            self->currentbucket = b;
+            self->currentoffset = currentoffset;
+            self->pseudoindex = i;
+            return 0;
+        }
+    }
     while (delta > 0) /* move right */
     {
         int max;
@@ -336,6 +378,7 @@ BTreeItems_slice(BTreeItems *self, Py_ssize_t ilow, Py_ssize_t ihigh)
     int lowoffset;
     int highoffset;
     Py_ssize_t length = -1;  /* len(self), but computed only if needed */
+    PyObject *result;
 
     /* Complications:
      * A Python slice never raises IndexError, but BTreeItems_seek does.
@@ -404,8 +447,16 @@ BTreeItems_slice(BTreeItems *self, Py_ssize_t ilow, Py_ssize_t ihigh)
         highbucket = self->currentbucket;
         highoffset = self->currentoffset;
     }
-    return newBTreeItems(self->kind,
-                         lowbucket, lowoffset, highbucket, highoffset);
+    result = newBTreeItems(self->kind,
+                           lowbucket, lowoffset, highbucket, highoffset);
+    if (result && self->tree && lowbucket)
+    {
+        Py_INCREF(self->tree);
+        ITEMS(result)->tree = self->tree;
+        ITEMS(result)->firstrank = self->firstrank + ilow;
+        ITEMS(result)->length = ihigh + 1 - ilow;
+    }
+    return result;
 }
 
 static PyObject *
@@ -546,6 +597,9 @@ newBTreeItems(char kind,
 
     self->currentoffset = lowoffset;
     self->pseudoindex = 0;
+    self->tree = NULL;
+    self->firstrank = 0;
+    self->length = -1;
 
     return OBJECT(self);
 }
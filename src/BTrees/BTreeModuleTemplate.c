@@ -53,8 +53,12 @@
 
 static PyObject *sort_str, *reverse_str, *__setstate___str;
 static PyObject *_bucket_type_str, *max_internal_size_str, *max_leaf_size_str;
+static PyObject *counted_str, *append_optimized_str, *packed_state_str;
 static PyObject *__slotnames__str;
 static PyObject *ConflictError = NULL;
+#ifdef KEY_PACK_CODE
+static PyObject *ArrayType = NULL;  /* array.array, for toArrays() */
+#endif
 
 static void PyVar_Assign(PyObject **v, PyObject *e) { Py_XDECREF(*v); *v=e;}
 #define ASSIGN(V,E) PyVar_Assign(&(V),(E))
@@ -262,6 +266,25 @@ typedef struct Bucket_s {
   struct Bucket_s *next;    /* the bucket with the next-larger keys */
   KEY_TYPE *keys;           /* 'len' keys, in increasing order */
   VALUE_TYPE *values;       /* 'len' corresponding values; NULL if a set */
+  /* True if __getstate__ should use the packed format.  Set when the
+   * state is loaded from that format, and by a BTree whose class sets
+   * 'packed_state' when it creates or changes the bucket.
+   */
+  int packed;
+  /* The number of buffers exported over keys or values.  While there are
+   * any, the arrays must not be moved or freed.
+   */
+  int exports;
+  /* While there are exports, the BucketArrays that they hold.  It takes
+   * the arrays over if the bucket is ghostified or loads a new state
+   * before they are all released.
+   */
+  PyObject *exported;
+  /* If not NULL, the packed state (a bytes object) that keys and values
+   * point into instead of arrays of the bucket's own; size is then len.
+   * Nothing may change them before _bucket_own() copies them out.
+   */
+  PyObject *borrowed;
 } Bucket;
 
 #define BUCKET(O) ((Bucket*)(O))
@@ -272,6 +295,10 @@ typedef struct Bucket_s {
 typedef struct BTreeItem_s {
   KEY_TYPE key;
   Sized *child; /* points to another BTree, or to a Bucket of some sort */
+  /* In a counted BTree, the number of keys reachable from child, or -1 if
+   * that isn't known yet.  Unused otherwise.
+   */
+  Py_ssize_t count;
 } BTreeItem;
 
 typedef struct BTree_s {
@@ -293,11 +320,22 @@ typedef struct BTree_s {
   BTreeItem *data;
   long max_internal_size;
   long max_leaf_size;
+  /* 0 until looked up, then 1 if the class attribute 'counted' is true,
+   * else -1.  See _BTree_counted().
+   */
+  int counted;
+  /* Likewise for the class attribute 'append_optimized'.  See
+   * _BTree_appendOptimized().
+   */
+  int append_optimized;
+  /* Likewise for 'packed_state'.  See _BTree_packedState(). */
+  int packed_state;
 } BTree;
 
 static PyTypeObject BTreeTypeType;
 static PyTypeObject BTreeType;
 static PyTypeObject BucketType;
+static PyTypeObject SetType;
 
 #define BTREE(O) ((BTree*)(O))
 
@@ -352,6 +390,11 @@ static PyTypeObject BucketType;
  *            do something with si.key and/or si.value;
  *            if (si.next(&si) < 0) { there was an error; }
  *        }
+ *    If si.skip isn't NULL, an element that has been seen can also be
+ *    followed by si.skip(&si, key) rather than si.next(&si).  That moves
+ *    straight to the first element >= key, galloping through the current
+ *    bucket and descending from the root of a BTree (kept in si.tree)
+ *    to get past whole buckets.
  * 5. Finalize the SetIterator:
  *        finiSetIteration(&si);
  *    This is mandatory!  si may contain references to iterator objects,
@@ -367,6 +410,8 @@ typedef struct SetIteration_s
   KEY_TYPE key;     /* next() sets to next key */
   VALUE_TYPE value; /* next() may set to next value */
   int (*next)(struct SetIteration_s*);  /* function to get next key+value */
+  int (*skip)(struct SetIteration_s*, KEY_TYPE); /* advance to >= key */
+  PyObject *tree;   /* the BTree 'set' iterates, for skip(); or NULL */
 } SetIteration;
 
 /* Finish the set iteration protocol.  This MUST be called by everyone
@@ -382,6 +427,7 @@ finiSetIteration(SetIteration *i)
         return;
     Py_DECREF(i->set);
     i->set = NULL;      /* so it doesn't hurt to call this again */
+    Py_CLEAR(i->tree);
 
     if (i->position > 0) {
         /* next() was called at least once, but didn't finish iterating
@@ -483,6 +529,140 @@ BTree_Realloc(void *p, size_t sz)
     return r;
 }
 
+#ifdef KEY_PACK_CODE
+/* Packed states.
+ *
+ * When the keys (and, for mappings, the values) are C numbers, a bucket's
+ * keys and values, or a BTree node's keys, can be saved as a single bytes
+ * object instead of a tuple of Python ints and floats.  The bytes start
+ * with an 8-byte header:
+ *
+ *     byte 0       PACKED_STATE_VERSION
+ *     byte 1       KEY_PACK_CODE, the struct module code of the keys
+ *     byte 2       VALUE_PACK_CODE, or 0 if no values follow the keys
+ *     byte 3       0
+ *     bytes 4-7    the number of keys, an unsigned little-endian int
+ *
+ * followed by the keys, then the values, as little-endian arrays.  The
+ * Python implementation reads and writes the same format.
+ */
+#define PACKED_STATE_VERSION 1
+#define PACKED_HEADER_SIZE 8
+
+/* Copy n items of itemsize bytes each, converting between native and
+ * little-endian byte order (the conversion is its own inverse).
+ */
+static void
+_packed_copy(char *to, const char *from, size_t itemsize, Py_ssize_t n)
+{
+    if (n == 0)
+        return;
+#if PY_LITTLE_ENDIAN
+    memcpy(to, from, itemsize * n);
+#else
+    Py_ssize_t i;
+    size_t j;
+
+    for (i = 0; i < n; i++, to += itemsize, from += itemsize)
+        for (j = 0; j < itemsize; j++)
+            to[j] = from[itemsize - 1 - j];
+#endif
+}
+
+/* Return a new bytes object in the packed format for n keys, and n
+ * values of value_size bytes if value_code isn't 0.  The header is filled
+ * in; *data is set to where the keys go.
+ */
+static PyObject *
+_packed_new(Py_ssize_t n, char value_code, size_t value_size, char **data)
+{
+    PyObject *result;
+    unsigned char *p;
+
+    result = PyBytes_FromStringAndSize(
+        NULL, PACKED_HEADER_SIZE + n * (sizeof(KEY_TYPE) + value_size));
+    if (result == NULL)
+        return NULL;
+    p = (unsigned char *)PyBytes_AS_STRING(result);
+    p[0] = PACKED_STATE_VERSION;
+    p[1] = KEY_PACK_CODE;
+    p[2] = value_code;
+    p[3] = 0;
+    p[4] = n & 0xff;
+    p[5] = (n >> 8) & 0xff;
+    p[6] = (n >> 16) & 0xff;
+    p[7] = (n >> 24) & 0xff;
+    *data = (char *)p + PACKED_HEADER_SIZE;
+    return result;
+}
+
+/* Check that state, a bytes object, is in the packed format with the
+ * given value code.  Return the number of keys in it and set *data to
+ * where they start, or return -1 on error.
+ */
+static Py_ssize_t
+_packed_count(PyObject *state, char value_code, size_t value_size,
+              const char **data)
+{
+    const unsigned char *p = (const unsigned char *)PyBytes_AS_STRING(state);
+    Py_ssize_t size = PyBytes_GET_SIZE(state);
+    size_t n;
+
+    if (size < PACKED_HEADER_SIZE || p[0] != PACKED_STATE_VERSION)
+    {
+        PyErr_SetString(PyExc_ValueError, "unsupported packed state");
+        return -1;
+    }
+    if (p[1] != KEY_PACK_CODE || p[2] != value_code)
+    {
+        PyErr_SetString(PyExc_TypeError,
+                        "packed state has the wrong key or value type");
+        return -1;
+    }
+    n = (size_t)p[4] | ((size_t)p[5] << 8) | ((size_t)p[6] << 16)
+        | ((size_t)p[7] << 24);
+    size -= PACKED_HEADER_SIZE;
+    if (n > INT_MAX
+        || size % (sizeof(KEY_TYPE) + value_size) != 0
+        || (size_t)size / (sizeof(KEY_TYPE) + value_size) != n)
+    {
+        PyErr_SetString(PyExc_ValueError, "packed state has the wrong size");
+        return -1;
+    }
+    *data = (const char *)p + PACKED_HEADER_SIZE;
+    return (Py_ssize_t)n;
+}
+
+/* Return 1 if the items of view are C numbers of the same kind (signed
+ * integers, unsigned integers or floats) and size as those of the struct
+ * module code 'code', in native byte order, else 0.
+ */
+static int
+_buffer_holds(const Py_buffer *view, char code, size_t size)
+{
+    const char *format = view->format ? view->format : "B";
+    const char *kinds[] = {"bhilqn", "BHILQN", "fd", NULL};
+    int i;
+
+    if ((size_t)view->itemsize != size)
+        return 0;
+    if (*format == '@' || *format == '='
+#if PY_LITTLE_ENDIAN
+        || *format == '<'
+#else
+        || *format == '>' || *format == '!'
+#endif
+        )
+        format++;
+    if (format[0] == 0 || format[1] != 0)
+        return 0;
+    for (i = 0; kinds[i] != NULL; i++)
+        if (strchr(kinds[i], code) != NULL)
+            return strchr(kinds[i], format[0]) != NULL;
+    return 0;
+}
+#endif
+
 /* Shared keyword-argument list for BTree/Bucket
  * (iter)?(keys|values|items)
  */
@@ -516,34 +696,115 @@ BTree_ShouldSuppressKeyError()
 #include "MergeTemplate.c"
 
 static struct PyMethodDef module_methods[] = {
-  {"difference", (PyCFunction) difference_m,    METH_VARARGS,
-   "difference(o1, o2)\n"
-   "compute the difference between o1 and o2"
+  {"difference", (PyCFunction) difference_m,    METH_VARARGS | METH_KEYWORDS,
+   "difference(o1, o2, *, min=None, max=None, excludemin=False, "
+   "excludemax=False)\n"
+   "compute the difference between o1 and o2\n"
+   "\nIf min or max is given, only keys in that range are considered."
+  },
+  {"union", (PyCFunction) union_m,      METH_VARARGS | METH_KEYWORDS,
+   "union(o1, o2, *, min=None, max=None, excludemin=False, "
+   "excludemax=False)\n"
+   "compute the union of o1 and o2\n"
+   "\nIf min or max is given, only keys in that range are considered."
   },
-  {"union", (PyCFunction) union_m,      METH_VARARGS,
-   "union(o1, o2)\ncompute the union of o1 and o2\n"
+  {"intersection", (PyCFunction) intersection_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "intersection(o1, o2, *, min=None, max=None, excludemin=False, "
+   "excludemax=False)\n"
+   "compute the intersection of o1 and o2\n"
+   "\nIf min or max is given, only keys in that range are considered."
+  },
+  {"iunion", (PyCFunction) iunion_m, METH_VARARGS | METH_KEYWORDS,
+   "iunion(o1, o2, *, min=None, max=None, excludemin=False, "
+   "excludemax=False)\n"
+   "iterate over the keys of union(o1, o2), merging o1 and o2 lazily"
+  },
+  {"iintersection", (PyCFunction) iintersection_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "iintersection(o1, o2, *, min=None, max=None, excludemin=False, "
+   "excludemax=False)\n"
+   "iterate over the keys of intersection(o1, o2), merging o1 and o2 lazily"
+  },
+  {"idifference", (PyCFunction) idifference_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "idifference(o1, o2, *, min=None, max=None, excludemin=False, "
+   "excludemax=False)\n"
+   "iterate over the keys of difference(o1, o2), merging o1 and o2 lazily"
+  },
+  {"differenceSize", (PyCFunction) differenceSize_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "differenceSize(o1, o2, limit=None)\n"
+   "count the keys in o1 but not in o2, stopping at limit"
+  },
+  {"unionSize", (PyCFunction) unionSize_m, METH_VARARGS | METH_KEYWORDS,
+   "unionSize(o1, o2, limit=None)\n"
+   "count the keys in o1 or o2, stopping at limit"
   },
-  {"intersection", (PyCFunction) intersection_m,        METH_VARARGS,
-   "intersection(o1, o2)\n"
-   "compute the intersection of o1 and o2"
+  {"intersectionSize", (PyCFunction) intersectionSize_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "intersectionSize(o1, o2, limit=None)\n"
+   "count the keys in both o1 and o2, stopping at limit"
   },
 #ifdef MERGE
-  {"weightedUnion", (PyCFunction) wunion_m,     METH_VARARGS,
-   "weightedUnion(o1, o2 [, w1, w2])\ncompute the union of o1 and o2\n"
-   "\nw1 and w2 are weights."
+  {"weightedUnion", (PyCFunction) wunion_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "weightedUnion(o1, o2 [, w1, w2], *, topk=None, min=None, max=None,\n"
+   "    excludemin=False, excludemax=False)\n"
+   "compute the union of o1 and o2\n"
+   "\nw1 and w2 are weights.  If topk is given, only the topk items\n"
+   "with the largest values are kept.  If min or max is given, only\n"
+   "keys in that range are considered."
   },
-  {"weightedIntersection", (PyCFunction) wintersection_m,       METH_VARARGS,
-   "weightedIntersection(o1, o2 [, w1, w2])\n"
+  {"weightedIntersection", (PyCFunction) wintersection_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "weightedIntersection(o1, o2 [, w1, w2], *, topk=None, min=None, max=None,\n"
+   "    excludemin=False, excludemax=False)\n"
    "compute the intersection of o1 and o2\n"
-   "\nw1 and w2 are weights."
+   "\nw1 and w2 are weights.  If topk is given, only the topk items\n"
+   "with the largest values are kept.  If min or max is given, only\n"
+   "keys in that range are considered."
+  },
+  {"multiWeightedUnion", (PyCFunction) multiWeightedUnion_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "multiWeightedUnion(pairs, *, topk=None)\n"
+   "compute the weighted union of a sequence of (o, weight) pairs\n"
+   "\nThe result is a bucket mapping each key to the sum of its\n"
+   "weighted values, as repeated weightedUnion calls would.  If topk\n"
+   "is given, only the topk items with the largest sums are kept."
   },
 #endif
 #ifdef MULTI_INT_UNION
-  {"multiunion", (PyCFunction) multiunion_m, METH_VARARGS,
-   "multiunion(seq)\ncompute union of a sequence of integer sets.\n"
+  {"multiunion", (PyCFunction) multiunion_m, METH_VARARGS | METH_KEYWORDS,
+   "multiunion(seq, *, threads=None)\n"
+   "compute union of a sequence of integer sets.\n"
+   "\n"
+   "Each element of seq must be an integer set, or convertible to one\n"
+   "via the set iteration protocol.  The union returned is an IISet.\n"
+   "If threads is greater than 1, very large unions are sorted on up to\n"
+   "that many threads."
+  },
+  {"multiunionSize", (PyCFunction) multiunionSize_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "multiunionSize(seq, limit=None)\n"
+   "count the keys in the union of a sequence of integer sets, up to limit."
+  },
+  {"multiintersection", (PyCFunction) multiintersection_m, METH_VARARGS,
+   "multiintersection(seq)\ncompute intersection of a sequence of integer "
+   "sets.\n"
    "\n"
    "Each element of seq must be an integer set, or convertible to one\n"
-   "via the set iteration protocol.  The union returned is an IISet."
+   "via the set iteration protocol.  The intersection returned is an IISet."
+  },
+  {"thresholdUnion", (PyCFunction) thresholdUnion_m,
+   METH_VARARGS | METH_KEYWORDS,
+   "thresholdUnion(seq, k, counts=False)\n"
+   "compute the keys found in at least k of a sequence of integer sets.\n"
+   "\n"
+   "Each element of seq must be an integer set, or convertible to one\n"
+   "via the set iteration protocol.  The keys are returned as an IISet,\n"
+   "or, if counts is true, as an IIBucket mapping each key to the number\n"
+   "of sets it was found in."
   },
 #endif
   {NULL,                NULL}           /* sentinel */
@@ -624,6 +885,9 @@ static PyObject*
 module_init(void)
 {
     PyObject *module, *mod_dict, *interfaces, *conflicterr;
+#ifdef KEY_PACK_CODE
+    PyObject *arraymodule;
+#endif
 
 #ifdef KEY_TYPE_IS_PYOBJECT
     object_ = PyTuple_GetItem(Py_TYPE(Py_None)->tp_bases, 0);
@@ -650,15 +914,27 @@ module_init(void)
     max_leaf_size_str = PyUnicode_InternFromString("max_leaf_size");
     if (! max_leaf_size_str)
         return NULL;
+    counted_str = PyUnicode_InternFromString("counted");
+    if (! counted_str)
+        return NULL;
+    append_optimized_str = PyUnicode_InternFromString("append_optimized");
+    if (! append_optimized_str)
+        return NULL;
+    packed_state_str = PyUnicode_InternFromString("packed_state");
+    if (! packed_state_str)
+        return NULL;
     __slotnames__str = PyUnicode_InternFromString("__slotnames__");
     if (!__slotnames__str)
         return NULL;
 
     BTreeType_setattro_allowed_names = PyTuple_Pack(
-        5,
+        8,
         /* BTree attributes  */
         max_internal_size_str,
         max_leaf_size_str,
+        counted_str,
+        append_optimized_str,
+        packed_state_str,
         /* zope.interface attributes */
         /*
           Technically, INTERNING directly here leaks references,
@@ -685,6 +961,16 @@ module_init(void)
         ConflictError=PyExc_ValueError;
     }
 
+#ifdef KEY_PACK_CODE
+    arraymodule = PyImport_ImportModule("array");
+    if (arraymodule == NULL)
+        return NULL;
+    ArrayType = PyObject_GetAttrString(arraymodule, "array");
+    Py_DECREF(arraymodule);
+    if (ArrayType == NULL)
+        return NULL;
+#endif
+
     /* Initialize the PyPersist_C_API and the type objects. */
     cPersistenceCAPI = (cPersistenceCAPIstruct *)PyCapsule_Import(
                 "persistent.cPersistence.CAPI", 0);
@@ -710,6 +996,19 @@ module_init(void)
     BTreeType.tp_new = PyType_GenericNew;
     TreeSetType.tp_new = PyType_GenericNew;
 
+    if (PyType_Ready(&BTreeCursor_Type) < 0)
+        return NULL;
+
+    if (PyType_Ready(&SetOpIterator_Type) < 0)
+        return NULL;
+
+#if defined(KEY_PACK_CODE) || defined(VALUE_PACK_CODE)
+    if (PyType_Ready(&BucketBuffer_Type) < 0)
+        return NULL;
+    if (PyType_Ready(&BucketArrays_Type) < 0)
+        return NULL;
+#endif
+
     if (!init_persist_type(&BucketType))
             return NULL;
 
@@ -749,6 +1048,9 @@ module_init(void)
     if (PyDict_SetItemString(mod_dict, MOD_NAME_PREFIX "TreeIterator",
                              (PyObject *)&BTreeIter_Type) < 0)
         return NULL;
+    if (PyDict_SetItemString(mod_dict, MOD_NAME_PREFIX "TreeCursor",
+                             (PyObject *)&BTreeCursor_Type) < 0)
+        return NULL;
         /* We also want to be able to access these constants without the prefix
          * so that code can more easily exchange modules (particularly the integer
          * and long modules, but also others).  The TreeIterator is only internal,
@@ -769,6 +1071,9 @@ module_init(void)
     if (PyDict_SetItemString(mod_dict, "TreeItems",
                              (PyObject *)&BTreeItemsType) < 0)
         return NULL;
+    if (PyDict_SetItemString(mod_dict, "TreeCursor",
+                             (PyObject *)&BTreeCursor_Type) < 0)
+        return NULL;
 #if defined(ZODB_64BIT_INTS) && defined(NEED_LONG_LONG_SUPPORT)
     if (PyDict_SetItemString(mod_dict, "using64bits", Py_True) < 0)
         return NULL;
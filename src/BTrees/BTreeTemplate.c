@@ -60,6 +60,135 @@ _max_leaf_size(BTree *self)
   return isize;
 }
 
+/* Return 1 if the class attribute 'name' of self's type is true, 0 if it
+ * isn't or is missing, -1 on error.  The answer is cached in *cache as 1
+ * or -1; 0 there means it hasn't been looked up yet.
+ */
+static int
+_BTree_classFlag(BTree *self, PyObject *name, int *cache)
+{
+    PyObject *flag;
+    int istrue = 0;
+
+    if (*cache) return *cache > 0;
+    flag = PyObject_GetAttr(OBJECT(OBJECT(self)->ob_type), name);
+    if (flag == NULL)
+        PyErr_Clear();
+    else
+    {
+        istrue = PyObject_IsTrue(flag);
+        Py_DECREF(flag);
+        if (istrue < 0)
+            return -1;
+    }
+    *cache = istrue ? 1 : -1;
+    return istrue;
+}
+
+/* Return 1 if self is a counted BTree, that is, if its class has a true
+ * 'counted' attribute; 0 if it isn't; -1 on error.
+ *
+ * In a counted BTree, data[i].count records how many keys are reachable
+ * from data[i].child, so that lengths, ranks and positional lookups take
+ * time proportional to the depth of the tree instead of to the number of
+ * buckets.  The counts are part of the pickled state.
+ */
+static int
+_BTree_counted(BTree *self)
+{
+    return _BTree_classFlag(self, counted_str, &self->counted);
+}
+
+/* Return 1 if self's class has a true 'append_optimized' attribute, 0 if
+ * not, -1 on error.
+ *
+ * When a node of such a tree overflows because of an insertion at the
+ * right edge of the whole tree, it is split just before its last entry
+ * instead of at the midpoint:  the left node stays full and the new right
+ * sibling starts out nearly empty.  Trees whose keys only ever increase
+ * (timestamps, sequence numbers) then end up with full buckets rather
+ * than half-full ones.  See BTree_grow().
+ */
+static int
+_BTree_appendOptimized(BTree *self)
+{
+    return _BTree_classFlag(self, append_optimized_str,
+                            &self->append_optimized);
+}
+
+/* Return 1 if self's class has a true 'packed_state' attribute, 0 if not,
+ * -1 on error.
+ *
+ * Such a tree saves its keys in the packed format described in
+ * BTreeModuleTemplate.c, and marks the buckets it creates or changes so
+ * that they save their keys and values that way too.  States in either
+ * format can always be loaded.
+ */
+static int
+_BTree_packedState(BTree *self)
+{
+    return _BTree_classFlag(self, packed_state_str, &self->packed_state);
+}
+
+/* Return the total of the counts of self's children, or -1 if any of them
+ * is unknown.  self must be activated.
+ */
+static Py_ssize_t
+_BTree_nodeCount(BTree *self)
+{
+    Py_ssize_t result = 0;
+    int i;
+
+    for (i = 0; i < self->len; i++)
+    {
+        if (self->data[i].count < 0)
+            return -1;
+        result += self->data[i].count;
+    }
+    return result;
+}
+
+/* Return the number of keys reachable from self->data[i].child, or -1 on
+ * error.  self must be activated.  In a counted BTree this is normally the
+ * recorded count; one that isn't known yet is computed (activating the
+ * subtree) and remembered.  Otherwise it is always computed.
+ */
+static Py_ssize_t
+_BTree_childCount(BTree *self, int i)
+{
+    Sized *child = self->data[i].child;
+    Py_ssize_t result = 0;
+    int counted, j;
+
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return -1;
+    if (counted && self->data[i].count >= 0)
+        return self->data[i].count;
+
+    PER_USE_OR_RETURN(child, -1);
+    if (SameType_Check(self, child))
+    {
+        for (j = 0; j < child->len; j++)
+        {
+            Py_ssize_t count = _BTree_childCount(BTREE(child), j);
+            if (count < 0)
+            {
+                result = -1;
+                break;
+            }
+            result += count;
+        }
+    }
+    else
+        result = child->len;
+    PER_UNUSE(child);
+
+    if (counted && result >= 0)
+        self->data[i].count = result;
+    return result;
+}
+
 /* Sanity-check a BTree.  This is a private helper for BTree_check.  Return:
  *      -1         Error.  If it's an internal inconsistency in the BTree,
  *                 AssertionError is set.
@@ -78,6 +207,7 @@ BTree_check_inner(BTree *self, Bucket *nextbucket)
     char *errormsg = "internal error";  /* someone should have overriden */
     Sized *activated_child = NULL;
     int result = -1;    /* until proved innocent */
+    int counted;
 
 #define CHECK(CONDITION, ERRORMSG)              \
   if (!(CONDITION)) {                           \
@@ -85,6 +215,10 @@ BTree_check_inner(BTree *self, Bucket *nextbucket)
     goto Error;                                 \
   }
 
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return -1;
+
     PER_USE_OR_RETURN(self, -1);
     CHECK(self->len >= 0, "BTree len < 0");
     CHECK(self->len <= self->size, "BTree len > size");
@@ -146,6 +280,16 @@ BTree_check_inner(BTree *self, Bucket *nextbucket)
             }
             if (BTree_check_inner(BTREE(child), bucketafter) < 0)
                 goto Done;
+            if (counted && self->data[i].count >= 0)
+            {
+                Py_ssize_t count;
+                UNLESS (PER_USE(child))
+                    goto Done;
+                count = _BTree_nodeCount(BTREE(child));
+                PER_ALLOW_DEACTIVATION(child);
+                CHECK(count < 0 || count == self->data[i].count,
+                      "BTree child count is damaged");
+            }
         }
     }
     else /* Our children are buckets. */
@@ -173,6 +317,9 @@ BTree_check_inner(BTree *self, Bucket *nextbucket)
                 bucketafter = BUCKET(self->data[i+1].child);
             CHECK(BUCKET(child)->next == bucketafter,
                     "Bucket next pointer is damaged");
+            CHECK(!counted || self->data[i].count < 0
+                  || self->data[i].count == child->len,
+                  "Bucket count is damaged");
             PER_ALLOW_DEACTIVATION(child);
             activated_child = NULL;
         }
@@ -327,6 +474,14 @@ BTree_newBucket(BTree *self)
     */
     result = SIZED(PyObject_CallObject(factory, NULL));
     Py_DECREF(factory);
+    if (result != NULL)
+    {
+        int packed = _BTree_packedState(self);
+        if (packed < 0)
+            Py_CLEAR(result);
+        else
+            BUCKET(result)->packed = packed;
+    }
     return result;
 }
 
@@ -380,12 +535,14 @@ BTree_split(BTree *self, int index, BTree *next)
 
 
 /* Fwd decl -- BTree_grow and BTree_split_root reference each other. */
-static int BTree_grow(BTree *self, int index, int noval);
+static int BTree_grow(BTree *self, int index, int noval, int append);
 
 /* Split the root.  This is a little special because the root isn't a child
  * of anything else, and the root needs to retain its object identity.  So
  * this routine moves the root's data into a new child, and splits the
- * latter.  This leaves the root with two children.
+ * latter.  This leaves the root with two children.  If append is true,
+ * the child is split as BTree_grow() splits nodes at the right edge of an
+ * append_optimized tree.
  *
  * Return:
  *      0   OK
@@ -394,7 +551,7 @@ static int BTree_grow(BTree *self, int index, int noval);
  * CAUTION:  The caller must call PER_CHANGED on self.
  */
 static int
-BTree_split_root(BTree *self, int noval)
+BTree_split_root(BTree *self, int noval, int append)
 {
     BTree *child;
     BTreeItem *d;
@@ -422,7 +579,7 @@ BTree_split_root(BTree *self, int noval)
     self->len = 1;
     self->size = 2;
     self->data[0].child = SIZED(child); /* transfers reference ownership */
-    return BTree_grow(self, 0, noval);
+    return BTree_grow(self, 0, noval, append);
 }
 
 /*
@@ -435,6 +592,10 @@ BTree_split_root(BTree *self, int noval)
 **                      must be 0 if self is empty (len == 0), and a new
 **                      empty bucket is created then.
 **              noval   Boolean; is this a set (true) or mapping (false)?
+**              append  Boolean; if true, split the child just before its
+**                      last entry instead of at the midpoint.  Used for
+**                      insertions at the right edge of an
+**                      append_optimized tree.
 **
 ** Returns:     0    on success
 **        -1    on failure
@@ -445,12 +606,17 @@ BTree_split_root(BTree *self, int noval)
 ** to get rid of the empty bucket.
 */
 static int
-BTree_grow(BTree *self, int index, int noval)
+BTree_grow(BTree *self, int index, int noval, int append)
 {
-    int i;
+    int i, counted;
+    Py_ssize_t vcount = -1, ecount = -1;
     Sized *v, *e = 0;
     BTreeItem *d;
 
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return -1;
+
     if (self->len == self->size)
     {
         if (self->size)
@@ -489,11 +655,25 @@ BTree_grow(BTree *self, int index, int noval)
             return -1;
         }
 
-        /* Now split between the original (v) and the new (e) at the midpoint*/
+        /* Now split between the original (v) and the new (e) at the
+         * midpoint, or before v's last entry when appending.
+         */
         if (SameType_Check(self, v))
-            i = BTree_split((BTree *)v, -1, (BTree *)e);
+        {
+            i = BTree_split((BTree *)v, append ? v->len - 1 : -1, (BTree *)e);
+            if (counted && i >= 0)
+            {
+                vcount = _BTree_nodeCount(BTREE(v));
+                ecount = _BTree_nodeCount(BTREE(e));
+            }
+        }
         else
-            i = bucket_split((Bucket *)v, -1, (Bucket *)e);
+        {
+            i = bucket_split((Bucket *)v, append ? v->len - 1 : -1,
+                             (Bucket *)e);
+            vcount = v->len;
+            ecount = e->len;
+        }
         PER_ALLOW_DEACTIVATION(v);
 
         if (i < 0)
@@ -503,6 +683,7 @@ BTree_grow(BTree *self, int index, int noval)
             return -1;
         }
 
+        d->count = vcount;
         index++;
         d++;
         if (self->len > index)    /* Shift up the old values one array slot */
@@ -523,10 +704,11 @@ BTree_grow(BTree *self, int index, int noval)
             INCREF_KEY(d->key);
         }
         d->child = e;
+        d->count = ecount;
         self->len++;
 
         if (self->len >= max_size * 2)    /* the root is huge */
-            return BTree_split_root(self, noval);
+            return BTree_split_root(self, noval, append);
     }
     else
     {
@@ -538,6 +720,7 @@ BTree_grow(BTree *self, int index, int noval)
         d->child = BTree_newBucket(self);
         if (d->child == NULL)
             return -1;
+        d->count = 0;
         self->len = 1;
         Py_INCREF(d->child);
         self->firstbucket = (Bucket *)d->child;
@@ -679,6 +862,50 @@ _BTree_clear(BTree *self)
     return 0;
 }
 
+/* Return 1 if key is the largest key reachable from child, a child of
+ * self, and child's rightmost bucket is the last bucket of the tree; that
+ * is, if key was just inserted at the right edge of the tree.  Return 0
+ * if not, -1 on error.
+ */
+static int
+_BTree_isRightEdge(BTree *self, Sized *child, KEY_TYPE key)
+{
+    Bucket *bucket;
+    int cmp = 1;
+    int result = -1;
+
+    if (SameType_Check(self, child))
+    {
+        PER_USE_OR_RETURN(child, -1);
+        bucket = BTree_lastBucket(BTREE(child));
+        PER_UNUSE(child);
+        if (bucket == NULL)
+            return -1;
+    }
+    else
+    {
+        bucket = BUCKET(child);
+        Py_INCREF(bucket);
+    }
+
+    UNLESS (PER_USE(bucket))
+        goto Done;
+    if (bucket->next == NULL && bucket->len > 0)
+    {
+        TEST_KEY_SET_OR(cmp, bucket->keys[bucket->len - 1], key)
+        {
+            PER_UNUSE(bucket);
+            goto Done;
+        }
+    }
+    result = cmp == 0;
+    PER_UNUSE(bucket);
+
+Done:
+    Py_DECREF(bucket);
+    return result;
+}
+
 /*
   Set (value != 0) or delete (value=0) a tree item.
 
@@ -715,6 +942,7 @@ _BTree_set(BTree *self, PyObject *keyarg, PyObject *value,
     int childlength;    /* len(self->data[min].child) */
     int status;         /* our return value; and return value from callee */
     int self_was_empty; /* was self empty at entry? */
+    int counted;        /* is self a counted BTree? */
 
     KEY_TYPE key;
     int copied = 1;
@@ -735,7 +963,7 @@ _BTree_set(BTree *self, PyObject *keyarg, PyObject *value,
         /* We're empty.  Make room. */
         if (value)
         {
-            if (BTree_grow(self, 0, noval) < 0)
+            if (BTree_grow(self, 0, noval, 0) < 0)
                 goto Error;
         }
         else
@@ -761,6 +989,14 @@ _BTree_set(BTree *self, PyObject *keyarg, PyObject *value,
         int bucket_changed = 0;
         status = _bucket_set(BUCKET(d->child), keyarg,
                             value, unique, noval, &bucket_changed);
+        if (bucket_changed)
+        {
+            int packed = _BTree_packedState(self);
+            if (packed < 0)
+                goto Error;
+            if (packed)
+                BUCKET(d->child)->packed = 1;
+        }
 #ifdef PERSISTENT
         /* If a BTree contains only a single bucket, BTree.__getstate__()
         * includes the bucket's entire state, and the bucket doesn't get
@@ -782,6 +1018,19 @@ _BTree_set(BTree *self, PyObject *keyarg, PyObject *value,
         goto Error;
     assert(status == 1 || status == 2);
 
+    /* The number of keys under the child changed by one, and in a counted
+    * BTree we record that.
+    */
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        goto Error;
+    if (counted)
+    {
+        if (d->count >= 0)
+            d->count += value ? 1 : -1;
+        changed = 1;
+    }
+
     /* The child changed size.  Get its new size.  Note that since the tree
     * rooted at the child changed size, so did the tree rooted at self:
     * our status must be >= 1 too.
@@ -808,7 +1057,12 @@ _BTree_set(BTree *self, PyObject *keyarg, PyObject *value,
             toobig = childlength > max_size;
         }
         if (toobig) {
-            if (BTree_grow(self, min, noval) < 0)
+            int append = _BTree_appendOptimized(self);
+            if (append > 0)
+                append = _BTree_isRightEdge(self, d->child, key);
+            if (append < 0)
+                goto Error;
+            if (BTree_grow(self, min, noval, append) < 0)
                 goto Error;
             changed = 1;        /* BTree_grow mutated self */
         }
@@ -1111,13 +1365,38 @@ err:
  *     )
  *
  * In the above, key[i] means self->data[i].key, and similarly for child[i].
+ *
+ * A counted BTree adds a third element, a tuple of the children's counts
+ * (-1 for a count that isn't known):
+ *
+ *     (
+ *          (child[0], key[1], child[1], ..., key[len-1], child[len-1]),
+ *          self->firstbucket,
+ *          (count[0], count[1], ..., count[len-1])
+ *     )
+ *
+ * If the class sets packed_state and the keys are C numbers, the first
+ * element instead starts with the keys in the packed format described in
+ * BTreeModuleTemplate.c, followed by the children:
+ *
+ *     (
+ *          (b'<header><key[1] ... key[len-1]>', child[0], ..., child[len-1]),
+ *          self->firstbucket
+ *     )
  */
 static PyObject *
 BTree_getstate(BTree *self)
 {
     PyObject *r = NULL;
     PyObject *o;
-    int i, l;
+    int i, l, counted, packed;
+
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return NULL;
+    packed = _BTree_packedState(self);
+    if (packed < 0)
+        return NULL;
 
     UNLESS (PER_USE(self))
         return NULL;
@@ -1144,6 +1423,36 @@ BTree_getstate(BTree *self)
         }
         else
         {
+#ifdef KEY_PACK_CODE
+            if (packed)
+            {
+                char *data;
+
+                o = _packed_new(self->len - 1, 0, 0, &data);
+                if (o == NULL)
+                    goto err;
+                for (i = 1; i < self->len; i++)
+                {
+                    _packed_copy(data, (char *)&self->data[i].key,
+                                 sizeof(KEY_TYPE), 1);
+                    data += sizeof(KEY_TYPE);
+                }
+                ASSIGN(r, PyTuple_New(self->len + 1));
+                if (r == NULL)
+                {
+                    Py_DECREF(o);
+                    goto err;
+                }
+                PyTuple_SET_ITEM(r, 0, o);
+                for (i = 0; i < self->len; i++)
+                {
+                    o = (PyObject *)self->data[i].child;
+                    Py_INCREF(o);
+                    PyTuple_SET_ITEM(r, i + 1, o);
+                }
+            }
+            else
+#endif
             for (i=0, l=0; i < self->len; i++)
             {
                 if (i)
@@ -1157,7 +1466,25 @@ BTree_getstate(BTree *self)
                 PyTuple_SET_ITEM(r,l,o);
                 l++;
             }
-            ASSIGN(r, Py_BuildValue("OO", r, self->firstbucket));
+            if (counted)
+            {
+                PyObject *counts = PyTuple_New(self->len);
+                if (counts == NULL)
+                    goto err;
+                for (i = 0; i < self->len; i++)
+                {
+                    o = PyLong_FromSsize_t(self->data[i].count);
+                    if (o == NULL)
+                    {
+                        Py_DECREF(counts);
+                        goto err;
+                    }
+                    PyTuple_SET_ITEM(counts, i, o);
+                }
+                ASSIGN(r, Py_BuildValue("OON", r, self->firstbucket, counts));
+            }
+            else
+                ASSIGN(r, Py_BuildValue("OO", r, self->firstbucket));
         }
 
     }
@@ -1180,9 +1507,12 @@ err:
 static int
 _BTree_setstate(BTree *self, PyObject *state, int noval)
 {
-    PyObject *items, *firstbucket = NULL;
+    PyObject *items, *firstbucket = NULL, *counts = NULL;
     BTreeItem *d;
     int len, l, i, copied=1;
+#ifdef KEY_PACK_CODE
+    const char *packed_keys = NULL;
+#endif
     PyTypeObject *leaftype = (noval ? &SetType : &BucketType);
 
     if (_BTree_clear(self) < 0)
@@ -1192,13 +1522,15 @@ _BTree_setstate(BTree *self, PyObject *state, int noval)
         None -- an empty BTree
         A one-tuple -- a single bucket btree
         A two-tuple -- a BTree with more than one bucket
+        A three-tuple -- a counted BTree with more than one bucket
         See comments for BTree_getstate() for the details.
     */
 
     if (state == Py_None)
         return 0;
 
-    if (!PyArg_ParseTuple(state, "O|O:__setstate__", &items, &firstbucket))
+    if (!PyArg_ParseTuple(state, "O|OO:__setstate__",
+                          &items, &firstbucket, &counts))
         return -1;
 
     if (!PyTuple_Check(items))
@@ -1210,7 +1542,35 @@ _BTree_setstate(BTree *self, PyObject *state, int noval)
 
     len = PyTuple_Size(items);
     ASSERT(len >= 0, "_BTree_setstate: items tuple has negative size", -1);
-    len = (len + 1) / 2;
+    if (len > 1 && PyBytes_Check(PyTuple_GET_ITEM(items, 0)))
+    {
+        /* The keys are packed, and the children follow them. */
+#ifdef KEY_PACK_CODE
+        len--;
+        if (_packed_count(PyTuple_GET_ITEM(items, 0), 0, 0, &packed_keys)
+            != len - 1)
+        {
+            if (!PyErr_Occurred())
+                PyErr_SetString(PyExc_ValueError,
+                                "packed state has the wrong number of keys");
+            return -1;
+        }
+#else
+        PyErr_SetString(PyExc_TypeError,
+                        "packed state not supported for this tree type");
+        return -1;
+#endif
+    }
+    else
+        len = (len + 1) / 2;
+
+    if (counts && !(PyTuple_Check(counts) && PyTuple_GET_SIZE(counts) == len))
+    {
+        PyErr_SetString(PyExc_TypeError,
+                        "tuple of child counts required for third state "
+                        "element");
+        return -1;
+    }
 
     assert(len > 0); /* If the BTree is empty, it's state is None. */
     assert(self->size == 0); /* We called _BTree_clear(). */
@@ -1223,6 +1583,18 @@ _BTree_setstate(BTree *self, PyObject *state, int noval)
     for (i = 0, d = self->data, l = 0; i < len; i++, d++)
     {
         PyObject *v;
+#ifdef KEY_PACK_CODE
+        if (packed_keys)
+        {
+            if (i)
+            {
+                _packed_copy((char *)&d->key, packed_keys, sizeof(KEY_TYPE), 1);
+                packed_keys += sizeof(KEY_TYPE);
+            }
+            l = i + 1;
+        }
+        else
+#endif
         if (i)
         { /* skip the first key slot */
             COPY_KEY_FROM_ARG(d->key, PyTuple_GET_ITEM(items, l), copied);
@@ -1267,6 +1639,23 @@ _BTree_setstate(BTree *self, PyObject *state, int noval)
             Py_INCREF(v);
         }
         l++;
+
+        /* Counts missing from the state (say, because the class only
+         * recently became counted) are computed when they're needed.
+         */
+        d->count = -1;
+        if (counts)
+        {
+            d->count = PyLong_AsSsize_t(PyTuple_GET_ITEM(counts, i));
+            if (d->count < -1 || (d->count == -1 && PyErr_Occurred()))
+            {
+                if (!PyErr_Occurred())
+                    PyErr_SetString(PyExc_ValueError,
+                                    "negative child count in state");
+                self->len = i + 1;
+                return -1;
+            }
+        }
     }
 
     if (!firstbucket)
@@ -1336,9 +1725,9 @@ get_bucket_state(PyObject *t)
         return NULL;
     }
 
-    if (PyTuple_GET_SIZE(t) == 2)
+    if (PyTuple_GET_SIZE(t) == 2 || PyTuple_GET_SIZE(t) == 3)
     {
-        /* A non-degenerate BTree. */
+        /* A non-degenerate BTree, possibly with child counts. */
         return merge_error(-1, -1, -1, 11);
     }
 
@@ -1347,7 +1736,7 @@ get_bucket_state(PyObject *t)
     if (PyTuple_GET_SIZE(t) != 1)
     {
         PyErr_SetString(PyExc_TypeError,
-                        "_p_resolveConflict: expected 1- or 2-tuple for state");
+                        "_p_resolveConflict: expected 1-, 2- or 3-tuple for state");
         return NULL;
     }
 
@@ -1668,6 +2057,9 @@ BTree_maxKey(BTree *self, PyObject *args)
     return BTree_maxminKey(self, args, 0);
 }
 
+static int
+_BTree_rankOfEntry(BTree *self, Bucket *b, int offset, Py_ssize_t *rank);
+
 /*
 ** BTree_rangeSearch
 **
@@ -1687,6 +2079,9 @@ BTree_rangeSearch(BTree *self, PyObject *args, PyObject *kw, char type)
     Bucket *highbucket = NULL;
     int lowoffset;
     int highoffset;
+    int counted;
+    Py_ssize_t firstrank = 0;
+    Py_ssize_t lastrank = -1;
     PyObject *result;
 
     if (args)
@@ -1834,11 +2229,30 @@ BTree_rangeSearch(BTree *self, PyObject *args, PyObject *kw, char type)
                 goto empty_and_decref_buckets;
     }
 
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        goto err_and_decref_buckets;
+    if (counted)
+    {
+        /* Remember where the range lies, for positional access. */
+        if (_BTree_rankOfEntry(self, lowbucket, lowoffset, &firstrank) < 0)
+            goto err_and_decref_buckets;
+        if (_BTree_rankOfEntry(self, highbucket, highoffset, &lastrank) < 0)
+            goto err_and_decref_buckets;
+    }
+
     PER_UNUSE(self);
 
     result = newBTreeItems(type, lowbucket, lowoffset, highbucket, highoffset);
     Py_DECREF(lowbucket);
     Py_DECREF(highbucket);
+    if (result && counted)
+    {
+        Py_INCREF(self);
+        ITEMS(result)->tree = self;
+        ITEMS(result)->firstrank = firstrank;
+        ITEMS(result)->length = lastrank + 1 - firstrank;
+    }
     return result;
 
 err_and_decref_buckets:
@@ -1966,6 +2380,64 @@ err:
     return NULL;
 }
 
+/* nlargest(k) and nsmallest(k): the k items with the largest (smallest)
+ * values, as (value, key) pairs, best first.  The buckets are visited in
+ * turn, keeping only the best k items seen so far.
+ */
+static PyObject *
+_BTree_nbest(BTree *self, PyObject *args, int sign, char *format)
+{
+    Py_ssize_t k;
+    Bucket *store, *b, *next;
+    TopK t;
+    PyObject *r = NULL;
+
+    UNLESS (PyArg_ParseTuple(args, format, &k))
+        return NULL;
+    if (k <= 0)
+        return PyList_New(0);
+
+    PER_USE_OR_RETURN(self, NULL);
+    b = self->firstbucket;
+    PER_UNUSE(self);
+
+    UNLESS (store = BUCKET(PyObject_CallObject(OBJECT(&BucketType), NULL)))
+        return NULL;
+    _topkInit(&t, k, sign);
+
+    while (b)
+    {
+        UNLESS (PER_USE(b))
+            goto done;
+        if (_bucket_topk(b, store, &t) < 0)
+        {
+            PER_UNUSE(b);
+            goto done;
+        }
+        next = b->next;
+        PER_UNUSE(b);
+        b = next;
+    }
+    r = _topkList(store, &t);
+
+done:
+    _topkFini(&t);
+    Py_DECREF(store);
+    return r;
+}
+
+static PyObject *
+BTree_nlargest(BTree *self, PyObject *args)
+{
+    return _BTree_nbest(self, args, 1, "n:nlargest");
+}
+
+static PyObject *
+BTree_nsmallest(BTree *self, PyObject *args)
+{
+    return _BTree_nbest(self, args, -1, "n:nsmallest");
+}
+
 /*
 ** BTree_getm
 */
@@ -2140,46 +2612,2590 @@ BTree_has_key(BTree *self, PyObject *key)
     Py_RETURN_FALSE;
 }
 
-
-static PyObject *
-BTree_addUnique(BTree *self, PyObject *args)
-{
-    int grew;
-    PyObject *key, *v;
-
-    UNLESS (PyArg_ParseTuple(args, "OO", &key, &v))
-        return NULL;
-
-    if ((grew=_BTree_set(self, key, v, 1, 0)) < 0)
-        return NULL;
-    return PyLong_FromLong(grew);
-}
-
 /**************************************************************************/
-/* Iterator support. */
+/* Batched lookups. */
 
-/* A helper to build all the iterators for BTrees and TreeSets.
- * If args is NULL, the iterator spans the entire structure.  Else it's an
- * argument tuple, with optional low and high arguments.
- * kind is 'k', 'v' or 'i'.
- * Returns a BTreeIter object, or NULL if error.
+/* Sort order[0:n] so that keys[order[0]], keys[order[1]], ... ascend.  tmp
+ * must have room for n indexes.  Probes often arrive sorted already, so
+ * check that first; otherwise do a bottom-up merge sort.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
  */
-static PyObject *
-buildBTreeIter(BTree *self, PyObject *args, PyObject *kw, char kind)
+static int
+_BTree_sortProbes(KEY_TYPE *keys, Py_ssize_t *order, Py_ssize_t *tmp,
+                  Py_ssize_t n)
 {
-    BTreeIter *result = NULL;
-    BTreeItems *items = (BTreeItems *)BTree_rangeSearch(self, args, kw, kind);
+    Py_ssize_t *src = order, *dst = tmp, *swap;
+    Py_ssize_t i, width, lo, mid, hi, a, b;
+    int cmp;
 
-    if (items)
+    for (i = 1; i < n; i++)
     {
-        result = BTreeIter_new(items);
-        Py_DECREF(items);
+        TEST_KEY_SET_OR(cmp, keys[order[i - 1]], keys[order[i]])
+            return -1;
+        if (cmp > 0)
+            break;
     }
-    return (PyObject *)result;
-}
+    if (i >= n)
+        return 0;
 
-/* The implementation of iter(BTree_or_TreeSet); the BTree tp_iter slot. */
-static PyObject *
+    for (width = 1; width < n; width *= 2)
+    {
+        for (lo = 0; lo < n; lo += 2 * width)
+        {
+            mid = lo + width < n ? lo + width : n;
+            hi = mid + width < n ? mid + width : n;
+            a = lo;
+            b = mid;
+            i = lo;
+            while (a < mid && b < hi)
+            {
+                TEST_KEY_SET_OR(cmp, keys[src[b]], keys[src[a]])
+                    return -1;
+                dst[i++] = cmp < 0 ? src[b++] : src[a++];
+            }
+            while (a < mid)
+                dst[i++] = src[a++];
+            while (b < hi)
+                dst[i++] = src[b++];
+        }
+        swap = src;
+        src = dst;
+        dst = swap;
+    }
+    if (src != order)
+        memcpy(order, src, n * sizeof(Py_ssize_t));
+    return 0;
+}
+
+/* Return a new reference to the bucket of the non-empty BTree self that
+ * would hold key, or NULL on error.
+ */
+static Bucket *
+_BTree_findBucket(BTree *self, KEY_TYPE key)
+{
+    Sized *child;
+    int i;
+
+    PER_USE_OR_RETURN(self, NULL);
+    for (;;)
+    {
+        BTREE_SEARCH(i, self, key, goto Error);
+        child = self->data[i].child;
+        if (! SameType_Check(self, child))
+            break;
+        PER_UNUSE(self);
+        self = BTREE(child);
+        PER_USE_OR_RETURN(self, NULL);
+    }
+    Py_INCREF(child);
+    PER_UNUSE(self);
+    return BUCKET(child);
+
+Error:
+    PER_UNUSE(self);
+    return NULL;
+}
+
+/* Look up every key in the iterable keyargs.  Return a list, in the order
+ * of keyargs, of True or False if has_key is true, else of the values
+ * found (dflt for a missing key).  As with get() and has_key(), a key
+ * of the wrong type is simply missing.
+ *
+ * The probes are sorted and answered in one sweep from left to right:
+ * a bucket stays activated for as long as the probes fall inside it, the
+ * next probe moves on to the following bucket when it can, and only
+ * probes that skip buckets search again from the root.
+ */
+static PyObject *
+_BTree_getMany(BTree *self, PyObject *keyargs, PyObject *dflt, int has_key)
+{
+    PyObject *seq, *result = NULL, *o;
+    PyObject **items;
+    KEY_TYPE *keys = NULL;
+    Py_ssize_t *order = NULL;
+    Bucket *bucket = NULL, *next;
+    Py_ssize_t n, m, i, j;
+    int copied, cmp, offset, empty;
+
+    seq = PySequence_Fast(keyargs, "expected an iterable of keys");
+    if (seq == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+    items = PySequence_Fast_ITEMS(seq);
+
+    UNLESS (result = PyList_New(n))
+        goto err;
+    o = has_key ? Py_False : dflt;
+    for (i = 0; i < n; i++)
+    {
+        Py_INCREF(o);
+        PyList_SET_ITEM(result, i, o);
+    }
+
+    keys = PyMem_Malloc(sizeof(KEY_TYPE) * (n ? n : 1));
+    order = PyMem_Malloc(sizeof(Py_ssize_t) * (n ? 2 * n : 1));
+    if (keys == NULL || order == NULL)
+    {
+        PyErr_NoMemory();
+        goto err;
+    }
+
+    /* Convert the keys; order lists the ones worth looking up. */
+    m = 0;
+    for (i = 0; i < n; i++)
+    {
+        copied = 1;
+        COPY_KEY_FROM_ARG(keys[i], items[i], copied);
+        UNLESS (copied)
+        {
+            if (! PyErr_ExceptionMatches(PyExc_TypeError))
+                goto err;
+            PyErr_Clear();
+            continue;
+        }
+        order[m++] = i;
+    }
+    if (_BTree_sortProbes(keys, order, order + n, m) < 0)
+        goto err;
+
+    UNLESS (PER_USE(self))
+        goto err;
+    empty = self->len == 0;
+    PER_UNUSE(self);
+    if (empty)
+        m = 0;
+
+    for (j = 0; j < m; j++)
+    {
+        i = order[j];
+        if (bucket != NULL)
+        {
+            TEST_KEY_SET_OR(cmp, keys[i], bucket->keys[bucket->len - 1])
+                goto err;
+            if (cmp > 0)
+            {
+                /* Past the end of this bucket.  Try the next one. */
+                next = bucket->next;
+                Py_XINCREF(next);
+                PER_UNUSE(bucket);
+                Py_DECREF(bucket);
+                bucket = next;
+                if (bucket != NULL)
+                {
+                    UNLESS (PER_USE(bucket))
+                    {
+                        Py_DECREF(bucket);
+                        bucket = NULL;
+                        goto err;
+                    }
+                    TEST_KEY_SET_OR(cmp, keys[i],
+                                    bucket->keys[bucket->len - 1])
+                        goto err;
+                    if (cmp > 0)
+                    {
+                        PER_UNUSE(bucket);
+                        Py_DECREF(bucket);
+                        bucket = NULL;
+                    }
+                }
+            }
+        }
+        if (bucket == NULL)
+        {
+            UNLESS (bucket = _BTree_findBucket(self, keys[i]))
+                goto err;
+            UNLESS (PER_USE(bucket))
+            {
+                Py_DECREF(bucket);
+                bucket = NULL;
+                goto err;
+            }
+        }
+
+        BUCKET_SEARCH(offset, cmp, bucket, keys[i], goto err);
+        if (cmp == 0)
+        {
+            if (has_key)
+            {
+                o = Py_True;
+                Py_INCREF(o);
+            }
+            else
+            {
+                COPY_VALUE_TO_OBJECT(o, bucket->values[offset]);
+                if (o == NULL)
+                    goto err;
+            }
+            PyList_SetItem(result, i, o);
+        }
+    }
+
+    if (bucket != NULL)
+    {
+        PER_UNUSE(bucket);
+        Py_DECREF(bucket);
+    }
+    PyMem_Free(keys);
+    PyMem_Free(order);
+    Py_DECREF(seq);
+    return result;
+
+err:
+    if (bucket != NULL)
+    {
+        PER_UNUSE(bucket);
+        Py_DECREF(bucket);
+    }
+    PyMem_Free(keys);
+    PyMem_Free(order);
+    Py_DECREF(seq);
+    Py_XDECREF(result);
+    return NULL;
+}
+
+static PyObject *
+BTree_getMany(BTree *self, PyObject *args, PyObject *kw)
+{
+    PyObject *keys;
+    PyObject *d = Py_None;
+    static char *kwlist[] = {"keys", "default", NULL};
+
+    if (! PyArg_ParseTupleAndKeywords(args, kw, "O|O:getMany", kwlist,
+                                      &keys, &d))
+        return NULL;
+    return _BTree_getMany(self, keys, d, 0);
+}
+
+static PyObject *
+BTree_containsMany(BTree *self, PyObject *keys)
+{
+    return _BTree_getMany(self, keys, NULL, 1);
+}
+
+static PyObject *
+BTree_addUnique(BTree *self, PyObject *args)
+{
+    int grew;
+    PyObject *key, *v;
+
+    UNLESS (PyArg_ParseTuple(args, "OO", &key, &v))
+        return NULL;
+
+    if ((grew=_BTree_set(self, key, v, 1, 0)) < 0)
+        return NULL;
+    return PyLong_FromLong(grew);
+}
+
+/**************************************************************************/
+/* Positional access. */
+
+/* Add to *rank the number of keys in self that are less than key.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_rank(BTree *self, KEY_TYPE key, Py_ssize_t *rank)
+{
+    Sized *child;
+    int i, min, result = -1;
+
+    PER_USE_OR_RETURN(self, -1);
+    if (self->len == 0)
+    {
+        result = 0;
+        goto Done;
+    }
+
+    BTREE_SEARCH(min, self, key, goto Done);
+    for (i = 0; i < min; i++)
+    {
+        Py_ssize_t count = _BTree_childCount(self, i);
+        if (count < 0)
+            goto Done;
+        *rank += count;
+    }
+
+    child = self->data[min].child;
+    if (SameType_Check(self, child))
+        result = _BTree_rank(BTREE(child), key, rank);
+    else
+    {
+        int cmp;
+
+        UNLESS (PER_USE(child))
+            goto Done;
+        BUCKET_SEARCH(i, cmp, BUCKET(child), key, goto BucketDone);
+        /* Whether or not key is present, i keys precede it. */
+        (void)cmp;
+        *rank += i;
+        result = 0;
+BucketDone:
+        PER_UNUSE(child);
+    }
+
+Done:
+    PER_UNUSE(self);
+    return result;
+}
+
+/* Find the entry at position pos (0 <= pos < len(self)).  Set *bucket to
+ * a new reference to the bucket holding it, and *offset to its offset in
+ * that bucket.
+ *
+ * Return:
+ *    -1    error (IndexError if pos is out of range)
+ *     0    OK
+ */
+static int
+_BTree_seekPosition(BTree *self, Py_ssize_t pos, Bucket **bucket, int *offset)
+{
+    Sized *child;
+    int i, result;
+
+    PER_USE_OR_RETURN(self, -1);
+    for (i = 0; i < self->len; i++)
+    {
+        Py_ssize_t count = _BTree_childCount(self, i);
+        if (count < 0)
+        {
+            PER_UNUSE(self);
+            return -1;
+        }
+        if (pos < count)
+            break;
+        pos -= count;
+    }
+    if (pos < 0 || i == self->len)
+    {
+        PER_UNUSE(self);
+        PyErr_SetString(PyExc_IndexError, "position out of range");
+        return -1;
+    }
+
+    child = self->data[i].child;
+    Py_INCREF(child);
+    PER_UNUSE(self);
+
+    if (SameType_Check(self, child))
+    {
+        result = _BTree_seekPosition(BTREE(child), pos, bucket, offset);
+        Py_DECREF(child);
+        return result;
+    }
+    *bucket = BUCKET(child);
+    *offset = (int)pos;
+    return 0;
+}
+
+/* Set *rank to the position of the entry at offset in bucket b, which must
+ * be a bucket of self.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_rankOfEntry(BTree *self, Bucket *b, int offset, Py_ssize_t *rank)
+{
+    KEY_TYPE key;
+    int result;
+
+    PER_USE_OR_RETURN(b, -1);
+    COPY_KEY(key, b->keys[offset]);
+    INCREF_KEY(key);
+    PER_UNUSE(b);
+
+    *rank = 0;
+    result = _BTree_rank(self, key, rank);
+    DECREF_KEY(key);
+    return result;
+}
+
+static PyObject *
+BTree_rank(BTree *self, PyObject *keyarg)
+{
+    KEY_TYPE key;
+    Py_ssize_t rank = 0;
+    int copied = 1;
+
+    COPY_KEY_FROM_ARG(key, keyarg, copied);
+    UNLESS (copied)
+        return NULL;
+
+    if (_BTree_rank(self, key, &rank) < 0)
+        return NULL;
+    return PyLong_FromSsize_t(rank);
+}
+
+static PyObject *
+BTree_keyAt(BTree *self, PyObject *index)
+{
+    Py_ssize_t i, len;
+    Bucket *bucket;
+    int offset;
+    PyObject *result;
+
+    i = PyNumber_AsSsize_t(index, PyExc_IndexError);
+    if (i == -1 && PyErr_Occurred())
+        return NULL;
+
+    if (i < 0)
+    {
+        len = BTree_length_or_nonzero(self, 0);
+        if (len < 0)
+            return NULL;
+        i += len;
+        if (i < 0)
+        {
+            PyErr_SetString(PyExc_IndexError, "position out of range");
+            return NULL;
+        }
+    }
+
+    if (_BTree_seekPosition(self, i, &bucket, &offset) < 0)
+        return NULL;
+
+    result = NULL;
+    if (PER_USE(bucket))
+    {
+        COPY_KEY_TO_OBJECT(result, bucket->keys[offset]);
+        PER_UNUSE(bucket);
+    }
+    Py_DECREF(bucket);
+    return result;
+}
+
+/**************************************************************************/
+/* Range deletion. */
+
+/* The keys a deleteRange() call removes. */
+typedef struct {
+    KEY_TYPE lo;
+    KEY_TYPE hi;
+    int has_lo;     /* false if there's no lower bound */
+    int has_hi;     /* false if there's no upper bound */
+    int excl_lo;    /* is lo itself left alone? */
+    int excl_hi;    /* is hi itself left alone? */
+} KeyRange;
+
+/* Set *first and *end to the offsets in bucket self, which must be
+ * activated, of the first key within r and of the first key after it.
+ * An empty range may leave *end less than *first.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_bucketRange(Bucket *self, KeyRange *r, int *first, int *end)
+{
+    int cmp;
+
+    *first = 0;
+    *end = self->len;
+    if (r->has_lo)
+    {
+        BUCKET_SEARCH(*first, cmp, self, r->lo, return -1);
+        if (cmp == 0 && r->excl_lo)
+            (*first)++;
+    }
+    if (r->has_hi)
+    {
+        BUCKET_SEARCH(*end, cmp, self, r->hi, return -1);
+        if (cmp == 0 && !r->excl_hi)
+            (*end)++;
+    }
+    return 0;
+}
+
+/* Remove the keys within r from bucket self, which must be activated.
+ * Set *removed to how many there were.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_trimBucket(Bucket *self, KeyRange *r, Py_ssize_t *removed)
+{
+    int first, end, i;
+
+    *removed = 0;
+    if (_BTree_bucketRange(self, r, &first, &end) < 0)
+        return -1;
+    if (end <= first)
+        return 0;
+    if (_bucket_own(self) < 0)
+        return -1;
+
+    for (i = first; i < end; i++)
+    {
+        DECREF_KEY(self->keys[i]);
+        if (self->values)
+        {
+            DECREF_VALUE(self->values[i]);
+        }
+    }
+    if (end < self->len)
+    {
+        memmove(self->keys + first, self->keys + end,
+                sizeof(KEY_TYPE) * (self->len - end));
+        if (self->values)
+            memmove(self->values + first, self->values + end,
+                    sizeof(VALUE_TYPE) * (self->len - end));
+    }
+    self->len -= end - first;
+    *removed = end - first;
+    return PER_CHANGED(self) < 0 ? -1 : 0;
+}
+
+static int
+_BTree_deleteRange(BTree *self, KeyRange *r, Py_ssize_t *removed);
+
+/* Remove the keys within r from self->data[i].child, a child of the
+ * activated BTree node self.  Add how many there were to *removed, unless
+ * that's -1 (unknown) already.  Set *changed if self must be saved.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_trimChild(BTree *self, int i, KeyRange *r, Py_ssize_t *removed,
+                 int *changed)
+{
+    Sized *child = self->data[i].child;
+    Py_ssize_t count;
+    int counted, status;
+
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return -1;
+
+    if (SameType_Check(self, child))
+        status = _BTree_deleteRange(BTREE(child), r, &count);
+    else
+    {
+        PER_USE_OR_RETURN(child, -1);
+        status = _BTree_trimBucket(BUCKET(child), r, &count);
+        PER_UNUSE(child);
+#ifdef PERSISTENT
+        /* See _BTree_set about a BTree's only, oid-less, bucket. */
+        if (count && self->len == 1 && child->oid == NULL)
+            *changed = 1;
+#endif
+    }
+    if (status < 0)
+        return -1;
+
+    if (counted && count)
+    {
+        if (count < 0 || self->data[i].count < 0)
+            self->data[i].count = -1;
+        else
+            self->data[i].count -= count;
+        *changed = 1;
+    }
+    if (*removed >= 0)
+        *removed = count < 0 ? -1 : *removed + count;
+    return 0;
+}
+
+/* Remove the keys within r from the BTree node self.  Only the (at most
+ * two) children that straddle an end of the range are searched; the
+ * children between them hold nothing but keys in the range, and are
+ * dropped without being activated.  Set *removed to how many keys went
+ * away, or to -1 if that isn't known (which is always the case in an
+ * uncounted BTree).
+ *
+ * Buckets that go away are not unlinked from the bucket chain here:
+ * BTree_deleteRange() does that once for the whole tree.  Each node's
+ * firstbucket is kept up to date, though.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_deleteRange(BTree *self, KeyRange *r, Py_ssize_t *removed)
+{
+    int first, last, i, j, keep, counted;
+    int changed = 0;
+    int result = -1;
+    Sized *child;
+#ifdef KEY_TYPE_IS_PYOBJECT
+    int first_went = 0;
+#endif
+    Bucket *firstbucket;
+
+    *removed = 0;
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return -1;
+
+    PER_USE_OR_RETURN(self, -1);
+    if (self->len == 0)
+    {
+        result = 0;
+        goto Done;
+    }
+
+#ifdef PERSISTENT
+    PER_READCURRENT(self, goto Done);
+#endif
+
+    first = 0;
+    last = self->len - 1;
+    if (r->has_lo)
+        BTREE_SEARCH(first, self, r->lo, goto Done);
+    if (r->has_hi)
+        BTREE_SEARCH(last, self, r->hi, goto Done);
+
+    /* Trim the children at the ends of the range. */
+    if (_BTree_trimChild(self, first, r, removed, &changed) < 0)
+        goto Done;
+    if (last != first && _BTree_trimChild(self, last, r, removed, &changed) < 0)
+        goto Done;
+
+    /* Drop the children in between, and those trimmed down to nothing. */
+    j = first;
+    for (i = first; i <= last; i++)
+    {
+        BTreeItem *d = self->data + i;
+
+        keep = 0;
+        if (i == first || i == last)
+        {
+            UNLESS (PER_USE(d->child))
+                goto Done;
+            keep = d->child->len > 0;
+            PER_UNUSE(d->child);
+        }
+        else if (*removed >= 0)
+            *removed = counted && d->count >= 0 ? *removed + d->count : -1;
+
+        if (keep)
+        {
+            if (j < i)
+                self->data[j] = *d;
+            j++;
+            continue;
+        }
+        Py_DECREF(d->child);
+#ifdef KEY_TYPE_IS_PYOBJECT
+        if (i > 0)
+        {
+            DECREF_KEY(d->key);
+        }
+        else
+            first_went = 1;
+#endif
+        changed = 1;
+    }
+    if (j <= last)
+    {
+        memmove(self->data + j, self->data + last + 1,
+                sizeof(BTreeItem) * (self->len - last - 1));
+        self->len -= last + 1 - j;
+    }
+#ifdef KEY_TYPE_IS_PYOBJECT
+    /* If our first child went, the key of the child that moved into slot
+     * 0, whether the trimmed last child or one past the range, is trash.
+     */
+    if (first_went && self->len > 0)
+    {
+        DECREF_KEY(self->data[0].key);
+    }
+#endif
+
+    if (first == 0)
+    {
+        /* Our first bucket may have gone. */
+        firstbucket = NULL;
+        if (self->len)
+        {
+            child = self->data[0].child;
+            if (SameType_Check(self, child))
+            {
+                UNLESS (PER_USE(child))
+                    goto Done;
+                firstbucket = BTREE(child)->firstbucket;
+                PER_UNUSE(child);
+            }
+            else
+                firstbucket = BUCKET(child);
+        }
+        if (firstbucket != self->firstbucket)
+        {
+            Py_XINCREF(firstbucket);
+            Py_XDECREF(self->firstbucket);
+            self->firstbucket = firstbucket;
+            changed = 1;
+        }
+    }
+    result = 0;
+
+Done:
+    if (changed && PER_CHANGED(self) < 0)
+        result = -1;
+    PER_UNUSE(self);
+    return result;
+}
+
+/* As with keys(), excluding a missing end of a range leaves out the
+ * smallest or largest key.  So if *min is None and excludemin is true,
+ * replace it with the smallest key in self, storing the new reference in
+ * *minkey for the caller to release; likewise *max and *maxkey.  If self
+ * is empty, nothing is replaced.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_rangeBounds(BTree *self, PyObject **min, PyObject **max,
+                   int excludemin, int excludemax,
+                   PyObject **minkey, PyObject **maxkey)
+{
+    PyObject *noargs;
+    int status;
+
+    *minkey = *maxkey = NULL;
+    if (! ((*min == Py_None && excludemin) || (*max == Py_None && excludemax)))
+        return 0;
+
+    status = BTree_length_or_nonzero(self, 1);
+    if (status <= 0)
+        return status;
+    UNLESS (noargs = PyTuple_New(0))
+        return -1;
+    if (*min == Py_None && excludemin)
+    {
+        UNLESS (*minkey = BTree_maxminKey(self, noargs, 1))
+            goto err;
+        *min = *minkey;
+    }
+    if (*max == Py_None && excludemax)
+    {
+        UNLESS (*maxkey = BTree_maxminKey(self, noargs, 0))
+            goto err;
+        *max = *maxkey;
+    }
+    Py_DECREF(noargs);
+    return 0;
+
+err:
+    Py_DECREF(noargs);
+    Py_CLEAR(*minkey);
+    return -1;
+}
+
+/* Remove the keys from min to max (None for no bound) from the BTree
+ * self, unlinking the buckets that go away.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_deleteBetween(BTree *self, PyObject *min, PyObject *max,
+                     int excludemin, int excludemax)
+{
+    KeyRange r;
+    Bucket *before = NULL;  /* the bucket holding the last key before r */
+    Bucket *after = NULL;   /* the bucket holding the first key after r */
+    Bucket *b;
+    PyObject *doomed = NULL;
+    Py_ssize_t removed, i;
+    int copied = 1;
+    int offset, cmp;
+
+    r.has_lo = min != Py_None;
+    r.has_hi = max != Py_None;
+    r.excl_lo = excludemin;
+    r.excl_hi = excludemax;
+    if (r.has_lo)
+    {
+        COPY_KEY_FROM_ARG(r.lo, min, copied);
+        UNLESS (copied)
+            return -1;
+    }
+    if (r.has_hi)
+    {
+        COPY_KEY_FROM_ARG(r.hi, max, copied);
+        UNLESS (copied)
+            return -1;
+    }
+    if (r.has_lo && r.has_hi)
+    {
+        TEST_KEY_SET_OR(cmp, r.lo, r.hi)
+            return -1;
+        if (cmp > 0 || (cmp == 0 && (excludemin || excludemax)))
+            return 0;   /* an empty range */
+    }
+
+    PER_USE_OR_RETURN(self, -1);
+
+    /* Find the buckets on either side of the range, which must end up
+     * linked to each other.
+     */
+    if (r.has_lo && BTree_findRangeEnd(self, min, 0, !excludemin,
+                                       &before, &offset) < 0)
+        goto err;
+    if (r.has_hi && BTree_findRangeEnd(self, max, 1, !excludemax,
+                                       &after, &offset) < 0)
+        goto err;
+
+    /* Hold references to the doomed buckets that are in memory.  Whole
+     * runs of buckets are about to be unlinked at once, and letting go
+     * of them front to back below avoids a deep chain of deallocations.
+     * Ghosts end the walk, since they don't reference their successors.
+     * If the range lies within a single bucket, nothing is unlinked.
+     */
+    UNLESS (doomed = PyList_New(0))
+        goto err;
+    if (before == NULL)
+        b = self->firstbucket;
+    else if (before == after)
+        b = NULL;
+    else
+    {
+        UNLESS (PER_USE(before))
+            goto err;
+        b = before->next;
+        PER_UNUSE(before);
+    }
+    while (b != NULL && b != after)
+    {
+#ifdef PERSISTENT
+        if (b->state == cPersistent_GHOST_STATE)
+            break;
+#endif
+        if (PyList_Append(doomed, OBJECT(b)) < 0)
+            goto err;
+        b = b->next;
+    }
+
+    if (_BTree_deleteRange(self, &r, &removed) < 0)
+        goto err;
+
+    if (before && before != after)
+    {
+        UNLESS (PER_USE(before))
+            goto err;
+        if (before->next != after)
+        {
+            Py_XINCREF(after);
+            Py_XDECREF(before->next);
+            before->next = after;
+            if (PER_CHANGED(before) < 0)
+            {
+                PER_UNUSE(before);
+                goto err;
+            }
+        }
+        PER_UNUSE(before);
+    }
+
+    for (i = 0; i < PyList_GET_SIZE(doomed); i++)
+    {
+        Py_INCREF(Py_None);
+        PyList_SetItem(doomed, i, Py_None);
+    }
+
+    PER_UNUSE(self);
+    Py_XDECREF(before);
+    Py_XDECREF(after);
+    Py_DECREF(doomed);
+    return 0;
+
+err:
+    PER_UNUSE(self);
+    Py_XDECREF(before);
+    Py_XDECREF(after);
+    Py_XDECREF(doomed);
+    return -1;
+}
+
+static PyObject *
+BTree_deleteRange(BTree *self, PyObject *args, PyObject *kw)
+{
+    PyObject *min = Py_None;
+    PyObject *max = Py_None;
+    PyObject *minkey = NULL;
+    PyObject *maxkey = NULL;
+    int excludemin = 0;
+    int excludemax = 0;
+    int status;
+
+    if (! PyArg_ParseTupleAndKeywords(args, kw, "|OOii", search_keywords,
+                                      &min, &max, &excludemin, &excludemax))
+        return NULL;
+    if (_BTree_rangeBounds(self, &min, &max, excludemin, excludemax,
+                           &minkey, &maxkey) < 0)
+        return NULL;
+
+    status = _BTree_deleteBetween(self, min, max, excludemin, excludemax);
+    Py_XDECREF(minkey);
+    Py_XDECREF(maxkey);
+    if (status < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+/**************************************************************************/
+/* Range counting. */
+
+/* Add to *count the number of keys within r reachable from self, which
+ * must be activated.  Only the (at most two) children straddling an end
+ * of the range are searched; those in between are wholly inside it, and
+ * contribute their counts (in an uncounted BTree, the lengths of their
+ * buckets).
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_countRange(BTree *self, KeyRange *r, Py_ssize_t *count)
+{
+    Sized *child;
+    Py_ssize_t n;
+    int first, last, i, lo, hi, status;
+
+    if (self->len == 0)
+        return 0;
+
+    first = 0;
+    last = self->len - 1;
+    if (r->has_lo)
+        BTREE_SEARCH(first, self, r->lo, return -1);
+    if (r->has_hi)
+        BTREE_SEARCH(last, self, r->hi, return -1);
+
+    for (i = first; i <= last; i++)
+    {
+        if (i != first && i != last)
+        {
+            n = _BTree_childCount(self, i);
+            if (n < 0)
+                return -1;
+            *count += n;
+            continue;
+        }
+
+        child = self->data[i].child;
+        PER_USE_OR_RETURN(child, -1);
+        if (SameType_Check(self, child))
+            status = _BTree_countRange(BTREE(child), r, count);
+        else
+        {
+            status = _BTree_bucketRange(BUCKET(child), r, &lo, &hi);
+            if (status >= 0 && hi > lo)
+                *count += hi - lo;
+        }
+        PER_UNUSE(child);
+        if (status < 0)
+            return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+BTree_count(BTree *self, PyObject *args, PyObject *kw)
+{
+    PyObject *min = Py_None;
+    PyObject *max = Py_None;
+    PyObject *minkey = NULL;
+    PyObject *maxkey = NULL;
+    PyObject *result = NULL;
+    KeyRange r;
+    Py_ssize_t count = 0;
+    int excludemin = 0;
+    int excludemax = 0;
+    int copied = 1;
+    int cmp, status;
+
+    if (! PyArg_ParseTupleAndKeywords(args, kw, "|OOii", search_keywords,
+                                      &min, &max, &excludemin, &excludemax))
+        return NULL;
+    if (_BTree_rangeBounds(self, &min, &max, excludemin, excludemax,
+                           &minkey, &maxkey) < 0)
+        return NULL;
+
+    r.has_lo = min != Py_None;
+    r.has_hi = max != Py_None;
+    r.excl_lo = excludemin;
+    r.excl_hi = excludemax;
+    if (r.has_lo)
+    {
+        COPY_KEY_FROM_ARG(r.lo, min, copied);
+        UNLESS (copied)
+            goto Done;
+    }
+    if (r.has_hi)
+    {
+        COPY_KEY_FROM_ARG(r.hi, max, copied);
+        UNLESS (copied)
+            goto Done;
+    }
+    if (r.has_lo && r.has_hi)
+    {
+        TEST_KEY_SET_OR(cmp, r.lo, r.hi)
+            goto Done;
+        if (cmp > 0 || (cmp == 0 && (excludemin || excludemax)))
+        {
+            result = PyLong_FromLong(0);
+            goto Done;
+        }
+    }
+
+    UNLESS (PER_USE(self))
+        goto Done;
+    status = _BTree_countRange(self, &r, &count);
+    PER_UNUSE(self);
+    if (status >= 0)
+        result = PyLong_FromSsize_t(count);
+
+Done:
+    Py_XDECREF(minkey);
+    Py_XDECREF(maxkey);
+    return result;
+}
+
+#ifdef KEY_PACK_CODE
+/* Return a new array.array of n items of the given struct code, and set
+ * *data to where they're stored.  The caller fills them in before anyone
+ * else sees the array.
+ */
+static PyObject *
+_BTree_newArray(char code, Py_ssize_t n, char **data)
+{
+    PyObject *one, *result;
+    Py_buffer view;
+
+    one = PyObject_CallFunction(ArrayType, "C[i]", code, 0);
+    if (one == NULL)
+        return NULL;
+    result = PySequence_Repeat(one, n);
+    Py_DECREF(one);
+    if (result == NULL)
+        return NULL;
+    if (PyObject_GetBuffer(result, &view, PyBUF_WRITABLE) < 0)
+    {
+        Py_DECREF(result);
+        return NULL;
+    }
+    *data = view.buf;
+    PyBuffer_Release(&view);
+    return result;
+}
+
+/* Return a (keys, values) tuple of arrays holding the items keys() would
+ * return for the same range arguments.  values is None for a TreeSet.
+ * The buckets of the range are visited twice, to count their items and
+ * then to copy them a bucket at a time.
+ */
+static PyObject *
+_BTree_toArrays(BTree *self, PyObject *args, PyObject *kw, int noval)
+{
+    BTreeItems *items;
+    Bucket *b, *next;
+    PyObject *keys = NULL, *values = NULL, *result = NULL;
+    char *kdata = NULL, *vdata = NULL;
+    Py_ssize_t n = 0, i;
+    int pass, lo, hi;
+
+#ifndef VALUE_PACK_CODE
+    if (!noval)
+    {
+        PyErr_SetString(PyExc_TypeError,
+                        "only values that are C numbers can be copied "
+                        "to an array");
+        return NULL;
+    }
+#endif
+
+    items = (BTreeItems *)BTree_rangeSearch(self, args, kw, 'k');
+    if (items == NULL)
+        return NULL;
+
+    for (pass = 0; pass < 2; pass++)
+    {
+        if (pass)
+        {
+            keys = _BTree_newArray(KEY_PACK_CODE, n, &kdata);
+            if (keys == NULL)
+                goto Done;
+#ifdef VALUE_PACK_CODE
+            if (!noval)
+            {
+                values = _BTree_newArray(VALUE_PACK_CODE, n, &vdata);
+                if (values == NULL)
+                    goto Done;
+            }
+#endif
+        }
+        i = 0;
+        for (b = items->firstbucket; b != NULL; b = next)
+        {
+            UNLESS (PER_USE(b))
+                goto Done;
+            lo = b == items->firstbucket ? items->first : 0;
+            hi = b == items->lastbucket ? items->last + 1 : b->len;
+            if (pass && hi > lo)
+            {
+                /* Loading a bucket in the first pass can let other threads
+                 * run.
+                 */
+                if (i + hi - lo > n || hi > b->len)
+                {
+                    PER_UNUSE(b);
+                    PyErr_SetString(PyExc_RuntimeError,
+                                    "the tree changed size during toArrays");
+                    goto Done;
+                }
+                memcpy(kdata + i * sizeof(KEY_TYPE), b->keys + lo,
+                       (hi - lo) * sizeof(KEY_TYPE));
+                if (vdata)
+                    memcpy(vdata + i * sizeof(VALUE_TYPE), b->values + lo,
+                           (hi - lo) * sizeof(VALUE_TYPE));
+            }
+            if (hi > lo)
+                i += hi - lo;
+            next = b == items->lastbucket ? NULL : b->next;
+            PER_UNUSE(b);
+        }
+        if (pass && i != n)
+        {
+            PyErr_SetString(PyExc_RuntimeError,
+                            "the tree changed size during toArrays");
+            goto Done;
+        }
+        n = i;
+    }
+
+    if (noval)
+    {
+        Py_INCREF(Py_None);
+        values = Py_None;
+    }
+    result = PyTuple_Pack(2, keys, values);
+
+Done:
+    Py_DECREF(items);
+    Py_XDECREF(keys);
+    Py_XDECREF(values);
+    return result;
+}
+#endif
+
+static PyObject *
+BTree_toArrays(BTree *self, PyObject *args, PyObject *kw)
+{
+#ifdef KEY_PACK_CODE
+    return _BTree_toArrays(self, args, kw, 0);
+#else
+    PyErr_SetString(PyExc_TypeError,
+                    "only keys that are C numbers can be copied to an array");
+    return NULL;
+#endif
+}
+
+/**************************************************************************/
+/* Bulk loading. */
+
+/* Return the smallest key in the subtree rooted at child, which must be
+ * a freshly built (hence non-ghost) bucket or BTree node of self's type.
+ */
+#define FROMSORTED_FIRST_BUCKET(SELF, CHILD) \
+    (SameType_Check((SELF), (CHILD)) ? BTREE(CHILD)->firstbucket \
+                                     : BUCKET(CHILD))
+
+/* Fill a fresh bucket with the next n entries of the sequence items,
+ * starting at *index.  prev points to the previous key stored (if
+ * *have_prev is true); it's used to check that keys are strictly
+ * ascending, and is updated to the last key stored.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_fillBucket(Bucket *bucket, PyObject **items, Py_ssize_t *index,
+                  int n, int noval, KEY_TYPE *prev, int *have_prev)
+{
+    int cmp;
+    int copied = 1;
+    KEY_TYPE key;
+    VALUE_TYPE value = {0};    /* squash nuisance warning */
+    PyObject *keyarg, *valuearg = NULL;
+
+    if (Bucket_grow(bucket, n, noval) < 0)
+        return -1;
+
+    while (bucket->len < n)
+    {
+        keyarg = items[(*index)++];
+        if (!noval)
+        {
+            if (!PyTuple_Check(keyarg) || PyTuple_GET_SIZE(keyarg) != 2)
+            {
+                PyErr_SetString(PyExc_TypeError,
+                                "Sequence must contain 2-item tuples");
+                return -1;
+            }
+            valuearg = PyTuple_GET_ITEM(keyarg, 1);
+            keyarg = PyTuple_GET_ITEM(keyarg, 0);
+        }
+
+        COPY_KEY_FROM_ARG(key, keyarg, copied);
+        UNLESS(copied)
+            return -1;
+#ifdef KEY_CHECK_ON_SET
+        if (!KEY_CHECK_ON_SET(keyarg))
+            return -1;
+#endif
+        if (!noval)
+        {
+            COPY_VALUE_FROM_ARG(value, valuearg, copied);
+            UNLESS(copied)
+                return -1;
+        }
+
+        if (*have_prev)
+        {
+            TEST_KEY_SET_OR(cmp, *prev, key)
+                return -1;
+            if (cmp >= 0)
+            {
+                PyErr_SetString(PyExc_ValueError,
+                                "keys must be in strictly ascending order");
+                return -1;
+            }
+        }
+
+        COPY_KEY(bucket->keys[bucket->len], key);
+        INCREF_KEY(bucket->keys[bucket->len]);
+        if (!noval)
+        {
+            COPY_VALUE(bucket->values[bucket->len], value);
+            INCREF_VALUE(bucket->values[bucket->len]);
+        }
+        bucket->len++;
+
+        COPY_KEY(*prev, key);
+        *have_prev = 1;
+    }
+    return 0;
+}
+
+/* Group the nodes in the list children into new BTree nodes of root's
+ * type holding at most max_children each, spreading them as evenly as
+ * possible.  If self is non-NULL, all the children are given to self
+ * instead (self is the root and must be empty).  Return a new list holding
+ * the parents (or an empty list when self is used), or NULL on error.
+ */
+static PyObject *
+_BTree_buildLevel(BTree *self, BTree *root, PyObject *children,
+                  int max_children)
+{
+    Py_ssize_t nchildren = PyList_GET_SIZE(children);
+    Py_ssize_t nparents, i, start;
+    PyObject *parents;
+
+    nparents = self ? 1 : (nchildren + max_children - 1) / max_children;
+    parents = PyList_New(0);
+    if (parents == NULL)
+        return NULL;
+
+    start = 0;
+    for (i = 0; i < nparents; i++)
+    {
+        BTree *parent;
+        Sized *child;
+        int j, n;
+
+        n = (int)(nchildren / nparents + (i < nchildren % nparents));
+        if (self)
+            parent = self;
+        else
+        {
+            parent = BTREE(PyObject_CallObject(OBJECT(Py_TYPE(root)), NULL));
+            if (parent == NULL)
+                goto err;
+            if (PyList_Append(parents, OBJECT(parent)) < 0)
+            {
+                Py_DECREF(parent);
+                goto err;
+            }
+            Py_DECREF(parent); /* owned by parents */
+        }
+
+        parent->data = BTree_Malloc(sizeof(BTreeItem) * n);
+        if (parent->data == NULL)
+            goto err;
+        parent->size = n;
+
+        for (j = 0; j < n; j++)
+        {
+            child = SIZED(PyList_GET_ITEM(children, start + j));
+            if (j)
+            {
+                COPY_KEY(parent->data[j].key,
+                         FROMSORTED_FIRST_BUCKET(root, child)->keys[0]);
+                INCREF_KEY(parent->data[j].key);
+            }
+            Py_INCREF(child);
+            parent->data[j].child = child;
+            parent->data[j].count = SameType_Check(root, child)
+                                    ? _BTree_nodeCount(BTREE(child))
+                                    : child->len;
+            parent->len++;
+        }
+        child = SIZED(PyList_GET_ITEM(children, start));
+        parent->firstbucket = FROMSORTED_FIRST_BUCKET(root, child);
+        Py_INCREF(parent->firstbucket);
+        start += n;
+    }
+    return parents;
+
+err:
+    Py_DECREF(parents);
+    return NULL;
+}
+
+/* Build the interior levels of self over the list children (buckets or
+ * BTree nodes), giving each node at most max_children children, until
+ * self (which must be empty) can hold the rest.  If nodes isn't NULL, add
+ * the number of new nodes below self to *nodes.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_buildLevels(BTree *self, PyObject *children, int max_children,
+                   Py_ssize_t *nodes)
+{
+    PyObject *parents;
+
+    Py_INCREF(children);
+    while (PyList_GET_SIZE(children) > max_children)
+    {
+        parents = _BTree_buildLevel(NULL, self, children, max_children);
+        Py_DECREF(children);
+        if (parents == NULL)
+            return -1;
+        if (nodes)
+            *nodes += PyList_GET_SIZE(parents);
+        children = parents;
+    }
+    parents = _BTree_buildLevel(self, self, children, max_children);
+    Py_DECREF(children);
+    if (parents == NULL)
+        return -1;
+    Py_DECREF(parents);
+    return 0;
+}
+
+/* Build a BTree or TreeSet of type 'type' bottom-up from the keys (or
+ * key, value pairs) in items, which must be in strictly ascending order.
+ * Buckets are packed to fill * max_leaf_size entries and interior nodes
+ * to fill * max_internal_size children, so no splitting ever happens.
+ */
+static PyObject *
+_BTree_fromSorted(PyObject *type, PyObject *items, double fill, int noval)
+{
+    BTree *self = NULL;
+    PyObject *seq = NULL, *children = NULL;
+    PyObject **entries;
+    Bucket *bucket, *prev_bucket = NULL;
+    Py_ssize_t n, index = 0, nbuckets, i;
+    long max_leaf, max_internal, leaf_fill, internal_fill;
+    KEY_TYPE prev = {0};    /* squash nuisance warning */
+    int have_prev = 0;
+
+    if (!(fill > 0.0 && fill <= 1.0))
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "fill must be greater than 0.0 and at most 1.0");
+        return NULL;
+    }
+
+    /* Like update_from_seq(), use items() on a mapping. */
+    if (!noval && (!PySequence_Check(items) ||
+                   PyObject_HasAttrString(items, "items")))
+    {
+        PyObject *meth = PyObject_GetAttrString(items, "items");
+        if (meth == NULL)
+            return NULL;
+        items = PyObject_CallObject(meth, NULL);
+        Py_DECREF(meth);
+        if (items == NULL)
+            return NULL;
+        seq = PySequence_Fast(items, "fromSorted() argument must be iterable");
+        Py_DECREF(items);
+    }
+    else
+        seq = PySequence_Fast(items, "fromSorted() argument must be iterable");
+    if (seq == NULL)
+        return NULL;
+
+    self = BTREE(PyObject_CallObject(type, NULL));
+    if (self == NULL)
+        goto err;
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    if (n == 0)
+        goto done;
+
+    max_leaf = _max_leaf_size(self);
+    if (max_leaf < 0)
+        goto err;
+    max_internal = _max_internal_size(self);
+    if (max_internal < 0)
+        goto err;
+    leaf_fill = (long)(max_leaf * fill);
+    if (leaf_fill < 1)
+        leaf_fill = 1;
+    internal_fill = (long)(max_internal * fill);
+    if (internal_fill < 2)
+        internal_fill = 2;
+
+    /* Build the buckets, spreading the entries evenly among them. */
+    nbuckets = (n + leaf_fill - 1) / leaf_fill;
+    children = PyList_New(0);
+    if (children == NULL)
+        goto err;
+    entries = PySequence_Fast_ITEMS(seq);
+    for (i = 0; i < nbuckets; i++)
+    {
+        bucket = BUCKET(BTree_newBucket(self));
+        if (bucket == NULL)
+            goto err;
+        if (PyList_Append(children, OBJECT(bucket)) < 0)
+        {
+            Py_DECREF(bucket);
+            goto err;
+        }
+        Py_DECREF(bucket); /* owned by children */
+        if (prev_bucket)
+        {
+            Py_INCREF(bucket);
+            prev_bucket->next = bucket;
+        }
+        prev_bucket = bucket;
+
+        if (_BTree_fillBucket(bucket, entries, &index,
+                              (int)(n / nbuckets + (i < n % nbuckets)),
+                              noval, &prev, &have_prev) < 0)
+            goto err;
+    }
+
+    /* Then the interior levels, until one node can hold all the rest. */
+    if (_BTree_buildLevels(self, children, (int)internal_fill, NULL) < 0)
+        goto err;
+
+done:
+    Py_XDECREF(children);
+    Py_DECREF(seq);
+    return OBJECT(self);
+
+err:
+    Py_XDECREF(children);
+    Py_DECREF(seq);
+    Py_XDECREF(self);
+    return NULL;
+}
+
+static PyObject *
+BTree_fromSorted(PyObject *type, PyObject *args, PyObject *kw)
+{
+    PyObject *items;
+    double fill = 1.0;
+    static char *kwlist[] = {"items", "fill", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "O|d:fromSorted", kwlist,
+                                     &items, &fill))
+        return NULL;
+    return _BTree_fromSorted(type, items, fill, 0);
+}
+
+#ifdef KEY_PACK_CODE
+static size_t _sortIntPairsNoDups(KEY_TYPE *p, VALUE_TYPE *v, size_t n);
+
+/* Copy the items of the buffer obj, which must be C numbers like those of
+ * the struct module code 'code' and 'size' bytes each, into a new malloc'ed
+ * array at *data (NULL if there are none).  Return the number of items, or
+ * -1 on error.
+ */
+static Py_ssize_t
+_BTree_copyBuffer(PyObject *obj, char code, size_t size, const char *what,
+                  void **data)
+{
+    Py_buffer view;
+    Py_ssize_t n;
+
+    *data = NULL;
+    if (PyObject_GetBuffer(obj, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+        return -1;
+    if (!_buffer_holds(&view, code, size))
+    {
+        PyBuffer_Release(&view);
+        PyErr_Format(PyExc_TypeError,
+                     "%s must be a buffer of C numbers like struct code '%c'",
+                     what, code);
+        return -1;
+    }
+    n = view.len / (Py_ssize_t)size;
+    if (n > 0)
+    {
+        *data = BTree_Malloc(n * size);
+        if (*data == NULL)
+            n = -1;
+        else
+            memcpy(*data, view.buf, n * size);
+    }
+    PyBuffer_Release(&view);
+    return n;
+}
+
+/* Build the empty, activated BTree or TreeSet self bottom-up from the n
+ * keys in keys, which must be in strictly ascending order, and, unless
+ * values is NULL, the n values in values, packing the buckets and
+ * interior nodes to fill like _BTree_fromSorted().
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_fillFromArrays(BTree *self, const KEY_TYPE *keys,
+                      VALUE_TYPE *values, Py_ssize_t n, double fill)
+{
+    PyObject *children = NULL;
+    Bucket *bucket, *prev_bucket = NULL;
+    Py_ssize_t index = 0, nbuckets, i;
+    long max_leaf, max_internal, leaf_fill, internal_fill;
+    int size, result = -1;
+
+    if (n == 0)
+        return 0;
+
+    max_leaf = _max_leaf_size(self);
+    if (max_leaf < 0)
+        return -1;
+    max_internal = _max_internal_size(self);
+    if (max_internal < 0)
+        return -1;
+    leaf_fill = (long)(max_leaf * fill);
+    if (leaf_fill < 1)
+        leaf_fill = 1;
+    internal_fill = (long)(max_internal * fill);
+    if (internal_fill < 2)
+        internal_fill = 2;
+
+    /* Build the buckets, spreading the entries evenly among them. */
+    nbuckets = (n + leaf_fill - 1) / leaf_fill;
+    children = PyList_New(0);
+    if (children == NULL)
+        return -1;
+    for (i = 0; i < nbuckets; i++)
+    {
+        bucket = BUCKET(BTree_newBucket(self));
+        if (bucket == NULL)
+            goto Done;
+        if (PyList_Append(children, OBJECT(bucket)) < 0)
+        {
+            Py_DECREF(bucket);
+            goto Done;
+        }
+        Py_DECREF(bucket); /* owned by children */
+        if (prev_bucket)
+        {
+            Py_INCREF(bucket);
+            prev_bucket->next = bucket;
+        }
+        prev_bucket = bucket;
+
+        size = (int)(n / nbuckets + (i < n % nbuckets));
+        if (Bucket_grow(bucket, size, values == NULL) < 0)
+            goto Done;
+        memcpy(bucket->keys, keys + index, size * sizeof(KEY_TYPE));
+        if (values)
+            memcpy(bucket->values, values + index,
+                   size * sizeof(VALUE_TYPE));
+        bucket->len = size;
+        index += size;
+    }
+
+    /* Then the interior levels, until one node can hold all the rest. */
+    result = _BTree_buildLevels(self, children, (int)internal_fill, NULL);
+
+Done:
+    Py_DECREF(children);
+    return result;
+}
+
+/* Build a BTree or TreeSet of type 'type' bottom-up from the n keys in the
+ * malloc'ed array keys and, unless values is NULL, the n values in the
+ * malloc'ed array values, which this frees.  Unless is_sorted is true,
+ * the keys (and values with them) are radix-sorted first and duplicates
+ * dropped; the last value given for a key wins, as with update().
+ */
+static PyObject *
+_BTree_fromArrays(PyObject *type, KEY_TYPE *keys, VALUE_TYPE *values,
+                  Py_ssize_t n, int is_sorted, double fill)
+{
+    BTree *self = NULL;
+    Py_ssize_t i;
+    int ascending = 1;
+
+    if (!(fill > 0.0 && fill <= 1.0))
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "fill must be greater than 0.0 and at most 1.0");
+        goto Done;
+    }
+
+    for (i = 1; i < n && ascending; i++)
+        if (!(keys[i - 1] < keys[i]))
+            ascending = 0;
+    if (!ascending)
+    {
+        if (is_sorted)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                            "keys must be in strictly ascending order");
+            goto Done;
+        }
+        if (values == NULL)
+            n = (Py_ssize_t)_sortIntNoDups(keys, (size_t)n);
+        else
+        {
+            /* The radix sort is stable, so the last value given for a
+             * key wins.
+             */
+            size_t nunique = _sortIntPairsNoDups(keys, values, (size_t)n);
+            if (nunique == (size_t)-1)
+            {
+                PyErr_NoMemory();
+                goto Done;
+            }
+            n = (Py_ssize_t)nunique;
+        }
+    }
+
+    self = BTREE(PyObject_CallObject(type, NULL));
+    if (self != NULL && _BTree_fillFromArrays(self, keys, values, n, fill) < 0)
+        Py_CLEAR(self);
+
+Done:
+    free(keys);
+    free(values);
+    return OBJECT(self);
+}
+#endif
+
+static PyObject *
+BTree_fromArrays(PyObject *type, PyObject *args, PyObject *kw)
+{
+#if defined(KEY_PACK_CODE) && defined(VALUE_PACK_CODE)
+    PyObject *okeys, *ovalues;
+    void *keys, *values;
+    Py_ssize_t n, nvalues;
+    int is_sorted = 0;
+    double fill = 1.0;
+    static char *kwlist[] = {"keys", "values", "sorted", "fill", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "OO|pd:fromArrays", kwlist,
+                                     &okeys, &ovalues, &is_sorted, &fill))
+        return NULL;
+    n = _BTree_copyBuffer(okeys, KEY_PACK_CODE, sizeof(KEY_TYPE), "keys",
+                          &keys);
+    if (n < 0)
+        return NULL;
+    nvalues = _BTree_copyBuffer(ovalues, VALUE_PACK_CODE, sizeof(VALUE_TYPE),
+                                "values", &values);
+    if (nvalues != n)
+    {
+        if (nvalues >= 0)
+            PyErr_SetString(PyExc_ValueError,
+                            "keys and values must have the same length");
+        free(keys);
+        free(values);
+        return NULL;
+    }
+    return _BTree_fromArrays(type, keys, values, n, is_sorted, fill);
+#else
+    PyErr_SetString(PyExc_TypeError,
+                    "only keys and values that are C numbers can be read "
+                    "from a buffer");
+    return NULL;
+#endif
+}
+
+/**************************************************************************/
+/* Compaction. */
+
+/* Append the buckets reachable from self, which must be activated, to the
+ * list buckets in key order, and add the number of BTree nodes below self
+ * to *nodes.
+ *
+ * Return:
+ *    -1    error
+ *     0    OK
+ */
+static int
+_BTree_collectBuckets(BTree *self, PyObject *buckets, Py_ssize_t *nodes)
+{
+    Sized *child;
+    int i, status;
+
+    for (i = 0; i < self->len; i++)
+    {
+        child = self->data[i].child;
+        if (SameType_Check(self, child))
+        {
+            (*nodes)++;
+            PER_USE_OR_RETURN(child, -1);
+            status = _BTree_collectBuckets(BTREE(child), buckets, nodes);
+            PER_UNUSE(child);
+            if (status < 0)
+                return -1;
+        }
+        else if (PyList_Append(buckets, OBJECT(child)) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+/* Copy the entries of the buckets in the list buckets that merge into
+ * the one before them (those not in survivors) onto the end of that one,
+ * and add them to its len, or, if undo is true, take them off its len
+ * again.  The buckets must have room.  The copies aren't owned until
+ * _BTree_unlinkMerged() empties the buckets they came from.
+ */
+static void
+_BTree_copyMerged(PyObject *buckets, PyObject *survivors, int noval,
+                  int undo)
+{
+    Py_ssize_t i, s = 0;
+    Bucket *b, *into = NULL;
+
+    for (i = 0; i < PyList_GET_SIZE(buckets); i++)
+    {
+        b = BUCKET(PyList_GET_ITEM(buckets, i));
+        if (s < PyList_GET_SIZE(survivors) &&
+            OBJECT(b) == PyList_GET_ITEM(survivors, s))
+        {
+            into = b;
+            s++;
+        }
+        else if (undo)
+            into->len -= b->len;
+        else
+        {
+            memcpy(into->keys + into->len, b->keys,
+                   sizeof(KEY_TYPE) * b->len);
+            if (!noval)
+                memcpy(into->values + into->len, b->values,
+                       sizeof(VALUE_TYPE) * b->len);
+            into->len += b->len;
+        }
+    }
+}
+
+/* Empty the buckets that _BTree_copyMerged() copied, which hands their
+ * references over to the copies, and unlink them from the bucket chain.
+ */
+static void
+_BTree_unlinkMerged(PyObject *buckets, PyObject *survivors)
+{
+    Py_ssize_t i, s = 0;
+    Bucket *b, *into = NULL;
+
+    for (i = 0; i < PyList_GET_SIZE(buckets); i++)
+    {
+        b = BUCKET(PyList_GET_ITEM(buckets, i));
+        if (s < PyList_GET_SIZE(survivors) &&
+            OBJECT(b) == PyList_GET_ITEM(survivors, s))
+        {
+            into = b;
+            s++;
+            continue;
+        }
+        b->len = 0;
+        /* The list still holds b, so dropping into's pointer is safe. */
+        Py_XINCREF(b->next);
+        Py_DECREF(into->next);
+        into->next = b->next;
+        Py_CLEAR(b->next);
+    }
+}
+
+/* Merge runs of adjacent buckets of self whose entries fit in fill *
+ * max_leaf_size, and rebuild the interior nodes with up to fill *
+ * max_internal_size children each, unless that wouldn't leave fewer
+ * persistent objects (buckets and interior nodes).  Return the number of
+ * objects that went away.
+ *
+ * Everything that can fail (loading the buckets, making room in those
+ * that others merge into, building the new interior) is done before the
+ * tree changes, so an error leaves it as it was.
+ */
+static PyObject *
+_BTree_compact(BTree *self, double fill, int noval)
+{
+    PyObject *buckets = NULL, *survivors = NULL, *result = NULL;
+    BTree *interior = NULL;
+    Bucket *b;
+    int *lens = NULL;
+    Py_ssize_t nbuckets = 0, nsurvivors = 0, nodes = 0, newnodes = 0;
+    Py_ssize_t used = 0, remaining, i;
+    long max_leaf, max_internal, leaf_fill, internal_fill;
+
+    if (!(fill > 0.0 && fill <= 1.0))
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "target_fill must be greater than 0.0 and at most 1.0");
+        return NULL;
+    }
+
+    max_leaf = _max_leaf_size(self);
+    if (max_leaf < 0)
+        return NULL;
+    max_internal = _max_internal_size(self);
+    if (max_internal < 0)
+        return NULL;
+    leaf_fill = (long)(max_leaf * fill);
+    if (leaf_fill < 1)
+        leaf_fill = 1;
+    internal_fill = (long)(max_internal * fill);
+    if (internal_fill < 2)
+        internal_fill = 2;
+
+    PER_USE_OR_RETURN(self, NULL);
+    if (self->len == 0)
+    {
+        PER_UNUSE(self);
+        return PyLong_FromLong(0);
+    }
+
+    UNLESS (buckets = PyList_New(0))
+        goto done;
+    if (_BTree_collectBuckets(self, buckets, &nodes) < 0)
+        goto done;
+    nbuckets = PyList_GET_SIZE(buckets);
+
+    /* Load all the buckets, and keep them loaded until we're done. */
+    for (used = 0; used < nbuckets; used++)
+        UNLESS (PER_USE(BUCKET(PyList_GET_ITEM(buckets, used))))
+            goto done;
+
+    /* Plan to merge each bucket into the one before it, if they fit
+     * together.  lens gets the length each survivor will have.
+     */
+    UNLESS (survivors = PyList_New(0))
+        goto done;
+    UNLESS (lens = BTree_Malloc(sizeof(int) * nbuckets))
+        goto done;
+    for (i = 0; i < nbuckets; i++)
+    {
+        b = BUCKET(PyList_GET_ITEM(buckets, i));
+        if (nsurvivors && lens[nsurvivors - 1] + b->len <= leaf_fill)
+        {
+            lens[nsurvivors - 1] += b->len;
+            continue;
+        }
+        if (PyList_Append(survivors, OBJECT(b)) < 0)
+            goto done;
+        lens[nsurvivors++] = b->len;
+    }
+
+    /* Leave the tree alone unless that takes fewer objects. */
+    for (remaining = nsurvivors; remaining > internal_fill; )
+    {
+        remaining = (remaining + internal_fill - 1) / internal_fill;
+        newnodes += remaining;
+    }
+    if (nsurvivors + newnodes >= nbuckets + nodes)
+    {
+        result = PyLong_FromLong(0);
+        goto done;
+    }
+
+    /* Make room in the buckets that others merge into. */
+    for (i = 0; i < nsurvivors; i++)
+    {
+        b = BUCKET(PyList_GET_ITEM(survivors, i));
+        if (lens[i] == b->len)
+            continue;
+        if (_bucket_own(b) < 0)
+            goto done;
+        if (lens[i] > b->size && Bucket_grow(b, lens[i], noval) < 0)
+            goto done;
+        if (PER_CHANGED(b) < 0)
+            goto done;
+    }
+#ifdef PERSISTENT
+    PER_READCURRENT(self, goto done);
+#endif
+    if (PER_CHANGED(self) < 0)
+        goto done;
+
+    /* Build the new interior over the merged buckets. */
+    _BTree_copyMerged(buckets, survivors, noval, 0);
+    interior = BTREE(PyObject_CallObject(OBJECT(Py_TYPE(self)), NULL));
+    if (interior == NULL ||
+        _BTree_buildLevels(interior, survivors, (int)internal_fill,
+                           NULL) < 0)
+    {
+        _BTree_copyMerged(buckets, survivors, noval, 1);
+        goto done;
+    }
+
+    /* Nothing can fail from here on.  The lists keep the old nodes and
+     * buckets alive meanwhile.
+     */
+    _BTree_unlinkMerged(buckets, survivors);
+    _BTree_clear(self);
+    self->data = interior->data;
+    self->len = interior->len;
+    self->size = interior->size;
+    self->firstbucket = interior->firstbucket;
+    interior->data = NULL;
+    interior->len = interior->size = 0;
+    interior->firstbucket = NULL;
+
+    result = PyLong_FromSsize_t(nodes + nbuckets - newnodes - nsurvivors);
+
+done:
+    for (i = 0; i < used; i++)
+        PER_UNUSE(BUCKET(PyList_GET_ITEM(buckets, i)));
+    PER_UNUSE(self);
+    Py_XDECREF(interior);
+    Py_XDECREF(buckets);
+    Py_XDECREF(survivors);
+    free(lens);
+    return result;
+}
+
+static PyObject *
+BTree_compact(BTree *self, PyObject *args, PyObject *kw)
+{
+    double fill = 1.0;
+    static char *kwlist[] = {"target_fill", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "|d:compact", kwlist, &fill))
+        return NULL;
+    return _BTree_compact(self, fill, 0);
+}
+
+/**************************************************************************/
+/* Cursor support. */
+
+static PyTypeObject BTreeCursor_Type;
+
+/* The type of cursor objects, returned by e.g. IIBTree().cursor(), and
+ * used for reverse iteration.  A cursor sits in the gap just before
+ * bucket->keys[offset].  It remembers the BTree nodes on the way down to
+ * that bucket, so that it can step to the bucket on either side without
+ * rescanning the bucket chain from firstbucket.
+ */
+typedef struct
+{
+    PyObject_HEAD
+    BTree *tree;        /* the root */
+    char kind;          /* 'k', 'v' or 'i', as for getBucketEntry */
+    int reverse;        /* does iteration go backwards? */
+    PyObject *min;      /* the bounds, if any; these own range.lo/hi */
+    PyObject *max;
+    KeyRange range;
+    BTree **nodes;      /* nodes[0] is tree, nodes[d+1] a child of nodes[d] */
+    int *indexes;       /* nodes[d+1] is nodes[d]->data[indexes[d]].child */
+    int depth;          /* the number of nodes on the path */
+    int allocated;      /* the room in nodes and indexes */
+    Bucket *bucket;     /* NULL if the tree is empty */
+    int offset;
+} BTreeCursor;
+
+/* Forget the path below depth, and the bucket. */
+static void
+_BTreeCursor_truncate(BTreeCursor *self, int depth)
+{
+    Py_CLEAR(self->bucket);
+    while (self->depth > depth)
+    {
+        self->depth--;
+        Py_DECREF(self->nodes[self->depth]);
+    }
+}
+
+/* Add node to the path, stealing the reference to it.  Return -1 on
+ * error, else 0.
+ */
+static int
+_BTreeCursor_push(BTreeCursor *self, BTree *node, int index)
+{
+    if (self->depth == self->allocated)
+    {
+        int allocated = self->allocated ? self->allocated * 2 : 8;
+        BTree **nodes;
+        int *indexes;
+
+        UNLESS (nodes = BTree_Realloc(self->nodes,
+                                      sizeof(BTree *) * allocated))
+            goto err;
+        self->nodes = nodes;
+        UNLESS (indexes = BTree_Realloc(self->indexes,
+                                        sizeof(int) * allocated))
+            goto err;
+        self->indexes = indexes;
+        self->allocated = allocated;
+    }
+    self->nodes[self->depth] = node;
+    self->indexes[self->depth] = index;
+    self->depth++;
+    return 0;
+
+err:
+    Py_DECREF(node);
+    return -1;
+}
+
+/* Go down from child, which is the root or the child of the last node on
+ * the path, along the leftmost (or rightmost) edge, and sit at the front
+ * (or the back) of the bucket found there.  Return -1 on error, else 0.
+ */
+static int
+_BTreeCursor_descend(BTreeCursor *self, Sized *child, int rightmost)
+{
+    BTree *node;
+    int i;
+
+    Py_INCREF(child);
+    while (SameType_Check(self->tree, child))
+    {
+        node = BTREE(child);
+        UNLESS (PER_USE(node))
+        {
+            Py_DECREF(node);
+            return -1;
+        }
+        if (node->len == 0)
+        {
+            /* An empty tree. */
+            PER_UNUSE(node);
+            Py_DECREF(node);
+            return 0;
+        }
+        i = rightmost ? node->len - 1 : 0;
+        child = node->data[i].child;
+        Py_INCREF(child);
+        PER_UNUSE(node);
+        if (_BTreeCursor_push(self, node, i) < 0)
+        {
+            Py_DECREF(child);
+            return -1;
+        }
+    }
+
+    UNLESS (PER_USE(child))
+    {
+        Py_DECREF(child);
+        return -1;
+    }
+    self->offset = rightmost ? BUCKET(child)->len : 0;
+    PER_UNUSE(child);
+    self->bucket = BUCKET(child);
+    return 0;
+}
+
+/* Sit just before the first key not less than key or, if after is true,
+ * just after the last key not greater than key.  Return -1 on error, else
+ * 0.
+ */
+static int
+_BTreeCursor_seekKey(BTreeCursor *self, KEY_TYPE key, int after)
+{
+    Sized *child = SIZED(self->tree);
+    BTree *node;
+    Bucket *bucket;
+    int i, cmp;
+
+    _BTreeCursor_truncate(self, 0);
+    Py_INCREF(child);
+    while (SameType_Check(self->tree, child))
+    {
+        node = BTREE(child);
+        UNLESS (PER_USE(node))
+        {
+            Py_DECREF(node);
+            return -1;
+        }
+        if (node->len == 0)
+        {
+            PER_UNUSE(node);
+            Py_DECREF(node);
+            return 0;
+        }
+        BTREE_SEARCH(i, node, key, goto node_err);
+        child = node->data[i].child;
+        Py_INCREF(child);
+        PER_UNUSE(node);
+        if (_BTreeCursor_push(self, node, i) < 0)
+        {
+            Py_DECREF(child);
+            return -1;
+        }
+    }
+
+    bucket = BUCKET(child);
+    UNLESS (PER_USE(bucket))
+    {
+        Py_DECREF(bucket);
+        return -1;
+    }
+    BUCKET_SEARCH(i, cmp, bucket, key, goto bucket_err);
+    if (cmp == 0 && after)
+        i++;
+    PER_UNUSE(bucket);
+    self->bucket = bucket;
+    self->offset = i;
+    return 0;
+
+node_err:
+    PER_UNUSE(node);
+    Py_DECREF(node);
+    return -1;
+
+bucket_err:
+    PER_UNUSE(bucket);
+    Py_DECREF(bucket);
+    return -1;
+}
+
+/* Sit at the start of the range (or, if end is true, at its end). */
+static int
+_BTreeCursor_seekEdge(BTreeCursor *self, int end)
+{
+    if (end ? self->range.has_hi : self->range.has_lo)
+    {
+        if (end)
+            return _BTreeCursor_seekKey(self, self->range.hi,
+                                        !self->range.excl_hi);
+        return _BTreeCursor_seekKey(self, self->range.lo,
+                                    self->range.excl_lo);
+    }
+    _BTreeCursor_truncate(self, 0);
+    return _BTreeCursor_descend(self, SIZED(self->tree), end);
+}
+
+/* Move to the front of the next bucket (or, if forward is false, to the
+ * back of the previous one), going only as far up the path as needed.
+ *
+ * Return:
+ *    -1    error
+ *     0    there is no such bucket; the cursor hasn't moved
+ *     1    OK
+ */
+static int
+_BTreeCursor_nextBucket(BTreeCursor *self, int forward)
+{
+    BTree *node;
+    Sized *child;
+    int d, i, len;
+
+    for (d = self->depth - 1; d >= 0; d--)
+    {
+        node = self->nodes[d];
+        PER_USE_OR_RETURN(node, -1);
+        len = node->len;
+        i = self->indexes[d];
+        if (i >= len)
+        {
+            PER_UNUSE(node);
+            PyErr_SetString(PyExc_RuntimeError,
+                            "the BTree being iterated changed size");
+            return -1;
+        }
+        i += forward ? 1 : -1;
+        if (0 <= i && i < len)
+        {
+            child = node->data[i].child;
+            Py_INCREF(child);
+            PER_UNUSE(node);
+            self->indexes[d] = i;
+            _BTreeCursor_truncate(self, d + 1);
+            i = _BTreeCursor_descend(self, child, !forward);
+            Py_DECREF(child);
+            return i < 0 ? -1 : 1;
+        }
+        PER_UNUSE(node);
+    }
+    return 0;
+}
+
+/* Return the entry just after the cursor (or, if forward is false, just
+ * before it), and move past it.  Return NULL without an exception set if
+ * there is no such entry within the cursor's range.
+ */
+static PyObject *
+_BTreeCursor_step(BTreeCursor *self, int forward)
+{
+    Bucket *bucket;
+    PyObject *result = NULL;
+    int i, cmp, status;
+
+    for (;;)
+    {
+        bucket = self->bucket;
+        if (bucket == NULL)
+            return NULL;
+        PER_USE_OR_RETURN(bucket, NULL);
+        if (self->offset > bucket->len)
+        {
+            PER_UNUSE(bucket);
+            PyErr_SetString(PyExc_RuntimeError,
+                            "the bucket being iterated changed size");
+            return NULL;
+        }
+        if (forward ? self->offset < bucket->len : self->offset > 0)
+            break;
+        PER_UNUSE(bucket);
+        status = _BTreeCursor_nextBucket(self, forward);
+        if (status <= 0)
+            return NULL;
+    }
+
+    i = forward ? self->offset : self->offset - 1;
+    if (forward && self->range.has_hi)
+    {
+        TEST_KEY_SET_OR(cmp, bucket->keys[i], self->range.hi)
+            goto Done;
+        if (cmp > 0 || (cmp == 0 && self->range.excl_hi))
+            goto Done;
+    }
+    else if (!forward && self->range.has_lo)
+    {
+        TEST_KEY_SET_OR(cmp, bucket->keys[i], self->range.lo)
+            goto Done;
+        if (cmp < 0 || (cmp == 0 && self->range.excl_lo))
+            goto Done;
+    }
+    result = getBucketEntry(bucket, i, self->kind);
+    if (result)
+        self->offset = forward ? i + 1 : i;
+
+Done:
+    PER_UNUSE(bucket);
+    return result;
+}
+
+/* Return a new cursor over the part of self between min and max, sitting
+ * at the start of it (or at the end, if reverse is true).
+ */
+static PyObject *
+_BTree_newCursor(BTree *self, PyObject *min, PyObject *max,
+                 int excludemin, int excludemax, int reverse, char kind)
+{
+    BTreeCursor *cursor;
+    PyObject *minkey, *maxkey;
+    int copied = 1;
+
+    UNLESS (cursor = PyObject_New(BTreeCursor, &BTreeCursor_Type))
+        return NULL;
+    Py_INCREF(self);
+    cursor->tree = self;
+    cursor->kind = kind;
+    cursor->reverse = reverse;
+    cursor->min = cursor->max = NULL;
+    cursor->range.has_lo = cursor->range.has_hi = 0;
+    cursor->range.excl_lo = excludemin;
+    cursor->range.excl_hi = excludemax;
+    cursor->nodes = NULL;
+    cursor->indexes = NULL;
+    cursor->depth = cursor->allocated = 0;
+    cursor->bucket = NULL;
+    cursor->offset = 0;
+
+    if (_BTree_rangeBounds(self, &min, &max, excludemin, excludemax,
+                           &minkey, &maxkey) < 0)
+        goto err;
+    if (min != Py_None)
+    {
+        Py_INCREF(min);
+        cursor->min = min;
+    }
+    if (max != Py_None)
+    {
+        Py_INCREF(max);
+        cursor->max = max;
+    }
+    Py_XDECREF(minkey);
+    Py_XDECREF(maxkey);
+    if (cursor->min)
+    {
+        COPY_KEY_FROM_ARG(cursor->range.lo, cursor->min, copied);
+        UNLESS (copied)
+            goto err;
+        cursor->range.has_lo = 1;
+    }
+    if (cursor->max)
+    {
+        COPY_KEY_FROM_ARG(cursor->range.hi, cursor->max, copied);
+        UNLESS (copied)
+            goto err;
+        cursor->range.has_hi = 1;
+    }
+
+    if (_BTreeCursor_seekEdge(cursor, reverse) < 0)
+        goto err;
+    return OBJECT(cursor);
+
+err:
+    Py_DECREF(cursor);
+    return NULL;
+}
+
+static char *cursor_keywords[] = {"min", "max",
+                                  "excludemin", "excludemax",
+                                  "reverse",
+                                  0};
+
+/* A helper to build the cursors for BTrees and TreeSets, from the
+ * arguments to cursor() or a reverse iterkeys() and friends.
+ */
+static PyObject *
+buildBTreeCursor(BTree *self, PyObject *args, PyObject *kw, char kind)
+{
+    PyObject *min = Py_None;
+    PyObject *max = Py_None;
+    int excludemin = 0;
+    int excludemax = 0;
+    int reverse = 0;
+
+    if (! PyArg_ParseTupleAndKeywords(args, kw, "|OOii$i", cursor_keywords,
+                                      &min, &max,
+                                      &excludemin, &excludemax,
+                                      &reverse))
+        return NULL;
+    return _BTree_newCursor(self, min, max, excludemin, excludemax,
+                            reverse, kind);
+}
+
+/* The implementation of BTree.cursor(). */
+static PyObject *
+BTree_cursor(BTree *self, PyObject *args, PyObject *kw)
+{
+    return buildBTreeCursor(self, args, kw, 'i');
+}
+
+/* The implementation of reversed(BTree_or_TreeSet). */
+static PyObject *
+BTree_reversed(BTree *self)
+{
+    return _BTree_newCursor(self, Py_None, Py_None, 0, 0, 1, 'k');
+}
+
+static void
+BTreeCursor_dealloc(BTreeCursor *self)
+{
+    _BTreeCursor_truncate(self, 0);
+    free(self->nodes);
+    free(self->indexes);
+    Py_XDECREF(self->min);
+    Py_XDECREF(self->max);
+    Py_DECREF(self->tree);
+    PyObject_Del(self);
+}
+
+static PyObject *
+BTreeCursor_seekStart(BTreeCursor *self)
+{
+    if (_BTreeCursor_seekEdge(self, 0) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+BTreeCursor_seekEnd(BTreeCursor *self)
+{
+    if (_BTreeCursor_seekEdge(self, 1) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+BTreeCursor_seek(BTreeCursor *self, PyObject *keyarg)
+{
+    KEY_TYPE key;
+    int copied = 1;
+    int cmp;
+
+    COPY_KEY_FROM_ARG(key, keyarg, copied);
+    UNLESS (copied)
+        return NULL;
+
+    /* Keep to the range. */
+    if (self->range.has_lo)
+    {
+        TEST_KEY_SET_OR(cmp, key, self->range.lo)
+            return NULL;
+        if (cmp <= 0)
+            return BTreeCursor_seekStart(self);
+    }
+    if (self->range.has_hi)
+    {
+        TEST_KEY_SET_OR(cmp, key, self->range.hi)
+            return NULL;
+        if (cmp > 0)
+            return BTreeCursor_seekEnd(self);
+    }
+    if (_BTreeCursor_seekKey(self, key, 0) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+/* The implementation of cursor.next() and cursor.prev(). */
+static PyObject *
+BTreeCursor_move(BTreeCursor *self, int forward)
+{
+    PyObject *result = _BTreeCursor_step(self, forward);
+
+    if (result == NULL && ! PyErr_Occurred())
+        PyErr_SetNone(PyExc_StopIteration);
+    return result;
+}
+
+static PyObject *
+BTreeCursor_next(BTreeCursor *self)
+{
+    return BTreeCursor_move(self, 1);
+}
+
+static PyObject *
+BTreeCursor_prev(BTreeCursor *self)
+{
+    return BTreeCursor_move(self, 0);
+}
+
+/* The cursor's tp_iternext slot:  iteration goes the way given by the
+ * reverse argument the cursor was made with.
+ */
+static PyObject *
+BTreeCursor_iternext(BTreeCursor *self)
+{
+    return _BTreeCursor_step(self, ! self->reverse);
+}
+
+static PyObject *
+BTreeCursor_getiter(PyObject *it)
+{
+    Py_INCREF(it);
+    return it;
+}
+
+static struct PyMethodDef BTreeCursor_methods[] = {
+    {"seek", (PyCFunction) BTreeCursor_seek, METH_O,
+     "seek(key)\n\n"
+     "Move to just before the first key not less than key, keeping to the\n"
+     "cursor's range."},
+
+    {"seekStart", (PyCFunction) BTreeCursor_seekStart, METH_NOARGS,
+     "seekStart()\n\nMove to the start of the cursor's range."},
+
+    {"seekEnd", (PyCFunction) BTreeCursor_seekEnd, METH_NOARGS,
+     "seekEnd()\n\nMove to the end of the cursor's range."},
+
+    {"next", (PyCFunction) BTreeCursor_next, METH_NOARGS,
+     "next() -> the entry after the cursor, moving past it\n\n"
+     "Raise StopIteration at the end of the range."},
+
+    {"prev", (PyCFunction) BTreeCursor_prev, METH_NOARGS,
+     "prev() -> the entry before the cursor, moving back past it\n\n"
+     "Raise StopIteration at the start of the range."},
+
+    {NULL, NULL}
+};
+
+static PyTypeObject BTreeCursor_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    MODULE_NAME MOD_NAME_PREFIX "TreeCursor",   /* tp_name */
+    sizeof(BTreeCursor),                        /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    /* methods */
+    (destructor)BTreeCursor_dealloc,            /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    0,                                          /* tp_doc */
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    (getiterfunc)BTreeCursor_getiter,           /* tp_iter */
+    (iternextfunc)BTreeCursor_iternext,         /* tp_iternext */
+    BTreeCursor_methods,                        /* tp_methods */
+    0,                                          /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+};
+
+/* End of cursor support. */
+
+/**************************************************************************/
+/* Iterator support. */
+
+/* A helper to build all the iterators for BTrees and TreeSets.
+ * If args is NULL, the iterator spans the entire structure.  Else it's an
+ * argument tuple, with optional low and high arguments.
+ * kind is 'k', 'v' or 'i'.
+ * Returns a BTreeIter object, or NULL if error.
+ */
+static PyObject *
+buildBTreeIter(BTree *self, PyObject *args, PyObject *kw, char kind)
+{
+    BTreeIter *result = NULL;
+    BTreeItems *items;
+
+    /* Reverse iteration is done by a cursor. */
+    if (kw && PyDict_GetItemString(kw, "reverse"))
+        return buildBTreeCursor(self, args, kw, kind);
+
+    items = (BTreeItems *)BTree_rangeSearch(self, args, kw, kind);
+    if (items)
+    {
+        result = BTreeIter_new(items);
+        Py_DECREF(items);
+    }
+    return (PyObject *)result;
+}
+
+/* The implementation of iter(BTree_or_TreeSet); the BTree tp_iter slot. */
+static PyObject *
 BTree_getiter(BTree *self)
 {
     return buildBTreeIter(self, NULL, NULL, 'k');
@@ -2235,6 +5251,15 @@ static struct PyMethodDef BTree_methods[] = {
      "has_key(key)\n\n"
      "Return true if the BTree contains the given key."},
 
+    {"getMany", (PyCFunction) BTree_getMany, METH_VARARGS | METH_KEYWORDS,
+     "getMany(keys[, default]) -> list of values\n\n"
+     "Return the values for keys, in order, with default (None if not\n"
+     "given) for each key that is missing."},
+
+    {"containsMany", (PyCFunction) BTree_containsMany, METH_O,
+     "containsMany(keys) -> list of booleans\n\n"
+     "Return, for each of keys in order, whether the BTree contains it."},
+
     {"keys", (PyCFunction) BTree_keys, METH_VARARGS | METH_KEYWORDS,
      "keys([min, max]) -> list of keys\n\n"
      "Returns the keys of the BTree.  If min and max are supplied, only\n"
@@ -2257,6 +5282,16 @@ static struct PyMethodDef BTree_methods[] = {
      "list is sorted by value.  Note that items() returns keys in the\n"
      "opposite order."},
 
+    {"nlargest", (PyCFunction) BTree_nlargest, METH_VARARGS,
+     "nlargest(k) ->  list of value, key pairs\n\n"
+     "Returns the k value, key pairs with the largest values, largest\n"
+     "first.  Equal values are listed in key order."},
+
+    {"nsmallest", (PyCFunction) BTree_nsmallest, METH_VARARGS,
+     "nsmallest(k) ->  list of value, key pairs\n\n"
+     "Returns the k value, key pairs with the smallest values, smallest\n"
+     "first.  Equal values are listed in key order."},
+
     {"get", (PyCFunction) BTree_getm, METH_VARARGS,
      "get(key[, default=None]) -> Value for key or default\n\n"
      "Return the value or the default if the key is not found."},
@@ -2293,18 +5328,80 @@ static struct PyMethodDef BTree_methods[] = {
      "Add an item if the key is not already used. Return 1 if the item was\n"
      "added, or 0 otherwise."},
 
+    {"rank", (PyCFunction) BTree_rank, METH_O,
+     "rank(key) -> int\n\n"
+     "Return the number of keys in the BTree that are less than key.  This\n"
+     "is the position of key in keys() if it is present."},
+
+    {"keyAt", (PyCFunction) BTree_keyAt, METH_O,
+     "keyAt(index) -> key\n\n"
+     "Return the key at the given position in keys(); negative positions\n"
+     "count from the end.  Raise IndexError if there is no such key."},
+
+    {"deleteRange", (PyCFunction) BTree_deleteRange,
+     METH_VARARGS | METH_KEYWORDS,
+     "deleteRange([min, max, excludemin, excludemax]) -> None\n\n"
+     "Remove every key between min and max (inclusive unless excluded).\n"
+     "Buckets and subtrees wholly inside the range are dropped without\n"
+     "being loaded; only the buckets at its ends are trimmed."},
+
+    {"compact", (PyCFunction) BTree_compact, METH_VARARGS | METH_KEYWORDS,
+     "compact([target_fill=1.0]) -> int\n\n"
+     "Merge adjacent buckets whose items fit in target_fill * max_leaf_size\n"
+     "and rebuild the interior nodes, in place.  Return the number of\n"
+     "persistent objects that went away."},
+
+    {"count", (PyCFunction) BTree_count, METH_VARARGS | METH_KEYWORDS,
+     "count([min, max, excludemin, excludemax]) -> int\n\n"
+     "Return the number of keys that keys() would return for the same\n"
+     "arguments, without building them.  Only the buckets at the ends of\n"
+     "the range are searched."},
+
+    {"toArrays", (PyCFunction) BTree_toArrays, METH_VARARGS | METH_KEYWORDS,
+     "toArrays([min, max, excludemin, excludemax]) -> (keys, values)\n\n"
+     "Return array.array copies of the keys and values that keys() and\n"
+     "values() would return for the same arguments.  Only trees whose\n"
+     "keys and values are C numbers support this."},
+
+    {"fromSorted", (PyCFunction) BTree_fromSorted,
+     METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+     "fromSorted(items[, fill=1.0]) -> BTree\n\n"
+     "Build a new BTree from (key, value) pairs in strictly ascending key\n"
+     "order.  Buckets are packed to fill * max_leaf_size entries and the\n"
+     "interior nodes built bottom-up, without any splitting."},
+
+    {"fromArrays", (PyCFunction) BTree_fromArrays,
+     METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+     "fromArrays(keys, values[, sorted=False, fill=1.0]) -> BTree\n\n"
+     "Build a new BTree from two C-contiguous buffers (such as array.array\n"
+     "or NumPy arrays) of the same length holding C numbers of the key and\n"
+     "value types.  Unless sorted is true, the keys are sorted first, and\n"
+     "the last value given for a key wins.  Only trees whose keys and\n"
+     "values are C numbers support this."},
+
     {"update", (PyCFunction) Mapping_update, METH_O,
      "update(collection)\n\n Add the items from the given collection."},
 
     {"iterkeys", (PyCFunction) BTree_iterkeys, METH_VARARGS | METH_KEYWORDS,
-     "B.iterkeys([min[,max]]) -> an iterator over the keys of B"},
+     "B.iterkeys([min[,max]][, reverse=False]) -> an iterator over the keys "
+     "of B"},
 
     {"itervalues", (PyCFunction) BTree_itervalues, METH_VARARGS | METH_KEYWORDS,
-     "B.itervalues([min[,max]]) -> an iterator over the values of B"},
+     "B.itervalues([min[,max]][, reverse=False]) -> an iterator over the "
+     "values of B"},
 
     {"iteritems", (PyCFunction) BTree_iteritems, METH_VARARGS | METH_KEYWORDS,
-     "B.iteritems([min[,max]]) -> an iterator over the (key, value) "
-     "items of B"},
+     "B.iteritems([min[,max]][, reverse=False]) -> an iterator over the "
+     "(key, value) items of B"},
+
+    {"cursor", (PyCFunction) BTree_cursor, METH_VARARGS | METH_KEYWORDS,
+     "cursor([min, max, excludemin, excludemax][, reverse=False])\n\n"
+     "Return a cursor over the (key, value) items of B between min and max,\n"
+     "which can move forwards and backwards with next() and prev() and be\n"
+     "moved to a key with seek()."},
+
+    {"__reversed__", (PyCFunction) BTree_reversed, METH_NOARGS,
+     "__reversed__() -> an iterator over the keys of B, largest first"},
 
     {"_check", (PyCFunction) BTree_check, METH_NOARGS,
      "Perform sanity check on BTree, and raise exception if flawed."},
@@ -2411,7 +5508,8 @@ BTree_tp_clear(BTree *self)
  * Return the number of elements in a BTree.  nonzero is a Boolean, and
  * when true requests just a non-empty/empty result.  Testing for emptiness
  * is efficient (constant-time).  Getting the true length takes time
- * proportional to the number of leaves (buckets).
+ * proportional to the number of leaves (buckets), except in a counted
+ * BTree, where only the root's child counts are summed.
  *
  * Return:
  *     When nonzero true:
@@ -2425,12 +5523,34 @@ BTree_tp_clear(BTree *self)
 static Py_ssize_t
 BTree_length_or_nonzero(BTree *self, int nonzero)
 {
-    int result;
+    Py_ssize_t result;
     Bucket *b;
     Bucket *next;
+    int counted;
+
+    counted = _BTree_counted(self);
+    if (counted < 0)
+        return -1;
 
     PER_USE_OR_RETURN(self, -1);
     b = self->firstbucket;
+    if (counted && !nonzero)
+    {
+        int i;
+        result = 0;
+        for (i = 0; i < self->len; i++)
+        {
+            Py_ssize_t count = _BTree_childCount(self, i);
+            if (count < 0)
+            {
+                PER_UNUSE(self);
+                return -1;
+            }
+            result += count;
+        }
+        PER_UNUSE(self);
+        return result;
+    }
     PER_UNUSE(self);
     if (nonzero)
         return b != NULL;
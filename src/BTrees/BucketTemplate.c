@@ -132,6 +132,146 @@ bucket_getitem(Bucket *self, PyObject *key)
     return result;
 }
 
+/* Set BufferError and return -1 if buffers are exported over the
+ * bucket's arrays, which mustn't be moved or freed until they're
+ * released.  Else return 0.
+ */
+static int
+_bucket_check_exports(Bucket *self)
+{
+    if (self->exports == 0)
+        return 0;
+    PyErr_SetString(PyExc_BufferError,
+                    "a buffer over the bucket is in use, so its keys and "
+                    "values can't be moved");
+    return -1;
+}
+
+#if defined(KEY_PACK_CODE) || defined(VALUE_PACK_CODE)
+/* The arrays of a bucket that buffers were exported over, once the bucket
+ * has let go of them.  They are freed when the last of those buffers is
+ * released.
+ */
+typedef struct
+{
+    PyObject_HEAD
+    KEY_TYPE *keys;
+    VALUE_TYPE *values;
+    PyObject *borrowed;     /* if not NULL, the arrays point into it */
+} BucketArrays;
+
+static void
+BucketArrays_dealloc(BucketArrays *self)
+{
+    if (self->borrowed)
+        Py_DECREF(self->borrowed);
+    else
+    {
+        free(self->keys);
+        free(self->values);
+    }
+    PyObject_Del(self);
+}
+
+static PyTypeObject BucketArrays_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    MODULE_NAME MOD_NAME_PREFIX "BucketArrays", /* tp_name */
+    sizeof(BucketArrays),                       /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)BucketArrays_dealloc,           /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+};
+#endif
+
+/* Hand the arrays that buffers are exported over to those buffers, which
+ * free them when the last of them is released, so that self can be
+ * ghostified or load a new state without waiting for that.  Only C
+ * numbers are exported, so arrays of objects stay with self.  Call
+ * _bucket_clear() afterwards.
+ */
+static void
+_bucket_detach(Bucket *self)
+{
+#if defined(KEY_PACK_CODE) || defined(VALUE_PACK_CODE)
+    BucketArrays *arrays = (BucketArrays *)self->exported;
+
+    if (arrays == NULL)
+        return;
+    if (self->borrowed)
+    {
+        arrays->borrowed = self->borrowed;
+        self->borrowed = NULL;
+        self->keys = NULL;
+        self->values = NULL;
+    }
+    else
+    {
+#ifdef KEY_PACK_CODE
+        arrays->keys = self->keys;
+        self->keys = NULL;
+#endif
+#ifdef VALUE_PACK_CODE
+        arrays->values = self->values;
+        self->values = NULL;
+#endif
+    }
+    self->exports = 0;
+    Py_CLEAR(self->exported);
+#endif
+}
+
+/* If self's keys and values point into its packed state, copy them to
+ * arrays of its own, which can be changed.  Anything that changes them
+ * in place calls this first.
+ *
+ * Return:  -1 on error, 0 on success
+ */
+static int
+_bucket_own(Bucket *self)
+{
+    KEY_TYPE *keys = NULL;
+    VALUE_TYPE *values = NULL;
+
+    if (self->borrowed == NULL)
+        return 0;
+    if (_bucket_check_exports(self) < 0)
+        return -1;
+    if (self->len)
+    {
+        UNLESS (keys = BTree_Malloc(sizeof(KEY_TYPE) * self->len))
+            return -1;
+        memcpy(keys, self->keys, sizeof(KEY_TYPE) * self->len);
+        if (self->values)
+        {
+            UNLESS (values = BTree_Malloc(sizeof(VALUE_TYPE) * self->len))
+            {
+                free(keys);
+                return -1;
+            }
+            memcpy(values, self->values, sizeof(VALUE_TYPE) * self->len);
+        }
+    }
+    Py_CLEAR(self->borrowed);
+    self->keys = keys;
+    self->values = values;
+    self->size = self->len;
+    return 0;
+}
+
 /*
 ** Bucket_grow
 **
@@ -153,6 +293,9 @@ Bucket_grow(Bucket *self, int newsize, int noval)
     KEY_TYPE *keys;
     VALUE_TYPE *values;
 
+    if (_bucket_check_exports(self) < 0 || _bucket_own(self) < 0)
+        return -1;
+
     if (self->size)
     {
         if (newsize < 0)
@@ -388,6 +531,8 @@ _bucket_set(Bucket *self, PyObject *keyarg, PyObject *v,
                 goto Done;
             }
 #endif
+            if (_bucket_own(self) < 0)
+                goto Done;
             if (changed)
                 *changed = 1;
             DECREF_VALUE(self->values[i]);
@@ -399,6 +544,8 @@ _bucket_set(Bucket *self, PyObject *keyarg, PyObject *v,
         }
 
         /* The key exists at index i, and should be deleted. */
+        if (_bucket_own(self) < 0)
+            goto Done;
         DECREF_KEY(self->keys[i]);
         self->len--;
         if (i < self->len)
@@ -441,6 +588,8 @@ _bucket_set(Bucket *self, PyObject *keyarg, PyObject *v,
     }
 
     /* The key doesn't exist and should be inserted at index i. */
+    if (_bucket_own(self) < 0)
+        goto Done;
     if (self->len == self->size && Bucket_grow(self, -1, noval) < 0)
         goto Done;
 
@@ -592,6 +741,8 @@ bucket_split(Bucket *self, int index, Bucket *next)
     int next_size;
 
     ASSERT(self->len > 1, "split of empty bucket", -1);
+    if (_bucket_own(self) < 0)
+        return -1;
 
     if (index < 0 || index >= self->len)
         index = self->len / 2;
@@ -614,6 +765,7 @@ bucket_split(Bucket *self, int index, Bucket *next)
     }
     next->size = next_size;
     next->len = next_size;
+    next->packed = self->packed;
     self->len = index;
 
     next->next = self->next;
@@ -1013,6 +1165,329 @@ err:
     return NULL;
 }
 
+/* Bounded selection of the k best entries of a bucket as it is filled.
+ *
+ * The entries are kept in an ordinary bucket, used as storage.  The caller
+ * appends each new entry at the end, as usual, and then calls
+ * _topkAdmit(), which keeps the bucket down to k entries by dropping the
+ * worse of the new entry and the worst entry kept so far.  An entry is
+ * better than another if its value is larger (smaller, when sign is -1),
+ * or if the values are equal and it arrived first; the entries kept are
+ * those a stable sort by value would put first.  That takes O(n log k)
+ * time and O(k) space, where sorting everything would take O(n log n)
+ * time and O(n) space.
+ */
+typedef struct {
+    Py_ssize_t k;           /* how many entries to keep */
+    int sign;               /* 1 keeps the largest values, -1 the smallest */
+    Py_ssize_t *heap;       /* positions in the bucket, worst entry first */
+    size_t *order;          /* order[pos]: when the entry at pos arrived */
+    Py_ssize_t allocated;   /* how many heap and order slots there are */
+    size_t seen;            /* how many entries have arrived */
+} TopK;
+
+static void
+_topkInit(TopK *t, Py_ssize_t k, int sign)
+{
+    t->k = k;
+    t->sign = sign;
+    t->heap = NULL;
+    t->order = NULL;
+    t->allocated = 0;
+    t->seen = 0;
+}
+
+static void
+_topkFini(TopK *t)
+{
+    free(t->heap);
+    free(t->order);
+    t->heap = NULL;
+    t->order = NULL;
+    t->allocated = 0;
+}
+
+/* Return 1 if the entry at position a of b is worse than the one at
+ * position c, 0 if it isn't, or -1 on error.
+ */
+static int
+_topkWorse(Bucket *b, TopK *t, Py_ssize_t a, Py_ssize_t c)
+{
+    int cmp = TEST_VALUE(b->values[a], b->values[c]);
+
+#ifdef VALUE_TYPE_IS_PYOBJECT
+    if (PyErr_Occurred())
+        return -1;
+#endif
+    if (cmp)
+        return t->sign * cmp < 0;
+    return t->order[a] > t->order[c];
+}
+
+static int
+_topkSiftUp(Bucket *b, TopK *t, Py_ssize_t pos)
+{
+    Py_ssize_t item = t->heap[pos], parent;
+    int worse;
+
+    while (pos > 0)
+    {
+        parent = (pos - 1) / 2;
+        worse = _topkWorse(b, t, item, t->heap[parent]);
+        if (worse < 0)
+            return -1;
+        if (! worse)
+            break;
+        t->heap[pos] = t->heap[parent];
+        pos = parent;
+    }
+    t->heap[pos] = item;
+    return 0;
+}
+
+static int
+_topkSiftDown(Bucket *b, TopK *t, Py_ssize_t n, Py_ssize_t pos)
+{
+    Py_ssize_t item = t->heap[pos], child;
+    int worse;
+
+    while ((child = 2 * pos + 1) < n)
+    {
+        if (child + 1 < n)
+        {
+            worse = _topkWorse(b, t, t->heap[child + 1], t->heap[child]);
+            if (worse < 0)
+                return -1;
+            child += worse;
+        }
+        worse = _topkWorse(b, t, t->heap[child], item);
+        if (worse < 0)
+            return -1;
+        if (! worse)
+            break;
+        t->heap[pos] = t->heap[child];
+        pos = child;
+    }
+    t->heap[pos] = item;
+    return 0;
+}
+
+/* An entry has just been appended to b.  Keep it, dropping the worst
+ * entry kept so far if there would be more than k, or drop it.  Return -1
+ * on error, else 0.
+ */
+static int
+_topkAdmit(Bucket *b, TopK *t)
+{
+    Py_ssize_t pos = b->len - 1, worst;
+    int worse;
+
+    if (b->len > t->allocated)
+    {
+        Py_ssize_t newsize = b->size < t->k ? b->size : t->k + 1;
+        Py_ssize_t *heap;
+        size_t *order;
+
+        UNLESS (heap = BTree_Realloc(t->heap, newsize * sizeof(Py_ssize_t)))
+            return -1;
+        t->heap = heap;
+        UNLESS (order = BTree_Realloc(t->order, newsize * sizeof(size_t)))
+            return -1;
+        t->order = order;
+        t->allocated = newsize;
+    }
+
+    t->order[pos] = t->seen++;
+    if (b->len <= t->k)
+    {
+        t->heap[pos] = pos;
+        return _topkSiftUp(b, t, pos);
+    }
+
+    worst = t->heap[0];
+    worse = _topkWorse(b, t, pos, worst);
+    if (worse < 0)
+        return -1;
+    if (worse)
+    {
+        DECREF_KEY(b->keys[pos]);
+        DECREF_VALUE(b->values[pos]);
+        b->len--;
+        return 0;
+    }
+
+    /* The new entry takes the place of the worst one. */
+    DECREF_KEY(b->keys[worst]);
+    COPY_KEY(b->keys[worst], b->keys[pos]);
+    DECREF_VALUE(b->values[worst]);
+    COPY_VALUE(b->values[worst], b->values[pos]);
+    t->order[worst] = t->order[pos];
+    b->len--;
+    return _topkSiftDown(b, t, b->len, 0);
+}
+
+typedef struct {
+    size_t order;
+    Py_ssize_t pos;
+} _TopKArrival;
+
+static int
+_topkArrivalCompare(const void *a, const void *b)
+{
+    size_t x = ((const _TopKArrival *)a)->order;
+    size_t y = ((const _TopKArrival *)b)->order;
+
+    return x < y ? -1 : x > y;
+}
+
+/* Put the entries kept back in the order they arrived in.  Return -1 on
+ * error, else 0.
+ */
+static int
+_topkRestoreOrder(Bucket *b, TopK *t)
+{
+    _TopKArrival *arrivals;
+    KEY_TYPE *keys = NULL;
+    VALUE_TYPE *values = NULL;
+    Py_ssize_t i;
+
+    if (b->len < 2)
+        return 0;
+    UNLESS (arrivals = BTree_Malloc(b->len * sizeof(_TopKArrival)))
+        return -1;
+    UNLESS (keys = BTree_Malloc(b->size * sizeof(KEY_TYPE)))
+        goto err;
+    UNLESS (values = BTree_Malloc(b->size * sizeof(VALUE_TYPE)))
+        goto err;
+
+    for (i = 0; i < b->len; i++)
+    {
+        arrivals[i].order = t->order[i];
+        arrivals[i].pos = i;
+    }
+    qsort(arrivals, b->len, sizeof(_TopKArrival), _topkArrivalCompare);
+    for (i = 0; i < b->len; i++)
+    {
+        COPY_KEY(keys[i], b->keys[arrivals[i].pos]);
+        COPY_VALUE(values[i], b->values[arrivals[i].pos]);
+    }
+
+    free(b->keys);
+    free(b->values);
+    b->keys = keys;
+    b->values = values;
+    free(arrivals);
+    return 0;
+
+err:
+    free(keys);
+    free(arrivals);
+    return -1;
+}
+
+/* Empty the heap into a new list of (value, key) pairs, best first. */
+static PyObject *
+_topkList(Bucket *b, TopK *t)
+{
+    PyObject *r, *item, *o;
+    Py_ssize_t n = b->len, pos;
+
+    UNLESS (r = PyList_New(n))
+        return NULL;
+
+    while (n > 0)
+    {
+        pos = t->heap[0];
+        t->heap[0] = t->heap[--n];
+        if (n > 0 && _topkSiftDown(b, t, n, 0) < 0)
+            goto err;
+
+        UNLESS (item = PyTuple_New(2))
+            goto err;
+        PyList_SET_ITEM(r, n, item);
+        COPY_VALUE_TO_OBJECT(o, b->values[pos]);
+        UNLESS (o)
+            goto err;
+        PyTuple_SET_ITEM(item, 0, o);
+        COPY_KEY_TO_OBJECT(o, b->keys[pos]);
+        UNLESS (o)
+            goto err;
+        PyTuple_SET_ITEM(item, 1, o);
+    }
+
+    return r;
+
+err:
+    Py_DECREF(r);
+    return NULL;
+}
+
+/* Offer every item of self to the selection t kept in store.  Return -1
+ * on error, else 0.  The caller must have activated self.
+ */
+static int
+_bucket_topk(Bucket *self, Bucket *store, TopK *t)
+{
+    int i;
+
+    for (i = 0; i < self->len; i++)
+    {
+        if (store->len >= store->size && Bucket_grow(store, -1, 0) < 0)
+            return -1;
+        COPY_KEY(store->keys[store->len], self->keys[i]);
+        INCREF_KEY(store->keys[store->len]);
+        COPY_VALUE(store->values[store->len], self->values[i]);
+        INCREF_VALUE(store->values[store->len]);
+        store->len++;
+        if (_topkAdmit(store, t) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+/* nlargest(k) and nsmallest(k): the k items with the largest (smallest)
+ * values, as (value, key) pairs, best first.
+ */
+static PyObject *
+_bucket_nbest(Bucket *self, PyObject *args, int sign, char *format)
+{
+    Py_ssize_t k;
+    Bucket *store;
+    TopK t;
+    PyObject *r = NULL;
+
+    UNLESS (PyArg_ParseTuple(args, format, &k))
+        return NULL;
+    if (k <= 0)
+        return PyList_New(0);
+
+    PER_USE_OR_RETURN(self, NULL);
+    store = BUCKET(PyObject_CallObject(OBJECT(&BucketType), NULL));
+    if (store)
+    {
+        _topkInit(&t, k, sign);
+        if (_bucket_topk(self, store, &t) >= 0)
+            r = _topkList(store, &t);
+        _topkFini(&t);
+        Py_DECREF(store);
+    }
+    PER_UNUSE(self);
+
+    return r;
+}
+
+static PyObject *
+bucket_nlargest(Bucket *self, PyObject *args)
+{
+    return _bucket_nbest(self, args, 1, "n:nlargest");
+}
+
+static PyObject *
+bucket_nsmallest(Bucket *self, PyObject *args)
+{
+    return _bucket_nbest(self, args, -1, "n:nsmallest");
+}
+
 static PyObject *
 bucket_byValue(Bucket *self, PyObject *omin)
 {
@@ -1106,6 +1581,14 @@ _bucket_clear(Bucket *self)
         when neither key nor value is an object, i.e. II. */
     (void)len;
 
+    if (self->borrowed)
+    {
+        /* Only C numbers are borrowed, so there's nothing to DECREF. */
+        Py_CLEAR(self->borrowed);
+        self->keys = NULL;
+        self->values = NULL;
+    }
+
     if (self->keys)
     {
 #ifdef KEY_TYPE_IS_PYOBJECT
@@ -1166,6 +1649,7 @@ bucket__p_deactivate(Bucket *self, PyObject *args, PyObject *keywords)
             return NULL;
         }
         if (ghostify) {
+            _bucket_detach(self);
             if (_bucket_clear(self) < 0)
             return NULL;
             PER_GHOSTIFY(self);
@@ -1183,6 +1667,8 @@ bucket_clear(Bucket *self, PyObject *args)
 
     if (self->len)
     {
+        if (_bucket_check_exports(self) < 0)
+            goto err;
         if (_bucket_clear(self) < 0)
         return NULL;
         if (PER_CHANGED(self) < 0)
@@ -1219,7 +1705,138 @@ err:
  *                               keys[len-1], values[len-1]),
  *          <self->next iff non-NULL>
  *     )
+ *
+ * If self->packed is true and the keys and values are C numbers, the
+ * tuple of keys (and values) is replaced by a bytes object in the packed
+ * format described in BTreeModuleTemplate.c:
+ *
+ *     (
+ *          b'<header><keys[0] ... keys[len-1]><values[0] ... values[len-1]>',
+ *          <self->next iff non-NULL>
+ *     )
+ */
+#ifdef KEY_PACK_CODE
+static PyObject *
+_bucket_pack(Bucket *self, int noval)
+{
+    PyObject *result;
+    char *data;
+
+#ifdef VALUE_PACK_CODE
+    if (!noval)
+    {
+        result = _packed_new(self->len, VALUE_PACK_CODE, sizeof(VALUE_TYPE),
+                             &data);
+        if (result == NULL)
+            return NULL;
+        _packed_copy(data, (char *)self->keys, sizeof(KEY_TYPE), self->len);
+        _packed_copy(data + sizeof(KEY_TYPE) * self->len,
+                     (char *)self->values, sizeof(VALUE_TYPE), self->len);
+        return result;
+    }
+#endif
+    assert(noval);
+    result = _packed_new(self->len, 0, 0, &data);
+    if (result == NULL)
+        return NULL;
+    _packed_copy(data, (char *)self->keys, sizeof(KEY_TYPE), self->len);
+    return result;
+}
+
+/* Replace the contents of self with those of items, a bytes object in
+ * the packed format, and set self->next to next.  noval is true for a
+ * set.  Return 0 on success, -1 on error.
+ *
+ * On little-endian machines the keys and values are used where they are
+ * in items, if they're aligned for it, instead of being copied: a bucket
+ * that's only searched never needs arrays of its own.
  */
+static int
+_bucket_unpack(Bucket *self, PyObject *items, Bucket *next, int noval)
+{
+    char value_code = 0;
+    size_t value_size = 0;
+    const char *data;
+    Py_ssize_t len;
+    int i;
+
+#ifdef VALUE_PACK_CODE
+    if (!noval)
+    {
+        value_code = VALUE_PACK_CODE;
+        value_size = sizeof(VALUE_TYPE);
+    }
+#endif
+    len = _packed_count(items, value_code, value_size, &data);
+    if (len < 0)
+        return -1;
+
+    for (i = self->len; --i >= 0; )
+    {
+        DECREF_KEY(self->keys[i]);
+        if (!noval)
+        {
+            DECREF_VALUE(self->values[i]);
+        }
+    }
+    self->len = 0;
+    Py_CLEAR(self->next);
+
+#if PY_LITTLE_ENDIAN
+    if (len > 0
+        && (uintptr_t)data % sizeof(KEY_TYPE) == 0
+        && (!value_size
+            || (uintptr_t)(data + sizeof(KEY_TYPE) * len) % value_size == 0))
+    {
+        _bucket_clear(self);
+        self->keys = (KEY_TYPE *)data;
+        if (value_size)
+            self->values = (VALUE_TYPE *)(data + sizeof(KEY_TYPE) * len);
+        Py_INCREF(items);
+        self->borrowed = items;
+        self->size = len;
+        goto done;
+    }
+#endif
+
+    if (len > self->size)
+    {
+        KEY_TYPE *keys;
+        VALUE_TYPE *values;
+
+        keys = BTree_Realloc(self->keys, sizeof(KEY_TYPE) * len);
+        if (keys == NULL)
+            return -1;
+        self->keys = keys;
+        if (!noval)
+        {
+            values = BTree_Realloc(self->values, sizeof(VALUE_TYPE) * len);
+            if (values == NULL)
+                return -1;
+            self->values = values;
+        }
+        self->size = len;
+    }
+
+    _packed_copy((char *)self->keys, data, sizeof(KEY_TYPE), len);
+    if (value_size)
+        _packed_copy((char *)self->values, data + sizeof(KEY_TYPE) * len,
+                     value_size, len);
+#if PY_LITTLE_ENDIAN
+done:
+#endif
+    self->len = len;
+    self->packed = 1;
+
+    if (next)
+    {
+        self->next = next;
+        Py_INCREF(next);
+    }
+    return 0;
+}
+#endif
+
 static PyObject *
 bucket_getstate(Bucket *self)
 {
@@ -1230,6 +1847,23 @@ bucket_getstate(Bucket *self)
 
     len = self->len;
 
+#ifdef KEY_PACK_CODE
+    if (self->packed)
+    {
+        int noval = PyObject_TypeCheck(OBJECT(self), &SetType);
+#ifndef VALUE_PACK_CODE
+        /* Only sets can be packed; the values are objects. */
+        if (noval)
+#endif
+        {
+            items = _bucket_pack(self, noval);
+            if (items == NULL)
+                goto err;
+            goto done;
+        }
+    }
+#endif
+
     if (self->values) /* Bucket */
     {
         items = PyTuple_New(len * 2);
@@ -1262,6 +1896,9 @@ bucket_getstate(Bucket *self)
         }
     }
 
+#ifdef KEY_PACK_CODE
+done:
+#endif
     if (self->next)
         state = Py_BuildValue("OO", items, self->next);
     else
@@ -1288,6 +1925,16 @@ _bucket_setstate(Bucket *self, PyObject *state)
 
     if (!PyArg_ParseTuple(state, "O|O:__setstate__", &items, &next))
         return -1;
+    if (self->exported || self->borrowed)
+    {
+        _bucket_detach(self);
+        _bucket_clear(self);
+    }
+
+#if defined(KEY_PACK_CODE) && defined(VALUE_PACK_CODE)
+    if (PyBytes_Check(items))
+        return _bucket_unpack(self, items, next, 0);
+#endif
 
     if (!PyTuple_Check(items)) {
         PyErr_SetString(PyExc_TypeError,
@@ -1304,6 +1951,7 @@ _bucket_setstate(Bucket *self, PyObject *state)
         DECREF_VALUE(self->values[i]);
     }
     self->len = 0;
+    self->packed = 0;
 
     if (self->next) {
         Py_DECREF(self->next);
@@ -1367,21 +2015,21 @@ static PyObject *
 bucket_sub(PyObject *self, PyObject *other)
 {
     PyObject *args = Py_BuildValue("OO", self, other);
-    return difference_m(NULL, args);
+    return difference_m(NULL, args, NULL);
 }
 
 static PyObject *
 bucket_or(PyObject *self, PyObject *other)
 {
     PyObject *args = Py_BuildValue("OO", self, other);
-    return union_m(NULL, args);
+    return union_m(NULL, args, NULL);
 }
 
 static PyObject *
 bucket_and(PyObject *self, PyObject *other)
 {
     PyObject *args = Py_BuildValue("OO", self, other);
-    return intersection_m(NULL, args);
+    return intersection_m(NULL, args, NULL);
 }
 
 static PyObject *
@@ -1688,6 +2336,195 @@ bucket__p_resolveConflict(Bucket *self, PyObject *args)
 }
 #endif
 
+#if defined(KEY_PACK_CODE) || defined(VALUE_PACK_CODE)
+/* Buffers over a bucket's keys or values.
+ *
+ * keysBuffer() and valuesBuffer() return a memoryview over a BucketBuffer,
+ * which exports the bucket's C array as a read-only, one-dimensional
+ * buffer of its len items, in the struct module format of the packed
+ * state.  While any such buffer is exported, the bucket counts it in
+ * 'exports', and won't let its arrays be moved or freed:  growing or
+ * clearing it raises BufferError.  If the bucket is ghostified or loads a
+ * new state meanwhile, the buffers keep its old arrays, in a BucketArrays
+ * that frees them when the last buffer is released, and the bucket gets
+ * new ones.  Changes that fit in the arrays are seen through the buffer.
+ */
+typedef struct
+{
+    PyObject_HEAD
+    Bucket *bucket;
+    int values;             /* export the values rather than the keys */
+    Py_ssize_t shape;       /* the number of items in the last export */
+} BucketBuffer;
+
+static void
+BucketBuffer_dealloc(BucketBuffer *self)
+{
+    Py_DECREF(self->bucket);
+    PyObject_Del(self);
+}
+
+static int
+BucketBuffer_getbuffer(BucketBuffer *self, Py_buffer *view, int flags)
+{
+    Bucket *bucket = self->bucket;
+    static char key_format[] = {
+#ifdef KEY_PACK_CODE
+        KEY_PACK_CODE,
+#endif
+        0};
+    static char value_format[] = {
+#ifdef VALUE_PACK_CODE
+        VALUE_PACK_CODE,
+#endif
+        0};
+
+    view->obj = NULL;
+    if (flags & PyBUF_WRITABLE)
+    {
+        PyErr_SetString(PyExc_BufferError, "bucket buffers are read-only");
+        return -1;
+    }
+    UNLESS (PER_USE(bucket))
+        return -1;
+    if (bucket->exported == NULL)
+    {
+        bucket->exported = (PyObject *)PyObject_New(BucketArrays,
+                                                    &BucketArrays_Type);
+        if (bucket->exported == NULL)
+        {
+            PER_UNUSE(bucket);
+            return -1;
+        }
+        ((BucketArrays *)bucket->exported)->keys = NULL;
+        ((BucketArrays *)bucket->exported)->values = NULL;
+        ((BucketArrays *)bucket->exported)->borrowed = NULL;
+    }
+
+    self->shape = bucket->len;
+    if (self->values)
+    {
+        view->buf = bucket->values;
+        view->itemsize = sizeof(VALUE_TYPE);
+        view->format = value_format;
+    }
+    else
+    {
+        view->buf = bucket->keys;
+        view->itemsize = sizeof(KEY_TYPE);
+        view->format = key_format;
+    }
+    /* An empty bucket may have no arrays yet. */
+    if (view->buf == NULL)
+        view->buf = &self->shape;
+    view->len = self->shape * view->itemsize;
+    view->readonly = 1;
+    view->ndim = 1;
+    if (!(flags & PyBUF_FORMAT))
+        view->format = NULL;
+    view->shape = (flags & PyBUF_ND) ? &self->shape : NULL;
+    view->strides =
+        ((flags & PyBUF_STRIDES) == PyBUF_STRIDES) ? &view->itemsize : NULL;
+    view->suboffsets = NULL;
+    view->internal = bucket->exported;
+    Py_INCREF(bucket->exported);
+    view->obj = (PyObject *)self;
+    Py_INCREF(self);
+
+    bucket->exports++;
+    PER_UNUSE(bucket);
+    return 0;
+}
+
+static void
+BucketBuffer_releasebuffer(BucketBuffer *self, Py_buffer *view)
+{
+    Bucket *bucket = self->bucket;
+    PyObject *arrays = (PyObject *)view->internal;
+
+    /* Unless the bucket has let go of the arrays meanwhile, it's still
+     * counting this buffer.
+     */
+    if (arrays == bucket->exported && --bucket->exports == 0)
+        Py_CLEAR(bucket->exported);
+    Py_DECREF(arrays);
+}
+
+static PyBufferProcs BucketBuffer_as_buffer = {
+    (getbufferproc)BucketBuffer_getbuffer,         /* bf_getbuffer */
+    (releasebufferproc)BucketBuffer_releasebuffer, /* bf_releasebuffer */
+};
+
+static PyTypeObject BucketBuffer_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    MODULE_NAME MOD_NAME_PREFIX "BucketBuffer", /* tp_name */
+    sizeof(BucketBuffer),                       /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    /* methods */
+    (destructor)BucketBuffer_dealloc,           /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    &BucketBuffer_as_buffer,                    /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+};
+
+/* Return a memoryview over the keys or, if values is true, the values of
+ * self.
+ */
+static PyObject *
+_bucket_buffer(Bucket *self, int values)
+{
+    BucketBuffer *buffer;
+    PyObject *result;
+
+    buffer = PyObject_New(BucketBuffer, &BucketBuffer_Type);
+    if (buffer == NULL)
+        return NULL;
+    Py_INCREF(self);
+    buffer->bucket = self;
+    buffer->values = values;
+    buffer->shape = 0;
+    result = PyMemoryView_FromObject((PyObject *)buffer);
+    Py_DECREF(buffer);
+    return result;
+}
+#endif
+
+static PyObject *
+bucket_keysBuffer(Bucket *self, PyObject *unused)
+{
+#ifdef KEY_PACK_CODE
+    return _bucket_buffer(self, 0);
+#else
+    PyErr_SetString(PyExc_TypeError,
+                    "only keys that are C numbers can be read as a buffer");
+    return NULL;
+#endif
+}
+
+static PyObject *
+bucket_valuesBuffer(Bucket *self, PyObject *unused)
+{
+#ifdef VALUE_PACK_CODE
+    return _bucket_buffer(self, 1);
+#else
+    PyErr_SetString(PyExc_TypeError,
+                    "only values that are C numbers can be read as a buffer");
+    return NULL;
+#endif
+}
+
 /* Caution:  Even though the _next attribute is read-only, a program could
    do arbitrary damage to the btree internals.  For example, it could call
    clear() on a bucket inside a BTree.
@@ -1711,6 +2548,12 @@ static struct PyMethodDef Bucket_methods[] = {
     {"keys", (PyCFunction) bucket_keys, METH_VARARGS | METH_KEYWORDS,
      "keys([min, max]) -- Return the keys"},
 
+    {"keysBuffer", (PyCFunction) bucket_keysBuffer, METH_NOARGS,
+     "keysBuffer() -- Return a read-only memoryview over the keys"},
+
+    {"valuesBuffer", (PyCFunction) bucket_valuesBuffer, METH_NOARGS,
+     "valuesBuffer() -- Return a read-only memoryview over the values"},
+
     {"has_key", (PyCFunction) bucket_has_key, METH_O,
      "has_key(key) -- Test whether the bucket contains the given key"},
 
@@ -1738,6 +2581,14 @@ static struct PyMethodDef Bucket_methods[] = {
      "byValue(min) -- "
      "Return value-keys with values >= min and reverse sorted by values"},
 
+    {"nlargest", (PyCFunction) bucket_nlargest, METH_VARARGS,
+     "nlargest(k) -- "
+     "Return the k value-keys with the largest values, largest first"},
+
+    {"nsmallest", (PyCFunction) bucket_nsmallest, METH_VARARGS,
+     "nsmallest(k) -- "
+     "Return the k value-keys with the smallest values, smallest first"},
+
     {"get", (PyCFunction) bucket_getm, METH_VARARGS,
      "get(key[,default]) -- Look up a value\n\n"
      "Return the default (or None) if the key is not found."},
@@ -1866,6 +2717,7 @@ Done:
 static int
 bucket_tp_clear(Bucket *self)
 {
+    _bucket_detach(self);
     if (self->state != cPersistent_GHOST_STATE)
         _bucket_clear(self);
     return 0;
@@ -198,12 +198,200 @@ class ISet(ISetMutable, IKeySequence):
     A set of unique items stored in a single persistent object.
     """
 
+    def keysBuffer():
+        """Return a read-only :class:`memoryview` over the keys.
+
+        Only sets whose keys are C numbers (integers or floats) have one;
+        for others, :class:`TypeError` is raised.  The view's format is
+        the :mod:`struct` code of the key type, so it can be handed to
+        :class:`array.array` or ``numpy.frombuffer`` without building an
+        object per key.
+
+        In the C implementation, the view reads the set's own array.
+        Until it is released, the set can't grow or be cleared
+        (:class:`BufferError` is raised).  If the set is turned into a
+        ghost or has its state replaced meanwhile, the view keeps the old
+        keys.  A set still reading its keys from a packed state can't be
+        changed at all.  The Python implementation returns a view over a
+        copy.
+
+        .. versionadded:: 6.5.0
+        """
+
+
+class ITreeCursor(Interface):
+    """
+    A position between two entries of a BTree or TreeSet.
+
+    A cursor moves over the entries within the range it was made with,
+    from one bucket to the next in either direction in constant
+    amortized time. Iterating over a cursor calls :meth:`next`, or
+    :meth:`prev` if it was made with ``reverse=True``.
+
+    .. versionadded:: 6.5.0
+    """
+
+    def seek(key):
+        """Move to just before the first key not less than *key*.
+
+        *key* need not be in the tree. A *key* outside the cursor's range
+        moves it to the nearer end of the range.
+        """
+
+    def seekStart():
+        """Move to before the first entry in the cursor's range."""
+
+    def seekEnd():
+        """Move to after the last entry in the cursor's range."""
+
+    def next():
+        """Return the entry after the cursor and move past it.
+
+        Raise `StopIteration` if there is none in the cursor's range.
+        """
+
+    def prev():
+        """Return the entry before the cursor and move back past it.
+
+        Raise `StopIteration` if there is none in the cursor's range.
+        """
+
 
 class ITreeSet(ISetMutable):
     """
     A set of unique items stored in a tree of persistent objects.
     """
 
+    def containsMany(keys):
+        """Return a list of booleans telling whether each of *keys* is in
+        the tree, in the order given.
+
+        The keys are sorted (unless they already are) and looked up in a
+        single pass over the buckets, which is much faster than testing
+        them one at a time. Keys of the wrong type are reported as
+        missing.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def rank(key):
+        """Return the number of keys in the tree less than *key*.
+
+        *key* need not be in the tree.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def keyAt(index):
+        """Return the key at position *index* in sorted order.
+
+        Negative indexes count from the end; `IndexError` is raised if
+        *index* is out of range. In a tree whose class sets ``counted``
+        to a true value, this and :meth:`rank` take time proportional
+        to the depth of the tree; otherwise they may visit every bucket.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def deleteRange(min=None, max=None, excludemin=False, excludemax=False):
+        """Remove the keys that :meth:`keys` would return for the same
+        arguments.
+
+        Buckets and subtrees that lie wholly inside the range are
+        unlinked without being loaded, and only the (at most two)
+        buckets at the ends of the range are trimmed, so far fewer
+        objects are loaded and changed than by deleting the keys one at
+        a time.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def compact(target_fill=1.0):
+        """Merge runs of adjacent buckets whose keys fit in
+        ``target_fill * max_leaf_size``, and rebuild the interior nodes
+        with up to ``target_fill * max_internal_size`` children each.
+
+        This repacks a tree left sparse by deletions, which only remove
+        a bucket once it is empty. It is done in place: the tree object
+        and the buckets that absorb their neighbours are kept, and buckets
+        already too full to merge are left untouched. Nothing changes
+        unless that leaves fewer persistent objects (buckets and interior
+        nodes) than before, and nothing changes if an error occurs, such
+        as a bucket failing to load. Return the number of persistent
+        objects that went away.
+
+        *target_fill* must be greater than 0.0 and at most 1.0.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def count(min=None, max=None, excludemin=False, excludemax=False):
+        """Return the number of keys that :meth:`keys` would return for
+        the same arguments, without building them.
+
+        Only the (at most two) buckets at the ends of the range are
+        searched. In between, a tree whose class sets ``counted`` to a
+        true value uses the counts kept in its internal nodes; otherwise
+        the lengths of the buckets are added up.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def toArrays(min=None, max=None, excludemin=False, excludemax=False):
+        """Return ``(keys, None)``, where keys is an :class:`array.array`
+        of the keys that :meth:`keys` would return for the same arguments.
+
+        Only sets whose keys are C numbers (integers or floats) support
+        this; others raise :class:`TypeError`.  The array's typecode is
+        the :mod:`struct` code of the key type.  The C implementation
+        copies the keys a bucket at a time, without building an object
+        per key.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def cursor(min=None, max=None, excludemin=False, excludemax=False,
+               *, reverse=False):
+        """Return an :class:`ITreeCursor` over the keys that :meth:`keys`
+        would return for the same arguments.
+
+        The cursor starts before the first of them, or after the last if
+        *reverse* is true, in which case iterating over it goes from the
+        largest key down. ``iterkeys(..., reverse=True)`` and
+        ``reversed(tree)`` are built on this.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def fromSorted(keys, fill=1.0):
+        """Class method: build a new tree set from *keys*.
+
+        The keys must be in strictly ascending order, or `ValueError` is
+        raised. The tree is built bottom-up in a single pass: each bucket
+        is packed with ``fill * max_leaf_size`` keys and each interior
+        node with ``fill * max_internal_size`` children, so no node is
+        ever split. *fill* must be greater than 0.0 and at most 1.0; use
+        a smaller value to leave room for later inserts.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def fromBuffer(keys, sorted=False, fill=1.0):
+        """Class method: build a new tree set from the buffer *keys*.
+
+        *keys* is any C-contiguous buffer, such as an :class:`array.array`
+        or a NumPy array, of C numbers of the same kind (signed or
+        unsigned integers) and size as the key type, in native byte
+        order; others raise :class:`TypeError`, as do sets whose keys
+        aren't C numbers. Unless *sorted* is true, the keys are sorted
+        and duplicates dropped first; if it is, they must be in strictly
+        ascending order. The tree is then built as by :meth:`fromSorted`.
+        The C implementation copies the keys without building an object
+        per key, and radix-sorts them.
+
+        .. versionadded:: 6.5.0
+        """
+
 
 class IMinimalDictionary(IKeyed, IMapping):
     """
@@ -316,6 +504,26 @@ class IDictionaryIsh(IMinimalDictionary):
         integer values, the normalization is division.
         """
 
+    def nlargest(k):
+        """Return a list of the k (value, key) pairs with the largest values.
+
+        The list is sorted by value, largest first; equal values are listed
+        in key order.  This is ``byValue`` without the normalization, cut
+        down to k pairs, but the items are never all sorted: finding them
+        takes time proportional to ``len(self) * log(k)``.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def nsmallest(k):
+        """Return a list of the k (value, key) pairs with the smallest values.
+
+        The list is sorted by value, smallest first; equal values are
+        listed in key order.
+
+        .. versionadded:: 6.5.0
+        """
+
     def setdefault(key, d):
         """D.setdefault(k, d) -> D.get(k, d), also set D[k]=d if k not in D.
 
@@ -346,6 +554,27 @@ class IDictionaryIsh(IMinimalDictionary):
         """
 
 
+class IBucket(IMinimalDictionary):
+    """
+    A mapping stored in a single persistent object.
+
+    .. versionadded:: 6.5.0
+    """
+
+    def keysBuffer():
+        """Return a read-only :class:`memoryview` over the keys.
+
+        This is the same as :meth:`ISet.keysBuffer`.
+        """
+
+    def valuesBuffer():
+        """Return a read-only :class:`memoryview` over the values.
+
+        Only buckets whose values are C numbers have one, with the
+        same pinning as :meth:`keysBuffer`.
+        """
+
+
 class IBTree(IDictionaryIsh):
 
     def insert(key, value):
@@ -367,6 +596,144 @@ class IBTree(IDictionaryIsh):
               key=generate_key()
         """
 
+    def getMany(keys, default=None):
+        """Return a list of the values for *keys*, in the order given.
+
+        *default* stands in for each key that isn't in the tree. Like
+        :meth:`containsMany`, the lookups are done in a single sorted
+        pass over the buckets.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def containsMany(keys):
+        """Return a list of booleans telling whether each of *keys* is in
+        the tree, in the order given.
+
+        The keys are sorted (unless they already are) and looked up in a
+        single pass over the buckets, which is much faster than testing
+        them one at a time. Keys of the wrong type are reported as
+        missing.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def rank(key):
+        """Return the number of keys in the tree less than *key*.
+
+        *key* need not be in the tree.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def keyAt(index):
+        """Return the key at position *index* in sorted order.
+
+        Negative indexes count from the end; `IndexError` is raised if
+        *index* is out of range. In a tree whose class sets ``counted``
+        to a true value, this and :meth:`rank` take time proportional
+        to the depth of the tree; otherwise they may visit every bucket.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def deleteRange(min=None, max=None, excludemin=False, excludemax=False):
+        """Remove the keys that :meth:`keys` would return for the same
+        arguments.
+
+        Buckets and subtrees that lie wholly inside the range are
+        unlinked without being loaded, and only the (at most two)
+        buckets at the ends of the range are trimmed, so far fewer
+        objects are loaded and changed than by deleting the keys one at
+        a time.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def compact(target_fill=1.0):
+        """Merge runs of adjacent buckets whose items fit in
+        ``target_fill * max_leaf_size``, and rebuild the interior nodes
+        with up to ``target_fill * max_internal_size`` children each.
+
+        This repacks a tree left sparse by deletions, which only remove
+        a bucket once it is empty. It is done in place: the tree object
+        and the buckets that absorb their neighbours are kept, and buckets
+        already too full to merge are left untouched. Nothing changes
+        unless that leaves fewer persistent objects (buckets and interior
+        nodes) than before, and nothing changes if an error occurs, such
+        as a bucket failing to load. Return the number of persistent
+        objects that went away.
+
+        *target_fill* must be greater than 0.0 and at most 1.0.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def count(min=None, max=None, excludemin=False, excludemax=False):
+        """Return the number of keys that :meth:`keys` would return for
+        the same arguments, without building them.
+
+        Only the (at most two) buckets at the ends of the range are
+        searched. In between, a tree whose class sets ``counted`` to a
+        true value uses the counts kept in its internal nodes; otherwise
+        the lengths of the buckets are added up.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def toArrays(min=None, max=None, excludemin=False, excludemax=False):
+        """Return ``(keys, values)``, two :class:`array.array` objects
+        holding what :meth:`keys` and :meth:`values` would return for the
+        same arguments.
+
+        Only trees whose keys and values are C numbers support this;
+        others raise :class:`TypeError`.  See
+        :meth:`ITreeSet.toArrays`.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def cursor(min=None, max=None, excludemin=False, excludemax=False,
+               *, reverse=False):
+        """Return an :class:`ITreeCursor` over the ``(key, value)`` items
+        that :meth:`items` would return for the same arguments.
+
+        The cursor starts before the first of them, or after the last if
+        *reverse* is true, in which case iterating over it goes from the
+        largest key down. ``iterkeys``, ``itervalues`` and ``iteritems``
+        also accept ``reverse=True``, and ``reversed(tree)`` iterates over
+        the keys from the largest down; all of these are built on a
+        cursor.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def fromSorted(items, fill=1.0):
+        """Class method: build a new BTree from *items*.
+
+        *items* is a sequence of ``(key, value)`` pairs, or a mapping,
+        whose keys are in strictly ascending order; `ValueError` is
+        raised otherwise. The tree is built bottom-up in a single pass:
+        each bucket is packed with ``fill * max_leaf_size`` items and
+        each interior node with ``fill * max_internal_size`` children,
+        so no node is ever split. *fill* must be greater than 0.0 and at
+        most 1.0; use a smaller value to leave room for later inserts.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def fromArrays(keys, values, sorted=False, fill=1.0):
+        """Class method: build a new BTree from the buffers *keys* and
+        *values*, which must have the same length.
+
+        Each must hold C numbers of the key or value type; see
+        :meth:`ITreeSet.fromBuffer`. Unless *sorted* is true, the items
+        are sorted by key first, and the last value given for a key wins,
+        as with :meth:`update`.
+
+        .. versionadded:: 6.5.0
+        """
+
     def __and__(other):
         """Shortcut for :meth:`~BTrees.Interfaces.IMerge.intersection`"""
 
@@ -403,7 +770,8 @@ class IMerge(Interface):
     mapping (Bucket and BTree) types.
     """
 
-    def difference(c1, c2):
+    def difference(c1, c2, *, min=None, max=None,
+                   excludemin=False, excludemax=False):
         """Return the keys or items in c1 for which there is no key in c2.
 
         If c1 is None, then None is returned.  If c2 is None, then c1
@@ -415,11 +783,21 @@ class IMerge(Interface):
         While *c1* must be one of those types, *c2* can be any Python iterable
         returning the correct types of objects.
 
+        If min or max is given, only the keys of c1 and c2 in that range
+        are considered, as by ``keys(min, max, excludemin, excludemax)``;
+        excludemin and excludemax only apply to a bound that is given.
+        Trees are searched for the ends of the range, so their buckets
+        outside it are never loaded.  If c2 is None, c1 is then returned
+        as a new Set or Bucket holding just the part of it in the range.
+
         .. versionchanged:: 4.8.0
            Add support for *c2* to be an arbitrary iterable.
+        .. versionchanged:: 6.5.0
+           Add the *min*, *max*, *excludemin* and *excludemax* arguments.
         """
 
-    def union(c1, c2):
+    def union(c1, c2, *, min=None, max=None,
+              excludemin=False, excludemax=False):
         """Compute the Union of c1 and c2.
 
         If c1 is None, then c2 is returned, otherwise, if c2 is None,
@@ -431,11 +809,17 @@ class IMerge(Interface):
         *c1* and *c2* can be any Python iterables returning the
         correct type of objects.
 
+        The range arguments restrict both inputs as they do for
+        :meth:`difference`.
+
         .. versionchanged:: 4.8.0
            Add support for arbitrary iterables.
+        .. versionchanged:: 6.5.0
+           Add the *min*, *max*, *excludemin* and *excludemax* arguments.
         """
 
-    def intersection(c1, c2):
+    def intersection(c1, c2, *, min=None, max=None,
+                     excludemin=False, excludemax=False):
         """Compute the intersection of c1 and c2.
 
         If c1 is None, then c2 is returned, otherwise, if c2 is None,
@@ -447,8 +831,80 @@ class IMerge(Interface):
         *c1* and *c2* can be any Python iterables returning the
         correct type of objects.
 
+        The range arguments restrict both inputs as they do for
+        :meth:`difference`.
+
         .. versionchanged:: 4.8.0
            Add support for arbitrary iterables.
+        .. versionchanged:: 6.5.0
+           Add the *min*, *max*, *excludemin* and *excludemax* arguments.
+        """
+
+    def differenceSize(c1, c2, limit=None):
+        """Return the number of keys in ``difference(c1, c2)``.
+
+        None arguments are treated as :meth:`difference` treats them, so
+        the result is 0 if c1 is None.  The keys are counted as the inputs
+        are merged, without building the difference.  If limit is not
+        None, counting stops once it reaches limit, and
+        ``min(len(difference(c1, c2)), limit)`` is returned.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def unionSize(c1, c2, limit=None):
+        """Return the number of keys in ``union(c1, c2)``.
+
+        The result is 0 if c1 and c2 are both None.  Otherwise this is
+        like :meth:`differenceSize`, but for :meth:`union`.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def intersectionSize(c1, c2, limit=None):
+        """Return the number of keys in ``intersection(c1, c2)``.
+
+        The result is 0 if c1 and c2 are both None.  Otherwise this is
+        like :meth:`differenceSize`, but for :meth:`intersection`.  As
+        with :meth:`intersection`, the larger input is skipped through
+        rather than stepped through when the inputs differ much in size,
+        and a small limit ends the merge early.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def iunion(c1, c2, *, min=None, max=None,
+               excludemin=False, excludemax=False):
+        """Return an iterator over the keys of ``union(c1, c2, ...)``.
+
+        The inputs are merged lazily, as the iterator is advanced, so
+        stopping early (say, after the first page of results) leaves the
+        rest of them unvisited, and the buckets holding it unloaded.
+        Arguments are handled as by :meth:`union`; arbitrary iterables
+        are sorted when the iterator is created.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def iintersection(c1, c2, *, min=None, max=None,
+                      excludemin=False, excludemax=False):
+        """Return an iterator over the keys of ``intersection(c1, c2, ...)``.
+
+        Like :meth:`iunion`, but for :meth:`intersection`.  The larger
+        input is skipped through, as by :meth:`intersection`.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def idifference(c1, c2, *, min=None, max=None,
+                    excludemin=False, excludemax=False):
+        """Return an iterator over the keys of ``difference(c1, c2, ...)``.
+
+        Like :meth:`iunion`, but for :meth:`difference`.  The iterator
+        produces only keys, even if c1 is a mapping; it is empty if c1
+        is None.
+
+        .. versionadded:: 6.5.0
         """
 
 
@@ -492,7 +948,8 @@ class IIMerge(IMerge):
     scored keys, using integer scores.
     """
 
-    def weightedUnion(c1, c2, weight1=1, weight2=1):
+    def weightedUnion(c1, c2, weight1=1, weight2=1, *, topk=None,
+                      min=None, max=None, excludemin=False, excludemax=False):
         """Compute the weighted union of c1 and c2.
 
         If c1 and c2 are None, the output is (0, None).
@@ -522,9 +979,24 @@ class IIMerge(IMerge):
                   c2[key]  if the key is in c2 and c2 is a mapping
 
         Note that c1 and c2 must be collections.
+
+        If topk is given, and the output is a Bucket, only the topk items
+        with the largest values are kept (ties going to the smaller keys),
+        still in key order.  They are selected as the items are produced,
+        so at most topk + 1 of them are held at once.  topk does not apply
+        when c1 or c2 is None.
+
+        The range arguments restrict both inputs as they do for
+        :meth:`IMerge.difference`.
+
+        .. versionchanged:: 6.5.0
+           Add the *topk*, *min*, *max*, *excludemin* and *excludemax*
+           arguments.
         """
 
-    def weightedIntersection(c1, c2, weight1=1, weight2=1):
+    def weightedIntersection(c1, c2, weight1=1, weight2=1, *, topk=None,
+                             min=None, max=None,
+                             excludemin=False, excludemax=False):
         """Compute the weighted intersection of c1 and c2.
 
         If c1 and c2 are None, the output is (0, None).
@@ -552,6 +1024,40 @@ class IIMerge(IMerge):
                   c2[key]  if c2 is a mapping
 
         Note that c1 and c2 must be collections.
+
+        If topk is given, and the output is a Bucket, only the topk items
+        with the largest values are kept (ties going to the smaller keys),
+        still in key order.  They are selected as the items are produced,
+        so at most topk + 1 of them are held at once.  topk does not apply
+        when c1 or c2 is None.
+
+        The range arguments restrict both inputs as they do for
+        :meth:`IMerge.difference`.
+
+        .. versionchanged:: 6.5.0
+           Add the *topk*, *min*, *max*, *excludemin* and *excludemax*
+           arguments.
+        """
+
+    def multiWeightedUnion(pairs, *, topk=None):
+        """Compute the weighted union of many collections at once.
+
+        pairs is a sequence of ``(c, weight)`` tuples; ``(c,)`` means a
+        weight of 1, and pairs whose c is None are ignored.  The output
+        is a Bucket whose keys are the union of all the c's keys, and
+        whose values are the sum of ``v*weight`` over the pairs whose c
+        holds the key, where v is 1 if c is a set and ``c[key]`` if c is
+        a mapping.
+
+        This is the Bucket that chaining :meth:`weightedUnion` through
+        the pairs would produce (even if every c is a set), but all the
+        inputs are merged in a single pass and no intermediate Buckets
+        are built.
+
+        If topk is given, only the topk items with the largest values are
+        kept, as with :meth:`weightedUnion`.
+
+        .. versionadded:: 6.5.0
         """
 
 
@@ -562,7 +1068,7 @@ class IMergeIntegerKey(IMerge):
     :class:`~BTrees.IIBTree.IIBTree`.
     """
 
-    def multiunion(seq):
+    def multiunion(seq, *, threads=None):
         """Return union of (zero or more) integer sets, as an integer set.
 
         seq is a sequence of objects each convertible to an integer set.
@@ -593,8 +1099,71 @@ class IMergeIntegerKey(IMerge):
         single linear-time radix sort, then duplicates are removed in a second
         linear-time pass.
 
+        If *threads* is greater than 1, a very large union is sorted on up
+        to that many native threads: the integers are split into ranges of
+        values, and each range is sorted and deduplicated on its own
+        thread. Inputs too small to gain from that are sorted on the
+        calling thread, as they are by default.
+
         .. versionchanged:: 4.8.0
            Add support for arbitrary iterables of integers.
+        .. versionchanged:: 6.5.0
+           Add the *threads* argument.
+        """
+
+    def multiunionSize(seq, limit=None):
+        """Return the number of keys in ``multiunion(seq)``.
+
+        No result set is returned.  If limit is not None, the result is
+        no more than limit, and if one of the inputs is a Set or Bucket
+        that holds at least limit keys, limit is returned without looking
+        at the others.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def multiintersection(seq):
+        """Return intersection of (zero or more) integer sets, as an
+        integer set.
+
+        seq is a sequence of objects each convertible to an integer set,
+        exactly as for :meth:`multiunion`.  The intersection is returned
+        as a Set from the same module; if seq is empty, so is the result.
+
+        The point to this method is that it can run much faster than
+        doing a sequence of two-input
+        :meth:`~BTrees.Interfaces.IMerge.intersection` calls.  No
+        intermediate results are built.  The smallest input proposes
+        candidate keys, and the other inputs, smallest first, skip ahead
+        to each candidate, galloping within buckets and descending from
+        the root of BTrees and TreeSets to pass over whole buckets.  The
+        work stops as soon as any input is exhausted.
+
+        .. versionadded:: 6.5.0
+        """
+
+    def thresholdUnion(seq, k, counts=False):
+        """Return the keys found in at least k of (zero or more) integer
+        sets.
+
+        seq is a sequence of objects each convertible to an integer set,
+        exactly as for :meth:`multiunion`; a key repeated within one of
+        them is only counted once.  k must be at least 1; with k equal to
+        1 this is :meth:`multiunion`, and with k equal to ``len(seq)`` it
+        is :meth:`multiintersection`.
+
+        The keys are returned as a Set from the same module.  If counts
+        is true, they are instead returned as a Bucket from the same
+        module, mapping each key to the number of inputs it was found in
+        (for example, :meth:`BTrees.IIBTree.thresholdUnion` returns an
+        :class:`BTrees.IIBTree.IIBucket`).
+
+        Like :meth:`multiunion`, all the keys are gathered and radix
+        sorted at once, and the counts are taken in a single linear pass,
+        which is much faster than a chain of
+        :meth:`~BTrees.Interfaces.IIMerge.weightedUnion` calls.
+
+        .. versionadded:: 6.5.0
         """
 
 
@@ -116,6 +116,8 @@ bucket_merge(Bucket *s1, Bucket *s2, Bucket *s3)
     r = (Bucket *)PyObject_CallObject((PyObject *)&SetType, NULL);
   if (r == NULL)
     goto err;
+  /* Keep the packed state format if either side wrote it. */
+  r->packed = s2->packed || s3->packed;
 
   if (i1.next(&i1) < 0)
     goto err;
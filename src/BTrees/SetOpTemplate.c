@@ -74,6 +74,212 @@ static int nextGenericKeyIter(SetIteration* i)
     return 0;
 }
 
+/* Return the offset of the first key >= key in b->keys[lo:], b->len if
+ * there is none, or -1 on error.  Probes lo, lo+1, lo+3, lo+7, ... until
+ * one is >= key and then binary-searches the last gap, so the cost grows
+ * with the log of the distance moved rather than the size of the bucket.
+ * The caller must have activated b.
+ */
+static int
+_bucket_gallop(Bucket *b, int lo, KEY_TYPE key)
+{
+    int hi = lo, step = 1, mid, cmp;
+
+    while (hi < b->len)
+    {
+        TEST_KEY_SET_OR(cmp, b->keys[hi], key) return -1;
+        if (cmp >= 0)
+            break;
+        lo = hi + 1;
+        hi += step;
+        step <<= 1;
+    }
+    if (hi > b->len)
+        hi = b->len;
+    /* keys[lo-1] < key, and keys[hi] >= key unless hi == len. */
+    while (lo < hi)
+    {
+        mid = lo + (hi - lo) / 2;
+        TEST_KEY_SET_OR(cmp, b->keys[mid], key) return -1;
+        if (cmp < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    return lo;
+}
+
+/* skip() for buckets and sets, where i->position is the offset just past
+ * the current key.
+ */
+static int
+skipBucket(SetIteration *i, KEY_TYPE key)
+{
+    Bucket *b = BUCKET(i->set);
+    int offset;
+
+    assert(i->position > 0);
+    UNLESS(PER_USE(b))
+        return -1;
+
+    offset = _bucket_gallop(b, i->position, key);
+    if (offset >= 0)
+    {
+        DECREF_KEY(i->key);
+        if (i->usesValue)
+        {
+            DECREF_VALUE(i->value);
+        }
+        if (offset < b->len)
+        {
+            COPY_KEY(i->key, b->keys[offset]);
+            INCREF_KEY(i->key);
+            if (i->usesValue)
+            {
+                COPY_VALUE(i->value, b->values[offset]);
+                INCREF_VALUE(i->value);
+            }
+            i->position = offset + 1;
+        }
+        else
+            i->position = -1;
+    }
+
+    PER_UNUSE(b);
+    return offset < 0 ? -1 : 0;
+}
+
+/* skip() for BTrees and TreeSets, where i->set is a BTreeItems over the
+ * tree, or a range of it, with its search finger on the current key.
+ * Keys in the current bucket or the next one are galloped to; anything
+ * further away is found by descending from the root of i->tree, so the
+ * buckets in between are never loaded.
+ */
+static int
+skipTreeItems(SetIteration *i, KEY_TYPE key)
+{
+    BTreeItems *items = ITEMS(i->set);
+    Bucket *b = items->lastbucket;
+    Bucket *next;
+    int offset, found, cmp;
+
+    assert(i->position > 0);
+    /* Nothing past the end of the range can be found, and the descent
+     * from the root must not land beyond it.
+     */
+    UNLESS(PER_USE(b))
+        return -1;
+    TEST_KEY_SET_OR(cmp, b->keys[items->last], key)
+    {
+        PER_UNUSE(b);
+        return -1;
+    }
+    PER_UNUSE(b);
+    if (cmp < 0)
+        goto exhausted;
+
+    b = items->currentbucket;
+    UNLESS(PER_USE(b))
+        return -1;
+    offset = _bucket_gallop(b, items->currentoffset + 1, key);
+    next = b == items->lastbucket ? NULL : b->next;
+    PER_UNUSE(b);
+    if (offset < 0)
+        return -1;
+
+    found = offset < b->len;
+    if (found)
+        Py_INCREF(b);
+    else if (next)
+    {
+        b = next;
+        UNLESS(PER_USE(b))
+            return -1;
+        cmp = -1;
+        if (b->len)
+        {
+            TEST_KEY_SET_OR(cmp, b->keys[b->len - 1], key)
+            {
+                PER_UNUSE(b);
+                return -1;
+            }
+        }
+        if (cmp >= 0)
+        {
+            offset = _bucket_gallop(b, 0, key);
+            found = offset >= 0;
+        }
+        PER_UNUSE(b);
+        if (offset < 0)
+            return -1;
+        if (found)
+            Py_INCREF(b);
+        else
+        {
+            /* Further away than the next bucket:  descend from the root
+             * instead of walking the bucket chain.
+             */
+            PyObject *keyobj;
+            BTree *tree = BTREE(i->tree);
+
+            COPY_KEY_TO_OBJECT(keyobj, key);
+            UNLESS(keyobj)
+                return -1;
+            UNLESS(PER_USE(tree))
+            {
+                Py_DECREF(keyobj);
+                return -1;
+            }
+            found = BTree_findRangeEnd(tree, keyobj, 1, 0, &b, &offset);
+            PER_UNUSE(tree);
+            Py_DECREF(keyobj);
+            if (found < 0)
+                return -1;
+        }
+    }
+    if (found && b == items->lastbucket && offset > items->last)
+    {
+        Py_DECREF(b);
+        found = 0;
+    }
+
+    if (found)
+    {
+        UNLESS(PER_USE(b))
+        {
+            Py_DECREF(b);
+            return -1;
+        }
+        DECREF_KEY(i->key);
+        COPY_KEY(i->key, b->keys[offset]);
+        INCREF_KEY(i->key);
+        if (i->usesValue)
+        {
+            DECREF_VALUE(i->value);
+            COPY_VALUE(i->value, b->values[offset]);
+            INCREF_VALUE(i->value);
+        }
+        PER_UNUSE(b);
+
+        Py_DECREF(items->currentbucket);
+        items->currentbucket = b;
+        items->currentoffset = offset;
+        items->pseudoindex = i->position++;
+        /* The finger no longer knows its position in a counted tree. */
+        Py_CLEAR(items->tree);
+        return 0;
+    }
+
+exhausted:
+    DECREF_KEY(i->key);
+    if (i->usesValue)
+    {
+        DECREF_VALUE(i->value);
+    }
+    i->position = -1;
+    return 0;
+}
+
 /* initSetIteration
  *
  * Start the set iteration protocol.  See the comments at struct SetIteration.
@@ -93,6 +299,8 @@ static int nextGenericKeyIter(SetIteration* i)
  *          iterate over s.
  *      i.position is set to 0.
  *      i.next is set to an appropriate iteration function.
+ *      i.skip is set to an appropriate skip function, or NULL if s
+ *          can't skip, and i.tree to s if s is a BTree or TreeSet.
  *      i.key and i.value are left alone.
  *
  * Internal
@@ -115,6 +323,8 @@ initSetIteration(SetIteration *i, PyObject *s, int useValues)
   i->set = NULL;
   i->position = -1;     /* set to 0 only on normal return */
   i->usesValue = 0;     /* assume it's a set or that values aren't iterated */
+  i->skip = NULL;
+  i->tree = NULL;
 
   if (PyObject_IsInstance(s, (PyObject *)&BucketType))
     {
@@ -128,12 +338,14 @@ initSetIteration(SetIteration *i, PyObject *s, int useValues)
         }
       else
         i->next = nextSet;
+      i->skip = skipBucket;
     }
   else if (PyObject_IsInstance(s, (PyObject *)&SetType))
     {
       i->set = s;
       Py_INCREF(s);
       i->next = nextSet;
+      i->skip = skipBucket;
     }
   else if (PyObject_IsInstance(s, (PyObject *)&BTreeType))
     {
@@ -147,12 +359,18 @@ initSetIteration(SetIteration *i, PyObject *s, int useValues)
         }
       else
         i->next = nextTreeSetItems;
+      i->skip = skipTreeItems;
+      i->tree = s;
+      Py_INCREF(s);
     }
   else if (PyObject_IsInstance(s, (PyObject *)&TreeSetType))
     {
       i->set = BTree_rangeSearch(BTREE(s), NULL, NULL, 'k');
       UNLESS(i->set) return -1;
       i->next = nextTreeSetItems;
+      i->skip = skipTreeItems;
+      i->tree = s;
+      Py_INCREF(s);
     }
 #ifdef KEY_CHECK
   else if (KEY_CHECK(s))
@@ -198,6 +416,93 @@ initSetIteration(SetIteration *i, PyObject *s, int useValues)
   return 0;
 }
 
+/* initSetIterationRange
+ *
+ * Like initSetIteration(), but only iterate over the keys of s in the
+ * range described by the args tuple and keywords dict range and rangekw,
+ * as taken by keys().  If range is NULL, iterate over all of s.
+ *
+ * BTrees and TreeSets are seeded through BTree_rangeSearch(), so buckets
+ * outside the range are never loaded; Buckets and Sets get a BTreeItems
+ * over the slice of them in range.  Other iterables are first made into
+ * a Set.
+ */
+static int
+initSetIterationRange(SetIteration *i, PyObject *s, int useValues,
+                      PyObject *range, PyObject *rangekw)
+{
+  char kind;
+
+  if (range == NULL)
+    return initSetIteration(i, s, useValues);
+
+  i->set = NULL;
+  i->position = -1;
+  i->usesValue = 0;
+  i->skip = NULL;
+  i->tree = NULL;
+
+  if (PyObject_IsInstance(s, (PyObject *)&BucketType)
+      || PyObject_IsInstance(s, (PyObject *)&SetType))
+    {
+      Bucket *b = BUCKET(s);
+      int low, high, rc;
+
+      kind = 'k';
+      if (useValues && PyObject_IsInstance(s, (PyObject *)&BucketType))
+        {
+          kind = 'i';
+          i->usesValue = 1;
+        }
+      UNLESS(PER_USE(b)) return -1;
+      rc = Bucket_rangeSearch(b, range, rangekw, &low, &high);
+      PER_UNUSE(b);
+      if (rc < 0) return -1;
+      i->set = newBTreeItems(kind, low <= high ? b : NULL, low, b, high);
+      UNLESS(i->set) return -1;
+    }
+  else if (PyObject_IsInstance(s, (PyObject *)&BTreeType)
+           || PyObject_IsInstance(s, (PyObject *)&TreeSetType))
+    {
+      kind = 'k';
+      if (useValues && PyObject_IsInstance(s, (PyObject *)&BTreeType))
+        {
+          kind = 'i';
+          i->usesValue = 1;
+        }
+      i->set = BTree_rangeSearch(BTREE(s), range, rangekw, kind);
+      UNLESS(i->set) return -1;
+      i->tree = s;
+      Py_INCREF(s);
+    }
+  else if (!useValues)
+    {
+      int rc;
+
+#ifdef KEY_CHECK
+      if (KEY_CHECK(s))
+        s = PyObject_CallFunction(OBJECT(&SetType), "((O))", s);
+      else
+#endif
+        s = PyObject_CallFunctionObjArgs(OBJECT(&SetType), s, NULL);
+      UNLESS(s) return -1;
+      rc = initSetIterationRange(i, s, 0, range, rangekw);
+      Py_DECREF(s);
+      return rc;
+    }
+  else
+    {
+      PyErr_SetString(PyExc_TypeError, "set operation: invalid argument, cannot iterate");
+      return -1;
+    }
+
+  i->next = i->usesValue ? nextBTreeItems : nextTreeSetItems;
+  i->skip = skipTreeItems;
+  i->position = 0;
+
+  return 0;
+}
+
 #ifndef MERGE_WEIGHT
 #define MERGE_WEIGHT(O, w) (O)
 #endif
@@ -207,10 +512,11 @@ copyRemaining(Bucket *r, SetIteration *i, int merge,
 
               /* See comment # 42 */
 #ifdef MERGE
-              VALUE_TYPE w)
+              VALUE_TYPE w,
 #else
-  int w)
+  int w,
 #endif
+              TopK *top)
 {
   while (i->position >= 0)
     {
@@ -224,12 +530,348 @@ copyRemaining(Bucket *r, SetIteration *i, int merge,
           INCREF_VALUE(r->values[r->len]);
         }
       r->len++;
+      if (top && _topkAdmit(r, top) < 0) return -1;
+      if (i->next(i) < 0) return -1;
+    }
+
+  return 0;
+}
+
+/* Step i through its remaining keys, adding them to *count until it
+ * reaches limit (if limit isn't negative).  Return -1 on error, else 0.
+ */
+static int
+countRemaining(SetIteration *i, Py_ssize_t *count, Py_ssize_t limit)
+{
+  while (i->position >= 0 && (limit < 0 || *count < limit))
+    {
+      ++*count;
       if (i->next(i) < 0) return -1;
     }
 
   return 0;
 }
 
+/* Once one input of set_operation() has been behind the other this many
+ * times in a row, and its keys aren't wanted in the output, it stops
+ * stepping through them and skips ahead with skip().  This is what makes
+ * intersecting a small set with a huge one cost time proportional to the
+ * small one, while evenly interleaved inputs still just merge.
+ */
+#define MIN_GALLOP 8
+
+/* The less common options of set_operation().  Passing NULL instead
+ * means the defaults:  keep every key, build the output, and merge the
+ * whole of both inputs.
+ */
+typedef struct {
+  Py_ssize_t topk;      /* if positive, keep only the topk best items */
+  int countonly;        /* if true, only count the keys, up to limit */
+  Py_ssize_t limit;     /* negative for no limit */
+  PyObject *range;      /* if not NULL, the args and keywords of a range */
+  PyObject *rangekw;    /* search restricting both inputs */
+} SetOpOptions;
+
+static const SetOpOptions defaultSetOpOptions = {0, 0, -1, NULL, NULL};
+
+#ifndef KEY_TYPE_IS_PYOBJECT
+/* Merging without the GIL.
+ *
+ * When the keys are C values and the output needs no values, the merge
+ * can run on plain arrays of keys, without touching a Python object, so
+ * that other threads run meanwhile.  The keys of each input are copied
+ * out first, with the GIL held:  that's a memcpy per bucket, cheap next
+ * to the merge, and the copies can't be changed by another thread while
+ * the merge reads them.  Only inputs whose buckets are all in memory are
+ * copied; a tree with ghost buckets is merged the usual way, since
+ * skipping through it may avoid loading most of them.  So is an input
+ * that would be skipped through because it is much larger than the other.
+ */
+
+/* Below this many keys in all, the GIL isn't worth releasing. */
+#define NOGIL_MIN_KEYS 10000
+
+/* Count the keys of s in *len or, if keys isn't NULL, copy them into
+ * keys, which has room for *len of them.  When only counting, stop at the
+ * first bucket that takes the count past *len, unless *len is negative.
+ * Return 1 if done, 0 if s isn't a Bucket, Set, BTree or TreeSet whose
+ * buckets are all in memory, or -1 on error.
+ */
+static int
+_keyArray(PyObject *s, KEY_TYPE *keys, Py_ssize_t *len)
+{
+  Bucket *b, *first = NULL;
+  BTree *tree = NULL;
+  Py_ssize_t n = 0, bound = keys ? -1 : *len;
+  int rc = 1;
+
+  if (PyObject_IsInstance(s, (PyObject *)&BucketType) ||
+      PyObject_IsInstance(s, (PyObject *)&SetType))
+    {
+      b = first = BUCKET(s);
+      UNLESS(PER_USE(b)) return -1;
+    }
+  else if (PyObject_IsInstance(s, (PyObject *)&BTreeType) ||
+           PyObject_IsInstance(s, (PyObject *)&TreeSetType))
+    {
+      tree = BTREE(s);
+      UNLESS(PER_USE(tree)) return -1;
+      first = tree->firstbucket;
+    }
+  else
+    return PyErr_Occurred() ? -1 : 0;
+
+  for (b = first; b != NULL; b = tree ? b->next : NULL)
+    {
+      if (bound >= 0 && n > bound)
+        break;
+      if (b->state == cPersistent_GHOST_STATE)
+        {
+          rc = 0;
+          break;
+        }
+      if (keys != NULL && b->len)
+        {
+          assert(n + b->len <= *len);
+          memcpy(keys + n, b->keys, sizeof(KEY_TYPE) * b->len);
+        }
+      n += b->len;
+    }
+
+  if (tree)
+    PER_UNUSE(tree);
+  else
+    PER_UNUSE(first);
+  *len = n;
+  return rc;
+}
+
+/* Return the offset of the first key >= key in keys[lo:n], or n if there
+ * is none, galloping as _bucket_gallop() does.
+ */
+static Py_ssize_t
+_gallopKeys(KEY_TYPE *keys, Py_ssize_t lo, Py_ssize_t n, KEY_TYPE key)
+{
+  Py_ssize_t hi = lo, step = 1, mid;
+  int cmp;
+
+  /* Comparing C keys can't fail, so there is nothing to do on error. */
+  while (hi < n)
+    {
+      TEST_KEY_SET_OR(cmp, keys[hi], key) {}
+      if (cmp >= 0)
+        break;
+      lo = hi + 1;
+      hi += step;
+      step <<= 1;
+    }
+  if (hi > n)
+    hi = n;
+  while (lo < hi)
+    {
+      mid = lo + (hi - lo) / 2;
+      TEST_KEY_SET_OR(cmp, keys[mid], key) {}
+      if (cmp < 0)
+        lo = mid + 1;
+      else
+        hi = mid;
+    }
+  return lo;
+}
+
+/* Merge the sorted keys k1[:n1] and k2[:n2] as set_operation() does,
+ * into out, or, if out is NULL, only count the keys that would be output,
+ * stopping at limit unless it is negative.  Return the number of keys.
+ * This doesn't need the GIL.
+ */
+static Py_ssize_t
+_mergeKeys(KEY_TYPE *k1, Py_ssize_t n1, KEY_TYPE *k2, Py_ssize_t n2,
+           int c1, int c12, int c2, KEY_TYPE *out, Py_ssize_t limit)
+{
+  Py_ssize_t i1 = 0, i2 = 0, n = 0;
+  int cmp, run1 = 0, run2 = 0;
+
+  if (out)
+    limit = -1;
+  while (i1 < n1 && i2 < n2 && (limit < 0 || n < limit))
+    {
+      TEST_KEY_SET_OR(cmp, k1[i1], k2[i2]) {}
+      if (cmp < 0)
+        {
+          run2 = 0;
+          if (c1)
+            {
+              if (out)
+                COPY_KEY(out[n], k1[i1]);
+              n++;
+              i1++;
+            }
+          else if (++run1 >= MIN_GALLOP)
+            i1 = _gallopKeys(k1, i1 + 1, n1, k2[i2]);
+          else
+            i1++;
+        }
+      else if (cmp == 0)
+        {
+          run1 = run2 = 0;
+          if (c12)
+            {
+              if (out)
+                COPY_KEY(out[n], k1[i1]);
+              n++;
+            }
+          i1++;
+          i2++;
+        }
+      else
+        {
+          run1 = 0;
+          if (c2)
+            {
+              if (out)
+                COPY_KEY(out[n], k2[i2]);
+              n++;
+              i2++;
+            }
+          else if (++run2 >= MIN_GALLOP)
+            i2 = _gallopKeys(k2, i2 + 1, n2, k1[i1]);
+          else
+            i2++;
+        }
+    }
+  if (c1 && i1 < n1)
+    {
+      if (out)
+        memcpy(out + n, k1 + i1, sizeof(KEY_TYPE) * (n1 - i1));
+      n += n1 - i1;
+    }
+  if (c2 && i2 < n2)
+    {
+      if (out)
+        memcpy(out + n, k2 + i2, sizeof(KEY_TYPE) * (n2 - i2));
+      n += n2 - i2;
+    }
+  if (limit >= 0 && n > limit)
+    n = limit;
+  return n;
+}
+
+/* Return 1 if s is a mapping whose values set_operation() would use. */
+static int
+_usesValues(PyObject *s, int useValues)
+{
+  return useValues && (PyObject_IsInstance(s, (PyObject *)&BucketType) ||
+                       PyObject_IsInstance(s, (PyObject *)&BTreeType));
+}
+
+/* Do what set_operation() would, by merging arrays of the keys of s1 and
+ * s2 with the GIL released.  Return 1 and set *result, 0 if that can't be
+ * done (see above), or -1 on error.
+ */
+static int
+_setOperationNoGIL(PyObject *s1, PyObject *s2, int usevalues1,
+                   int usevalues2, int c1, int c12, int c2,
+                   int countonly, Py_ssize_t limit, PyObject **result)
+{
+  KEY_TYPE *k1 = NULL, *k2 = NULL, *out = NULL;
+  Py_ssize_t n1, n2, room, n;
+  Py_ssize_t bound = c1 && c2 ? -1 : NOGIL_MIN_KEYS;
+  Bucket *r = NULL;
+  int rc;
+
+  if (_usesValues(s1, usevalues1) || _usesValues(s2, usevalues2))
+    return PyErr_Occurred() ? -1 : 0;
+
+  /* A small input against a huge one is better galloped through by
+   * set_operation(), so find that out without walking all of the huge
+   * one:  count both up to a bound that grows until one of them is
+   * counted in full, then the other only as far as that decides it.
+   */
+  for (;;)
+    {
+      n1 = n2 = bound;
+      if ((rc = _keyArray(s1, NULL, &n1)) <= 0 ||
+          (rc = _keyArray(s2, NULL, &n2)) <= 0)
+        return rc;
+      if (bound < 0 || n1 <= bound || n2 <= bound)
+        break;
+      bound = bound > PY_SSIZE_T_MAX / 1024 ? -1 : bound * 32;
+    }
+  if (bound >= 0 && n1 > bound)
+    {
+      n1 = c1 ? -1 : n2 * 32 + 31;
+      if ((rc = _keyArray(s1, NULL, &n1)) <= 0)
+        return rc;
+    }
+  else if (bound >= 0 && n2 > bound)
+    {
+      n2 = c2 ? -1 : n1 * 32 + 31;
+      if ((rc = _keyArray(s2, NULL, &n2)) <= 0)
+        return rc;
+    }
+  if ((! c1 && n1 / 32 > n2) || (! c2 && n2 / 32 > n1))
+    return 0;
+
+  room = 0;
+  if (! countonly)
+    {
+      room = (c1 ? n1 : 0) + (c2 ? n2 : 0) + (c12 ? Py_MIN(n1, n2) : 0);
+      if (room > INT_MAX)
+        return 0;
+    }
+
+  rc = -1;
+  if (n1 && ! (k1 = BTree_Malloc(sizeof(KEY_TYPE) * n1)))
+    goto done;
+  if (n2 && ! (k2 = BTree_Malloc(sizeof(KEY_TYPE) * n2)))
+    goto done;
+  if (room && ! (out = BTree_Malloc(sizeof(KEY_TYPE) * room)))
+    goto done;
+  if (! countonly && ! (r = BUCKET(PyObject_CallObject(OBJECT(&SetType),
+                                                       NULL))))
+    goto done;
+  /* Nothing has run since the inputs were counted, so they still fit.
+   * Should a bucket have turned into a ghost anyway, let set_operation()
+   * do the work.
+   */
+  if ((rc = _keyArray(s1, k1, &n1)) <= 0 ||
+      (rc = _keyArray(s2, k2, &n2)) <= 0)
+    goto done;
+
+  if (n1 + n2 >= NOGIL_MIN_KEYS)
+    {
+      Py_BEGIN_ALLOW_THREADS
+      n = _mergeKeys(k1, n1, k2, n2, c1, c12, c2, out, limit);
+      Py_END_ALLOW_THREADS
+    }
+  else
+    n = _mergeKeys(k1, n1, k2, n2, c1, c12, c2, out, limit);
+
+  if (countonly)
+    *result = PyLong_FromSsize_t(n);
+  else
+    {
+      if (n)
+        {
+          r->keys = out;
+          r->size = (int)room;
+          r->len = (int)n;
+          out = NULL;
+        }
+      *result = OBJECT(r);
+      r = NULL;
+    }
+  rc = *result ? 1 : -1;
+
+ done:
+  free(k1);
+  free(k2);
+  free(out);
+  Py_XDECREF(r);
+  return rc;
+}
+#endif
+
 /* This is the workhorse for all set merge operations:  the weighted and
  * unweighted flavors of union and intersection, and set difference.  The
  * algorithm is conceptually simple but the code is complicated due to all
@@ -254,8 +896,25 @@ copyRemaining(Bucket *r, SetIteration *i, int merge,
  * c2
  *     Boolean.  Should keys that appear in c2 but not c1 appear in the output?
  *
+ * opts
+ *     NULL, or the less common options:
+ *
+ *     opts->topk
+ *         If positive, and the output is a mapping, only the topk items
+ *         with the largest values are kept, as they are produced, in a
+ *         bounded heap (see TopK).  Equal values are kept in key order.
+ *
+ *     opts->countonly, opts->limit
+ *         If countonly is true, no output is built:  the keys that would
+ *         be output are only counted, and the merge stops as soon as the
+ *         count reaches limit, unless limit is negative.
+ *
+ *     opts->range, opts->rangekw
+ *         If range is not NULL, only the keys of s1 and s2 in the range
+ *         they describe are merged (see initSetIterationRange()).
+ *
  * Returns NULL if error, else a Set or Bucket, depending on whether a set or
- * mapping was requested.
+ * mapping was requested, or, if countonly is true, the number of keys.
  */
 static PyObject *
 set_operation(PyObject *s1, PyObject *s2,
@@ -276,16 +935,41 @@ set_operation(PyObject *s1, PyObject *s2,
 #else
               int w1, int w2,
 #endif
-              int c1, int c12, int c2)
+              int c1, int c12, int c2, const SetOpOptions *opts)
 
 
 {
   Bucket *r=0;
   SetIteration i1 = {0,0,0}, i2 = {0,0,0};
   int cmp, merge;
+  int run1 = 0, run2 = 0;   /* how many times in a row i1 (i2) was behind */
+  TopK top, *ptop = NULL;
+  Py_ssize_t count = 0;     /* number of keys output, if countonly */
+  Py_ssize_t topk, limit;
+  int countonly;
+
+  if (opts == NULL)
+    opts = &defaultSetOpOptions;
+  topk = opts->topk;
+  countonly = opts->countonly;
+  limit = opts->limit;
+
+#ifndef KEY_TYPE_IS_PYOBJECT
+  if (topk <= 0 && opts->range == NULL)
+    {
+      PyObject *result = NULL;
+      int rc = _setOperationNoGIL(s1, s2, usevalues1, usevalues2,
+                                  c1, c12, c2, countonly, limit, &result);
+      if (rc != 0)
+        return rc < 0 ? NULL : result;
+    }
+#endif
 
-  if (initSetIteration(&i1, s1, usevalues1) < 0) goto err;
-  if (initSetIteration(&i2, s2, usevalues2) < 0) goto err;
+  _topkInit(&top, topk, 1);
+  if (initSetIterationRange(&i1, s1, usevalues1,
+                            opts->range, opts->rangekw) < 0) goto err;
+  if (initSetIterationRange(&i2, s2, usevalues2,
+                            opts->range, opts->rangekw) < 0) goto err;
   merge = i1.usesValue | i2.usesValue;
 
   if (merge)
@@ -323,24 +1007,31 @@ set_operation(PyObject *s1, PyObject *s2,
         }
 #endif
 
-      UNLESS(r=BUCKET(PyObject_CallObject(OBJECT(&BucketType), NULL)))
+      UNLESS(countonly ||
+             (r=BUCKET(PyObject_CallObject(OBJECT(&BucketType), NULL))))
         goto err;
+      if (topk > 0)
+        ptop = &top;
     }
   else
     {
-      UNLESS(r=BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL)))
+      UNLESS(countonly ||
+             (r=BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL))))
         goto err;
     }
 
   if (i1.next(&i1) < 0) goto err;
   if (i2.next(&i2) < 0) goto err;
 
-  while (i1.position >= 0 && i2.position >= 0)
+  while (i1.position >= 0 && i2.position >= 0 &&
+         (limit < 0 || count < limit))
     {
       TEST_KEY_SET_OR(cmp, i1.key, i2.key) goto err;
       if(cmp < 0)
         {
-          if(c1)
+          if(c1 && countonly)
+            count++;
+          else if(c1)
             {
               if(r->len >= r->size && Bucket_grow(r, -1, ! merge) < 0) goto err;
               COPY_KEY(r->keys[r->len], i1.key);
@@ -351,12 +1042,20 @@ set_operation(PyObject *s1, PyObject *s2,
                   INCREF_VALUE(r->values[r->len]);
                 }
               r->len++;
+              if (ptop && _topkAdmit(r, ptop) < 0) goto err;
             }
-          if (i1.next(&i1) < 0) goto err;
+          run2 = 0;
+          if (! c1 && i1.skip && ++run1 >= MIN_GALLOP)
+            {
+              if (i1.skip(&i1, i2.key) < 0) goto err;
+            }
+          else if (i1.next(&i1) < 0) goto err;
         }
       else if(cmp==0)
         {
-          if(c12)
+          if(c12 && countonly)
+            count++;
+          else if(c12)
             {
               if(r->len >= r->size && Bucket_grow(r, -1, ! merge) < 0) goto err;
               COPY_KEY(r->keys[r->len], i1.key);
@@ -371,13 +1070,17 @@ set_operation(PyObject *s1, PyObject *s2,
 #endif
                 }
               r->len++;
+              if (ptop && _topkAdmit(r, ptop) < 0) goto err;
             }
+          run1 = run2 = 0;
           if (i1.next(&i1) < 0) goto err;
           if (i2.next(&i2) < 0) goto err;
         }
       else
         {
-          if(c2)
+          if(c2 && countonly)
+            count++;
+          else if(c2)
             {
               if(r->len >= r->size && Bucket_grow(r, -1, ! merge) < 0) goto err;
               COPY_KEY(r->keys[r->len], i2.key);
@@ -388,16 +1091,34 @@ set_operation(PyObject *s1, PyObject *s2,
                   INCREF_VALUE(r->values[r->len]);
                 }
               r->len++;
+              if (ptop && _topkAdmit(r, ptop) < 0) goto err;
             }
-          if (i2.next(&i2) < 0) goto err;
+          run1 = 0;
+          if (! c2 && i2.skip && ++run2 >= MIN_GALLOP)
+            {
+              if (i2.skip(&i2, i1.key) < 0) goto err;
+            }
+          else if (i2.next(&i2) < 0) goto err;
         }
     }
-  if(c1 && copyRemaining(r, &i1, merge, w1) < 0) goto err;
-  if(c2 && copyRemaining(r, &i2, merge, w2) < 0) goto err;
+  if (countonly)
+    {
+      if(c1 && countRemaining(&i1, &count, limit) < 0) goto err;
+      if(c2 && countRemaining(&i2, &count, limit) < 0) goto err;
+      finiSetIteration(&i1);
+      finiSetIteration(&i2);
+      _topkFini(&top);
+      return PyLong_FromSsize_t(count);
+    }
+
+  if(c1 && copyRemaining(r, &i1, merge, w1, ptop) < 0) goto err;
+  if(c2 && copyRemaining(r, &i2, merge, w2, ptop) < 0) goto err;
+  if (ptop && _topkRestoreOrder(r, ptop) < 0) goto err;
 
 
   finiSetIteration(&i1);
   finiSetIteration(&i2);
+  _topkFini(&top);
 
   return OBJECT(r);
 
@@ -409,154 +1130,1020 @@ set_operation(PyObject *s1, PyObject *s2,
  err:
   finiSetIteration(&i1);
   finiSetIteration(&i2);
+  _topkFini(&top);
   Py_XDECREF(r);
   return NULL;
 }
 
-static PyObject *
-difference_m(PyObject *ignored, PyObject *args)
+/* Fill in the range of opts from the range arguments of an operation.
+ * Without a min or a max, the inputs are not restricted at all, and the
+ * exclude flags only apply to a bound that was given.  Return -1 on
+ * error, else 0.
+ */
+static int
+_setRange(SetOpOptions *opts, PyObject *min, PyObject *max,
+          int excludemin, int excludemax)
 {
-  PyObject *o1, *o2;
-
-  UNLESS(PyArg_ParseTuple(args, "OO", &o1, &o2)) return NULL;
-
+  opts->range = opts->rangekw = NULL;
+  if (min == Py_None && max == Py_None)
+    return 0;
 
-  if (o1 == Py_None || o2 == Py_None)
+  UNLESS(opts->range = PyTuple_Pack(2, min, max))
+    return -1;
+  opts->rangekw = Py_BuildValue("{sisi}",
+                                "excludemin", min != Py_None && excludemin,
+                                "excludemax", max != Py_None && excludemax);
+  UNLESS(opts->rangekw)
     {
-      /* difference(None, X) -> None; difference(X, None) -> X */
-      Py_INCREF(o1);
-      return o1;
+      Py_CLEAR(opts->range);
+      return -1;
     }
+  return 0;
+}
 
-  return set_operation(o1, o2, 1, 0, /* preserve values from o1, ignore o2's */
-                       1, 0,         /* o1's values multiplied by 1 */
-                       1, 0, 0);     /* take only keys unique to o1 */
+static void
+_clearRange(SetOpOptions *opts)
+{
+  Py_CLEAR(opts->range);
+  Py_CLEAR(opts->rangekw);
 }
 
+/* The result of an operation with a None input and the input o:  o
+ * itself, or, if opts has a range and o isn't None, a new Bucket or Set
+ * with just the keys (and values) of o in that range.
+ */
 static PyObject *
-union_m(PyObject *ignored, PyObject *args)
+_restrictedCopy(PyObject *o, const SetOpOptions *opts)
 {
-  PyObject *o1, *o2;
-
-  UNLESS(PyArg_ParseTuple(args, "OO", &o1, &o2)) return NULL;
+  int mapping;
+
+  if (opts->range == NULL || o == Py_None)
+    {
+      Py_INCREF(o);
+      return o;
+    }
+
+  mapping = PyObject_IsInstance(o, (PyObject *)&BucketType);
+  if (mapping == 0)
+    mapping = PyObject_IsInstance(o, (PyObject *)&BTreeType);
+  if (mapping < 0)
+    return NULL;
+
+  return set_operation(o, o, mapping, 0, /* preserve values from o */
+                       1, 0,             /* o's values multiplied by 1 */
+                       0, 1, 0,          /* take each key of o once */
+                       opts);            /* in the range */
+}
+
+static char *range_keywords[] = {"o1", "o2", "min", "max",
+                                 "excludemin", "excludemax", NULL};
+
+static PyObject *
+difference_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *o1, *o2, *min = Py_None, *max = Py_None, *result;
+  int excludemin = 0, excludemax = 0;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "OO|$OOii:difference",
+                                     range_keywords, &o1, &o2, &min, &max,
+                                     &excludemin, &excludemax)) return NULL;
+  if (_setRange(&opts, min, max, excludemin, excludemax) < 0)
+    return NULL;
 
   if (o1 == Py_None)
     {
-      Py_INCREF(o2);
-      return o2;
+      /* difference(None, X) -> None; difference(X, None) -> X */
+      Py_INCREF(o1);
+      result = o1;
     }
   else if (o2 == Py_None)
+    result = _restrictedCopy(o1, &opts);
+  else
+    result = set_operation(o1, o2, 1, 0, /* preserve values from o1, ignore o2's */
+                           1, 0,         /* o1's values multiplied by 1 */
+                           1, 0, 0,      /* take only keys unique to o1 */
+                           &opts);       /* in the range, if any */
+  _clearRange(&opts);
+  return result;
+}
+
+static PyObject *
+union_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *o1, *o2, *min = Py_None, *max = Py_None, *result;
+  int excludemin = 0, excludemax = 0;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "OO|$OOii:union",
+                                     range_keywords, &o1, &o2, &min, &max,
+                                     &excludemin, &excludemax)) return NULL;
+  if (_setRange(&opts, min, max, excludemin, excludemax) < 0)
+    return NULL;
+
+  if (o1 == Py_None)
+    result = _restrictedCopy(o2, &opts);
+  else if (o2 == Py_None)
+    result = _restrictedCopy(o1, &opts);
+  else
+    result = set_operation(o1, o2, 0, 0,    /* ignore values in both */
+                           1, 1,            /* the weights are irrelevant */
+                           1, 1, 1,         /* take all keys */
+                           &opts);          /* in the range, if any */
+  _clearRange(&opts);
+  return result;
+}
+
+static PyObject *
+intersection_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *o1, *o2, *min = Py_None, *max = Py_None, *result;
+  int excludemin = 0, excludemax = 0;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "OO|$OOii:intersection",
+                                     range_keywords, &o1, &o2, &min, &max,
+                                     &excludemin, &excludemax)) return NULL;
+  if (_setRange(&opts, min, max, excludemin, excludemax) < 0)
+    return NULL;
+
+  if (o1 == Py_None)
+    result = _restrictedCopy(o2, &opts);
+  else if (o2 == Py_None)
+    result = _restrictedCopy(o1, &opts);
+  else
+    result = set_operation(o1, o2, 0, 0,    /* ignore values in both */
+                           1, 1,            /* the weights are irrelevant */
+                           0, 1, 0,         /* take only keys common to both */
+                           &opts);          /* in the range, if any */
+  _clearRange(&opts);
+  return result;
+}
+
+/* Convert the limit argument of the *Size operations:  None means no
+ * limit, stored as -1.  Return -1 on error, else 0.
+ */
+static int
+_parseLimit(PyObject *o, Py_ssize_t *limit)
+{
+  *limit = -1;
+  if (o == NULL || o == Py_None)
+    return 0;
+
+  *limit = PyNumber_AsSsize_t(o, NULL);
+  if (*limit == -1 && PyErr_Occurred())
+    return -1;
+  if (*limit < 0)
     {
-      Py_INCREF(o1);
-      return o1;
+      PyErr_SetString(PyExc_ValueError, "limit must not be negative");
+      return -1;
     }
+  return 0;
+}
+
+/* Return len(o), but no more than limit (unless limit is negative), as
+ * an int object.
+ */
+static PyObject *
+_limitedLength(PyObject *o, Py_ssize_t limit)
+{
+  Py_ssize_t n = PyObject_Length(o);
+
+  if (n < 0)
+    return NULL;
+  if (limit >= 0 && n > limit)
+    n = limit;
+  return PyLong_FromSsize_t(n);
+}
+
+/* The *Size operations parse (o1, o2, limit=None), handle None inputs as
+ * the operations they count do, and otherwise let set_operation() count
+ * the keys instead of building the output.
+ */
+static int
+_parseSizeArgs(PyObject *args, PyObject *kw, char *format,
+               PyObject **o1, PyObject **o2, SetOpOptions *opts)
+{
+  PyObject *olimit = NULL;
+  static char *kwlist[] = {"o1", "o2", "limit", NULL};
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, format, kwlist,
+                                     o1, o2, &olimit))
+    return -1;
+  opts->countonly = 1;
+  return _parseLimit(olimit, &opts->limit);
+}
+
+static PyObject *
+differenceSize_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *o1, *o2;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  if (_parseSizeArgs(args, kw, "OO|O:differenceSize",
+                     &o1, &o2, &opts) < 0)
+    return NULL;
+
+  if (o1 == Py_None)
+    return PyLong_FromLong(0);
+  if (o2 == Py_None)
+    return _limitedLength(o1, opts.limit);
+
+  return set_operation(o1, o2, 0, 0,    /* ignore values in both */
+                       1, 1,            /* the weights are irrelevant */
+                       1, 0, 0,         /* count only keys unique to o1 */
+                       &opts);          /* but only count them */
+}
+
+static PyObject *
+unionSize_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *o1, *o2;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  if (_parseSizeArgs(args, kw, "OO|O:unionSize", &o1, &o2, &opts) < 0)
+    return NULL;
+
+  if (o1 == Py_None)
+    return o2 == Py_None ? PyLong_FromLong(0) : _limitedLength(o2, opts.limit);
+  if (o2 == Py_None)
+    return _limitedLength(o1, opts.limit);
 
   return set_operation(o1, o2, 0, 0,    /* ignore values in both */
                        1, 1,            /* the weights are irrelevant */
-                       1, 1, 1);        /* take all keys */
+                       1, 1, 1,         /* count all keys */
+                       &opts);          /* but only count them */
 }
 
 static PyObject *
-intersection_m(PyObject *ignored, PyObject *args)
+intersectionSize_m(PyObject *ignored, PyObject *args, PyObject *kw)
 {
   PyObject *o1, *o2;
+  SetOpOptions opts = defaultSetOpOptions;
 
-  UNLESS(PyArg_ParseTuple(args, "OO", &o1, &o2)) return NULL;
+  if (_parseSizeArgs(args, kw, "OO|O:intersectionSize",
+                     &o1, &o2, &opts) < 0)
+    return NULL;
 
   if (o1 == Py_None)
+    return o2 == Py_None ? PyLong_FromLong(0) : _limitedLength(o2, opts.limit);
+  if (o2 == Py_None)
+    return _limitedLength(o1, opts.limit);
+
+  return set_operation(o1, o2, 0, 0,    /* ignore values in both */
+                       1, 1,            /* the weights are irrelevant */
+                       0, 1, 0,         /* count only keys common to both */
+                       &opts);          /* but only count them */
+}
+
+/* Lazy set operations.
+ *
+ * iunion(), iintersection() and idifference() return a SetOpIterator,
+ * which runs the merge of set_operation() one output key at a time.  The
+ * inputs are only advanced as far as the keys asked for so far, so an
+ * iteration abandoned early never visits (or loads the buckets of) the
+ * rest of them.
+ */
+static PyTypeObject SetOpIterator_Type;
+
+typedef struct
+{
+  PyObject_HEAD
+  SetIteration i1, i2;  /* an input that was None is already exhausted */
+  int c1, c12, c2;      /* which keys to produce, as for set_operation() */
+  int run1, run2;       /* how many times in a row i1 (i2) was behind */
+} SetOpIterator;
+
+static void
+SetOpIterator_dealloc(SetOpIterator *self)
+{
+  finiSetIteration(&self->i1);
+  finiSetIteration(&self->i2);
+  PyObject_Del(self);
+}
+
+static PyObject *
+SetOpIterator_getiter(PyObject *it)
+{
+  Py_INCREF(it);
+  return it;
+}
+
+/* Return the next key produced by the merge, or NULL without an exception
+ * set once there are no more.  Both the end of the iteration and errors
+ * are sticky:  either way, the inputs are let go of.
+ */
+static PyObject *
+SetOpIterator_next(SetOpIterator *self)
+{
+  SetIteration *i1 = &self->i1, *i2 = &self->i2;
+  PyObject *result = NULL;
+  int cmp, produce, advance1, advance2;
+
+  while (result == NULL)
     {
-      Py_INCREF(o2);
-      return o2;
+      advance1 = advance2 = 0;
+      if (i1->position >= 0 && i2->position >= 0)
+        {
+          TEST_KEY_SET_OR(cmp, i1->key, i2->key) goto err;
+          if (cmp < 0)
+            {
+              produce = self->c1;
+              advance1 = 1;
+            }
+          else if (cmp == 0)
+            {
+              produce = self->c12;
+              advance1 = advance2 = 1;
+            }
+          else
+            {
+              produce = self->c2;
+              advance2 = 1;
+            }
+        }
+      else if (self->c1 && i1->position >= 0)
+        produce = advance1 = 1;
+      else if (self->c2 && i2->position >= 0)
+        produce = advance2 = 1;
+      else
+        goto done;
+
+      if (produce)
+        {
+          if (advance1)
+            {
+              COPY_KEY_TO_OBJECT(result, i1->key);
+            }
+          else
+            {
+              COPY_KEY_TO_OBJECT(result, i2->key);
+            }
+          UNLESS(result) goto err;
+        }
+
+      if (advance1 && advance2)
+        {
+          self->run1 = self->run2 = 0;
+          if (i1->next(i1) < 0 || i2->next(i2) < 0) goto err;
+        }
+      else if (advance1)
+        {
+          self->run2 = 0;
+          if (! produce && i1->skip && ++self->run1 >= MIN_GALLOP)
+            {
+              if (i1->skip(i1, i2->key) < 0) goto err;
+            }
+          else if (i1->next(i1) < 0) goto err;
+        }
+      else
+        {
+          self->run1 = 0;
+          if (! produce && i2->skip && ++self->run2 >= MIN_GALLOP)
+            {
+              if (i2->skip(i2, i1->key) < 0) goto err;
+            }
+          else if (i2->next(i2) < 0) goto err;
+        }
     }
-  else if (o2 == Py_None)
+  return result;
+
+ err:
+  Py_XDECREF(result);
+ done:
+  finiSetIteration(i1);
+  finiSetIteration(i2);
+  return NULL;
+}
+
+static PyTypeObject SetOpIterator_Type = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  MODULE_NAME MOD_NAME_PREFIX "SetOpIterator", /* tp_name */
+  sizeof(SetOpIterator),                      /* tp_basicsize */
+  0,                                          /* tp_itemsize */
+  /* methods */
+  (destructor)SetOpIterator_dealloc,          /* tp_dealloc */
+  0,                                          /* tp_print */
+  0,                                          /* tp_getattr */
+  0,                                          /* tp_setattr */
+  0,                                          /* tp_compare */
+  0,                                          /* tp_repr */
+  0,                                          /* tp_as_number */
+  0,                                          /* tp_as_sequence */
+  0,                                          /* tp_as_mapping */
+  0,                                          /* tp_hash */
+  0,                                          /* tp_call */
+  0,                                          /* tp_str */
+  0,                                          /* tp_getattro */
+  0,                                          /* tp_setattro */
+  0,                                          /* tp_as_buffer */
+  Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+  0,                                          /* tp_doc */
+  0,                                          /* tp_traverse */
+  0,                                          /* tp_clear */
+  0,                                          /* tp_richcompare */
+  0,                                          /* tp_weaklistoffset */
+  (getiterfunc)SetOpIterator_getiter,         /* tp_iter */
+  (iternextfunc)SetOpIterator_next,           /* tp_iternext */
+  0,                                          /* tp_methods */
+  0,                                          /* tp_members */
+  0,                                          /* tp_getset */
+  0,                                          /* tp_base */
+  0,                                          /* tp_dict */
+  0,                                          /* tp_descr_get */
+  0,                                          /* tp_descr_set */
+};
+
+/* Build the SetOpIterator for the lazy operation taking the keys c1, c12
+ * and c2 of its inputs.  None inputs are handled as the operation that
+ * builds its result does:  they are empty, except that intersection()
+ * returns the other input.
+ */
+static PyObject *
+_setOpIterator(PyObject *args, PyObject *kw, char *format,
+               int c1, int c12, int c2)
+{
+  PyObject *o1, *o2, *min = Py_None, *max = Py_None;
+  int excludemin = 0, excludemax = 0;
+  SetOpOptions opts = defaultSetOpOptions;
+  SetOpIterator *self = NULL;
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, format, range_keywords,
+                                     &o1, &o2, &min, &max,
+                                     &excludemin, &excludemax)) return NULL;
+  if (_setRange(&opts, min, max, excludemin, excludemax) < 0)
+    return NULL;
+
+  UNLESS(self = PyObject_New(SetOpIterator, &SetOpIterator_Type))
+    goto err;
+  memset(&self->i1, 0, sizeof(SetIteration));
+  memset(&self->i2, 0, sizeof(SetIteration));
+  self->i1.position = self->i2.position = -1;
+  if (c12 && (o1 == Py_None || o2 == Py_None))
+    c1 = c2 = 1;
+  self->c1 = c1;
+  self->c12 = c12;
+  self->c2 = c2;
+  self->run1 = self->run2 = 0;
+
+  if (o1 != Py_None)
     {
-      Py_INCREF(o1);
-      return o1;
+      if (initSetIterationRange(&self->i1, o1, 0,
+                                opts.range, opts.rangekw) < 0) goto err;
+      if (self->i1.next(&self->i1) < 0) goto err;
     }
+  if (o2 != Py_None)
+    {
+      if (initSetIterationRange(&self->i2, o2, 0,
+                                opts.range, opts.rangekw) < 0) goto err;
+      if (self->i2.next(&self->i2) < 0) goto err;
+    }
+  _clearRange(&opts);
+  return OBJECT(self);
 
-  return set_operation(o1, o2, 0, 0,    /* ignore values in both */
-                       1, 1,            /* the weights are irrelevant */
-                       0, 1, 0);        /* take only keys common to both */
+ err:
+  _clearRange(&opts);
+  Py_XDECREF(self);
+  return NULL;
+}
+
+static PyObject *
+iunion_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  return _setOpIterator(args, kw, "OO|$OOii:iunion", 1, 1, 1);
+}
+
+static PyObject *
+iintersection_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  return _setOpIterator(args, kw, "OO|$OOii:iintersection", 0, 1, 0);
+}
+
+static PyObject *
+idifference_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  return _setOpIterator(args, kw, "OO|$OOii:idifference", 1, 0, 0);
 }
 
 #ifdef MERGE
 
+/* Convert the topk argument of the weighted operations:  None keeps
+ * every item, a positive integer k keeps the k items with the largest
+ * values.  Store 0 for None.  Return -1 on error, else 0.
+ */
+static int
+_parseTopK(PyObject *o, Py_ssize_t *topk)
+{
+  *topk = 0;
+  if (o == NULL || o == Py_None)
+    return 0;
+
+  *topk = PyNumber_AsSsize_t(o, NULL);
+  if (*topk == -1 && PyErr_Occurred())
+    return -1;
+  if (*topk < 1)
+    {
+      PyErr_SetString(PyExc_ValueError, "topk must be at least 1");
+      return -1;
+    }
+  return 0;
+}
+
+static char *weighted_keywords[] = {"o1", "o2", "w1", "w2", "topk",
+                                    "min", "max",
+                                    "excludemin", "excludemax", NULL};
+
 static PyObject *
-wunion_m(PyObject *ignored, PyObject *args)
+wunion_m(PyObject *ignored, PyObject *args, PyObject *kw)
 {
-  PyObject *o1, *o2;
+  PyObject *o1, *o2, *otopk = NULL, *min = Py_None, *max = Py_None;
   VALUE_TYPE w1 = 1, w2 = 1;
-
-  UNLESS(PyArg_ParseTuple(args, "OO|" VALUE_PARSE VALUE_PARSE,
-                          &o1, &o2, &w1, &w2)
+  int excludemin = 0, excludemax = 0;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "OO|" VALUE_PARSE VALUE_PARSE
+                                     "$OOOii:weightedUnion",
+                                     weighted_keywords,
+                                     &o1, &o2, &w1, &w2, &otopk, &min, &max,
+                                     &excludemin, &excludemax)
          ) return NULL;
+  if (_parseTopK(otopk, &opts.topk) < 0)
+    return NULL;
+  if (_setRange(&opts, min, max, excludemin, excludemax) < 0)
+    return NULL;
 
   if (o1 == Py_None)
-    return Py_BuildValue(VALUE_PARSE "O", (o2 == Py_None ? 0 : w2), o2);
+    {
+      if (o2 != Py_None)
+        o1 = _restrictedCopy(o2, &opts);
+      else
+        w2 = 0;
+    }
   else if (o2 == Py_None)
-    return Py_BuildValue(VALUE_PARSE "O", w1, o1);
-
-  o1 = set_operation(o1, o2, 1, 1, w1, w2, 1, 1, 1);
+    {
+      o1 = _restrictedCopy(o1, &opts);
+      w2 = w1;
+    }
+  else
+    {
+      o1 = set_operation(o1, o2, 1, 1, w1, w2, 1, 1, 1, &opts);
+      w2 = 1;
+    }
+  _clearRange(&opts);
+  if (o1 == Py_None)
+    return Py_BuildValue(VALUE_PARSE "O", w2, o1);
   if (o1)
-    ASSIGN(o1, Py_BuildValue(VALUE_PARSE "O", (VALUE_TYPE)1, o1));
+    ASSIGN(o1, Py_BuildValue(VALUE_PARSE "O", w2, o1));
 
   return o1;
 }
 
 static PyObject *
-wintersection_m(PyObject *ignored, PyObject *args)
+wintersection_m(PyObject *ignored, PyObject *args, PyObject *kw)
 {
-  PyObject *o1, *o2;
+  PyObject *o1, *o2, *otopk = NULL, *min = Py_None, *max = Py_None;
   VALUE_TYPE w1 = 1, w2 = 1;
-
-  UNLESS(PyArg_ParseTuple(args, "OO|" VALUE_PARSE VALUE_PARSE,
-                          &o1, &o2, &w1, &w2)
+  int excludemin = 0, excludemax = 0;
+  SetOpOptions opts = defaultSetOpOptions;
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "OO|" VALUE_PARSE VALUE_PARSE
+                                     "$OOOii:weightedIntersection",
+                                     weighted_keywords,
+                                     &o1, &o2, &w1, &w2, &otopk, &min, &max,
+                                     &excludemin, &excludemax)
          ) return NULL;
+  if (_parseTopK(otopk, &opts.topk) < 0)
+    return NULL;
+  if (_setRange(&opts, min, max, excludemin, excludemax) < 0)
+    return NULL;
 
   if (o1 == Py_None)
-    return Py_BuildValue(VALUE_PARSE "O", (o2 == Py_None ? 0 : w2), o2);
+    {
+      if (o2 != Py_None)
+        o1 = _restrictedCopy(o2, &opts);
+      else
+        w2 = 0;
+    }
   else if (o2 == Py_None)
-    return Py_BuildValue(VALUE_PARSE "O", w1, o1);
-
-  o1 = set_operation(o1, o2, 1, 1, w1, w2, 0, 1, 0);
+    {
+      o1 = _restrictedCopy(o1, &opts);
+      w2 = w1;
+    }
+  else
+    {
+      o1 = set_operation(o1, o2, 1, 1, w1, w2, 0, 1, 0, &opts);
+      if (o1 && o1->ob_type != (PyTypeObject*)(&SetType))
+        w2 = 1;
+      else
+        w2 += w1;
+    }
+  _clearRange(&opts);
+  if (o1 == Py_None)
+    return Py_BuildValue(VALUE_PARSE "O", w2, o1);
   if (o1)
-    ASSIGN(o1, Py_BuildValue(VALUE_PARSE "O",
-                             ((o1->ob_type == (PyTypeObject*)(&SetType)) ? w2+w1 : 1),
-                             o1));
+    ASSIGN(o1, Py_BuildValue(VALUE_PARSE "O", w2, o1));
 
   return o1;
 }
 
-#endif
+/* Restore the order of heap[0:n], a binary min-heap of indices into its
+ * ordered by key and then by index, after the entry at pos has moved on
+ * to a larger key.  Return -1 on error, else 0.
+ */
+static int
+_heapSiftDown(SetIteration *its, Py_ssize_t *heap, Py_ssize_t n,
+              Py_ssize_t pos)
+{
+  Py_ssize_t item = heap[pos], child;
+  int cmp;
 
-#ifdef MULTI_INT_UNION
-#include "sorters.c"
+  while ((child = 2 * pos + 1) < n)
+    {
+      if (child + 1 < n)
+        {
+          TEST_KEY_SET_OR(cmp, its[heap[child + 1]].key,
+                          its[heap[child]].key) return -1;
+          if (cmp < 0 || (cmp == 0 && heap[child + 1] < heap[child]))
+            child++;
+        }
+      TEST_KEY_SET_OR(cmp, its[heap[child]].key, its[item].key) return -1;
+      if (cmp > 0 || (cmp == 0 && heap[child] > item))
+        break;
+      heap[pos] = heap[child];
+      pos = child;
+    }
+  heap[pos] = item;
+  return 0;
+}
 
-/* Input is a sequence of integer sets (or convertible to sets by the
-   set iteration protocol).  Output is the union of the sets.  The point
-   is to run much faster than doing pairs of unions.
-*/
+/* Input is a sequence of (mapping or set, weight) pairs.  Output is a
+ * bucket whose keys are the union of all the keys, and whose values are
+ * the sum of value*weight over the inputs holding each key, a set's
+ * values being taken as 1.  That's what a chain of weightedUnion() calls
+ * computes, but the inputs are merged in one pass, through a heap of
+ * their iterators, so no intermediate buckets are built.  Equal keys are
+ * taken from the inputs in order, so the sums are added up in the same
+ * order, too.  With topk, each sum is offered to a bounded heap once it is
+ * complete, and only the topk largest are kept.
+ */
 static PyObject *
-multiunion_m(PyObject *ignored, PyObject *args)
+multiWeightedUnion_m(PyObject *ignored, PyObject *args, PyObject *kw)
 {
   PyObject *seq;          /* input sequence */
-  int n;                  /* length of input sequence */
-  PyObject *set = NULL;   /* an element of the input sequence */
-  Bucket *result;         /* result set */
-  SetIteration setiter = {0};
-  int i;
-
-  UNLESS(PyArg_ParseTuple(args, "O", &seq))
+  Py_ssize_t n;           /* length of input sequence */
+  PyObject *pair = NULL;  /* an element of the input sequence */
+  PyObject *o;
+  Bucket *result;
+  SetIteration *its = NULL;
+  VALUE_TYPE *weights = NULL;
+  Py_ssize_t *heap = NULL;
+  Py_ssize_t nits = 0, nheap = 0, i;
+  int cmp;
+  PyObject *otopk = NULL;
+  Py_ssize_t topk;
+  TopK top;
+  static char *kwlist[] = {"pairs", "topk", NULL};
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "O|$O:multiWeightedUnion",
+                                     kwlist, &seq, &otopk))
+    return NULL;
+  if (_parseTopK(otopk, &topk) < 0)
     return NULL;
 
   n = PyObject_Length(seq);
   if (n < 0)
     return NULL;
 
-  /* Construct an empty result set. */
-  result = BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL));
-  if (result == NULL)
+  UNLESS(result = BUCKET(PyObject_CallObject(OBJECT(&BucketType), NULL)))
     return NULL;
+  if (n == 0)
+    return OBJECT(result);
+  _topkInit(&top, topk, 1);
+
+  UNLESS(its = BTree_Malloc(n * sizeof(SetIteration)))
+    goto err;
+  UNLESS(weights = BTree_Malloc(n * sizeof(VALUE_TYPE)))
+    goto err;
+  UNLESS(heap = BTree_Malloc(n * sizeof(Py_ssize_t)))
+    goto err;
+
+  for (i = 0; i < n; i++)
+    {
+      weights[nits] = 1;
+      UNLESS(pair = PySequence_GetItem(seq, i))
+        goto err;
+      UNLESS(PyTuple_Check(pair))
+        {
+          PyErr_SetString(PyExc_TypeError,
+                          "multiWeightedUnion expects (o, weight) pairs");
+          goto err;
+        }
+      UNLESS(PyArg_ParseTuple(pair, "O|" VALUE_PARSE ":multiWeightedUnion",
+                              &o, &weights[nits]))
+        goto err;
+      if (o != Py_None)
+        {
+          if (initSetIteration(&its[nits], o, 1) < 0)
+            goto err;
+          nits++;
+          its[nits - 1].value = MERGE_DEFAULT;
+          if (its[nits - 1].next(&its[nits - 1]) < 0)
+            goto err;
+          if (its[nits - 1].position >= 0)
+            heap[nheap++] = nits - 1;
+        }
+      Py_DECREF(pair);
+      pair = NULL;
+    }
+
+  for (i = nheap / 2 - 1; i >= 0; i--)
+    if (_heapSiftDown(its, heap, nheap, i) < 0)
+      goto err;
+
+  while (nheap > 0)
+    {
+      SetIteration *it = &its[heap[0]];
+      VALUE_TYPE value = MERGE_WEIGHT(it->value, weights[heap[0]]);
+
+      /* Start a new result entry, or add to the last one. */
+      cmp = 1;
+      if (result->len)
+        TEST_KEY_SET_OR(cmp, it->key, result->keys[result->len - 1]) goto err;
+      if (cmp == 0)
+        result->values[result->len - 1] += value;
+      else
+        {
+          /* The last entry's sum is complete. */
+          if (topk && result->len && _topkAdmit(result, &top) < 0)
+            goto err;
+          if (result->len >= result->size && Bucket_grow(result, -1, 0) < 0)
+            goto err;
+          COPY_KEY(result->keys[result->len], it->key);
+          INCREF_KEY(result->keys[result->len]);
+          result->values[result->len] = value;
+          result->len++;
+        }
+
+      if (it->next(it) < 0)
+        goto err;
+      if (it->position < 0)
+        heap[0] = heap[--nheap];
+      if (nheap > 0 && _heapSiftDown(its, heap, nheap, 0) < 0)
+        goto err;
+    }
+  if (topk && result->len)
+    {
+      if (_topkAdmit(result, &top) < 0)
+        goto err;
+      if (_topkRestoreOrder(result, &top) < 0)
+        goto err;
+    }
+
+  for (i = 0; i < nits; i++)
+    finiSetIteration(&its[i]);
+  free(its);
+  free(weights);
+  free(heap);
+  _topkFini(&top);
+  return OBJECT(result);
+
+ err:
+  Py_XDECREF(pair);
+  for (i = 0; i < nits; i++)
+    finiSetIteration(&its[i]);
+  free(its);
+  free(weights);
+  free(heap);
+  _topkFini(&top);
+  Py_DECREF(result);
+  return NULL;
+}
+
+#endif
+
+#ifdef MULTI_INT_UNION
+#include "sorters.c"
+
+/* sort_int_nodups() with the GIL released, if there are enough keys for
+   that to pay.  It only touches p, which the caller mustn't have shared
+   yet.
+*/
+static size_t
+_sortIntNoDups(KEY_TYPE *p, size_t n)
+{
+  size_t result;
+
+  if (n < NOGIL_MIN_KEYS)
+    return sort_int_nodups(p, n);
+
+  Py_BEGIN_ALLOW_THREADS
+  result = sort_int_nodups(p, n);
+  Py_END_ALLOW_THREADS
+  return result;
+}
+
+/* sort_int_pairs_nodups() likewise. */
+static size_t
+_sortIntPairsNoDups(KEY_TYPE *p, VALUE_TYPE *v, size_t n)
+{
+  size_t result;
+
+  if (n < NOGIL_MIN_KEYS)
+    return sort_int_pairs_nodups(p, v, n);
+
+  Py_BEGIN_ALLOW_THREADS
+  result = sort_int_pairs_nodups(p, v, n);
+  Py_END_ALLOW_THREADS
+  return result;
+}
+
+/* Sorting on several threads.
+ *
+ * The key space is cut into as many ranges as there are threads, at
+ * splitters picked from a sample of the keys, and the keys are
+ * scattered into one block per range.  All copies of a key land in the
+ * same block, so each block can be sorted and deduplicated on its own,
+ * and the blocks, in range order, concatenate to the result.  The
+ * workers run sort_int_nodups() and nothing else, so they never need
+ * the GIL; the calling thread sorts the first block itself.
+ */
+
+/* Below this many keys per thread, starting threads doesn't pay. */
+#define PARALLEL_MIN_KEYS 100000
+/* At most this many threads, so a block index fits in a byte. */
+#define PARALLEL_MAX_THREADS 64
+/* Keys sampled per thread to pick the splitters. */
+#define PARALLEL_SAMPLE 64
+
+typedef struct {
+  KEY_TYPE *keys;             /* the block, sorted in place */
+  size_t n;                   /* number of keys in the block */
+  size_t nunique;             /* number left after sorting */
+  PyThread_type_lock done;    /* held until a worker has sorted it */
+} SortBlock;
+
+static void
+_sortBlock(void *arg)
+{
+  SortBlock *block = (SortBlock *)arg;
+
+  block->nunique = sort_int_nodups(block->keys, block->n);
+  PyThread_release_lock(block->done);
+}
+
+/* Return the index of the block key belongs in:  the number of the
+   nsplit (ascending) splitters that are <= key.
+*/
+static unsigned char
+_blockIndex(const KEY_TYPE *splitters, int nsplit, KEY_TYPE key)
+{
+  int lo = 0, hi = nsplit;
+
+  while (lo < hi)
+    {
+      int mid = (lo + hi) / 2;
+
+      if (splitters[mid] <= key)
+        lo = mid + 1;
+      else
+        hi = mid;
+    }
+  return (unsigned char)lo;
+}
+
+/* Pick up to nblocks-1 splitters from a sample of the n keys at p, and
+   return how many blocks they make.  Runs without the GIL.
+*/
+static int
+_pickSplitters(const KEY_TYPE *p, size_t n, int nblocks,
+               KEY_TYPE *sample, KEY_TYPE *splitters)
+{
+  size_t nsample = (size_t)nblocks * PARALLEL_SAMPLE;
+  size_t step = n / nsample;
+  size_t i;
+  int j;
+
+  for (i = 0; i < nsample; i++)
+    sample[i] = p[i * step];
+  nsample = sort_int_nodups(sample, nsample);
+  if ((size_t)nblocks > nsample)
+    nblocks = (int)nsample;
+  for (j = 1; j < nblocks; j++)
+    splitters[j - 1] = sample[j * nsample / nblocks];
+  return nblocks;
+}
+
+/* _sortIntNoDups() on up to nthreads threads.  If there aren't enough
+   keys for that, or memory or threads run short before anything is
+   done, sort on this thread.
+*/
+static size_t
+_sortIntNoDupsThreaded(KEY_TYPE *p, size_t n, int nthreads)
+{
+  KEY_TYPE *work = NULL, *sample = NULL, *splitters = NULL;
+  unsigned char *where = NULL;
+  SortBlock *blocks = NULL;
+  size_t i, result = 0;
+  int nblocks = nthreads, j;
+
+  if ((size_t)nblocks > n / PARALLEL_MIN_KEYS)
+    nblocks = (int)(n / PARALLEL_MIN_KEYS);
+  if (nblocks > PARALLEL_MAX_THREADS)
+    nblocks = PARALLEL_MAX_THREADS;
+  if (nblocks < 2)
+    return _sortIntNoDups(p, n);
+
+  work = malloc(n * sizeof(KEY_TYPE));
+  where = malloc(n);
+  sample = malloc((size_t)nblocks * PARALLEL_SAMPLE * sizeof(KEY_TYPE));
+  splitters = malloc((size_t)nblocks * sizeof(KEY_TYPE));
+  blocks = calloc((size_t)nblocks, sizeof(SortBlock));
+  if (work == NULL || where == NULL || sample == NULL || splitters == NULL
+      || blocks == NULL)
+    {
+      result = _sortIntNoDups(p, n);
+      goto done;
+    }
+
+  /* Partition the keys into blocks, in work. */
+  Py_BEGIN_ALLOW_THREADS
+  nblocks = _pickSplitters(p, n, nblocks, sample, splitters);
+  for (i = 0; i < n; i++)
+    {
+      where[i] = _blockIndex(splitters, nblocks - 1, p[i]);
+      blocks[where[i]].n++;
+    }
+  blocks[0].keys = work;
+  for (j = 1; j < nblocks; j++)
+    blocks[j].keys = blocks[j - 1].keys + blocks[j - 1].n;
+  for (j = 0; j < nblocks; j++)
+    blocks[j].nunique = 0;
+  for (i = 0; i < n; i++)
+    {
+      SortBlock *block = &blocks[where[i]];
+
+      block->keys[block->nunique++] = p[i];
+    }
+  Py_END_ALLOW_THREADS
+
+  /* Hand every block but the first to a thread of its own.  A block
+     whose lock or thread can't be had is left for this thread.
+  */
+  for (j = 1; j < nblocks; j++)
+    {
+      SortBlock *block = &blocks[j];
+
+      block->done = PyThread_allocate_lock();
+      if (block->done == NULL)
+        continue;
+      PyThread_acquire_lock(block->done, WAIT_LOCK);
+      if (PyThread_start_new_thread(_sortBlock, block)
+          == PYTHREAD_INVALID_THREAD_ID)
+        {
+          PyThread_release_lock(block->done);
+          PyThread_free_lock(block->done);
+          block->done = NULL;
+        }
+    }
+
+  Py_BEGIN_ALLOW_THREADS
+  for (j = 0; j < nblocks; j++)
+    if (blocks[j].done == NULL)
+      blocks[j].nunique = sort_int_nodups(blocks[j].keys, blocks[j].n);
+  for (j = 0; j < nblocks; j++)
+    {
+      if (blocks[j].done != NULL)
+        {
+          PyThread_acquire_lock(blocks[j].done, WAIT_LOCK);
+          PyThread_free_lock(blocks[j].done);
+        }
+      memcpy(p + result, blocks[j].keys, blocks[j].nunique * sizeof(KEY_TYPE));
+      result += blocks[j].nunique;
+    }
+  Py_END_ALLOW_THREADS
+
+ done:
+  free(work);
+  free(where);
+  free(sample);
+  free(splitters);
+  free(blocks);
+  return result;
+}
+
+/* Append the keys of every integer set in seq (or thing convertible to a
+   set by the set iteration protocol) to result, an empty Set, without
+   sorting them.  If nodups is true, an input that has to be iterated
+   contributes each of its keys only once; sets, buckets and trees can't
+   repeat a key anyway.  Return -1 on error, else 0.
+*/
+static int
+_multiCollect(Bucket *result, PyObject *seq, Py_ssize_t n, int nodups)
+{
+  PyObject *set = NULL;   /* an element of the input sequence */
+  SetIteration setiter = {0};
+  Py_ssize_t i;
+  int start;
 
   /* For each set in the input sequence, append its elements to the result
      set.  At this point, we ignore the possibility of duplicates. */
@@ -582,11 +2169,16 @@ multiunion_m(PyObject *ignored, PyObject *args)
       /* No cheap way:  iterate over set's elements one at a time. */
       if (initSetIteration(&setiter, set, 0) < 0) goto Error;
       if (setiter.next(&setiter) < 0) goto Error;
+      start = result->len;
       while (setiter.position >= 0) {
-        if (result->len >= result->size && Bucket_grow(result, -1, 1) < 0)
-          goto Error;
-        COPY_KEY(result->keys[result->len], setiter.key);
-        ++result->len;
+        /* Iterated inputs come out sorted, so repeats are adjacent. */
+        if (! nodups || result->len == start ||
+            result->keys[result->len - 1] != setiter.key) {
+          if (result->len >= result->size && Bucket_grow(result, -1, 1) < 0)
+            goto Error;
+          COPY_KEY(result->keys[result->len], setiter.key);
+          ++result->len;
+        }
         /* We know the key is an int, so no need to incref it. */
         if (setiter.next(&setiter) < 0) goto Error;
       }
@@ -595,6 +2187,59 @@ multiunion_m(PyObject *ignored, PyObject *args)
     Py_DECREF(set);
     set = NULL;
   }
+  return 0;
+
+ Error:
+  Py_XDECREF(set);
+  finiSetIteration(&setiter);
+  return -1;
+}
+
+/* Input is a sequence of integer sets (or convertible to sets by the
+   set iteration protocol), and optionally how many threads may sort.
+   Output is the union of the sets.  The point is to run much faster than
+   doing pairs of unions.
+*/
+static PyObject *
+multiunion_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *seq;          /* input sequence */
+  Py_ssize_t n;           /* length of input sequence */
+  Bucket *result;         /* result set */
+  PyObject *othreads = NULL;
+  Py_ssize_t threads = 1;
+  static char *kwlist[] = {"seq", "threads", NULL};
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "O|$O:multiunion", kwlist,
+                                     &seq, &othreads))
+    return NULL;
+  if (othreads != NULL && othreads != Py_None)
+    {
+      threads = PyNumber_AsSsize_t(othreads, NULL);
+      if (threads == -1 && PyErr_Occurred())
+        return NULL;
+      if (threads < 1)
+        {
+          PyErr_SetString(PyExc_ValueError, "threads must be at least 1");
+          return NULL;
+        }
+      if (threads > PARALLEL_MAX_THREADS)
+        threads = PARALLEL_MAX_THREADS;
+    }
+
+  n = PyObject_Length(seq);
+  if (n < 0)
+    return NULL;
+
+  /* Construct an empty result set. */
+  result = BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL));
+  if (result == NULL)
+    return NULL;
+
+  if (_multiCollect(result, seq, n, 0) < 0) {
+    Py_DECREF(result);
+    return NULL;
+  }
 
   /* Combine, sort, remove duplicates, and reset the result's len.
      If the set shrinks (which happens if and only if there are
@@ -603,15 +2248,347 @@ multiunion_m(PyObject *ignored, PyObject *args)
   */
   if (result->len > 0) {
     size_t newlen;          /* number of elements in final result set */
-    newlen = sort_int_nodups(result->keys, (size_t)result->len);
+    newlen = _sortIntNoDupsThreaded(result->keys, (size_t)result->len,
+                                    (int)threads);
     result->len = (int)newlen;
   }
   return (PyObject *)result;
+}
+
+/* Input is a sequence of integer sets (or convertible to sets by the
+   set iteration protocol), and an optional limit.  Output is the number
+   of keys multiunion would return, but no more than limit.  The keys
+   are gathered and sorted as for multiunion, but no result set is
+   returned, and if any one input already holds limit keys, nothing else
+   is done.
+*/
+static PyObject *
+multiunionSize_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *seq;          /* input sequence */
+  Py_ssize_t n;           /* length of input sequence */
+  PyObject *olimit = NULL;
+  Py_ssize_t limit;
+  Bucket *keys;           /* the keys gathered */
+  size_t count = 0;       /* number of distinct keys */
+  Py_ssize_t i;
+  static char *kwlist[] = {"seq", "limit", NULL};
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "O|O:multiunionSize", kwlist,
+                                     &seq, &olimit))
+    return NULL;
+  if (_parseLimit(olimit, &limit) < 0)
+    return NULL;
+
+  n = PyObject_Length(seq);
+  if (n < 0)
+    return NULL;
+
+  /* A single set or bucket with enough keys settles it. */
+  if (limit >= 0)
+    for (i = 0; i < n; i++)
+      {
+        PyObject *set = PySequence_GetItem(seq, i);
+        int len = -1;
+
+        if (set == NULL)
+          return NULL;
+        if (set->ob_type == (PyTypeObject*)&SetType ||
+            set->ob_type == (PyTypeObject*)&BucketType)
+          {
+            UNLESS (PER_USE(BUCKET(set)))
+              {
+                Py_DECREF(set);
+                return NULL;
+              }
+            len = BUCKET(set)->len;
+            PER_UNUSE(BUCKET(set));
+          }
+        Py_DECREF(set);
+        if (len >= limit)
+          return PyLong_FromSsize_t(limit);
+      }
+
+  keys = BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL));
+  if (keys == NULL)
+    return NULL;
+
+  if (_multiCollect(keys, seq, n, 0) < 0) {
+    Py_DECREF(keys);
+    return NULL;
+  }
+  if (keys->len > 0)
+    count = _sortIntNoDups(keys->keys, (size_t)keys->len);
+  Py_DECREF(keys);
+
+  if (limit >= 0 && count > (size_t)limit)
+    count = limit;
+  return PyLong_FromSize_t(count);
+}
+
+/* Input is a sequence of integer sets (or convertible to sets by the
+   set iteration protocol) and a threshold k.  Output is the set of keys
+   found in at least k of the inputs or, if counts is true, a bucket
+   mapping each of those keys to the number of inputs it was found in.
+   All the keys are gathered, sorted and counted in one pass, as
+   multiunion does, rather than merged input by input.
+*/
+static PyObject *
+thresholdUnion_m(PyObject *ignored, PyObject *args, PyObject *kw)
+{
+  PyObject *seq;          /* input sequence */
+  Py_ssize_t n;           /* length of input sequence */
+  Py_ssize_t k;           /* how many inputs a key must be in */
+  int counts = 0;         /* return a bucket of counts? */
+  Bucket *keys;           /* the keys gathered, and then those kept */
+  Bucket *result;         /* result bucket, when counts is true */
+  size_t *tally = NULL;   /* how many inputs each kept key was in */
+  size_t newlen = 0;      /* number of keys kept */
+  size_t i;
+  static char *kwlist[] = {"seq", "k", "counts", NULL};
+
+  UNLESS(PyArg_ParseTupleAndKeywords(args, kw, "On|i:thresholdUnion", kwlist,
+                                     &seq, &k, &counts))
+    return NULL;
+
+  if (k < 1) {
+    PyErr_SetString(PyExc_ValueError, "k must be at least 1");
+    return NULL;
+  }
+
+  n = PyObject_Length(seq);
+  if (n < 0)
+    return NULL;
+
+  keys = BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL));
+  if (keys == NULL)
+    return NULL;
+
+  /* No key can be in more inputs than there are. */
+  if (k <= n) {
+    if (_multiCollect(keys, seq, n, 1) < 0)
+      goto Error;
+    if (keys->len > 0) {
+      if (counts) {
+        UNLESS (tally = BTree_Malloc(keys->len * sizeof(size_t)))
+          goto Error;
+      }
+      newlen = sort_int_threshold(keys->keys, (size_t)keys->len,
+                                  (size_t)k, tally);
+    }
+  }
+  keys->len = (int)newlen;
+  if (! counts)
+    return (PyObject *)keys;
+
+  result = BUCKET(PyObject_CallObject(OBJECT(&BucketType), NULL));
+  if (result == NULL)
+    goto Error;
+  if (newlen > 0 && Bucket_grow(result, (int)newlen, 0) < 0)
+    goto BucketError;
+  for (i = 0; i < newlen; ++i) {
+    PyObject *count;
+    int copied = 1;
+
+    UNLESS (count = PyLong_FromSize_t(tally[i]))
+      goto BucketError;
+    COPY_VALUE_FROM_ARG(result->values[i], count, copied);
+    UNLESS (copied) {
+      Py_DECREF(count);
+      goto BucketError;
+    }
+    INCREF_VALUE(result->values[i]);
+    Py_DECREF(count);
+    COPY_KEY(result->keys[i], keys->keys[i]);
+    result->len++;
+  }
+  free(tally);
+  Py_DECREF(keys);
+  return (PyObject *)result;
+
+ BucketError:
+  Py_DECREF(result);
+ Error:
+  free(tally);
+  Py_DECREF(keys);
+  return NULL;
+}
+
+/* Return a cheap estimate of how many keys the set iteration i will
+ * produce, or -1 on error.  Sets, buckets, counted trees and sorted lists
+ * know their size; other trees would have to load every bucket to find
+ * out, so they are assumed to be huge.
+ */
+static Py_ssize_t
+_setSizeEstimate(SetIteration *i)
+{
+  Py_ssize_t result = PY_SSIZE_T_MAX;
+
+  if (i->next == nextKeyAsSet)
+    result = 1;
+  else if (i->tree)
+    {
+      BTree *tree = BTREE(i->tree);
+      int counted = _BTree_counted(tree);
+
+      if (counted < 0)
+        return -1;
+      PER_USE_OR_RETURN(tree, -1);
+      if (! tree->len)
+        result = 0;
+      else if (counted && _BTree_nodeCount(tree) >= 0)
+        result = _BTree_nodeCount(tree);
+      PER_UNUSE(tree);
+    }
+  else if (i->skip)
+    {
+      PER_USE_OR_RETURN(BUCKET(i->set), -1);
+      result = BUCKET(i->set)->len;
+      PER_UNUSE(BUCKET(i->set));
+    }
+  else
+    result = PyObject_LengthHint(i->set, PY_SSIZE_T_MAX);
+  return result;
+}
+
+/* Advance i to its first key >= key.  i must already have a key. */
+static int
+_setAdvance(SetIteration *i, KEY_TYPE key)
+{
+  int cmp;
+
+  while (i->position >= 0)
+    {
+      TEST_KEY_SET_OR(cmp, i->key, key) return -1;
+      if (cmp >= 0)
+        break;
+      if (i->skip)
+        return i->skip(i, key);
+      if (i->next(i) < 0)
+        return -1;
+    }
+  return 0;
+}
+
+/* Input is a sequence of integer sets (or convertible to sets by the
+   set iteration protocol).  Output is the intersection of the sets.
+   The smallest input proposes candidate keys, and the others, in order
+   of increasing size, are skipped ahead to each candidate in turn; a
+   larger key found along the way becomes the next candidate.  Nothing
+   is built but the result, and it stops as soon as any input runs out.
+*/
+static PyObject *
+multiintersection_m(PyObject *ignored, PyObject *args)
+{
+  PyObject *seq;          /* input sequence */
+  Py_ssize_t n;           /* length of input sequence */
+  PyObject *set = NULL;   /* an element of the input sequence */
+  Bucket *result;         /* result set */
+  SetIteration *its = NULL;
+  Py_ssize_t *sizes = NULL;
+  Py_ssize_t i, j;
+  KEY_TYPE key;
+  int cmp;
+
+  UNLESS(PyArg_ParseTuple(args, "O", &seq))
+    return NULL;
+
+  n = PyObject_Length(seq);
+  if (n < 0)
+    return NULL;
+
+  /* Construct an empty result set. */
+  result = BUCKET(PyObject_CallObject(OBJECT(&SetType), NULL));
+  if (result == NULL || n == 0)
+    return (PyObject *)result;
+
+  UNLESS (its = BTree_Malloc(n * sizeof(SetIteration)))
+    goto Error;
+  for (i = 0; i < n; ++i)
+    its[i].set = NULL;
+  UNLESS (sizes = BTree_Malloc(n * sizeof(Py_ssize_t)))
+    goto Error;
+
+  /* Start iterating over each input, keeping them sorted by size. */
+  for (i = 0; i < n; ++i) {
+    SetIteration it;
+    Py_ssize_t size;
+
+    set = PySequence_GetItem(seq, i);
+    if (set == NULL)
+      goto Error;
+    if (initSetIteration(&its[i], set, 0) < 0)
+      goto Error;
+    Py_DECREF(set);
+    set = NULL;
+
+    size = _setSizeEstimate(&its[i]);
+    if (size < 0)
+      goto Error;
+    it = its[i];
+    for (j = i; j > 0 && sizes[j - 1] > size; --j) {
+      its[j] = its[j - 1];
+      sizes[j] = sizes[j - 1];
+    }
+    its[j] = it;
+    sizes[j] = size;
+  }
+
+  for (i = 0; i < n; ++i) {
+    if (its[i].next(&its[i]) < 0)
+      goto Error;
+    if (its[i].position < 0)
+      goto Done;
+  }
+
+  /* its[0] is on the candidate key, and so are its[1:j]. */
+  key = its[0].key;
+  j = 1;
+  for (;;) {
+    if (j == n) {
+      if (result->len >= result->size && Bucket_grow(result, -1, 1) < 0)
+        goto Error;
+      COPY_KEY(result->keys[result->len], key);
+      ++result->len;
+      if (its[0].next(&its[0]) < 0)
+        goto Error;
+    }
+    else {
+      if (_setAdvance(&its[j], key) < 0)
+        goto Error;
+      if (its[j].position < 0)
+        break;
+      TEST_KEY_SET_OR(cmp, its[j].key, key) goto Error;
+      if (cmp == 0) {
+        ++j;
+        continue;
+      }
+      /* A new, larger candidate. */
+      if (_setAdvance(&its[0], its[j].key) < 0)
+        goto Error;
+    }
+    if (its[0].position < 0)
+      break;
+    key = its[0].key;
+    j = 1;
+  }
+
+ Done:
+  for (i = 0; i < n; ++i)
+    finiSetIteration(&its[i]);
+  free(its);
+  free(sizes);
+  return (PyObject *)result;
 
  Error:
   Py_DECREF(result);
   Py_XDECREF(set);
-  finiSetIteration(&setiter);
+  if (its) {
+    for (i = 0; i < n; ++i)
+      finiSetIteration(&its[i]);
+    free(its);
+  }
+  free(sizes);
   return NULL;
 }
 #endif
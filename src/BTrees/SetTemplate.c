@@ -28,6 +28,160 @@ Set_insert(Bucket *self, PyObject *args)
     return PyLong_FromLong(i);
 }
 
+#ifdef KEY_PACK_CODE
+/* When the length hint of update()'s argument says it holds at least this
+ * many keys, they're collected and radix-sorted up front, then merged in
+ * all at once, instead of being inserted one at a time.
+ */
+#define BULK_UPDATE_MIN 1024
+
+static size_t _sortIntNoDups(KEY_TYPE *p, size_t n);
+
+/* Collect the keys seq yields, probably about hint of them, into a new
+ * malloc'ed array at *keys, sorted and without duplicates, and return how
+ * many there are, or -1 on error.  If a key can't be converted or the
+ * iteration fails, stop there with the exception set; *keys then holds the
+ * keys before it.
+ */
+static Py_ssize_t
+_Set_collectKeys(PyObject *seq, Py_ssize_t hint, KEY_TYPE **keys)
+{
+    PyObject *iter, *v;
+    KEY_TYPE *p, *grown;
+    Py_ssize_t n = 0, size = hint;
+    int copied = 1;
+
+    *keys = NULL;
+    iter = PyObject_GetIter(seq);
+    if (iter == NULL)
+        return -1;
+    p = BTree_Malloc(size * sizeof(KEY_TYPE));
+    if (p == NULL)
+        goto err;
+    while ((v = PyIter_Next(iter)) != NULL)
+    {
+        if (n == size)
+        {
+            size *= 2;
+            grown = BTree_Realloc(p, size * sizeof(KEY_TYPE));
+            if (grown == NULL)
+            {
+                Py_DECREF(v);
+                goto err;
+            }
+            p = grown;
+        }
+        COPY_KEY_FROM_ARG(p[n], v, copied);
+        Py_DECREF(v);
+        UNLESS (copied)
+            break;
+        n++;
+    }
+    Py_DECREF(iter);
+    *keys = p;
+    return (Py_ssize_t)_sortIntNoDups(p, (size_t)n);
+
+err:
+    Py_DECREF(iter);
+    free(p);
+    return -1;
+}
+
+/* Add the keys seq yields to the set or tree set self by collecting them
+ * with _Set_collectKeys() and passing them to merge, which returns how
+ * many were new.  The keys before one that stopped the collection are
+ * still added, as if they'd been inserted one at a time.
+ */
+static int
+_Set_bulkUpdate(PyObject *self, PyObject *seq, Py_ssize_t hint,
+                int (*merge)(PyObject *, const KEY_TYPE *, Py_ssize_t))
+{
+    PyObject *type, *value, *traceback;
+    KEY_TYPE *keys;
+    Py_ssize_t n;
+    int added;
+
+    n = _Set_collectKeys(seq, hint, &keys);
+    if (n < 0)
+        return -1;
+    PyErr_Fetch(&type, &value, &traceback);
+    added = merge(self, keys, n);
+    free(keys);
+    if (type == NULL)
+        return added;
+    if (added < 0)
+    {
+        Py_DECREF(type);
+        Py_XDECREF(value);
+        Py_XDECREF(traceback);
+    }
+    else
+        PyErr_Restore(type, value, traceback);
+    return -1;
+}
+
+/* Merge the n sorted, distinct keys in keys into the set self.  Return
+ * how many of them were new, or -1 on error.
+ */
+static int
+_Set_mergeKeys(PyObject *obj, const KEY_TYPE *keys, Py_ssize_t n)
+{
+    Bucket *self = BUCKET(obj);
+    KEY_TYPE *merged;
+    Py_ssize_t i = 0, j = 0, len = 0;
+    int added = -1;
+
+    PER_USE_OR_RETURN(self, -1);
+    if (n == 0)
+    {
+        added = 0;
+        goto Done;
+    }
+    if (_bucket_check_exports(self) < 0 || _bucket_own(self) < 0)
+        goto Done;
+    if (n > INT_MAX - self->len)
+    {
+        PyErr_NoMemory();
+        goto Done;
+    }
+    merged = BTree_Malloc((self->len + n) * sizeof(KEY_TYPE));
+    if (merged == NULL)
+        goto Done;
+    while (i < self->len && j < n)
+    {
+        if (self->keys[i] < keys[j])
+            merged[len++] = self->keys[i++];
+        else
+        {
+            if (!(keys[j] < self->keys[i]))
+                i++;
+            merged[len++] = keys[j++];
+        }
+    }
+    while (i < self->len)
+        merged[len++] = self->keys[i++];
+    while (j < n)
+        merged[len++] = keys[j++];
+
+    added = (int)(len - self->len);
+    if (added == 0)
+    {
+        free(merged);
+        goto Done;
+    }
+    free(self->keys);
+    self->keys = merged;
+    self->size = (int)(self->len + n);
+    self->len = (int)len;
+    if (PER_CHANGED(self) < 0)
+        added = -1;
+
+Done:
+    PER_UNUSE(self);
+    return added;
+}
+#endif
+
 /* _Set_update and _TreeSet_update are identical except for the
    function they call to add the element to the set.
 */
@@ -37,6 +191,14 @@ _Set_update(Bucket *self, PyObject *seq)
 {
     int n=0, ind=0;
     PyObject *iter, *v;
+#ifdef KEY_PACK_CODE
+    Py_ssize_t hint = PyObject_LengthHint(seq, 0);
+
+    if (hint < 0)
+        return -1;
+    if (hint >= BULK_UPDATE_MIN)
+        return _Set_bulkUpdate(OBJECT(self), seq, hint, _Set_mergeKeys);
+#endif
 
     iter = PyObject_GetIter(seq);
     if (iter == NULL)
@@ -223,6 +385,16 @@ _set_setstate(Bucket *self, PyObject *args)
 
     UNLESS (PyArg_ParseTuple(args, "O|O", &items, &next))
         return -1;
+    if (self->exported || self->borrowed)
+    {
+        _bucket_detach(self);
+        _bucket_clear(self);
+    }
+
+#ifdef KEY_PACK_CODE
+    if (PyBytes_Check(items))
+        return _bucket_unpack(self, items, next, 1);
+#endif
 
     if (!PyTuple_Check(items)) {
         PyErr_SetString(PyExc_TypeError,
@@ -238,6 +410,7 @@ _set_setstate(Bucket *self, PyObject *args)
         DECREF_KEY(self->keys[i]);
     }
     self->len=0;
+    self->packed=0;
 
     if (self->next)
     {
@@ -301,6 +474,9 @@ static struct PyMethodDef Set_methods[] = {
     {"keys", (PyCFunction) bucket_keys, METH_VARARGS | METH_KEYWORDS,
      "keys()\nReturn the keys"},
 
+    {"keysBuffer", (PyCFunction) bucket_keysBuffer, METH_NOARGS,
+     "keysBuffer()\nReturn a read-only memoryview over the keys"},
+
     {"has_key", (PyCFunction) bucket_has_key, METH_O,
      "has_key(key)\nTest whether the bucket contains the given key"},
 
@@ -29,6 +29,51 @@ TreeSet_insert(BTree *self, PyObject *args)
     return PyLong_FromLong(i);
 }
 
+#ifdef KEY_PACK_CODE
+/* Add the n sorted, distinct keys in keys to the tree set self.  An empty
+ * set is built bottom-up, like fromSorted() does; otherwise the keys are
+ * inserted in order, each next to the last.  Return how many of them were
+ * new, or -1 on error.
+ */
+static int
+_TreeSet_mergeKeys(PyObject *obj, const KEY_TYPE *keys, Py_ssize_t n)
+{
+    BTree *self = BTREE(obj);
+    PyObject *key;
+    Py_ssize_t i;
+    int added = 0, ind;
+
+    if (n == 0)
+        return 0;
+    PER_USE_OR_RETURN(self, -1);
+    if (self->len == 0 && n <= INT_MAX)
+    {
+        if (_BTree_clear(self) < 0
+            || _BTree_fillFromArrays(self, keys, NULL, n, 1.0) < 0
+            || PER_CHANGED(self) < 0)
+            added = -1;
+        else
+            added = (int)n;
+        PER_UNUSE(self);
+        return added;
+    }
+    PER_UNUSE(self);
+
+    for (i = 0; i < n; i++)
+    {
+        COPY_KEY_TO_OBJECT(key, keys[i]);
+        if (key == NULL)
+            return -1;
+        ind = _BTree_set(self, key, Py_None, 1, 1);
+        Py_DECREF(key);
+        if (ind < 0)
+            return -1;
+        added += ind;
+    }
+    return added;
+}
+#endif
+
 /* _Set_update and _TreeSet_update are identical except for the
    function they call to add the element to the set.
 */
@@ -38,6 +83,14 @@ _TreeSet_update(BTree *self, PyObject *seq)
 {
     int n=0, ind=0;
     PyObject *iter, *v;
+#ifdef KEY_PACK_CODE
+    Py_ssize_t hint = PyObject_LengthHint(seq, 0);
+
+    if (hint < 0)
+        return -1;
+    if (hint >= BULK_UPDATE_MIN)
+        return _Set_bulkUpdate(OBJECT(self), seq, hint, _TreeSet_mergeKeys);
+#endif
 
     iter = PyObject_GetIter(seq);
     if (iter == NULL)
@@ -236,6 +289,75 @@ TreeSet_setstate(BTree *self, PyObject *args)
     return Py_None;
 }
 
+static PyObject *
+TreeSet_compact(BTree *self, PyObject *args, PyObject *kw)
+{
+    double fill = 1.0;
+    static char *kwlist[] = {"target_fill", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "|d:compact", kwlist, &fill))
+        return NULL;
+    return _BTree_compact(self, fill, 1);
+}
+
+/* The implementation of TreeSet.cursor(). */
+static PyObject *
+TreeSet_cursor(BTree *self, PyObject *args, PyObject *kw)
+{
+    return buildBTreeCursor(self, args, kw, 'k');
+}
+
+static PyObject *
+TreeSet_toArrays(BTree *self, PyObject *args, PyObject *kw)
+{
+#ifdef KEY_PACK_CODE
+    return _BTree_toArrays(self, args, kw, 1);
+#else
+    PyErr_SetString(PyExc_TypeError,
+                    "only keys that are C numbers can be copied to an array");
+    return NULL;
+#endif
+}
+
+static PyObject *
+TreeSet_fromSorted(PyObject *type, PyObject *args, PyObject *kw)
+{
+    PyObject *keys;
+    double fill = 1.0;
+    static char *kwlist[] = {"keys", "fill", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "O|d:fromSorted", kwlist,
+                                     &keys, &fill))
+        return NULL;
+    return _BTree_fromSorted(type, keys, fill, 1);
+}
+
+static PyObject *
+TreeSet_fromBuffer(PyObject *type, PyObject *args, PyObject *kw)
+{
+#ifdef KEY_PACK_CODE
+    PyObject *okeys;
+    void *keys;
+    Py_ssize_t n;
+    int is_sorted = 0;
+    double fill = 1.0;
+    static char *kwlist[] = {"keys", "sorted", "fill", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "O|pd:fromBuffer", kwlist,
+                                     &okeys, &is_sorted, &fill))
+        return NULL;
+    n = _BTree_copyBuffer(okeys, KEY_PACK_CODE, sizeof(KEY_TYPE), "keys",
+                          &keys);
+    if (n < 0)
+        return NULL;
+    return _BTree_fromArrays(type, keys, NULL, n, is_sorted, fill);
+#else
+    PyErr_SetString(PyExc_TypeError,
+                    "only keys that are C numbers can be read from a buffer");
+    return NULL;
+#endif
+}
+
 static struct PyMethodDef TreeSet_methods[] =
 {
     {"__getstate__", (PyCFunction) BTree_getstate, METH_NOARGS,
@@ -250,6 +372,10 @@ static struct PyMethodDef TreeSet_methods[] =
      "has_key(key)\n\n"
      "Return true if the TreeSet contains the given key."},
 
+    {"containsMany", (PyCFunction) BTree_containsMany, METH_O,
+     "containsMany(keys) -> list of booleans\n\n"
+     "Return, for each of keys in order, whether the TreeSet contains it."},
+
     {"keys", (PyCFunction) BTree_keys, METH_VARARGS | METH_KEYWORDS,
      "keys([min, max]) -> list of keys\n\n"
      "Returns the keys of the TreeSet.  If min and max are supplied, only\n"
@@ -277,6 +403,69 @@ static struct PyMethodDef TreeSet_methods[] =
     {"update", (PyCFunction)TreeSet_update, METH_VARARGS,
      "update(collection)\n\n Add the items from the given collection."},
 
+    {"rank", (PyCFunction) BTree_rank, METH_O,
+     "rank(key) -> int\n\n"
+     "Return the number of keys in the TreeSet that are less than key.\n"
+     "This is the position of key in keys() if it is present."},
+
+    {"keyAt", (PyCFunction) BTree_keyAt, METH_O,
+     "keyAt(index) -> key\n\n"
+     "Return the key at the given position in keys(); negative positions\n"
+     "count from the end.  Raise IndexError if there is no such key."},
+
+    {"deleteRange", (PyCFunction) BTree_deleteRange,
+     METH_VARARGS | METH_KEYWORDS,
+     "deleteRange([min, max, excludemin, excludemax]) -> None\n\n"
+     "Remove every key between min and max (inclusive unless excluded).\n"
+     "Buckets and subtrees wholly inside the range are dropped without\n"
+     "being loaded; only the buckets at its ends are trimmed."},
+
+    {"compact", (PyCFunction) TreeSet_compact, METH_VARARGS | METH_KEYWORDS,
+     "compact([target_fill=1.0]) -> int\n\n"
+     "Merge adjacent buckets whose keys fit in target_fill * max_leaf_size\n"
+     "and rebuild the interior nodes, in place.  Return the number of\n"
+     "persistent objects that went away."},
+
+    {"count", (PyCFunction) BTree_count, METH_VARARGS | METH_KEYWORDS,
+     "count([min, max, excludemin, excludemax]) -> int\n\n"
+     "Return the number of keys that keys() would return for the same\n"
+     "arguments, without building them.  Only the buckets at the ends of\n"
+     "the range are searched."},
+
+    {"toArrays", (PyCFunction) TreeSet_toArrays,
+     METH_VARARGS | METH_KEYWORDS,
+     "toArrays([min, max, excludemin, excludemax]) -> (keys, None)\n\n"
+     "Return an array.array copy of the keys that keys() would return for\n"
+     "the same arguments.  Only sets whose keys are C numbers support\n"
+     "this."},
+
+    {"fromSorted", (PyCFunction) TreeSet_fromSorted,
+     METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+     "fromSorted(keys[, fill=1.0]) -> TreeSet\n\n"
+     "Build a new TreeSet from keys in strictly ascending order.  Buckets\n"
+     "are packed to fill * max_leaf_size keys and the interior nodes built\n"
+     "bottom-up, without any splitting."},
+
+    {"fromBuffer", (PyCFunction) TreeSet_fromBuffer,
+     METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+     "fromBuffer(keys[, sorted=False, fill=1.0]) -> TreeSet\n\n"
+     "Build a new TreeSet from a C-contiguous buffer (such as an\n"
+     "array.array or NumPy array) of C numbers of the key type.  Unless\n"
+     "sorted is true, the keys are sorted and duplicates dropped first.\n"
+     "Only sets whose keys are C numbers support this."},
+
+    {"iterkeys", (PyCFunction) BTree_iterkeys, METH_VARARGS | METH_KEYWORDS,
+     "iterkeys([min[,max]][, reverse=False]) -> an iterator over the keys"},
+
+    {"cursor", (PyCFunction) TreeSet_cursor, METH_VARARGS | METH_KEYWORDS,
+     "cursor([min, max, excludemin, excludemax][, reverse=False])\n\n"
+     "Return a cursor over the keys between min and max, which can move\n"
+     "forwards and backwards with next() and prev() and be moved to a key\n"
+     "with seek()."},
+
+    {"__reversed__", (PyCFunction) BTree_reversed, METH_NOARGS,
+     "__reversed__() -> an iterator over the keys, largest first"},
+
     {"remove", (PyCFunction)TreeSet_remove, METH_VARARGS,
      "remove(id) -- Remove a key from the set"},
 
@@ -14,6 +14,12 @@
 """Python BTree implementation
 """
 
+import array
+import heapq
+import operator
+import struct
+import sys
+
 from persistent import Persistent
 
 from ._compat import compare
@@ -109,11 +115,35 @@ class _ArithmeticMixin:
 
 class _BucketBase(_ArithmeticMixin, _Base):
 
-    __slots__ = ('_keys', '_next', '_to_key')
+    __slots__ = ('_keys', '_next', '_to_key', '_packed')
 
     def clear(self):
         self._keys = self._key_type()
         self._next = None
+        # Whether __getstate__ should use the packed format.
+        self._packed = False
+
+    def _packState(self, values=None):
+        # Our keys, and values if given, in the packed format, or None if
+        # we shouldn't or can't be saved that way.
+        if not self._packed:
+            return None
+        key_code = _packCode(self._to_key)
+        value_code = None
+        if values is not None:
+            value_code = _packCode(self._to_value)
+            if value_code is None:
+                return None
+        if key_code is None:
+            return None
+        return _pack_state(self._keys, key_code, values, value_code)
+
+    def _unpackState(self, data, has_values):
+        key_code = _packCode(self._to_key)
+        value_code = _packCode(self._to_value) if has_values else None
+        if key_code is None or (has_values and value_code is None):
+            raise TypeError("tuple required for first state element")
+        return _unpack_state(data, key_code, value_code)
 
     def __len__(self):
         return len(self._keys)
@@ -122,6 +152,9 @@ class _BucketBase(_ArithmeticMixin, _Base):
     def size(self):
         return len(self._keys)
 
+    def keysBuffer(self):
+        return _native_buffer(self._keys, _packCode(self._to_key), 'keys')
+
     def _deleteNextBucket(self):
         next = self._next
         if next is not None:
@@ -312,6 +345,16 @@ class _MutableMappingMixin:
         del self[key]
         return key, value
 
+    def nlargest(self, k):
+        return heapq.nlargest(
+            k, ((v, key) for (key, v) in self.items()),
+            key=operator.itemgetter(0))
+
+    def nsmallest(self, k):
+        return heapq.nsmallest(
+            k, ((v, key) for (key, v) in self.items()),
+            key=operator.itemgetter(0))
+
 
 class Bucket(_MutableMappingMixin, _BucketBase):
 
@@ -322,6 +365,10 @@ class Bucket(_MutableMappingMixin, _BucketBase):
     def _to_value(self, x):
         return x
 
+    def valuesBuffer(self):
+        return _native_buffer(self._values, _packCode(self._to_value),
+                              'values')
+
     def setdefault(self, key, value):
         key, value = self._to_key(key), self._to_value(value)
         status, value = self._set(key, value, True)
@@ -425,6 +472,7 @@ class Bucket(_MutableMappingMixin, _BucketBase):
         new_instance._values = self._values[index:]
         del self._keys[index:]
         del self._values[index:]
+        new_instance._packed = self._packed
         new_instance._next = self._next
         self._next = new_instance
         return new_instance
@@ -456,18 +504,23 @@ class Bucket(_MutableMappingMixin, _BucketBase):
     def __getstate__(self):
         keys = self._keys
         values = self._values
-        data = []
-        for i in range(len(keys)):
-            data.append(keys[i])
-            data.append(values[i])
-        data = tuple(data)
+        data = self._packState(values)
+        if data is None:
+            data = []
+            for i in range(len(keys)):
+                data.append(keys[i])
+                data.append(values[i])
+            data = tuple(data)
 
         if self._next is not None:
             return data, self._next
         return (data, )
 
     def __setstate__(self, state):
-        if not isinstance(state[0], tuple):
+        packed = None
+        if isinstance(state[0], bytes):
+            packed = self._unpackState(state[0], True)
+        elif not isinstance(state[0], tuple):
             raise TypeError("tuple required for first state element")
 
         self.clear()
@@ -477,6 +530,11 @@ class Bucket(_MutableMappingMixin, _BucketBase):
             self._next = None
             state = state[0]
 
+        if packed is not None:
+            self._keys, self._values = packed
+            self._packed = True
+            return
+
         keys = self._keys
         values = self._values
         for i in range(0, len(state), 2):
@@ -619,6 +677,8 @@ class Bucket(_MutableMappingMixin, _BucketBase):
             raise merge_error(10)
 
         result._next = b_old._next
+        # Keep the packed state format if either side wrote it.
+        result._packed = b_com._packed or b_new._packed
         return result.__getstate__()
 
     def __repr__(self):
@@ -706,13 +766,18 @@ class Set(_MutableSetMixin, _BucketBase):
             add(i)
 
     def __getstate__(self):
-        data = tuple(self._keys)
+        data = self._packState()
+        if data is None:
+            data = tuple(self._keys)
         if self._next is not None:
             return data, self._next
         return (data, )
 
     def __setstate__(self, state):
-        if not isinstance(state[0], tuple):
+        packed = None
+        if isinstance(state[0], bytes):
+            packed = self._unpackState(state[0], False)
+        elif not isinstance(state[0], tuple):
             raise TypeError('tuple required for first state element')
 
         self.clear()
@@ -722,6 +787,11 @@ class Set(_MutableSetMixin, _BucketBase):
             self._next = None
             state = state[0]
 
+        if packed is not None:
+            self._keys = packed[0]
+            self._packed = True
+            return
+
         self._keys.extend(state)
 
     def _set(self, key, value=None, ifunset=False):
@@ -750,6 +820,7 @@ class Set(_MutableSetMixin, _BucketBase):
         new_instance = type(self)()
         new_instance._keys = self._keys[index:]
         del self._keys[index:]
+        new_instance._packed = self._packed
         new_instance._next = self._next
         self._next = new_instance
         return new_instance
@@ -880,6 +951,8 @@ class Set(_MutableSetMixin, _BucketBase):
             raise merge_error(10)
 
         result._next = b_old._next
+        # Keep the packed state format if either side wrote it.
+        result._packed = b_com._packed or b_new._packed
         return result.__getstate__()
 
     def __repr__(self):
@@ -888,11 +961,14 @@ class Set(_MutableSetMixin, _BucketBase):
 
 class _TreeItem:
 
-    __slots__ = ('key', 'child')
+    __slots__ = ('key', 'child', 'count')
 
-    def __init__(self, key, child):
+    def __init__(self, key, child, count=-1):
         self.key = key
         self.child = child
+        # In a counted tree, the number of keys reachable from child,
+        # or -1 if that isn't known yet.
+        self.count = count
 
 
 class _Tree(_ArithmeticMixin, _Base):
@@ -945,6 +1021,8 @@ class _Tree(_ArithmeticMixin, _Base):
         return bool(self._data)
 
     def __len__(self):
+        if self._isCounted():
+            return sum(self._childCount(i) for i in range(len(self._data)))
         accumulated = 0
         bucket = self._firstbucket
         while bucket is not None:
@@ -956,6 +1034,45 @@ class _Tree(_ArithmeticMixin, _Base):
     def size(self):
         return len(self._data)
 
+    def _isCounted(self):
+        return bool(getattr(type(self), 'counted', False))
+
+    def _isAppendOptimized(self):
+        return bool(getattr(type(self), 'append_optimized', False))
+
+    def _isPackedState(self):
+        return bool(getattr(type(self), 'packed_state', False))
+
+    def _nodeCount(self):
+        # The total of our children's counts, or -1 if any is unknown.
+        result = 0
+        for item in self._data:
+            if item.count < 0:
+                return -1
+            result += item.count
+        return result
+
+    def _countOf(self, child):
+        # The count to record for one of our children.
+        if type(child) is type(self):
+            return child._nodeCount()
+        return len(child._keys)
+
+    def _childCount(self, index):
+        item = self._data[index]
+        counted = self._isCounted()
+        if counted and item.count >= 0:
+            return item.count
+        child = item.child
+        if type(child) is type(self):
+            result = sum(child._childCount(i)
+                         for i in range(len(child._data)))
+        else:
+            result = len(child._keys)
+        if counted:
+            item.count = result
+        return result
+
     def _search(self, key):
         data = self._data
         if data:
@@ -996,6 +1113,9 @@ class _Tree(_ArithmeticMixin, _Base):
             return False
         return self._data[index].child.has_key(key)
 
+    def containsMany(self, keys):
+        return [key in self for key in keys]
+
     def keys(self, min=_marker, max=_marker,
              excludemin=False, excludemax=False,
              itertype='iterkeys'):
@@ -1010,15 +1130,34 @@ class _Tree(_ArithmeticMixin, _Base):
 
         iterargs = min, max, excludemin, excludemax
 
-        return _TreeItems(bucket, itertype, iterargs)
+        items = _TreeItems(bucket, itertype, iterargs)
+        if self._isCounted():
+            start, end = self._rankRange(*iterargs)
+            items.tree = self
+            items.firstrank = start
+            items._len = end - start
+        return items
 
     def iterkeys(self, min=_marker, max=_marker,
-                 excludemin=False, excludemax=False):
+                 excludemin=False, excludemax=False, *, reverse=False):
+        if reverse:
+            return _TreeCursor(self, 'k', min, max, excludemin, excludemax,
+                               reverse)
         return iter(self.keys(min, max, excludemin, excludemax))
 
     def __iter__(self):
         return iter(self.keys())
 
+    def __reversed__(self):
+        return _TreeCursor(self, 'k', reverse=True)
+
+    _cursor_kind = 'k'
+
+    def cursor(self, min=_marker, max=_marker,
+               excludemin=False, excludemax=False, *, reverse=False):
+        return _TreeCursor(self, self._cursor_kind, min, max,
+                           excludemin, excludemax, reverse)
+
     def minKey(self, min=_marker):
         if min is _marker or min is None:
             bucket = self._firstbucket
@@ -1061,13 +1200,25 @@ class _Tree(_ArithmeticMixin, _Base):
 
         result = child._set(key, value, ifunset)
         grew = result[0]
+        if (
+            grew is not None and
+            type(child) is not type(self) and
+            self._isPackedState()
+        ):
+            child._packed = True
         if grew:
+            if self._isCounted():
+                if data[index].count >= 0:
+                    data[index].count += 1
+                self._p_changed = True
             if type(child) is type(self):
                 max_size = type(self).max_internal_size
             else:
                 max_size = type(self).max_leaf_size
             if child.size > max_size:
-                self._grow(child, index)
+                append = (self._isAppendOptimized() and
+                          self._isRightEdge(child, key))
+                self._grow(child, index, append)
 
         # If a BTree contains only a single bucket, BTree.__getstate__()
         # includes the bucket's entire state, and the bucket doesn't get
@@ -1083,19 +1234,34 @@ class _Tree(_ArithmeticMixin, _Base):
             self._p_changed = 1
         return result
 
-    def _grow(self, child, index):
+    def _isRightEdge(self, child, key):
+        # Is key the largest key under child, and is child's rightmost
+        # bucket the last bucket of the whole tree?
+        while type(child) is type(self):
+            child = child._data[-1].child
+        return (child._next is None and
+                compare(child._keys[-1], key) == 0)
+
+    def _grow(self, child, index, append=False):
         self._p_changed = True
-        new_child = child._split()
+        if append:
+            # Leave child full and start a nearly empty right sibling.
+            new_child = child._split(child.size - 1)
+        else:
+            new_child = child._split()
         self._data.insert(index + 1, _TreeItem(new_child.minKey(), new_child))
+        if self._isCounted():
+            self._data[index].count = self._countOf(child)
+            self._data[index + 1].count = self._countOf(new_child)
         if len(self._data) >= type(self).max_internal_size * 2:
-            self._split_root()
+            self._split_root(append)
 
-    def _split_root(self):
+    def _split_root(self, append=False):
         child = type(self)()
         child._data = self._data
         child._firstbucket = self._firstbucket
         self._data = [_TreeItem(None, child)]
-        self._grow(child, 0)
+        self._grow(child, 0, append)
 
     def _split(self, index=None):
         data = self._data
@@ -1131,6 +1297,11 @@ class _Tree(_ArithmeticMixin, _Base):
 
         removed_first_bucket, value = child._del(key)
 
+        if self._isCounted():
+            if data[index].count >= 0:
+                data[index].count -= 1
+            self._p_changed = True
+
         # See comment in _set about small trees
         if (
             len(data) == 1 and
@@ -1166,6 +1337,240 @@ class _Tree(_ArithmeticMixin, _Base):
     def _deleteNextBucket(self):
         self._data[-1].child._deleteNextBucket()
 
+    def deleteRange(self, min=_marker, max=_marker,
+                    excludemin=False, excludemax=False):
+        for key in list(self.keys(min, max, excludemin, excludemax)):
+            self._del(key)
+
+    def count(self, min=_marker, max=_marker,
+              excludemin=False, excludemax=False):
+        if not self._data:
+            return 0
+        if min is _marker or min is None:
+            min = self.minKey() if excludemin else None
+        else:
+            min = self._to_key(min)
+        if max is _marker or max is None:
+            max = self.maxKey() if excludemax else None
+        else:
+            max = self._to_key(max)
+        if min is not None and max is not None:
+            cmp_ = compare(min, max)
+            if cmp_ > 0 or (cmp_ == 0 and (excludemin or excludemax)):
+                return 0
+        return self._count(min, max, excludemin, excludemax)
+
+    def _count(self, min, max, excludemin, excludemax):
+        # Only the children at the ends of the range need searching.
+        data = self._data
+        first = 0 if min is None else self._search(min)
+        last = len(data) - 1 if max is None else self._search(max)
+        result = 0
+        for i in range(first, last + 1):
+            if first < i < last:
+                result += self._childCount(i)
+                continue
+            child = data[i].child
+            if type(child) is type(self):
+                result += child._count(min, max, excludemin, excludemax)
+            else:
+                lo, hi = 0, len(child._keys)
+                if min is not None:
+                    lo = child._search(min)
+                    if lo < 0:
+                        lo = -lo - 1
+                    elif excludemin:
+                        lo += 1
+                if max is not None:
+                    hi = child._search(max)
+                    if hi < 0:
+                        hi = -hi - 1
+                    elif not excludemax:
+                        hi += 1
+                if hi > lo:
+                    result += hi - lo
+        return result
+
+    def rank(self, key):
+        return self._rank(self._to_key(key))
+
+    def _rank(self, key):
+        # The number of keys in the tree less than key.
+        data = self._data
+        if not data:
+            return 0
+        index = self._search(key)
+        result = sum(self._childCount(i) for i in range(index))
+        child = data[index].child
+        if type(child) is type(self):
+            return result + child._rank(key)
+        i = child._search(key)
+        return result + (i if i >= 0 else -i - 1)
+
+    def keyAt(self, index):
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError("position out of range")
+        bucket, offset = self._seekPosition(index)
+        return bucket._keys[offset]
+
+    def _seekPosition(self, pos):
+        # The bucket holding the entry at position pos, and its offset there.
+        data = self._data
+        for i in range(len(data)):
+            count = self._childCount(i)
+            if pos < count:
+                break
+            pos -= count
+        else:
+            raise IndexError("position out of range")
+        child = data[i].child
+        if type(child) is type(self):
+            return child._seekPosition(pos)
+        return child, pos
+
+    def _rankRange(self, min, max, excludemin, excludemax):
+        # The positions of the first key in the range, and of the
+        # first key after it.
+        if min is _marker or min is None:
+            start = 1 if excludemin else 0
+        else:
+            start = self._rank(min)
+            if excludemin and min in self:
+                start += 1
+        if max is _marker or max is None:
+            end = len(self)
+            if excludemax:
+                end -= 1
+        else:
+            max = self._to_key(max)
+            end = self._rank(max)
+            if not excludemax and max in self:
+                end += 1
+        return start, end if end > start else start
+
+    @classmethod
+    def _fromSorted(cls, keys, values, fill):
+        if not 0.0 < fill <= 1.0:
+            raise ValueError("fill must be greater than 0.0 and at most 1.0")
+        tree = cls()
+        if not keys:
+            return tree
+
+        to_key = cls._to_key
+        keys = [to_key(k) for k in keys]
+        for i in range(1, len(keys)):
+            if compare(keys[i - 1], keys[i]) >= 0:
+                raise ValueError("keys must be in strictly ascending order")
+        if values is not None:
+            to_value = cls._to_value
+            values = [to_value(v) for v in values]
+
+        # Pack the buckets, spreading the entries evenly among them.
+        children = []
+        previous = None
+        packed = bool(getattr(cls, 'packed_state', False))
+        for start, end in _even_chunks(
+                len(keys), max(1, int(cls.max_leaf_size * fill))):
+            bucket = cls._bucket_type()
+            bucket._packed = packed
+            bucket._keys = keys[start:end]
+            if values is not None:
+                bucket._values = values[start:end]
+            if previous is not None:
+                previous._next = bucket
+            previous = bucket
+            children.append((bucket._keys[0], bucket, bucket))
+
+        # Then build the interior levels, until one node holds the rest.
+        tree._buildLevels(children, fill)
+        return tree
+
+    def _buildLevels(self, children, fill):
+        # Build the interior levels over children, until self can hold
+        # the rest. Return the number of new nodes below self.
+        cls = type(self)
+        max_children = max(2, int(cls.max_internal_size * fill))
+        nodes = 0
+        while len(children) > max_children:
+            parents = []
+            for start, end in _even_chunks(len(children), max_children):
+                node = cls()
+                node._fill(children[start:end])
+                parents.append((children[start][0], node, node._firstbucket))
+            nodes += len(parents)
+            children = parents
+        self._fill(children)
+        return nodes
+
+    def _collectBuckets(self, buckets):
+        # Append our buckets to the list buckets, in key order, and
+        # return the number of nodes below us.
+        nodes = 0
+        for item in self._data:
+            child = item.child
+            if type(child) is type(self):
+                nodes += 1 + child._collectBuckets(buckets)
+            else:
+                buckets.append(child)
+        return nodes
+
+    def compact(self, target_fill=1.0):
+        if not 0.0 < target_fill <= 1.0:
+            raise ValueError(
+                "target_fill must be greater than 0.0 and at most 1.0")
+        if not self._data:
+            return 0
+        buckets = []
+        nodes = self._collectBuckets(buckets)
+
+        # Plan to merge each bucket into the one before it, if they fit
+        # together. Loading the buckets is all that can fail, so that
+        # happens before anything changes.
+        leaf_fill = max(1, int(self.max_leaf_size * target_fill))
+        groups = []
+        size = 0
+        for bucket in buckets:
+            if groups and size + len(bucket._keys) <= leaf_fill:
+                groups[-1].append(bucket)
+                size += len(bucket._keys)
+            else:
+                groups.append([bucket])
+                size = len(bucket._keys)
+
+        # Leave the tree alone unless that takes fewer objects.
+        max_children = max(2, int(self.max_internal_size * target_fill))
+        remaining = len(groups)
+        needed = 0
+        while remaining > max_children:
+            remaining = -(-remaining // max_children)
+            needed += remaining
+        if len(groups) + needed >= len(buckets) + nodes:
+            return 0
+
+        for current, *merged in groups:
+            for bucket in merged:
+                current._keys.extend(bucket._keys)
+                if isinstance(current, Bucket):
+                    current._values.extend(bucket._values)
+                current._next = bucket._next
+                current._p_changed = True
+                bucket._next = None
+
+        children = [(group[0]._keys[0], group[0], group[0])
+                    for group in groups]
+        newnodes = self._buildLevels(children, target_fill)
+        return nodes + len(buckets) - newnodes - len(groups)
+
+    def _fill(self, children):
+        # children is a sequence of (minimum key, child, firstbucket)
+        self._data = [_TreeItem(key, child, self._countOf(child))
+                      for key, child, _ in children]
+        self._data[0].key = None
+        self._firstbucket = children[0][2]
+
     def __getstate__(self):
         data = self._data
 
@@ -1181,12 +1586,20 @@ class _Tree(_ArithmeticMixin, _Base):
         ):
             return ((data[0].child.__getstate__(), ), )
 
-        data = iter(data)
-        sdata = [next(data).child]
-        for item in data:
-            sdata.append(item.key)
-            sdata.append(item.child)
-
+        key_code = _packCode(self._to_key)
+        if self._isPackedState() and key_code is not None:
+            sdata = [_pack_state([item.key for item in data[1:]], key_code)]
+            sdata.extend(item.child for item in data)
+        else:
+            items = iter(data)
+            sdata = [next(items).child]
+            for item in items:
+                sdata.append(item.key)
+                sdata.append(item.child)
+
+        if self._isCounted():
+            counts = tuple(item.count for item in data)
+            return tuple(sdata), self._firstbucket, counts
         return tuple(sdata), self._firstbucket
 
     def __setstate__(self, state):
@@ -1202,7 +1615,33 @@ class _Tree(_ArithmeticMixin, _Base):
             bucket.__setstate__(state[0][0])
             state = [bucket], bucket
 
-        data, self._firstbucket = state
+        data, self._firstbucket = state[:2]
+        if len(data) > 1 and isinstance(data[0], bytes):
+            # The keys are packed, and the children follow them.
+            key_code = _packCode(self._to_key)
+            if key_code is None:
+                raise TypeError(
+                    "packed state not supported for this tree type")
+            keys, _ = _unpack_state(data[0], key_code)
+            children = data[1:]
+            if len(keys) != len(children) - 1:
+                raise ValueError("packed state has the wrong number of keys")
+            data = [children[0]]
+            for key, child in zip(keys, children[1:]):
+                data.append(key)
+                data.append(child)
+        # Missing counts (the tree is new, or only recently became
+        # counted) are computed when they're needed.
+        counts = [-1] * ((len(data) + 1) // 2)
+        if len(state) > 2:
+            if (not isinstance(state[2], tuple) or
+                    len(state[2]) != len(counts)):
+                raise TypeError("tuple of child counts required for "
+                                "third state element")
+            counts = list(state[2])
+            if any(count < -1 for count in counts):
+                raise ValueError("negative child count in state")
+        counts.reverse()
         data = list(reversed(data))
 
         # verify children are either tree or bucket nodes.
@@ -1215,11 +1654,11 @@ class _Tree(_ArithmeticMixin, _Base):
                                 (_tp_name(type(child)), _tp_name(type(self)),
                                  _tp_name(self._bucket_type)))
 
-        self._data.append(_TreeItem(None, data.pop()))
+        self._data.append(_TreeItem(None, data.pop(), counts.pop()))
         while data:
             key = data.pop()
             child = data.pop()
-            self._data.append(_TreeItem(key, child))
+            self._data.append(_TreeItem(key, child, counts.pop()))
 
     def _assert(self, condition, message):
         if not condition:
@@ -1251,6 +1690,11 @@ class _Tree(_ArithmeticMixin, _Base):
             for i in range(len(data) - 1):
                 data[i].child._check(data[i + 1].child._firstbucket)
             data[-1].child._check(nextbucket)
+            if self._isCounted():
+                for i in data:
+                    count = i.child._nodeCount()
+                    assert_(i.count < 0 or count < 0 or i.count == count,
+                            "BTree child count is damaged")
         elif child_class is self._bucket_type:
             assert_(
                 self._firstbucket is data[0].child,
@@ -1265,6 +1709,10 @@ class _Tree(_ArithmeticMixin, _Base):
                 data[-1].child._next is nextbucket,
                 "Bucket next pointer is damaged"
             )
+            if self._isCounted():
+                for i in data:
+                    assert_(i.count < 0 or i.count == len(i.child._keys),
+                            "Bucket count is damaged")
         else:
             assert_(False, "Incorrect child type")
 
@@ -1281,16 +1729,121 @@ class _Tree(_ArithmeticMixin, _Base):
         return r
 
 
+def _even_chunks(length, max_size):
+    # Split range(length) into the fewest (start, end) chunks of at most
+    # max_size items each, with sizes differing by at most one.
+    count = -(-length // max_size)
+    size, extra = divmod(length, count)
+    start = 0
+    for i in range(count):
+        end = start + size + (i < extra)
+        yield start, end
+        start = end
+
+
+# Packed states hold keys, and maybe values, that are C numbers as raw
+# little-endian arrays behind an 8-byte header: the format version, the
+# struct codes of the keys and of the values (0 if there are none), a
+# zero byte, and the number of keys.  The C implementation reads and
+# writes the same format; see BTreeModuleTemplate.c.
+_PACKED_STATE_VERSION = 1
+_packed_header = struct.Struct('<BccxI')
+
+
+def _packCode(datatype):
+    # The struct code of a native data type, None for other types.
+    return getattr(datatype, '_struct_format', None)
+
+
+def _native_buffer(items, code, what):
+    # A read-only memoryview of items as a C array, like the buffers the C
+    # implementation exports.  Here it is a copy, so nothing is pinned.
+    if code is None:
+        raise TypeError(
+            "only %s that are C numbers can be read as a buffer" % what)
+    return memoryview(array.array(code, items)).toreadonly()
+
+
+_buffer_kinds = ('bhilqn', 'BHILQN', 'fd')
+_native_orders = '@=<' if sys.byteorder == 'little' else '@=>!'
+
+
+def _buffer_items(buf, code, what):
+    # The items of a C-contiguous buffer as a list.  Like the C
+    # implementation, only accept C numbers of the same kind and size as
+    # those of the struct code, in native byte order.
+    if code is None:
+        raise TypeError(
+            "only %s that are C numbers can be read from a buffer" % what)
+    view = memoryview(buf)
+    if not view.c_contiguous:
+        raise BufferError("%s buffer is not C-contiguous" % what)
+    fmt = view.format
+    if fmt[:1] and fmt[0] in _native_orders:
+        fmt = fmt[1:]
+    kind = [k for k in _buffer_kinds if code in k][0]
+    if (view.itemsize != struct.calcsize(code) or len(fmt) != 1
+            or fmt not in kind):
+        raise TypeError(
+            "%s must be a buffer of C numbers like struct code %r"
+            % (what, code))
+    return view.cast('B').cast(code).tolist()
+
+
+def _check_array_code(code, what):
+    if code is None:
+        raise TypeError(
+            "only %s that are C numbers can be copied to an array" % what)
+    return code
+
+
+def _pack_state(keys, key_code, values=None, value_code=None):
+    n = len(keys)
+    result = [
+        _packed_header.pack(_PACKED_STATE_VERSION, key_code.encode('ascii'),
+                            (value_code or '\0').encode('ascii'), n),
+        struct.pack('<%d%s' % (n, key_code), *keys),
+    ]
+    if value_code is not None:
+        result.append(struct.pack('<%d%s' % (n, value_code), *values))
+    return b''.join(result)
+
+
+def _unpack_state(data, key_code=None, value_code=None):
+    # Return the lists of keys and values (None if there are none) in a
+    # packed state, checking its type codes unless key_code is None.
+    if (len(data) < _packed_header.size or
+            data[0] != _PACKED_STATE_VERSION):
+        raise ValueError("unsupported packed state")
+    _, kcode, vcode, n = _packed_header.unpack_from(data)
+    kcode = kcode.decode('ascii')
+    vcode = vcode.decode('ascii') if vcode != b'\0' else None
+    if key_code is not None and (kcode, vcode) != (key_code, value_code):
+        raise TypeError("packed state has the wrong key or value type")
+    keys = struct.Struct('<%d%s' % (n, kcode))
+    values = struct.Struct('<%d%s' % (n, vcode)) if vcode else None
+    size = _packed_header.size + keys.size + (values.size if values else 0)
+    if len(data) != size:
+        raise ValueError("packed state has the wrong size")
+    offset = _packed_header.size
+    result_keys = list(keys.unpack_from(data, offset))
+    result_values = None
+    if values is not None:
+        result_values = list(values.unpack_from(data, offset + keys.size))
+    return result_keys, result_values
+
+
 def _get_simple_btree_bucket_state(state):
     if state is None:
         return state
     if not isinstance(state, tuple):
         raise TypeError("_p_resolveConflict: expected tuple or None for state")
-    if len(state) == 2:  # non-degenerate BTree, can't resolve
+    if len(state) in (2, 3):  # non-degenerate BTree, can't resolve
         raise BTreesConflictError(-1, -1, -1, 11)
     # Peel away wrapper to get to only-bucket state.
     if len(state) != 1:
-        raise TypeError("_p_resolveConflict: expected 1- or 2-tuple for state")
+        raise TypeError(
+            "_p_resolveConflict: expected 1-, 2- or 3-tuple for state")
     state = state[0]
     if not isinstance(state, tuple) or len(state) != 1:
         raise TypeError("_p_resolveConflict: expected 1-tuple containing "
@@ -1311,6 +1864,8 @@ class _TreeItems:
         'it',
         'v',
         '_len',
+        'tree',
+        'firstrank',
     )
 
     def __init__(self, firstbucket, itertype, iterargs):
@@ -1321,6 +1876,10 @@ class _TreeItems:
         self.it = iter(self)
         self.v = None
         self._len = None
+        # For a counted tree, the tree and the position in it of our
+        # first entry, so that indexing can seek from the root.
+        self.tree = None
+        self.firstrank = 0
 
     def __getitem__(self, i):
         if isinstance(i, slice):
@@ -1330,6 +1889,16 @@ class _TreeItems:
             if i < 0:
                 raise IndexError(i)
 
+        if self.tree is not None:
+            if i >= self._len:
+                raise IndexError(i)
+            bucket, offset = self.tree._seekPosition(self.firstrank + i)
+            if self.itertype == 'itervalues':
+                return bucket._values[offset]
+            if self.itertype == 'iteritems':
+                return bucket._keys[offset], bucket._values[offset]
+            return bucket._keys[offset]
+
         if i < self.index:
             self.index = -1
             self.it = iter(self)
@@ -1381,16 +1950,186 @@ class _TreeIterator:
         )
 
 
+class _TreeCursor:
+    """A position between two entries of a BTree or TreeSet.
+
+    Besides the current bucket, a cursor keeps the path of ``[node,
+    index]`` pairs leading down to it from the root, so that moving to
+    the bucket on either side doesn't rescan the chain of buckets.
+    """
+
+    __slots__ = (
+        '_tree',
+        '_kind',
+        '_reverse',
+        '_min',
+        '_max',
+        '_excludemin',
+        '_excludemax',
+        '_path',
+        '_bucket',
+        '_offset',
+    )
+
+    def __init__(self, tree, kind, min=_marker, max=_marker,
+                 excludemin=False, excludemax=False, reverse=False):
+        if min is _marker:
+            min = None
+        if max is _marker:
+            max = None
+        # As with keys(), excluding a missing end of the range leaves
+        # out the smallest or largest key.
+        if tree:
+            if min is None and excludemin:
+                min = tree.minKey()
+            if max is None and excludemax:
+                max = tree.maxKey()
+        self._tree = tree
+        self._kind = kind
+        self._reverse = reverse
+        self._min = None if min is None else tree._to_key(min)
+        self._max = None if max is None else tree._to_key(max)
+        self._excludemin = excludemin
+        self._excludemax = excludemax
+        self._path = []
+        self._bucket = None
+        self._offset = 0
+        self._seekEdge(reverse)
+
+    def _descend(self, child, rightmost):
+        # Go down the leftmost (or rightmost) edge below child.
+        tree_type = type(self._tree)
+        while type(child) is tree_type:
+            data = child._data
+            if not data:
+                return  # An empty tree.
+            i = len(data) - 1 if rightmost else 0
+            self._path.append([child, i])
+            child = data[i].child
+        self._bucket = child
+        self._offset = len(child._keys) if rightmost else 0
+
+    def _seekKey(self, key, after):
+        del self._path[:]
+        self._bucket = None
+        node = self._tree
+        tree_type = type(node)
+        while type(node) is tree_type:
+            if not node._data:
+                return
+            i = node._search(key)
+            self._path.append([node, i])
+            node = node._data[i].child
+        i = node._search(key)
+        if i < 0:
+            i = -i - 1
+        elif after:
+            i += 1
+        self._bucket = node
+        self._offset = i
+
+    def _seekEdge(self, end):
+        if end:
+            if self._max is not None:
+                return self._seekKey(self._max, not self._excludemax)
+        elif self._min is not None:
+            return self._seekKey(self._min, self._excludemin)
+        del self._path[:]
+        self._bucket = None
+        self._descend(self._tree, end)
+
+    def _nextBucket(self, forward):
+        path = self._path
+        for depth in range(len(path) - 1, -1, -1):
+            node, i = path[depth]
+            data = node._data
+            if i >= len(data):
+                raise RuntimeError("the BTree being iterated changed size")
+            i += 1 if forward else -1
+            if 0 <= i < len(data):
+                path[depth][1] = i
+                del path[depth + 1:]
+                self._descend(data[i].child, not forward)
+                return True
+        return False
+
+    def _step(self, forward):
+        while True:
+            bucket = self._bucket
+            if bucket is None:
+                raise StopIteration
+            keys = bucket._keys
+            offset = self._offset
+            if offset > len(keys):
+                raise RuntimeError("the bucket being iterated changed size")
+            if offset < len(keys) if forward else offset > 0:
+                break
+            if not self._nextBucket(forward):
+                raise StopIteration
+
+        i = offset if forward else offset - 1
+        key = keys[i]
+        if forward:
+            if self._max is not None:
+                cmp_ = compare(key, self._max)
+                if cmp_ > 0 or (cmp_ == 0 and self._excludemax):
+                    raise StopIteration
+        elif self._min is not None:
+            cmp_ = compare(key, self._min)
+            if cmp_ < 0 or (cmp_ == 0 and self._excludemin):
+                raise StopIteration
+        self._offset = i + 1 if forward else i
+
+        if self._kind == 'k':
+            return key
+        value = bucket._values[i]
+        if self._kind == 'v':
+            return value
+        return key, value
+
+    def seek(self, key):
+        key = self._tree._to_key(key)
+        if self._min is not None and compare(key, self._min) <= 0:
+            return self.seekStart()
+        if self._max is not None and compare(key, self._max) > 0:
+            return self.seekEnd()
+        self._seekKey(key, False)
+
+    def seekStart(self):
+        self._seekEdge(False)
+
+    def seekEnd(self):
+        self._seekEdge(True)
+
+    def next(self):
+        return self._step(True)
+
+    def prev(self):
+        return self._step(False)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._step(not self._reverse)
+
+
 class Tree(_MutableMappingMixin, _Tree):
 
     __slots__ = ()
 
+    _cursor_kind = 'i'
+
     def get(self, key, default=None):
         bucket = self._findbucket(key)
         if bucket:
             return bucket.get(key, default)
         return default
 
+    def getMany(self, keys, default=None):
+        get = self.get
+        return [get(key, default) for key in keys]
+
     def __getitem__(self, key):
         bucket = self._findbucket(key)
         if bucket:
@@ -1401,8 +2140,19 @@ class Tree(_MutableMappingMixin, _Tree):
                excludemin=False, excludemax=False):
         return self.keys(min, max, excludemin, excludemax, 'itervalues')
 
+    def toArrays(self, min=_marker, max=_marker,
+                 excludemin=False, excludemax=False):
+        key_code = _check_array_code(_packCode(self._to_key), 'keys')
+        value_code = _check_array_code(_packCode(self._to_value), 'values')
+        args = min, max, excludemin, excludemax
+        return (array.array(key_code, self.keys(*args)),
+                array.array(value_code, self.values(*args)))
+
     def itervalues(self, min=_marker, max=_marker,
-                   excludemin=False, excludemax=False):
+                   excludemin=False, excludemax=False, *, reverse=False):
+        if reverse:
+            return _TreeCursor(self, 'v', min, max, excludemin, excludemax,
+                               reverse)
         return iter(self.values(min, max, excludemin, excludemax))
 
     def items(self, min=_marker, max=_marker,
@@ -1410,7 +2160,10 @@ class Tree(_MutableMappingMixin, _Tree):
         return self.keys(min, max, excludemin, excludemax, 'iteritems')
 
     def iteritems(self, min=_marker, max=_marker,
-                  excludemin=False, excludemax=False):
+                  excludemin=False, excludemax=False, *, reverse=False):
+        if reverse:
+            return _TreeCursor(self, 'i', min, max, excludemin, excludemax,
+                               reverse)
         return iter(self.items(min, max, excludemin, excludemax))
 
     def byValue(self, min):
@@ -1420,6 +2173,36 @@ class Tree(_MutableMappingMixin, _Tree):
     def insert(self, key, value):
         return bool(self._set(key, value, True)[0])
 
+    @classmethod
+    def fromSorted(cls, items, fill=1.0):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        elif hasattr(items, 'items'):
+            items = items.items()
+
+        keys = []
+        values = []
+        for item in items:
+            if not isinstance(item, tuple) or len(item) != 2:
+                raise TypeError('Sequence must contain 2-item tuples')
+            keys.append(item[0])
+            values.append(item[1])
+        return cls._fromSorted(keys, values, fill)
+
+    @classmethod
+    def fromArrays(cls, keys, values, sorted=False, fill=1.0):
+        keys = _buffer_items(keys, _packCode(cls._to_key), 'keys')
+        values = _buffer_items(values, _packCode(cls._to_value), 'values')
+        if len(keys) != len(values):
+            raise ValueError("keys and values must have the same length")
+        if not sorted:
+            # The last value given for a key wins, as with update().
+            items = dict(zip(keys, values))
+            keys = list(items)
+            keys.sort()
+            values = [items[k] for k in keys]
+        return cls._fromSorted(keys, values, fill)
+
 
 class TreeSet(_MutableSetMixin, _Tree):
 
@@ -1438,6 +2221,24 @@ class TreeSet(_MutableSetMixin, _Tree):
         for i in items:
             add(i)
 
+    def toArrays(self, min=_marker, max=_marker,
+                 excludemin=False, excludemax=False):
+        key_code = _check_array_code(_packCode(self._to_key), 'keys')
+        keys = self.keys(min, max, excludemin, excludemax)
+        return array.array(key_code, keys), None
+
+    @classmethod
+    def fromSorted(cls, keys, fill=1.0):
+        return cls._fromSorted(list(keys), None, fill)
+
+    @classmethod
+    def fromBuffer(cls, keys, sorted=False, fill=1.0):
+        keys = _buffer_items(keys, _packCode(cls._to_key), 'keys')
+        if not sorted:
+            keys = list(set(keys))
+            keys.sort()
+        return cls._fromSorted(keys, None, fill)
+
     _p_resolveConflict = _Tree._p_resolveConflict
 
 
@@ -1465,7 +2266,40 @@ class set_operation:
         return self.func(self.set_type, *a, **k)
 
 
-def difference(set_type, o1, o2):
+def _range_search(min, max, excludemin, excludemax):
+    # The keys() arguments restricting the inputs of a set operation to
+    # a range, or None if they aren't restricted.  The exclude flags only
+    # apply to a bound that was given.
+    if min is None and max is None:
+        return None
+    return dict(min=min, max=max,
+                excludemin=min is not None and bool(excludemin),
+                excludemax=max is not None and bool(excludemax))
+
+
+def _in_range(set_type, o, search):
+    # o itself if search is None (or o is), else a new bucket or set of
+    # just the keys (and values) of o in the range search describes.
+    if search is None or o is None:
+        return o
+    if not isinstance(o, _Base):
+        o = set_type(o)
+    if isinstance(o, _MutableMappingMixin):
+        items = o.items(**search)
+        result = o._mapping_type()
+        result._keys = [key for key, _ in items]
+        result._values = [value for _, value in items]
+    else:
+        result = o._set_type()
+        result._keys = list(o.keys(**search))
+    return result
+
+
+def difference(set_type, o1, o2, *, min=None, max=None,
+               excludemin=False, excludemax=False):
+    search = _range_search(min, max, excludemin, excludemax)
+    o1 = _in_range(set_type, o1, search)
+    o2 = _in_range(set_type, o2, search)
     if o1 is None or o2 is None:
         return o1
     i1 = _SetIteration(o1, True, 0)
@@ -1499,7 +2333,11 @@ def difference(set_type, o1, o2):
     return result
 
 
-def union(set_type, o1, o2):
+def union(set_type, o1, o2, *, min=None, max=None,
+          excludemin=False, excludemax=False):
+    search = _range_search(min, max, excludemin, excludemax)
+    o1 = _in_range(set_type, o1, search)
+    o2 = _in_range(set_type, o2, search)
     if o1 is None:
         return o2
     if o2 is None:
@@ -1532,7 +2370,11 @@ def union(set_type, o1, o2):
     return result
 
 
-def intersection(set_type, o1, o2):
+def intersection(set_type, o1, o2, *, min=None, max=None,
+                 excludemin=False, excludemax=False):
+    search = _range_search(min, max, excludemin, excludemax)
+    o1 = _in_range(set_type, o1, search)
+    o2 = _in_range(set_type, o2, search)
     if o1 is None:
         return o2
     if o2 is None:
@@ -1557,6 +2399,136 @@ def intersection(set_type, o1, o2):
     return result
 
 
+def _imerge(i1, i2, c1, c12, c2):
+    # Yield the keys that are only in i1 (if c1), in both (if c12) or
+    # only in i2 (if c2), advancing the sorted iterators i1 and i2 only
+    # as far as needed for each one.
+    k1 = next(i1, _marker)
+    k2 = next(i2, _marker)
+    while k1 is not _marker and k2 is not _marker:
+        cmp_ = compare(k1, k2)
+        if cmp_ < 0:
+            if c1:
+                yield k1
+            k1 = next(i1, _marker)
+        elif cmp_ == 0:
+            if c12:
+                yield k1
+            k1 = next(i1, _marker)
+            k2 = next(i2, _marker)
+        else:
+            if c2:
+                yield k2
+            k2 = next(i2, _marker)
+    while c1 and k1 is not _marker:
+        yield k1
+        k1 = next(i1, _marker)
+    while c2 and k2 is not _marker:
+        yield k2
+        k2 = next(i2, _marker)
+
+
+def _iset_operation(set_type, o1, o2, c1, c12, c2, search):
+    # The inputs are prepared now, and merged as the result is iterated.
+    if c12 and (o1 is None or o2 is None):
+        # intersection() returns the input that isn't None.
+        c1 = c2 = 1
+
+    def iterkeys(o):
+        if o is None:
+            return iter(())
+        if search is None:
+            return iter(o if isinstance(o, _Base) else sorted(o))
+        if not isinstance(o, _Base):
+            o = set_type(o)
+        return iter(o.keys(**search))
+
+    return _imerge(iterkeys(o1), iterkeys(o2), c1, c12, c2)
+
+
+def iunion(set_type, o1, o2, *, min=None, max=None,
+           excludemin=False, excludemax=False):
+    search = _range_search(min, max, excludemin, excludemax)
+    return _iset_operation(set_type, o1, o2, 1, 1, 1, search)
+
+
+def iintersection(set_type, o1, o2, *, min=None, max=None,
+                  excludemin=False, excludemax=False):
+    search = _range_search(min, max, excludemin, excludemax)
+    return _iset_operation(set_type, o1, o2, 0, 1, 0, search)
+
+
+def idifference(set_type, o1, o2, *, min=None, max=None,
+                excludemin=False, excludemax=False):
+    search = _range_search(min, max, excludemin, excludemax)
+    return _iset_operation(set_type, o1, o2, 1, 0, 0, search)
+
+
+def _check_limit(limit):
+    if limit is None:
+        return None
+    limit = operator.index(limit)
+    if limit < 0:
+        raise ValueError("limit must not be negative")
+    return limit
+
+
+def _limited(count, limit):
+    return count if limit is None else min(count, limit)
+
+
+def _count_merge(o1, o2, c1, c12, c2, limit):
+    # Count the keys that are only in o1 (if c1), in both (if c12) or
+    # only in o2 (if c2), stopping once the count reaches limit.
+    i1 = _SetIteration(o1, False, 0, True)
+    i2 = _SetIteration(o2, False, 0, True)
+    count = 0
+    while i1.active and i2.active and (limit is None or count < limit):
+        cmp_ = compare(i1.key, i2.key)
+        if cmp_ < 0:
+            count += c1
+            i1.advance()
+        elif cmp_ == 0:
+            count += c12
+            i1.advance()
+            i2.advance()
+        else:
+            count += c2
+            i2.advance()
+    for i, c in (i1, c1), (i2, c2):
+        while c and i.active and (limit is None or count < limit):
+            count += 1
+            i.advance()
+    return count
+
+
+def differenceSize(set_type, o1, o2, limit=None):
+    limit = _check_limit(limit)
+    if o1 is None:
+        return 0
+    if o2 is None:
+        return _limited(len(o1), limit)
+    return _count_merge(o1, o2, 1, 0, 0, limit)
+
+
+def unionSize(set_type, o1, o2, limit=None):
+    limit = _check_limit(limit)
+    if o1 is None:
+        return 0 if o2 is None else _limited(len(o2), limit)
+    if o2 is None:
+        return _limited(len(o1), limit)
+    return _count_merge(o1, o2, 1, 1, 1, limit)
+
+
+def intersectionSize(set_type, o1, o2, limit=None):
+    limit = _check_limit(limit)
+    if o1 is None:
+        return 0 if o2 is None else _limited(len(o2), limit)
+    if o2 is None:
+        return _limited(len(o1), limit)
+    return _count_merge(o1, o2, 0, 1, 0, limit)
+
+
 def _prepMergeIterators(o1, o2):
     MERGE_DEFAULT = getattr(o1, 'MERGE_DEFAULT', None)
     if MERGE_DEFAULT is None:
@@ -1566,7 +2538,32 @@ def _prepMergeIterators(o1, o2):
     return i1, i2
 
 
-def weightedUnion(set_type, o1, o2, w1=1, w2=1):
+def _check_topk(topk):
+    if topk is None:
+        return None
+    topk = operator.index(topk)
+    if topk < 1:
+        raise ValueError("topk must be at least 1")
+    return topk
+
+
+def _keep_topk(result, topk):
+    # Keep only the topk items with the largest values, still in key
+    # order.  Equal values are kept in key order, too.
+    if topk is None or len(result._keys) <= topk:
+        return
+    keep = sorted(heapq.nlargest(topk, range(len(result._values)),
+                                 key=result._values.__getitem__))
+    result._keys = [result._keys[i] for i in keep]
+    result._values = [result._values[i] for i in keep]
+
+
+def weightedUnion(set_type, o1, o2, w1=1, w2=1, *, topk=None,
+                  min=None, max=None, excludemin=False, excludemax=False):
+    topk = _check_topk(topk)
+    search = _range_search(min, max, excludemin, excludemax)
+    o1 = _in_range(set_type, o1, search)
+    o2 = _in_range(set_type, o2, search)
     if o1 is None:
         if o2 is None:
             return 0, None
@@ -1616,10 +2613,18 @@ def weightedUnion(set_type, o1, o2, w1=1, w2=1):
     while i2.active:
         copy(i2, w2)
         i2.advance()
+    if _merging:
+        _keep_topk(result, topk)
     return 1, result
 
 
-def weightedIntersection(set_type, o1, o2, w1=1, w2=1):
+def weightedIntersection(set_type, o1, o2, w1=1, w2=1, *, topk=None,
+                         min=None, max=None,
+                         excludemin=False, excludemax=False):
+    topk = _check_topk(topk)
+    search = _range_search(min, max, excludemin, excludemax)
+    o1 = _in_range(set_type, o1, search)
+    o2 = _in_range(set_type, o2, search)
     if o1 is None:
         if o2 is None:
             return 0, None
@@ -1652,11 +2657,47 @@ def weightedIntersection(set_type, o1, o2, w1=1, w2=1):
             i2.advance()
     if isinstance(result, (Set, TreeSet)):
         return w1 + w2, result
+    _keep_topk(result, topk)
     return 1, result
 
 
-def multiunion(set_type, seqs):
+def multiWeightedUnion(set_type, pairs, *, topk=None):
+    topk = _check_topk(topk)
+    mapping_type = set_type._mapping_type
+    MERGE_WEIGHT = mapping_type.MERGE_WEIGHT
+    totals = {}
+    for pair in pairs:
+        if not isinstance(pair, tuple):
+            raise TypeError("multiWeightedUnion expects (o, weight) pairs")
+        o, w = pair if len(pair) > 1 else (pair[0], 1)
+        if o is None:
+            continue
+        i = _SetIteration(o, True, mapping_type.MERGE_DEFAULT)
+        while i.active:
+            value = MERGE_WEIGHT(i.value, w)
+            if i.key in totals:
+                value = totals[i.key] + value
+            totals[i.key] = value
+            i.advance()
+    result = mapping_type()
+    result.update(sorted(totals.items()))
+    _keep_topk(result, topk)
+    return result
+
+
+def _check_threads(threads):
+    if threads is None:
+        return 1
+    threads = operator.index(threads)
+    if threads < 1:
+        raise ValueError("threads must be at least 1")
+    return threads
+
+
+def multiunion(set_type, seqs, *, threads=None):
     # XXX simple/slow implementation. Goal is just to get tests to pass.
+    # The threads argument is only checked; everything runs here.
+    _check_threads(threads)
     result = set_type()
     for s in seqs:
         try:
@@ -1667,6 +2708,62 @@ def multiunion(set_type, seqs):
     return result
 
 
+def multiunionSize(set_type, seqs, limit=None):
+    limit = _check_limit(limit)
+    return _limited(len(multiunion(set_type, seqs)), limit)
+
+
+def _multiintersection_size(s):
+    if isinstance(s, _Tree) or not hasattr(s, '__len__'):
+        return float('inf')
+    return len(s)
+
+
+def multiintersection(set_type, seqs):
+    inputs = []
+    for s in seqs:
+        try:
+            iter(s)
+        except TypeError:
+            s = set_type((s, ))
+        inputs.append(s)
+    if not inputs:
+        return set_type()
+    # Start from the smallest input. The sizes of trees, and of iterables
+    # without len(), aren't cheap to know, so take those to be huge.
+    inputs.sort(key=_multiintersection_size)
+    result = set_type()
+    result.update(inputs[0])
+    for s in inputs[1:]:
+        if not result:
+            break
+        result = intersection(set_type, result, s)
+    return result
+
+
+def thresholdUnion(set_type, seqs, k, counts=False):
+    if k < 1:
+        raise ValueError("k must be at least 1")
+    tally = {}
+    for s in seqs:
+        try:
+            iter(s)
+        except TypeError:
+            s = (s, )
+        keys = set_type()
+        keys.update(s)
+        for key in keys:
+            tally[key] = tally.get(key, 0) + 1
+    keys = sorted(key for key, count in tally.items() if count >= k)
+    if counts:
+        result = set_type._mapping_type()
+        result.update((key, tally[key]) for key in keys)
+    else:
+        result = set_type()
+        result.update(keys)
+    return result
+
+
 def MERGE(self, value1, weight1, value2, weight2):
     return (value1 * weight1) + (value2 * weight2)
 
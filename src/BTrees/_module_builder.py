@@ -29,6 +29,7 @@ def _create_classes(
     from ._base import Set
     from ._base import Tree
     from ._base import TreeSet
+    from ._base import _TreeCursor as TreeCursor
     from ._base import _TreeItems as TreeItems
     from ._base import _TreeIterator
 
@@ -37,6 +38,7 @@ def _create_classes(
     prefix = key_datatype.prefix_code + value_datatype.prefix_code
 
     classes['TreeItems'] = classes['TreeItemsPy'] = TreeItems
+    classes['TreeCursor'] = classes['TreeCursorPy'] = TreeCursor
     for base in (
             Bucket,
             Set,
@@ -86,10 +88,20 @@ def _create_classes(
 
 def _create_set_operations(module_name, key_type, value_type, set_type):
     from ._base import difference
+    from ._base import differenceSize
+    from ._base import idifference
+    from ._base import iintersection
     from ._base import intersection
+    from ._base import intersectionSize
+    from ._base import iunion
+    from ._base import multiintersection
     from ._base import multiunion
+    from ._base import multiunionSize
+    from ._base import multiWeightedUnion
     from ._base import set_operation
+    from ._base import thresholdUnion
     from ._base import union
+    from ._base import unionSize
     from ._base import weightedIntersection
     from ._base import weightedUnion
 
@@ -98,12 +110,16 @@ def _create_set_operations(module_name, key_type, value_type, set_type):
         for op in (
             difference, intersection,
             union,
+            differenceSize, intersectionSize,
+            unionSize,
+            idifference, iintersection,
+            iunion,
         ) + (
-            (weightedIntersection, weightedUnion,)
+            (weightedIntersection, weightedUnion, multiWeightedUnion)
             if value_type.supports_value_union()
             else ()
         ) + (
-            (multiunion,)
+            (multiunion, multiintersection, thresholdUnion, multiunionSize)
             if key_type.supports_value_union()
             else ()
         )
@@ -154,6 +170,9 @@ def populate_module(mod_globals,
         'Bucket', 'Set', 'BTree', 'TreeSet',
         'union', 'intersection', 'difference',
         'weightedUnion', 'weightedIntersection', 'multiunion',
+        'multiintersection', 'thresholdUnion', 'multiWeightedUnion',
+        'differenceSize', 'unionSize', 'intersectionSize', 'multiunionSize',
+        'iunion', 'iintersection', 'idifference',
     )
     prefix = key_datatype.prefix_code + value_datatype.prefix_code
 
@@ -174,10 +193,11 @@ def populate_module(mod_globals,
     directlyProvides(module or sys.modules[module_name], interface)
     for cls_name, iface in {
             'BTree': interfaces.IBTree,
-            'Bucket': interfaces.IMinimalDictionary,
+            'Bucket': interfaces.IBucket,
             'Set': interfaces.ISet,
             'TreeSet': interfaces.ITreeSet,
             'TreeItems': interfaces.IMinimalSequence,
+            'TreeCursor': interfaces.ITreeCursor,
     }.items():
         classImplements(mod_globals[cls_name], iface)
         classImplements(mod_globals[cls_name + 'Py'], iface)
@@ -200,7 +220,8 @@ def populate_module(mod_globals,
         # That's too many coincidences to rely on though.
         abc.register(mod_globals[cls_name + 'Py'])
 
-    # Set node sizes.
+    # Set node sizes, and leave trees uncounted, splitting at the
+    # midpoint and saving tuple states by default.
     for cls_name in ('BTree', 'TreeSet'):
 
         for suffix in ('', 'Py'):
@@ -209,6 +230,9 @@ def populate_module(mod_globals,
                 value_datatype
             )
             cls.max_internal_size = key_datatype.tree_size
+            cls.counted = False
+            cls.append_optimized = False
+            cls.packed_state = False
 
 
 def create_module(prefix):
@@ -90,6 +90,7 @@ from BTrees.fsBTree import fsBTreePy, fsBucketPy, fsSetPy, fsTreeSetPy
 
 from BTrees.utils import positive_id
 from BTrees.utils import oid_repr
+from BTrees._base import _unpack_state
 from BTrees._compat import compare
 
 TYPE_UNKNOWN, TYPE_BTREE, TYPE_BUCKET = range(3)
@@ -164,6 +165,14 @@ BTREE_EMPTY, BTREE_ONE, BTREE_NORMAL = range(3)
 #                                       key[len-1], child[len-1]),
 #          self->firstbucket
 #     )
+#
+# With packed_state, the keys are instead packed into a bytes object that
+# comes first, followed by the children:
+#
+#     (
+#          (b'<header><key[1] ... key[len-1]>', child[0], ..., child[len-1]),
+#          self->firstbucket
+#     )
 
 _btree2bucket = {}
 for kv in _FAMILIES:
@@ -187,8 +196,14 @@ def crack_btree(t, is_mapping):
         state = state[0]
         return BTREE_ONE, state, None
 
-    assert len(state) == 2
-    data, firstbucket = state
+    # A counted BTree adds a third element, the tuple of child counts.
+    assert len(state) in (2, 3)
+    data = state[0]
+    if isinstance(data[0], bytes):
+        keys, _ = _unpack_state(data[0])
+        kids = list(data[1:])
+        assert len(kids) == len(keys) + 1
+        return BTREE_NORMAL, keys, kids
     n = len(data)
     assert n & 1
     kids = []
@@ -229,6 +244,9 @@ def crack_btree(t, is_mapping):
 #                               keys[len-1], values[len-1]),
 #          <self->next iff non-NULL>
 #     )
+#
+# In the packed format, the first element is a bytes object holding the
+# keys and then the values.
 
 
 def crack_bucket(b, is_mapping):
@@ -236,6 +254,9 @@ def crack_bucket(b, is_mapping):
     assert isinstance(state, tuple)
     assert 1 <= len(state) <= 2
     data = state[0]
+    if isinstance(data, bytes):
+        keys, values = _unpack_state(data)
+        return keys, values or []
     if not is_mapping:
         return data, []
     keys = []
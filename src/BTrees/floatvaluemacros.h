@@ -24,3 +24,8 @@
 #define MERGE_DEFAULT 1.0f
 #define MERGE(O1, w1, O2, w2) ((O1)*(w1)+(O2)*(w2))
 #define MERGE_WEIGHT(O, w) ((O)*(w))
+
+/* The struct module format code of VALUE_TYPE, recorded in packed states.
+ * See _packed_new() in BTreeModuleTemplate.c.
+ */
+#define VALUE_PACK_CODE 'f'
@@ -119,3 +119,20 @@
 #define INCREF_KEY(k)
 #define COPY_KEY(KEY, E) (KEY=(E))
 #define MULTI_INT_UNION 1
+
+/* The struct module format code of KEY_TYPE, recorded in packed states.
+ * See _packed_new() in BTreeModuleTemplate.c.
+ */
+#if defined(ZODB_64BIT_INTS)
+#if defined(ZODB_UNSIGNED_KEY_INTS)
+#define KEY_PACK_CODE 'Q'
+#else
+#define KEY_PACK_CODE 'q'
+#endif
+#else
+#if defined(ZODB_UNSIGNED_KEY_INTS)
+#define KEY_PACK_CODE 'I'
+#else
+#define KEY_PACK_CODE 'i'
+#endif
+#endif
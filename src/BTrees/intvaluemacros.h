@@ -115,3 +115,20 @@
 #define MERGE_DEFAULT 1
 #define MERGE(O1, w1, O2, w2) ((O1)*(w1)+(O2)*(w2))
 #define MERGE_WEIGHT(O, w) ((O)*(w))
+
+/* The struct module format code of VALUE_TYPE, recorded in packed states.
+ * See _packed_new() in BTreeModuleTemplate.c.
+ */
+#if defined(ZODB_64BIT_INTS)
+#if defined(ZODB_UNSIGNED_VALUE_INTS)
+#define VALUE_PACK_CODE 'Q'
+#else
+#define VALUE_PACK_CODE 'q'
+#endif
+#else
+#if defined(ZODB_UNSIGNED_VALUE_INTS)
+#define VALUE_PACK_CODE 'I'
+#else
+#define VALUE_PACK_CODE 'i'
+#endif
+#endif
@@ -39,8 +39,97 @@ check_argument_cmp(PyObject *arg)
     return 1;
 }
 
+/* Three-way comparison of two keys of the same exact type, which must be
+ * str, bytes, int or a tuple of those, without going through rich
+ * comparison.  Set *done to 0 (and return 0) if the keys aren't of such a
+ * type, or if the answer isn't cheap to compute; the caller must then
+ * fall back to COMPARE.  Trees whose keys are all strings or all ints
+ * (the common case) answer every probe of a search here.
+ */
+static int
+compare_exact_keys(PyObject *lhs, PyObject *rhs, int *done)
+{
+    PyTypeObject *type = Py_TYPE(lhs);
+
+    *done = 1;
+    if (type != Py_TYPE(rhs))
+        goto fallback;
+
+    if (type == &PyUnicode_Type)
+        return PyUnicode_Compare(lhs, rhs);
+
+    if (type == &PyLong_Type)
+    {
+        int overflow;
+        long l, r;
+
+        l = PyLong_AsLongAndOverflow(lhs, &overflow);
+        if (overflow)
+            goto fallback;
+        r = PyLong_AsLongAndOverflow(rhs, &overflow);
+        if (overflow)
+            goto fallback;
+        return l < r ? -1 : (l > r ? 1 : 0);
+    }
+
+    if (type == &PyBytes_Type)
+    {
+        Py_ssize_t llen = PyBytes_GET_SIZE(lhs);
+        Py_ssize_t rlen = PyBytes_GET_SIZE(rhs);
+        int cmp = memcmp(PyBytes_AS_STRING(lhs), PyBytes_AS_STRING(rhs),
+                         llen < rlen ? llen : rlen);
+        if (cmp)
+            return cmp < 0 ? -1 : 1;
+        return llen < rlen ? -1 : (llen > rlen ? 1 : 0);
+    }
+
+    if (type == &PyTuple_Type)
+    {
+        Py_ssize_t llen = PyTuple_GET_SIZE(lhs);
+        Py_ssize_t rlen = PyTuple_GET_SIZE(rhs);
+        Py_ssize_t i;
+
+        for (i = 0; i < llen && i < rlen; i++)
+        {
+            PyObject *l = PyTuple_GET_ITEM(lhs, i);
+            PyObject *r = PyTuple_GET_ITEM(rhs, i);
+            int cmp;
+
+            /* Only flat tuples; an item that needs rich comparison means
+             * the whole tuple does, to keep tuple semantics exact.
+             */
+            if (Py_TYPE(l) == &PyTuple_Type)
+                goto fallback;
+            cmp = compare_exact_keys(l, r, done);
+            if (! *done)
+                return 0;
+            if (cmp)
+                return cmp;
+        }
+        return llen < rlen ? -1 : (llen > rlen ? 1 : 0);
+    }
+
+fallback:
+    *done = 0;
+    return 0;
+}
+
+static int
+compare_keys(PyObject *lhs, PyObject *rhs)
+{
+    int done, cmp;
+
+    if (lhs != Py_None && rhs != Py_None)
+    {
+        cmp = compare_exact_keys(lhs, rhs, &done);
+        if (done)
+            return cmp;
+    }
+    return COMPARE(lhs, rhs);
+}
+
 #define TEST_KEY_SET_OR(V, KEY, TARGET) \
-if ( ( (V) = COMPARE((KEY),(TARGET)) ), PyErr_Occurred() )
+if ( ( (V) = compare_keys((KEY),(TARGET)) ), PyErr_Occurred() )
 #define INCREF_KEY(k) Py_INCREF(k)
 #define DECREF_KEY(KEY) Py_DECREF(KEY)
 #define COPY_KEY(KEY, E) KEY=(E)
@@ -14,8 +14,10 @@
 
 /* Revision information: $Id$ */
 
-/* The only routine here intended to be used outside the file is
+/* The routines here intended to be used outside the file are
    size_t sort_int_nodups(int *p, size_t n)
+   size_t sort_int_threshold(int *p, size_t n, size_t k, size_t *counts)
+   size_t sort_int_pairs_nodups(int *p, VALUE_TYPE *v, size_t n)
 
    Sort the array of n ints pointed at by p, in place, and also remove
    duplicates.  Return the number of unique elements remaining, which occupy
@@ -27,11 +29,20 @@
 
    Notes:
 
-   + This is specific to n-byte signed ints, with endianness natural to the
-     platform.  `n` is determined based on ZODB_64BIT_INTS.
+   + This is specific to n-byte ints, with endianness natural to the
+     platform.  `n` is determined based on ZODB_64BIT_INTS, and they are
+     unsigned if ZODB_UNSIGNED_KEY_INTS is defined.
 
    + 4*n bytes of available heap memory are required for best speed
      (8*n when ZODB_64BIT_INTS is defined).
+
+   sort_int_threshold is the same, except that it keeps only the values
+   that occur at least k times, and, if counts isn't NULL, stores how many
+   times each one occurred at the same index of counts.
+
+   sort_int_pairs_nodups sorts the keys in p together with the parallel
+   array of values v, keeping the last value given for each key.  It
+   returns (size_t)-1 if it runs out of memory.
 */
 
 #include <stdlib.h>
@@ -48,6 +59,11 @@
 */
 typedef KEY_TYPE element_type;
 
+/* The type of the values radixsort_int() can carry along with the
+   elements.
+*/
+typedef VALUE_TYPE payload_type;
+
 /* The radixsort is faster than the quicksort for large arrays, but radixsort
    has high fixed overhead, making it a poor choice for small arrays.  The
    crossover point isn't critical, and is sensitive to things like compiler
@@ -72,12 +88,17 @@ typedef KEY_TYPE element_type;
    'work' is work storage at least as large as 'in'.  Depending on how many
    swaps are done internally, the final result may come back in 'in' or 'work';
    and that pointer is returned.
+   If payload isn't NULL, *payload is an array of n values to move along
+   with the elements, and pwork is work storage as large; *payload is set
+   to wherever they end up.  The sort is stable.
 
-   radixsort_int is specific to signed n-byte ints, with natural machine
-   endianness.  `n` is determined based on ZODB_64BIT_INTS.
+   radixsort_int is specific to n-byte ints, with natural machine
+   endianness.  `n` is determined based on ZODB_64BIT_INTS, and they are
+   unsigned if ZODB_UNSIGNED_KEY_INTS is defined.
 */
 static element_type*
-radixsort_int(element_type *in, element_type *work, size_t n)
+radixsort_int(element_type *in, element_type *work, size_t n,
+              payload_type **payload, payload_type *pwork)
 {
 	/* count[i][j] is the number of input elements that have byte value j
 	   in byte position i, where byte position 0 is the LSB.  Note that
@@ -157,7 +178,11 @@ radixsort_int(element_type *in, element_type *work, size_t n)
 		/* Compute the correct output starting index for each possible
 		   byte value.
 		*/
+#ifdef ZODB_UNSIGNED_KEY_INTS
+		if (1) {
+#else
 		if (bytenum < sizeof(element_type) - 1) {
+#endif
 			for (i = 0; i < 256; ++i) {
 				const size_t icount = pcount[i];
 				index[i] = total;
@@ -206,6 +231,16 @@ radixsort_int(element_type *in, element_type *work, size_t n)
 		*/
 		pinbyte = (unsigned char  *)in + offset;
 		i = 0;
+		if (payload) {
+			payload_type *pin = *payload;
+			for (; i < n; ++i, pinbyte += sizeof(element_type)) {
+				const size_t j = index[*pinbyte]++;
+				work[j] = in[i];
+				pwork[j] = pin[i];
+			}
+			*payload = pwork;
+			pwork = pin;
+		}
 		/* Reduce number of elements to copy to a multiple of 4. */
 		while ((n - i) & 0x3) {
 			unsigned char byte = *pinbyte;
@@ -282,6 +317,53 @@ uniq(element_type *out, element_type *in, size_t n)
 	return pout - out;
 }
 
+/* Like uniq, but for the sorted elements in and the parallel array of
+   values pin, storing the last value of each run of equal elements into
+   pout.  Again, out and pout may be in and pin.
+   Return the number of elements in out.
+*/
+static size_t
+uniq_pairs(element_type *out, payload_type *pout, element_type *in,
+           payload_type *pin, size_t n)
+{
+	size_t i, j = 0;
+
+	for (i = 0; i < n; ++i) {
+		if (i + 1 < n && in[i + 1] == in[i])
+			continue;
+		out[j] = in[i];
+		pout[j] = pin[i];
+		++j;
+	}
+	return j;
+}
+
+/* Like uniq, but store only the distinct elements that occur at least k
+   times in in, and if counts isn't NULL store how often each occurred in
+   the matching position of counts.
+   Return the number of elements in out.
+*/
+static size_t
+uniq_threshold(element_type *out, element_type *in, size_t n, size_t k,
+               size_t *counts)
+{
+	size_t i, run;
+	element_type *pout = out;
+
+	assert(out);
+	assert(in);
+	for (i = 0; i < n; i += run) {
+		for (run = 1; i + run < n && in[i + run] == in[i]; ++run)
+			;
+		if (run >= k) {
+			if (counts)
+				counts[pout - out] = run;
+			*pout++ = in[i];
+		}
+	}
+	return pout - out;
+}
+
 #if 0
 /* insertionsort is no longer referenced directly, but I'd like to keep
  *  the code here just in case.
@@ -529,7 +611,7 @@ sort_int_nodups(KEY_TYPE *p, size_t n)
 		work = (element_type *)malloc(n * sizeof(element_type));
 
 	if (work) {
-		element_type *out = radixsort_int(p, work, n);
+		element_type *out = radixsort_int(p, work, n, NULL, NULL);
 		nunique = uniq(p, out, n);
 		free(work);
 	}
@@ -540,3 +622,58 @@ sort_int_nodups(KEY_TYPE *p, size_t n)
 
 	return nunique;
 }
+
+/* Sort p and keep one of each value occurring at least k times. */
+static size_t
+sort_int_threshold(KEY_TYPE *p, size_t n, size_t k, size_t *counts)
+{
+	size_t nkept;
+	element_type *work;
+	element_type *out = p;
+
+	assert(sizeof(KEY_TYPE) == sizeof(element_type));
+	assert(p);
+
+	work = NULL;
+	if (n > QUICKSORT_BEATS_RADIXSORT)
+		work = (element_type *)malloc(n * sizeof(element_type));
+
+	if (work)
+		out = radixsort_int(p, work, n, NULL, NULL);
+	else
+		quicksort(p, n);
+	nkept = uniq_threshold(p, out, n, k, counts);
+	free(work);
+
+	return nkept;
+}
+
+/* Sort p and the parallel values v by key and remove duplicate keys,
+   keeping the last value given for each.  Return the number of keys left,
+   or (size_t)-1 if there isn't enough memory.
+*/
+static size_t
+sort_int_pairs_nodups(KEY_TYPE *p, VALUE_TYPE *v, size_t n)
+{
+	size_t nunique;
+	element_type *work, *out;
+	payload_type *pwork, *pout = v;
+
+	assert(sizeof(KEY_TYPE) == sizeof(element_type));
+	assert(p);
+	assert(v);
+
+	/* The quicksort isn't stable, so always use the radixsort. */
+	work = (element_type *)malloc(n * sizeof(element_type) + 1);
+	pwork = (payload_type *)malloc(n * sizeof(payload_type) + 1);
+	if (work == NULL || pwork == NULL) {
+		free(work);
+		free(pwork);
+		return (size_t)-1;
+	}
+	out = radixsort_int(p, work, n, &pout, pwork);
+	nunique = uniq_pairs(p, v, out, pout, n);
+	free(work);
+	free(pwork);
+	return nunique;
+}
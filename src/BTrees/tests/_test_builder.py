@@ -22,11 +22,11 @@ from .common import MappingBase
 from .common import MappingConflictTestBase
 from .common import ModuleTest
 from .common import MultiUnion
-from .common import NormalSetTests
 from .common import SetConflictTestBase
 from .common import SetResult
 from .common import TestLongIntKeys
 from .common import TestLongIntValues
+from .common import TreeSetTests
 from .common import Weighted
 from .common import itemsToSet
 from .common import makeMapBuilder
@@ -161,6 +161,7 @@ class ClassBuilder:
             # Weighted and MultiUnion.
 
             # These attributes are used in both
+            key_type = self.key_type
             mkbucket = btree_module.Bucket
             # Weighted uses union as a factory, self.union()(...).
             # MultiUnion calls it directly.
@@ -177,10 +178,15 @@ class ClassBuilder:
             if base is Weighted:
                 weightedUnion = btree_module.def_weightedUnion
                 weightedIntersection = btree_module.def_weightedIntersection
+                multiWeightedUnion = btree_module.def_multiWeightedUnion
 
             # These are specific to MultiUnion, and may not exist
             # in key types that don't support unions (``'O'``)
             multiunion = getattr(btree_module, 'multiunion', None)
+            multiintersection = getattr(
+                btree_module, 'multiintersection', None)
+            thresholdUnion = getattr(btree_module, 'thresholdUnion', None)
+            multiunionSize = getattr(btree_module, 'multiunionSize', None)
             mkset = btree_module.Set
             mktreeset = btree_module.TreeSet
             mkbtree = tree
@@ -205,6 +211,12 @@ class ClassBuilder:
             union = btree_module.union
             intersection = btree_module.intersection
             difference = btree_module.difference
+            unionSize = btree_module.unionSize
+            intersectionSize = btree_module.intersectionSize
+            differenceSize = btree_module.differenceSize
+            iunion = btree_module.iunion
+            iintersection = btree_module.iintersection
+            idifference = btree_module.idifference
 
             def builders(self):
                 return (
@@ -245,7 +257,7 @@ class ClassBuilder:
         tree = getattr(btree_module, type_name)
         iface = {
             'BTree': interfaces.IBTree,
-            'Bucket': interfaces.IMinimalDictionary,
+            'Bucket': interfaces.IBucket,
             'Set': interfaces.ISet,
             'TreeSet': interfaces.ITreeSet
         }[type_name]
@@ -295,7 +307,7 @@ class ClassBuilder:
                              I_SetsBase,
                              SetConflictTestBase,)),
                     ('TreeSet', (I_SetsBase,
-                                 NormalSetTests,
+                                 TreeSetTests,
                                  SetConflictTestBase,))
             ):
                 self._create_type_tests(btree_module, type_name, test_bases)
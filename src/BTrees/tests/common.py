@@ -12,8 +12,10 @@
 #
 ##############################################################################
 
+import bisect
 import functools
 import platform
+import random
 import sys
 import unittest
 from unittest import skip
@@ -503,6 +505,51 @@ class Base(ZODBAccess, SignedMixin):
         self.assertFalse(issubclass(NonSub, type(t)))
         self.assertNotIsInstance(NonSub(), type(t))
 
+    def _countObjects(self, t, is_mapping=True):
+        # The number of buckets and interior nodes below t.
+        from BTrees.check import BTREE_NORMAL
+        from BTrees.check import crack_btree
+        kind, _, kids = crack_btree(t, is_mapping)
+        if kind != BTREE_NORMAL:
+            return kind  # an empty tree, or one with a single bucket
+        return sum(1 + (self._countObjects(kid, is_mapping)
+                        if type(kid) is type(t) else 0)
+                   for kid in kids)
+
+    def _assertPackedStates(self, t, is_mapping=True):
+        # Every node of t saves its state in the packed format if its keys
+        # (and values) are C numbers, and the states load back.
+        from BTrees._base import _packCode
+        from BTrees._base import _unpack_state
+        from BTrees.check import BTREE_NORMAL
+        from BTrees.check import crack_btree
+        kind, _, kids = crack_btree(t, is_mapping)
+        self.assertEqual(kind, BTREE_NORMAL)
+        for kid in kids:
+            if type(kid) is type(t):
+                self._assertPackedStates(kid, is_mapping)
+                continue
+            module = sys.modules[type(kid).__module__]
+            packable = _packCode(module.BucketPy._to_key) is not None
+            if is_mapping:
+                packable = (packable and
+                            _packCode(module.BucketPy._to_value) is not None)
+                expected = list(kid.items())
+            else:
+                expected = list(kid)
+            state = kid.__getstate__()
+            if packable:
+                keys, values = _unpack_state(state[0])
+                self.assertEqual(keys, list(kid.keys()))
+                if is_mapping:
+                    self.assertEqual(values, list(kid.values()))
+            else:
+                self.assertIsInstance(state[0], tuple)
+            copy = type(kid)()
+            copy.__setstate__(state)
+            self.assertEqual(list(copy.items()) if is_mapping
+                             else list(copy), expected)
+
 
 class MappingBase(Base):
     # Tests common to mappings (buckets, btrees)
@@ -538,6 +585,62 @@ class MappingBase(Base):
         with self.assertRaises(KeyError):
             t.popitem()
 
+    def testNLargestNSmallest(self):
+        t = self._makeOne()
+        self.assertEqual(t.nlargest(3), [])
+        self.assertEqual(t.nsmallest(3), [])
+
+        to_key = self.coerce_to_key
+        to_value = self.coerce_to_value
+        for i in range(1000):
+            t[to_key(i)] = to_value(i * 7 % 13)
+        # Stable sorts leave equal values in key order.
+        pairs = [(v, k) for (k, v) in t.items()]
+        largest = sorted(pairs, key=lambda pair: pair[0], reverse=True)
+        smallest = sorted(pairs, key=lambda pair: pair[0])
+        for k in 0, 1, 5, 13, 200, 1000, 5000:
+            self.assertEqual(t.nlargest(k), largest[:k])
+            self.assertEqual(t.nsmallest(k), smallest[:k])
+        self.assertEqual(t.nlargest(-1), [])
+
+    def testBuffers(self):
+        t = self._makeOne()
+        if not hasattr(t, 'valuesBuffer'):
+            self.skipTest("only buckets have buffers")
+        to_key = self.coerce_to_key
+        to_value = self.coerce_to_value
+        for i in range(10):
+            t[to_key(i)] = to_value(i * 3)
+        for method, datatype, expected in (
+                (t.keysBuffer, self.key_type, list(t.keys())),
+                (t.valuesBuffer, self.value_type, list(t.values()))):
+            code = getattr(datatype, '_struct_format', None)
+            if code is None:
+                with self.assertRaises(TypeError):
+                    method()
+                continue
+            with method() as view:
+                self.assertTrue(view.readonly)
+                self.assertEqual(view.format, code)
+                self.assertEqual(view.tolist(), expected)
+        if 'Py' in type(self).__name__ or _c_optimizations_ignored():
+            # The Python buffers are copies, and pin nothing.
+            return
+        if getattr(self.key_type, '_struct_format', None) is None:
+            return
+
+        # While a buffer is exported, the arrays can't move.
+        view = t.keysBuffer()
+        with self.assertRaises(BufferError):
+            for i in range(10, 1000):
+                t[to_key(i)] = to_value(i)
+        with self.assertRaises(BufferError):
+            t.clear()
+        view.release()
+        t.clear()
+        self.assertEqual(len(t), 0)
+        self.assertEqual(t.keysBuffer().tolist(), [])
+
     def testShortRepr(self):
         # test the repr because buckets have a complex repr implementation
         # internally the cutoff from a stack allocated buffer to a heap
@@ -1456,6 +1559,42 @@ class BTreeTests(MappingBase):
         t._check()
         check(t)
 
+    @_skip_wo_ZODB
+    def testInvalidateWhileBufferExported(self):
+        # A bucket invalidated while a buffer is exported over it lets the
+        # buffer keep its old keys, and loads its new state.
+        import transaction
+        if (getattr(self.key_type, '_struct_format', None) is None
+                or 'Py' in type(self).__name__
+                or _c_optimizations_ignored()):
+            self.skipTest("only C buckets with C number keys pin them")
+        transaction.begin()
+        t = self._makeOne()
+        self._populate(t, 1000)
+        root = self._getRoot()
+        root['t'] = t
+        transaction.commit()
+
+        bucket = t._firstbucket
+        view = bucket.keysBuffer()
+        keys = view.tolist()
+        first = keys[0]
+        root2 = self._getRoot()
+        del root2['t'][first]
+        transaction.commit()
+        transaction.begin()
+        try:
+            self.assertEqual(bucket._p_status, 'ghost')
+            self.assertEqual(view.tolist(), keys)
+            self.assertNotIn(first, t)
+            self.assertEqual(list(t)[:2], keys[1:3])
+            self._checkIt(t)
+            view.release()
+            self.assertEqual(bucket.keysBuffer().tolist(), keys[1:])
+        finally:
+            self._closeRoot(root)
+            self._closeRoot(root2)
+
     @_skip_wo_ZODB
     def testAccessRaisesPOSKeyErrorOnNested(self):
         # We don't hide a POSKeyError that happens when
@@ -1853,6 +1992,666 @@ class BTreeTests(MappingBase):
         self.assertEqual(lsubtract(list(t.keys()), [K[0], K[1]]), [])
         self._checkIt(t)
 
+    def _bucketLengths(self, t):
+        lengths = []
+        bucket = t._firstbucket
+        while bucket is not None:
+            lengths.append(len(bucket))
+            state = bucket.__getstate__()
+            bucket = state[1] if len(state) == 2 else None
+        return lengths
+
+    def testFromSorted(self):
+        cls = self._getTargetClass()
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        t = cls.fromSorted(items)
+        self.assertIs(type(t), cls)
+        self._checkIt(t)
+        self.assertEqual(list(t.items()), items)
+        # Every bucket is packed full, except for rounding.
+        lengths = self._bucketLengths(t)
+        self.assertEqual(sum(lengths), len(items))
+        self.assertEqual(len(lengths), -(-len(items) // cls.max_leaf_size))
+        self.assertLessEqual(max(lengths) - min(lengths), 1)
+
+        # The tree is fully usable afterwards.
+        del t[keys[0]]
+        t[keys[0]] = self.VALUES[1]
+        self.assertEqual(t[keys[0]], self.VALUES[1])
+        self._checkIt(t)
+
+    def testFromSortedFill(self):
+        cls = self._getTargetClass()
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        full = cls.fromSorted(items)
+        for fill in 0.5, 0.01:
+            t = cls.fromSorted(items, fill=fill)
+            self._checkIt(t)
+            self.assertEqual(list(t.items()), items)
+            self.assertGreater(len(self._bucketLengths(t)),
+                               len(self._bucketLengths(full)))
+
+        for fill in 0.0, -1.0, 1.5:
+            with self.assertRaises(ValueError):
+                cls.fromSorted(items, fill)
+
+    def testFromSortedMappingAndEmpty(self):
+        cls = self._getTargetClass()
+        K = self.KEYS
+        V = self.VALUES
+        t = cls.fromSorted({K[1]: V[1], K[2]: V[2]})
+        self.assertEqual(list(t.items()), [(K[1], V[1]), (K[2], V[2])])
+        self._checkIt(t)
+
+        t = cls.fromSorted(())
+        self.assertEqual(len(t), 0)
+        self.assertFalse(t)
+        self._checkIt(t)
+
+    def testFromSortedRejectsUnsorted(self):
+        cls = self._getTargetClass()
+        K = sorted(self.KEYS)
+        V = self.VALUES
+        with self.assertRaises(ValueError):
+            cls.fromSorted([(K[2], V[2]), (K[1], V[1])])
+        with self.assertRaises(ValueError):
+            cls.fromSorted([(K[1], V[1]), (K[1], V[2])])
+        with self.assertRaises(TypeError):
+            cls.fromSorted([K[1], K[2]])
+
+    def testGetMany(self):
+        t = self._makeOne()
+        K = self.KEYS
+        V = self.VALUES
+        self.assertEqual(t.getMany([K[1], K[2]]), [None, None])
+        t.update(list(zip(K[::2], V[::2])))
+        probes = list(K[::-7]) + [K[4], K[4], K[3]]
+        expected = [t.get(k, 42) for k in probes]
+        self.assertEqual(t.getMany(probes, 42), expected)
+        self.assertEqual(t.getMany(iter(probes), default=42), expected)
+        # Sorted input takes the same path, minus the sort.
+        probes = sorted(K[10:500])
+        self.assertEqual(t.getMany(probes), [t.get(k) for k in probes])
+        self.assertEqual(t.getMany([]), [])
+
+    def testContainsMany(self):
+        t = self._makeOne()
+        K = self.KEYS
+        V = self.VALUES
+        t.update(list(zip(K[1::3], V[1::3])))
+        probes = list(reversed(K))
+        self.assertEqual(t.containsMany(probes), [k in t for k in probes])
+        self.assertRaises(TypeError, t.containsMany, 42)
+
+    def testDeleteRange(self):
+        cls = self._getTargetClass()
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        cases = [
+            ((keys[10], keys[1500]), {}),
+            ((keys[3], keys[5]), {}),   # within a single bucket
+            ((keys[100], keys[200]), dict(excludemin=True, excludemax=True)),
+            ((None, keys[700]), {}),
+            ((keys[1300], None), dict(excludemax=True)),
+            ((None, None), dict(excludemin=True)),
+            ((keys[5], keys[5]), dict(excludemin=True)),
+            ((keys[6], keys[5]), {}),
+            ((), {}),
+        ]
+        for args, kw in cases:
+            t = cls.fromSorted(items)
+            doomed = set(t.keys(*args, **kw))
+            t.deleteRange(*args, **kw)
+            self._checkIt(t)
+            self.assertEqual(list(t.items()),
+                             [i for i in items if i[0] not in doomed])
+            self.assertEqual(len(t), len(items) - len(doomed))
+            # The tree is fully usable afterwards.
+            for k, v in items[::100]:
+                t[k] = v
+            self._checkIt(t)
+
+        t = self._makeOne()
+        t.deleteRange(keys[1], keys[2])
+        self.assertEqual(len(t), 0)
+
+    def testDeleteRangeCounted(self):
+        cls = self._getCountedClass()
+        keys = sorted(self.KEYS)
+        t = cls.fromSorted(list(zip(keys, self.VALUES)), fill=0.5)
+        t.deleteRange(keys[7], keys[1900], excludemax=True)
+        t._check()
+        expected = keys[:7] + keys[1900:]
+        self.assertEqual(list(t.keys()), expected)
+        self.assertEqual(len(t), len(expected))
+        self.assertEqual([t.keyAt(i) for i in range(len(expected))],
+                         expected)
+        t.deleteRange(keys[1950])
+        t._check()
+        self.assertEqual(list(t.keys()), keys[:7] + keys[1900:1950])
+
+    def testReverseIteration(self):
+        cls = self._getCountedClass()
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        t = cls.fromSorted(items)
+        self.assertEqual(list(reversed(t)), keys[::-1])
+        self.assertEqual(list(t.iterkeys(reverse=True)), keys[::-1])
+        self.assertEqual(list(t.itervalues(reverse=True)),
+                         [v for k, v in items[::-1]])
+        for args, kw, expected in [
+                ((keys[10], keys[1500]), {}, items[10:1501]),
+                ((keys[3], keys[5]), dict(excludemin=True), items[4:6]),
+                ((None, keys[700]), dict(excludemax=True), items[:700]),
+                ((None, None), dict(excludemin=True, excludemax=True),
+                 items[1:-1]),
+                ((keys[6], keys[5]), {}, []),
+        ]:
+            self.assertEqual(list(t.iteritems(*args, reverse=True, **kw)),
+                             expected[::-1])
+        self.assertEqual(list(self._makeOne().iterkeys(reverse=True)), [])
+        self.assertEqual(list(reversed(self._makeOne())), [])
+
+    def testCursor(self):
+        cls = self._getCountedClass()
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        # Leave gaps to seek into.
+        t = cls.fromSorted(items[::2])
+
+        c = t.cursor()
+        self.assertRaises(StopIteration, c.prev)
+        self.assertEqual(c.next(), items[0])
+        self.assertEqual(c.next(), items[2])
+        self.assertEqual(c.prev(), items[2])
+        self.assertEqual(c.prev(), items[0])
+        self.assertEqual(list(c), items[::2])
+        self.assertRaises(StopIteration, c.next)
+
+        # Walking back and forth across buckets.
+        c.seek(keys[101])
+        self.assertEqual([c.prev() for _ in range(20)],
+                         items[100:60:-2])
+        self.assertEqual([c.next() for _ in range(40)], items[62:142:2])
+        c.seek(keys[100])
+        self.assertEqual(c.next(), items[100])
+        c.seekEnd()
+        self.assertEqual(c.prev(), items[-1])
+        c.seekStart()
+        self.assertEqual(c.next(), items[0])
+
+        # A bounded cursor keeps to its range.
+        c = t.cursor(keys[500], keys[600], excludemin=True)
+        self.assertEqual(list(c), items[502:601:2])
+        self.assertEqual(c.prev(), items[600])
+        c.seek(keys[0])
+        self.assertRaises(StopIteration, c.prev)
+        self.assertEqual(c.next(), items[502])
+        c.seek(keys[1000])
+        self.assertRaises(StopIteration, c.next)
+        self.assertEqual(c.prev(), items[600])
+
+        c = t.cursor(keys[500], keys[600], reverse=True)
+        self.assertEqual(list(c), items[600:499:-2])
+        self.assertEqual(c.next(), items[500])
+
+        c = self._makeOne().cursor()
+        self.assertEqual(list(c), [])
+        c.seek(keys[0])
+        self.assertRaises(StopIteration, c.next)
+        self.assertRaises(StopIteration, c.prev)
+
+    def testCount(self):
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        cases = [
+            ((), {}, 2001),
+            ((keys[10], keys[1500]), {}, 1491),
+            ((keys[3], keys[5]), dict(excludemin=True), 2),
+            ((keys[100], keys[200]), dict(excludemin=True, excludemax=True),
+             99),
+            ((None, keys[700]), dict(excludemax=True), 700),
+            ((keys[1300], None), {}, 701),
+            ((None, None), dict(excludemin=True, excludemax=True), 1999),
+            ((keys[5], keys[5]), {}, 1),
+            ((keys[5], keys[5]), dict(excludemax=True), 0),
+            ((keys[6], keys[5]), {}, 0),
+        ]
+        for cls in self._getTargetClass(), self._getCountedClass():
+            t = cls.fromSorted(items)
+            for args, kw, expected in cases:
+                self.assertEqual(t.count(*args, **kw), expected)
+            # Keys that aren't in the tree.
+            t = cls.fromSorted(items[::2])
+            self.assertEqual(t.count(keys[101], keys[401]), 150)
+            self.assertEqual(t.count(keys[1], keys[1]), 0)
+            self.assertEqual(cls().count(keys[1], keys[2]), 0)
+
+    def testToArrays(self):
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        key_code = getattr(self.key_type, '_struct_format', None)
+        value_code = getattr(self.value_type, '_struct_format', None)
+        t = self._getTargetClass().fromSorted(items)
+        if key_code is None or value_code is None:
+            with self.assertRaises(TypeError):
+                t.toArrays()
+            return
+        for args, kw in (
+                ((), {}),
+                ((keys[10], keys[1500]), {}),
+                ((keys[100], keys[200]),
+                 dict(excludemin=True, excludemax=True)),
+                ((None, keys[700]), dict(excludemax=True)),
+                ((keys[6], keys[5]), {}),
+        ):
+            k, v = t.toArrays(*args, **kw)
+            self.assertEqual((k.typecode, v.typecode), (key_code, value_code))
+            self.assertEqual(k.tolist(), list(t.keys(*args, **kw)))
+            self.assertEqual(v.tolist(), list(t.values(*args, **kw)))
+        k, v = self._getTargetClass()().toArrays()
+        self.assertEqual((len(k), len(v)), (0, 0))
+
+    def testFromArrays(self):
+        import array
+        key_code = getattr(self.key_type, '_struct_format', None)
+        value_code = getattr(self.value_type, '_struct_format', None)
+        cls = self._getTargetClass()
+        if key_code is None or value_code is None:
+            with self.assertRaises(TypeError):
+                cls.fromArrays(array.array('i'), array.array('i'))
+            return
+        keys = list(self.KEYS)
+        values = list(self.VALUES)
+        random.Random(42).shuffle(keys)
+        # Repeated keys take the last value given for them.
+        keys += keys[:10]
+        values += values[-10:]
+        expected = dict(zip(keys, values))
+        t = cls.fromArrays(array.array(key_code, keys),
+                           array.array(value_code, values))
+        t._check()
+        self.assertEqual(list(t.items()), sorted(expected.items()))
+
+        keys = sorted(self.KEYS)
+        t = cls.fromArrays(memoryview(array.array(key_code, keys)),
+                           array.array(value_code, self.VALUES),
+                           sorted=True, fill=0.5)
+        t._check()
+        self.assertEqual(list(t.items()), list(zip(keys, self.VALUES)))
+        self.assertEqual(len(cls.fromArrays(array.array(key_code),
+                                            array.array(value_code))), 0)
+
+        with self.assertRaises(ValueError):
+            cls.fromArrays(array.array(key_code, keys[::-1]),
+                           array.array(value_code, self.VALUES), sorted=True)
+        with self.assertRaises(ValueError):
+            cls.fromArrays(array.array(key_code, keys),
+                           array.array(value_code, self.VALUES[:-1]))
+        with self.assertRaises(TypeError):
+            # The right size but the wrong kind of number.
+            cls.fromArrays(array.array(key_code.swapcase(), [1]),
+                           array.array(value_code, [1]))
+        with self.assertRaises(TypeError):
+            cls.fromArrays(array.array(key_code, [1]), b'x')
+
+    @_skip_wo_ZODB
+    def testCompactPersistent(self):
+        import transaction
+        keys = sorted(self.KEYS)
+        transaction.begin()
+        t = self._makeOne()
+        root = self._getRoot()
+        root.t = t
+        t.update(list(zip(keys, self.VALUES)))
+        transaction.commit()
+        for k in keys:
+            if k not in keys[::7]:
+                del t[k]
+        expected = list(t.items())
+        transaction.commit()
+        root._p_jar.cacheMinimize()
+        self.assertTrue(t.compact() > 0)
+        transaction.commit()
+        self._closeRoot(root)
+
+        root = self._getRoot()
+        try:
+            t = root.t
+            t._check()
+            self.assertEqual(list(t.items()), expected)
+        finally:
+            self._closeRoot(root)
+
+    def testCompact(self):
+        class Small(self._getTargetClass()):
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        keys = sorted(self.KEYS)
+        items = list(zip(keys, self.VALUES))
+        for cls in Small, self._getCountedClass():
+            t = cls()
+            t.update(items)
+            for k in keys[::5] + keys[1::5] + keys[2::5]:
+                del t[k]
+            expected = list(t.items())
+            before = self._countObjects(t)
+            freed = t.compact()
+            t._check()
+            self.assertTrue(freed > 0)
+            self.assertEqual(self._countObjects(t), before - freed)
+            self.assertEqual(list(t.items()), expected)
+            self.assertEqual(len(t), len(expected))
+            self.assertEqual(t.keyAt(len(expected) // 2),
+                             expected[len(expected) // 2][0])
+            # Nothing is left to merge.
+            self.assertEqual(t.compact(), 0)
+            # A lower fill leaves room in the buckets, but merges nothing
+            # that's too full already.
+            self.assertEqual(t.compact(0.5), 0)
+            t._check()
+            t.update(items)
+            t._check()
+            self.assertEqual(list(t.items()), items)
+
+        self.assertEqual(self._makeOne().compact(), 0)
+        self.assertRaises(ValueError, Small().compact, 0.0)
+        self.assertRaises(ValueError, Small().compact, 1.5)
+
+    def testCompactNeverGrows(self):
+        # Rebuilding the interior at a low fill would take more objects
+        # than merging two buckets saves.
+        class Narrow(self._getTargetClass()):
+            max_leaf_size = 30
+            max_internal_size = 8
+
+        keys = sorted(self.KEYS)
+        t = Narrow.fromSorted(list(zip(keys, self.VALUES)))
+        for k in keys[:29] + keys[30:59]:
+            del t[k]
+        expected = list(t.items())
+        before = self._countObjects(t)
+        self.assertEqual(t.compact(0.3), 0)
+        self.assertEqual(self._countObjects(t), before)
+        freed = t.compact()
+        self.assertTrue(freed > 0)
+        self.assertEqual(self._countObjects(t), before - freed)
+        t._check()
+        self.assertEqual(list(t.items()), expected)
+
+    def testCompactWithBufferExported(self):
+        # Buckets that can't grow because buffers are exported over them
+        # leave the whole tree as it was.
+        if (getattr(self.key_type, '_struct_format', None) is None
+                or 'Py' in type(self).__name__
+                or _c_optimizations_ignored()):
+            self.skipTest("only C buckets with C number keys pin them")
+
+        class Small(self._getTargetClass()):
+            max_leaf_size = 10
+
+        # Half-full buckets have no room to take in their neighbours.
+        keys = sorted(self.KEYS)
+        t = Small.fromSorted(list(zip(keys, self.VALUES)), 0.5)
+        for k in keys[::3] + keys[1::3]:
+            del t[k]
+        expected = list(t.items())
+        # The first buckets could merge, but later ones can't.
+        buckets = []
+        bucket = t._firstbucket
+        while bucket is not None:
+            buckets.append(bucket)
+            bucket = bucket._next
+        views = [bucket.keysBuffer() for bucket in buckets[10:]]
+        self.assertRaises(BufferError, t.compact)
+        t._check()
+        self.assertEqual(list(t.items()), expected)
+        for view in views:
+            view.release()
+        self.assertTrue(t.compact() > 0)
+        t._check()
+        self.assertEqual(list(t.items()), expected)
+
+    @_skip_wo_ZODB
+    def testCompactWithMissingBucket(self):
+        # A bucket that fails to load leaves the whole tree as it was.
+        import transaction
+        from ZODB.POSException import POSKeyError
+        keys = sorted(self.KEYS)
+        transaction.begin()
+        t = self._makeOne()
+        root = self._getRoot()
+        root.t = t
+        t.update(list(zip(keys, self.VALUES)))
+        transaction.commit()
+        for k in keys[::3] + keys[1::3]:
+            del t[k]
+        expected = list(t.items())
+        transaction.commit()
+
+        bucket = t._firstbucket
+        for _ in range(3):
+            bucket = bucket._next
+        oid = bucket._p_oid
+        root._p_jar.cacheMinimize()
+        t._p_activate()
+        data = self.db._storage._data.pop(oid)
+        try:
+            self.assertRaises(POSKeyError, t.compact)
+        finally:
+            self.db._storage._data[oid] = data
+        try:
+            t._check()
+            self.assertEqual(list(t.items()), expected)
+        finally:
+            self._closeRoot(root)
+
+    def testAppendOptimized(self):
+        class Small(self._getTargetClass()):
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        class Appending(Small):
+            append_optimized = True
+
+        class CountedAppending(self._getCountedClass()):
+            append_optimized = True
+
+        keys = sorted(self.KEYS)
+        plain = Small()
+        for k, v in zip(keys, self.VALUES):
+            plain[k] = v
+        for cls in Appending, CountedAppending:
+            t = cls()
+            for k, v in zip(keys, self.VALUES):
+                t[k] = v
+            t._check()
+            self.assertEqual(list(t.items()), list(plain.items()))
+            self.assertEqual(len(t), len(keys))
+            # Every bucket but the last one is full, which takes about
+            # half as many objects as splitting at the midpoint.
+            self.assertTrue(self._countObjects(t) * 3 <
+                            self._countObjects(plain) * 2)
+            if cls is Appending:
+                # The root was split the same way, leaving all but its
+                # last entry in its first child.
+                first = t.__getstate__()[0][0]
+                self.assertEqual(len(first.__getstate__()[0]) // 2 + 1,
+                                 2 * Small.max_internal_size - 1)
+            # Insertions elsewhere still split at the midpoint.
+            t2 = cls()
+            t2.update(list(zip(keys[::2], self.VALUES)))
+            for k, v in zip(keys[1::2], self.VALUES):
+                t2[k] = v
+            t2._check()
+            self.assertEqual(list(t2.keys()), keys)
+
+    def testPackedState(self):
+        class Packed(self._getTargetClass()):
+            packed_state = True
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        items = list(zip(sorted(self.KEYS), self.VALUES))
+        for t in Packed(items[:40]), Packed.fromSorted(items[:40]):
+            t._check()
+            self._assertPackedStates(t)
+            copy = Packed()
+            copy.__setstate__(t.__getstate__())
+            copy._check()
+            self.assertEqual(list(copy.items()), items[:40])
+        # A single bucket is packed inside the tree's state.
+        t = Packed(items[:2])
+        copy = Packed()
+        copy.__setstate__(t.__getstate__())
+        self.assertEqual(list(copy.items()), items[:2])
+        # Trees that aren't packed still load packed states, and write
+        # tuples.
+        copy = self._makeOne()
+        copy.__setstate__(Packed(items[:2]).__getstate__())
+        self.assertEqual(list(copy.items()), items[:2])
+        self.assertIsInstance(self._makeOne(items[:2]).__getstate__()[0][0][0],
+                              tuple)
+        # Packed states are checked for the key and value types.
+        self.assertRaises(TypeError, self._makeOne().__setstate__,
+                          (((b'\x01zz\x00\x00\x00\x00\x00',),),))
+
+    def testPackedStateSharedWithBucket(self):
+        # A bucket loaded from a packed state may search its keys where
+        # they are in it; changing the bucket mustn't change the state.
+        class Packed(self._getTargetClass()):
+            packed_state = True
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        items = list(zip(sorted(self.KEYS), self.VALUES))
+        first = Packed.fromSorted(items[:40])._firstbucket
+        state = first.__getstate__()[:1]
+        expected = list(first.items())
+        (k0, v0), (k1, v1) = expected[:2]
+        for name, args in (
+                ('__setitem__', (k0, v1)),
+                ('__setitem__', (items[39][0], v0)),
+                ('__delitem__', (k1,)),
+                ('update', ([(k1, v0), (items[38][0], v1)],)),
+                ('clear', ()),
+        ):
+            bucket = type(first)()
+            bucket.__setstate__(state)
+            self.assertEqual(bucket[k1], v1)
+            model = dict(expected)
+            getattr(bucket, name)(*args)
+            getattr(model, name)(*args)
+            self.assertEqual(list(bucket.items()), sorted(model.items()))
+            bucket.__setstate__(state)
+            self.assertEqual(list(bucket.items()), expected)
+
+    @_skip_wo_ZODB
+    def testPackedStatePersistent(self):
+        import transaction
+        cls = self._getTargetClass()
+        items = list(zip(sorted(self.KEYS), self.VALUES))
+        cls.packed_state = True
+        try:
+            transaction.begin()
+            root = self._getRoot()
+            root.t = t = cls()
+            t.update(items)
+            transaction.commit()
+            del t[items[5][0]]
+            transaction.commit()
+            self._closeRoot(root)
+
+            root = self._getRoot()
+            t = root.t
+            t._check()
+            self.assertEqual(list(t.items()), items[:5] + items[6:])
+            self._assertPackedStates(t)
+            self._closeRoot(root)
+        finally:
+            cls.packed_state = False
+
+    def _getCountedClass(self):
+        class Counted(self._getTargetClass()):
+            counted = True
+            # Small nodes, so that the tree has several levels.
+            max_leaf_size = 4
+            max_internal_size = 4
+        return Counted
+
+    def testCounted(self):
+        cls = self._getCountedClass()
+        items = list(zip(self.KEYS, self.VALUES))
+        random.Random(42).shuffle(items)
+        t = cls()
+        for k, v in items:
+            t[k] = v
+        t._check()
+        keys = sorted(self.KEYS)
+        self.assertEqual(len(t), len(keys))
+        for i, k in enumerate(keys):
+            self.assertEqual(t.rank(k), i)
+            self.assertEqual(t.keyAt(i), k)
+        self.assertEqual(t.keyAt(-1), keys[-1])
+        self.assertRaises(IndexError, t.keyAt, len(keys))
+        self.assertRaises(IndexError, t.keyAt, -len(keys) - 1)
+
+        # Deletions keep the counts straight too.
+        for k, _ in items[::2]:
+            del t[k]
+        t._check()
+        keys = sorted(k for k, _ in items[1::2])
+        self.assertEqual(len(t), len(keys))
+        self.assertEqual([t.keyAt(i) for i in range(len(keys))], keys)
+        # A key that's gone still has a rank.
+        missing = items[0][0]
+        self.assertEqual(t.rank(missing), bisect.bisect_left(keys, missing))
+
+        # Indexing into ranges seeks by position.
+        lo, hi = keys[10], keys[-10]
+        for r in (t.keys(lo, hi), t.items(lo, hi),
+                  t.keys(lo, hi, excludemin=True, excludemax=True)):
+            expected = list(r)
+            self.assertEqual(len(r), len(expected))
+            self.assertEqual([r[i] for i in range(len(r))], expected)
+            self.assertEqual(r[-1], expected[-1])
+        values = t.values()
+        self.assertEqual(values[len(keys) // 2], t[keys[len(keys) // 2]])
+
+    def testCountedState(self):
+        cls = self._getCountedClass()
+        t = cls.fromSorted(list(zip(sorted(self.KEYS), self.VALUES)))
+        t._check()
+        state = t.__getstate__()
+        self.assertEqual(len(state), 3)
+
+        # Counts round-trip, and are recomputed when missing.
+        for s in state, state[:2]:
+            t2 = cls()
+            t2.__setstate__(s)
+            t2._check()
+            self.assertEqual(len(t2), len(t))
+            self.assertEqual(t2.keyAt(100), t.keyAt(100))
+
+        t2 = cls()
+        self.assertRaises(TypeError, t2.__setstate__,
+                          state[:2] + ((),))
+        self.assertRaises(ValueError, t2.__setstate__,
+                          state[:2] + ((-2,) * len(state[2]),))
+
+    def testRankAndKeyAtUncounted(self):
+        t = self._makeOne()
+        self.assertEqual(t.rank(self.KEYS[1]), 0)
+        self.assertRaises(IndexError, t.keyAt, 0)
+        t.update(list(zip(self.KEYS, self.VALUES)))
+        keys = sorted(self.KEYS)
+        self.assertEqual(t.rank(keys[1000]), 1000)
+        self.assertEqual(t.keyAt(1000), keys[1000])
+        self.assertEqual(t.keyAt(-2), keys[-2])
+
     def testDamagedIterator(self):
         # A cute one from Steve Alexander.  This caused the BTreeItems
         # object to go insane, accessing memory beyond the allocated part
@@ -2353,6 +3152,26 @@ class NormalSetTests(Base):
         t.update(keys)
         self.assertEqual(list(t.keys()), items)
 
+    def testUpdateInBulk(self):
+        # Large updates of sets of C numbers are sorted and merged all at
+        # once; that must look the same as adding one key at a time.
+        keys = list(self.KEYS)
+        random.Random(42).shuffle(keys)
+        t = self._makeOne()
+        t.update(keys[::2] * 2)
+        self.assertEqual(list(t), sorted(keys[::2]))
+        t.update(keys)
+        self.assertEqual(list(t), sorted(keys))
+        if hasattr(t, '_check'):
+            t._check()
+
+        # A key that can't be converted stops the update, but the keys
+        # before it are added.
+        t = self._makeOne()
+        with self.assertRaises(TypeError):
+            t.update(keys[:1500] + [object()] + keys[1500:])
+        self.assertEqual(list(t), sorted(keys[:1500]))
+
     def testEmptyRangeSearches(self):
         t = self._makeOne()
         K = self.KEYS
@@ -2505,6 +3324,229 @@ class NormalSetTests(Base):
         # being set depends on whether this is a TreeSet or a plain Set
 
 
+class TreeSetTests(NormalSetTests):
+    # Tests specific to TreeSets
+
+    def testFromSorted(self):
+        cls = self._getTargetClass()
+        keys = sorted(self.KEYS)
+        for fill in 1.0, 0.5, 0.01:
+            t = cls.fromSorted(keys, fill)
+            self.assertIs(type(t), cls)
+            t._check()
+            self.assertEqual(list(t), keys)
+        t.remove(keys[0])
+        t.add(keys[0])
+        t._check()
+        self.assertEqual(list(t), keys)
+
+        t = cls.fromSorted(iter(()))
+        self.assertEqual(len(t), 0)
+        t._check()
+
+    def testFromSortedRejectsUnsorted(self):
+        cls = self._getTargetClass()
+        K = sorted(self.KEYS)
+        with self.assertRaises(ValueError):
+            cls.fromSorted([K[2], K[1]])
+        with self.assertRaises(ValueError):
+            cls.fromSorted([K[1], K[1]])
+        with self.assertRaises(ValueError):
+            cls.fromSorted([K[1]], fill=0)
+
+    def testContainsMany(self):
+        t = self._makeOne()
+        K = self.KEYS
+        t.update(K[::2])
+        probes = list(K[::-3]) + [K[0]]
+        self.assertEqual(t.containsMany(probes), [k in t for k in probes])
+        self.assertEqual(self._makeOne().containsMany(K[:3]), [False] * 3)
+
+    def testDeleteRange(self):
+        cls = self._getTargetClass()
+        keys = sorted(self.KEYS)
+        for args, kw in [((keys[1], keys[1999]), {}),
+                         ((keys[30], keys[40]), dict(excludemin=True)),
+                         ((keys[1000], None), {})]:
+            t = cls.fromSorted(keys)
+            doomed = set(t.keys(*args, **kw))
+            t.deleteRange(*args, **kw)
+            t._check()
+            self.assertEqual(list(t), [k for k in keys if k not in doomed])
+            t.update(keys[::50])
+            t._check()
+
+    def testCursor(self):
+        keys = sorted(self.KEYS)
+        t = self._getTargetClass().fromSorted(keys)
+        self.assertEqual(list(reversed(t)), keys[::-1])
+        self.assertEqual(list(t.iterkeys(keys[7], keys[1200],
+                                         excludemax=True, reverse=True)),
+                         keys[1199:6:-1])
+        c = t.cursor(keys[10])
+        self.assertEqual([c.next() for _ in range(3)], keys[10:13])
+        c.seek(keys[900])
+        self.assertEqual([c.prev() for _ in range(3)], keys[899:896:-1])
+        self.assertEqual(c.next(), keys[897])
+        c.seek(keys[0])
+        self.assertRaises(StopIteration, c.prev)
+        self.assertEqual(list(t.cursor(reverse=True)), keys[::-1])
+
+    def testCompact(self):
+        class Small(self._getTargetClass()):
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        keys = sorted(self.KEYS)
+        t = Small.fromSorted(keys)
+        t.deleteRange(keys[100], keys[1900])
+        for k in keys[::3]:
+            t.discard(k)
+        expected = list(t)
+        self.assertTrue(t.compact() > 0)
+        t._check()
+        self.assertEqual(list(t), expected)
+        self.assertEqual(t.compact(), 0)
+
+    def testAppendOptimized(self):
+        class Small(self._getTargetClass()):
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        class Appending(Small):
+            append_optimized = True
+
+        keys = sorted(self.KEYS)
+        plain = Small()
+        t = Appending()
+        for k in keys:
+            plain.add(k)
+            t.add(k)
+        t._check()
+        self.assertEqual(list(t), keys)
+        self.assertTrue(self._countObjects(t, False) * 3 <
+                        self._countObjects(plain, False) * 2)
+
+    def testPackedState(self):
+        class Packed(self._getTargetClass()):
+            packed_state = True
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        keys = sorted(self.KEYS)[:40]
+        for t in Packed(keys), Packed.fromSorted(keys):
+            t._check()
+            self._assertPackedStates(t, False)
+            copy = Packed()
+            copy.__setstate__(t.__getstate__())
+            copy._check()
+            self.assertEqual(list(copy), keys)
+
+    def testPackedStateSharedWithBucket(self):
+        # A bucket loaded from a packed state may search its keys where
+        # they are in it; changing the bucket mustn't change the state.
+        class Packed(self._getTargetClass()):
+            packed_state = True
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        keys = sorted(self.KEYS)
+        first = Packed.fromSorted(keys[:40])._firstbucket
+        state = first.__getstate__()[:1]
+        expected = list(first)
+        for name, args in (
+                ('add', (keys[39],)),
+                ('remove', (expected[1],)),
+                ('update', ([expected[0], keys[38]],)),
+                ('clear', ()),
+        ):
+            bucket = type(first)()
+            bucket.__setstate__(state)
+            self.assertIn(expected[1], bucket)
+            model = set(expected)
+            getattr(bucket, name)(*args)
+            getattr(model, name)(*args)
+            self.assertEqual(list(bucket), sorted(model))
+            bucket.__setstate__(state)
+            self.assertEqual(list(bucket), expected)
+
+    def testCount(self):
+        keys = sorted(self.KEYS)
+        t = self._getTargetClass().fromSorted(keys[::2])
+        self.assertEqual(t.count(), 1001)
+        self.assertEqual(t.count(keys[10], keys[20], excludemin=True), 5)
+        self.assertEqual(t.count(keys[11], keys[1999]), 994)
+
+    def testToArrays(self):
+        keys = sorted(self.KEYS)
+        t = self._getTargetClass().fromSorted(keys[::2])
+        code = getattr(self.key_type, '_struct_format', None)
+        if code is None:
+            with self.assertRaises(TypeError):
+                t.toArrays()
+            return
+        for args, kw in (
+                ((), {}),
+                ((keys[11], keys[1999]), {}),
+                ((keys[10], keys[20]), dict(excludemin=True)),
+                ((keys[20], keys[10]), {}),
+        ):
+            k, v = t.toArrays(*args, **kw)
+            self.assertIsNone(v)
+            self.assertEqual(k.typecode, code)
+            self.assertEqual(k.tolist(), list(t.keys(*args, **kw)))
+
+    def testFromBuffer(self):
+        import array
+        cls = self._getTargetClass()
+        code = getattr(self.key_type, '_struct_format', None)
+        if code is None:
+            with self.assertRaises(TypeError):
+                cls.fromBuffer(array.array('i'))
+            return
+        keys = list(self.KEYS) * 2
+        random.Random(42).shuffle(keys)
+        t = cls.fromBuffer(array.array(code, keys))
+        t._check()
+        self.assertEqual(list(t), sorted(set(keys)))
+
+        keys = sorted(self.KEYS)
+        t = cls.fromBuffer(array.array(code, keys), sorted=True, fill=0.5)
+        t._check()
+        self.assertEqual(list(t), keys)
+        self.assertEqual(len(cls.fromBuffer(array.array(code))), 0)
+        with self.assertRaises(ValueError):
+            cls.fromBuffer(array.array(code, keys[::-1]), sorted=True)
+        with self.assertRaises(TypeError):
+            cls.fromBuffer(array.array(code.swapcase(), [1]))
+
+    def testCounted(self):
+        class Counted(self._getTargetClass()):
+            counted = True
+            max_leaf_size = 4
+            max_internal_size = 4
+
+        keys = list(self.KEYS)
+        random.Random(42).shuffle(keys)
+        t = Counted()
+        t.update(keys)
+        for k in keys[::3]:
+            t.remove(k)
+        t._check()
+        keys = sorted(set(keys) - set(keys[::3]))
+        self.assertEqual(len(t), len(keys))
+        self.assertEqual([t.keyAt(i) for i in range(len(keys))], keys)
+        self.assertEqual([t.rank(k) for k in keys], list(range(len(keys))))
+        r = t.keys(keys[5], keys[-5])
+        self.assertEqual(len(r), len(keys) - 9)
+        self.assertEqual(r[len(r) // 2], keys[5 + len(r) // 2])
+
+        t2 = Counted()
+        t2.__setstate__(t.__getstate__())
+        t2._check()
+        self.assertEqual(len(t2), len(keys))
+
+
 class ExtendedSetTests(NormalSetTests):
 
     def testLen(self):
@@ -2524,6 +3566,63 @@ class ExtendedSetTests(NormalSetTests):
         for x in r:
             self.assertEqual(t[x], to_key(x))
 
+    def testKeysBuffer(self):
+        t = self._makeOne()
+        to_key = self.coerce_to_key
+        t.update(to_key(x) for x in range(10))
+        code = getattr(self.key_type, '_struct_format', None)
+        if code is None:
+            with self.assertRaises(TypeError):
+                t.keysBuffer()
+            return
+        with t.keysBuffer() as view:
+            self.assertTrue(view.readonly)
+            self.assertEqual(view.format, code)
+            self.assertEqual(view.tolist(), list(t))
+        if 'Py' in type(self).__name__ or _c_optimizations_ignored():
+            return
+
+        view = t.keysBuffer()
+        with self.assertRaises(BufferError):
+            t.update(to_key(x) for x in range(10, 1000))
+        # A new state leaves the old keys to the buffer.
+        keys = view.tolist()
+        t.__setstate__(((to_key(1),),))
+        self.assertEqual(list(t), [to_key(1)])
+        self.assertEqual(view.tolist(), keys)
+        view.release()
+        t.update(to_key(x) for x in range(10, 1000))
+        self.assertEqual(len(t), 991)
+
+    @_skip_wo_ZODB
+    def testKeysBufferSurvivesDeactivation(self):
+        import transaction
+        if (getattr(self.key_type, '_struct_format', None) is None
+                or 'Py' in type(self).__name__
+                or _c_optimizations_ignored()):
+            self.skipTest("only C buckets with C number keys pin them")
+        to_key = self.coerce_to_key
+        t = self._makeOne()
+        t.update(to_key(x) for x in range(10))
+        root = self._getRoot()
+        root['t'] = t
+        transaction.commit()
+
+        root2 = self._getRoot()
+        t2 = root2['t']
+        view = t2.keysBuffer()
+        t2._p_deactivate()
+        self.assertEqual(t2._p_status, 'ghost')
+        self.assertEqual(view.tolist(), list(t))
+        self.assertEqual(list(t2), list(t))
+        t2._p_invalidate()
+        self.assertEqual(view.tolist(), list(t))
+        view.release()
+        self.assertEqual(list(t2), list(t))
+
+        self._closeRoot(root)
+        self._closeRoot(root2)
+
 
 class KeyCoercionFailed(Exception):
     """Raised when we use a static key that we expect to be able to fit."""
@@ -2673,10 +3772,22 @@ class ModuleTest:
     def test_weightedIntersection_presence(self):
         self._check_union_presence(self.value_type, 'weightedIntersection')
 
+    def test_multiWeightedUnion_presence(self):
+        self._check_union_presence(self.value_type, 'multiWeightedUnion')
+
     # The multiunion function requires the key type to support unions
     def test_multiunion_presence(self):
         self._check_union_presence(self.key_type, 'multiunion')
 
+    def test_multiintersection_presence(self):
+        self._check_union_presence(self.key_type, 'multiintersection')
+
+    def test_thresholdUnion_presence(self):
+        self._check_union_presence(self.key_type, 'thresholdUnion')
+
+    def test_multiunionSize_presence(self):
+        self._check_union_presence(self.key_type, 'multiunionSize')
+
 
 class I_SetsBase:
 
@@ -2861,11 +3972,13 @@ def makeSetBuilder(self, setbuilder):
     return result
 
 
-class SetResult:
+class SetResult(ZODBAccess):
     # Subclasses have to set up:
     #     builders() - function returning functions to build inputs,
     #     each returned callable takes an optional keys arg
     #     intersection, union, difference - set to the type-correct versions
+    #     intersectionSize, unionSize, differenceSize - likewise
+    #     iintersection, iunion, idifference - likewise
     def setUp(self):
         super().setUp()
         _skip_if_pure_py_and_py_test(self)
@@ -3014,6 +4127,42 @@ class SetResult:
                         self.assertEqual(list(C), want)
                     self.assertEqual(set(A) - set(B), set(A - B))
 
+    def testSizes(self):
+        inputs = self.As + self.Bs + self.emptys
+        ops = ((self.union, self.unionSize),
+               (self.intersection, self.intersectionSize),
+               (self.difference, self.differenceSize))
+        for A in inputs:
+            for B in inputs:
+                for op, size in ops:
+                    for b in B, list(B):
+                        n = len(op(A, b))
+                        self.assertEqual(size(A, b), n)
+                        for limit in 0, 1, 2, 100:
+                            self.assertEqual(size(A, b, limit),
+                                             min(n, limit))
+                            self.assertEqual(size(A, b, limit=limit),
+                                             min(n, limit))
+
+    def testSizesNone(self):
+        for size in self.unionSize, self.intersectionSize, self.differenceSize:
+            self.assertEqual(size(None, None), 0)
+            for A in self.As:
+                self.assertEqual(size(A, None), 4)
+                self.assertEqual(size(A, None, 3), 3)
+                if size == self.differenceSize:
+                    self.assertEqual(size(None, A), 0)
+                else:
+                    self.assertEqual(size(None, A, limit=5), 4)
+
+    def testSizesBadLimit(self):
+        A = self.As[0]
+        for size in self.unionSize, self.intersectionSize, self.differenceSize:
+            with self.assertRaises(ValueError):
+                size(A, A, -1)
+            with self.assertRaises(TypeError):
+                size(A, A, 'a')
+
     def testLargerInputs(self):
         from random import randint
 
@@ -3047,10 +4196,188 @@ class SetResult:
                             (A, B, Akeys, Bkeys, list(got), want)
                         )
 
+    def testSkewedInputs(self):
+        # A few keys against many exercises skipping ahead through the
+        # larger input, both within its buckets and across them.
+        K = self.KEYS
+        small = [3, 4, 700, 701, 1402, 1999]
+        large = list(range(0, 2000, 2))
+        Smalls = [makeset(small) for makeset in self.builders()]
+        Larges = [makeset(large) for makeset in self.builders()]
+        small = [K[k] for k in small]
+        large = [K[k] for k in large]
+
+        for S in Smalls:
+            for L in Larges:
+                self.assertEqual(list(self.intersection(S, L)),
+                                 self._intersection(small, large))
+                self.assertEqual(list(self.intersection(L, S)),
+                                 self._intersection(large, small))
+                self.assertEqual(list(self.difference(S, L)),
+                                 self._difference(small, large))
+                self.assertEqual(list(self.difference(L, S)),
+                                 self._difference(large, small))
+
+    @_skip_wo_ZODB
+    def testGhostInputs(self):
+        # Inputs whose buckets are still ghosts after loading from the
+        # database must give the same results as resident ones.
+        import transaction
+        K = self.KEYS
+        evens = list(range(0, 2000, 2))
+        thirds = list(range(0, 2000, 3))
+        for makeset in self.builders():
+            root = self._getRoot()
+            root['A'] = makeset(evens)
+            root['B'] = makeset(thirds)
+            transaction.commit()
+
+            root2 = self._getRoot()
+            A, B = root2['A'], root2['B']
+            A._p_deactivate()
+            B._p_deactivate()
+            a = [K[k] for k in evens]
+            b = [K[k] for k in thirds]
+            self.assertEqual(list(self.union(A, B)), self._union(a, b))
+            self.assertEqual(list(self.intersection(A, B)),
+                             self._intersection(a, b))
+            self.assertEqual(list(self.difference(A, B)),
+                             self._difference(a, b))
+            self.assertEqual(self.intersectionSize(A, B),
+                             len(self._intersection(a, b)))
+
+            self._closeRoot(root)
+            self._closeRoot(root2)
+
+    def _inRange(self, keys, lo, hi, excludemin=False, excludemax=False):
+        return [k for k in keys
+                if (lo is None or lo < k or (lo == k and not excludemin))
+                and (hi is None or k < hi or (k == hi and not excludemax))]
+
+    def testRanges(self):
+        K = self.KEYS
+        inputs = self.As + self.Bs + self.emptys
+        ops = ((self.union, self._union),
+               (self.intersection, self._intersection),
+               (self.difference, self._difference))
+        for lo, hi in (None, 4), (3, None), (3, 6), (5, 4), (0, 9):
+            lo = None if lo is None else K[lo]
+            hi = None if hi is None else K[hi]
+            for exmin in False, True:
+                for exmax in False, True:
+                    kw = dict(min=lo, max=hi,
+                              excludemin=exmin, excludemax=exmax)
+                    for A in inputs:
+                        a = self._inRange(A, lo, hi, exmin, exmax)
+                        for B in inputs:
+                            b = self._inRange(B, lo, hi, exmin, exmax)
+                            for op, simulator in ops:
+                                C = op(A, B, **kw)
+                                self.assertEqual(list(C), simulator(a, b))
+                            C = self.difference(A, B, **kw)
+                            if hasattr(A, 'values'):
+                                self.assertEqual(
+                                    list(C.items()),
+                                    [(k, A[k]) for k in self._difference(a,
+                                                                         b)])
+                            C = self.union(A, list(B), **kw)
+                            self.assertEqual(list(C), self._union(a, b))
+
+    def testRangesNone(self):
+        K = self.KEYS
+        for op in self.union, self.intersection, self.difference:
+            self.assertIsNone(op(None, None, min=K[1], max=K[5]))
+            for A in self.As:
+                # Without a bound, the exclude flags change nothing.
+                self.assertIs(op(A, None, excludemin=True), A)
+                C = op(A, None, min=K[3], max=K[5], excludemax=True)
+                self.assertEqual(list(C), self._inRange(A, K[3], K[5],
+                                                        excludemax=True))
+                self.assertEqual(hasattr(C, 'values'), hasattr(A, 'values'))
+                C = op(None, A, min=K[4])
+                if op == self.difference:
+                    self.assertIsNone(C)
+                else:
+                    self.assertEqual(list(C), self._inRange(A, K[4], None))
+
+    def testSkewedRanges(self):
+        # Skipping ahead through the larger input must stop at the end of
+        # the range, even when it descends from the root to get there.
+        K = self.KEYS
+        small = [3, 4, 700, 701, 1402, 1404, 1999]
+        large = list(range(0, 2000, 2))
+        Smalls = [makeset(small) for makeset in self.builders()]
+        Larges = [makeset(large) for makeset in self.builders()]
+        small = [K[k] for k in small]
+        large = [K[k] for k in large]
+
+        for lo, hi in (2, 1402), (4, 1403), (701, 1999), (5, 699):
+            lo, hi = K[lo], K[hi]
+            s = self._inRange(small, lo, hi)
+            L = self._inRange(large, lo, hi)
+            for S in Smalls:
+                for B in Larges:
+                    self.assertEqual(
+                        list(self.intersection(S, B, min=lo, max=hi)),
+                        self._intersection(s, L))
+                    self.assertEqual(
+                        list(self.intersection(B, S, min=lo, max=hi)),
+                        self._intersection(L, s))
+                    self.assertEqual(
+                        list(self.difference(S, B, min=lo, max=hi)),
+                        self._difference(s, L))
+
+    def testIterators(self):
+        K = self.KEYS
+        inputs = self.As + self.Bs + self.emptys
+        ops = ((self.iunion, self.union),
+               (self.iintersection, self.intersection),
+               (self.idifference, self.difference))
+        for A in inputs:
+            for B in inputs:
+                for iop, op in ops:
+                    for b in B, self._reversed(B):
+                        self.assertEqual(list(iop(A, b)), list(op(A, b)))
+                    self.assertEqual(
+                        list(iop(A, B, min=K[3], max=K[6],
+                                 excludemax=True)),
+                        list(op(A, B, min=K[3], max=K[6], excludemax=True)))
+
+    def testIteratorsNone(self):
+        for iop in self.iunion, self.iintersection, self.idifference:
+            self.assertEqual(list(iop(None, None)), [])
+            for A in self.As:
+                self.assertEqual(list(iop(A, None)), list(A))
+                if iop == self.idifference:
+                    self.assertEqual(list(iop(None, A)), [])
+                else:
+                    self.assertEqual(list(iop(None, A)), list(A))
+
+    def testIteratorsStopEarly(self):
+        # Each key is merged as it is asked for; what is left is still
+        # produced correctly after a pause, and the end is sticky.
+        K = self.KEYS
+        small = [3, 4, 700, 701, 1402, 1999]
+        large = list(range(0, 2000, 2))
+        for makeset in self.builders():
+            S = makeset(small)
+            L = makeset(large)
+            for iop, op in ((self.iunion, self.union),
+                            (self.iintersection, self.intersection),
+                            (self.idifference, self.difference)):
+                for A, B in (S, L), (L, S):
+                    it = iop(A, B)
+                    self.assertIs(iter(it), it)
+                    want = list(op(A, B))
+                    first = [next(it) for _ in range(min(2, len(want)))]
+                    self.assertEqual(first + list(it), want)
+                    self.assertEqual(list(it), [])
+        self.assertEqual(next(self.iunion(None, [K[2], K[1]])), K[1])
+
 
 class Weighted(SignedMixin):
     # Subclasses must set up (as class variables):
-    #     weightedUnion, weightedIntersection
+    #     weightedUnion, weightedIntersection, multiWeightedUnion
     #     builders -- sequence of constructors, taking items
     #     union, intersection -- the module routines of those names
     #     mkbucket -- the module bucket builder
@@ -3183,6 +4510,168 @@ class Weighted(SignedMixin):
                     else:
                         self.assertEqual(got_s.items(), want_s)
 
+    def testSkewedIntersection(self):
+        # Values must stay with their keys when the larger input is
+        # skipped through rather than stepped through.
+        small = [(3, 1), (4, 2), (700, 3), (1401, 4)]
+        large = [(k, k + 1) for k in range(0, 1500, 3)]
+        Smalls = [make(small) for make in self.builders()]
+        Larges = [make(large) for make in self.builders()]
+        for S in Smalls:
+            for L in Larges:
+                for A, B in (S, L), (L, S):
+                    want_w, want_s = self._wintersection(A, B, 2, 3)
+                    got_w, got_s = self.weightedIntersection()(A, B, 2, 3)
+                    self.assertEqual(got_w, want_w)
+                    if isaset(got_s):
+                        self.assertEqual(got_s.keys(), want_s)
+                    else:
+                        self.assertEqual(got_s.items(), want_s)
+
+    # Python simulation of multiWeightedUnion.
+    def _mwunion(self, pairs):
+        result = {}
+        for c, w in pairs:
+            for key, value in self._normalize(c).items():
+                result[key] = result.get(key, 0) + value * w
+        return sorted(result.items())
+
+    def testMultiWeightedUnion(self):
+        inputs = self.As + self.Bs + self.emptys
+        for A in inputs:
+            for B in inputs:
+                for w1, w2 in self.weights:
+                    if (
+                        (w1 < 0 or w2 < 0) and
+                        not self.SUPPORTS_NEGATIVE_VALUES
+                    ):
+                        continue
+                    pairs = [(A, w1), (None, 5), (B, w2), (A, w2)]
+                    got = self.multiWeightedUnion()(pairs)
+                    self.assertFalse(isaset(got))
+                    self.assertEqual(list(got.items()),
+                                     self._mwunion([(A, w1), (B, w2),
+                                                    (A, w2)]))
+
+    def testMultiWeightedUnionDefaultWeight(self):
+        A = self.As[0]
+        got = self.multiWeightedUnion()([(A,), (A,)])
+        self.assertEqual(list(got.items()), self._mwunion([(A, 2)]))
+        self.assertEqual(len(self.multiWeightedUnion()([])), 0)
+
+    def testMultiWeightedUnionBadPair(self):
+        with self.assertRaises(TypeError):
+            self.multiWeightedUnion()([self.As[0]])
+
+    def testMultiWeightedUnionMany(self):
+        # Enough inputs, with enough keys, for a deep heap and trees
+        # with several buckets.
+        mkbucket = self.builders()[0]
+        inputs = [mkbucket([(k, 1) for k in range(i, 1000, i + 1)])
+                  for i in range(20)]
+        inputs = [make(list(c.items())) for c, make in
+                  zip(inputs, self.builders() * 5)]
+        pairs = [(c, 2) for c in inputs]
+        got = self.multiWeightedUnion()(pairs)
+        self.assertEqual(list(got.items()), self._mwunion(pairs))
+
+    # Keep the k simulated result items with the largest values, ties
+    # going to the smaller keys, in key order.
+    def _topk(self, items, k):
+        best = sorted(range(len(items)), key=lambda i: items[i][1],
+                      reverse=True)[:k]
+        return [items[i] for i in sorted(best)]
+
+    def testTopK(self):
+        inputs = self.As + self.Bs + self.emptys
+        for op, simulate in ((self.weightedUnion(), self._wunion),
+                             (self.weightedIntersection(),
+                              self._wintersection)):
+            for A in inputs:
+                for B in inputs:
+                    for w1, w2 in (1, 7), (0, 0), (-3, 1):
+                        if w1 < 0 and not self.SUPPORTS_NEGATIVE_VALUES:
+                            continue
+                        want_w, want_s = simulate(A, B, w1, w2)
+                        for k in 1, 2, 3, 100:
+                            got_w, got_s = op(A, B, w1, w2, topk=k)
+                            self.assertEqual(got_w, want_w)
+                            if isaset(got_s):
+                                self.assertEqual(got_s.keys(), want_s)
+                            else:
+                                self.assertEqual(list(got_s.items()),
+                                                 self._topk(want_s, k))
+
+    def testTopKNone(self):
+        for op in self.weightedUnion(), self.weightedIntersection():
+            for A in self.As:
+                w, C = op(None, A, topk=1)
+                self.assertIs(C, A)
+                self.assertEqual(w, 1)
+
+    def testTopKBadValue(self):
+        A = self.As[0]
+        for k in 0, -1:
+            for op in self.weightedUnion(), self.weightedIntersection():
+                with self.assertRaises(ValueError):
+                    op(A, A, topk=k)
+            with self.assertRaises(ValueError):
+                self.multiWeightedUnion()([(A, 1)], topk=k)
+        with self.assertRaises(TypeError):
+            self.weightedUnion()(A, A, topk=1.5)
+
+    def testRanges(self):
+        for lo, hi in (None, 4), (3, None), (2, 6), (4, 2):
+            inRange = [(k, v) for k, v in self.Aitems + self.Bitems
+                       if (lo is None or lo <= k) and (hi is None or k <= hi)]
+            for makeA in self.builders():
+                A = makeA(self.Aitems)
+                Ar = makeA([i for i in self.Aitems if i in inRange])
+                for makeB in self.builders():
+                    B = makeB(self.Bitems)
+                    Br = makeB([i for i in self.Bitems if i in inRange])
+                    for w1, w2 in (1, 1), (2, 7):
+                        for op, simulate in (
+                                (self.weightedUnion(), self._wunion),
+                                (self.weightedIntersection(),
+                                 self._wintersection)):
+                            want_w, want_s = simulate(Ar, Br, w1, w2)
+                            got_w, got_s = op(A, B, w1, w2, min=lo, max=hi)
+                            self.assertEqual(got_w, want_w)
+                            if isaset(got_s):
+                                self.assertEqual(got_s.keys(), want_s)
+                            else:
+                                self.assertEqual(got_s.items(), want_s)
+                            got_w, got_s = op(A, B, w1, w2, topk=1,
+                                              min=lo, max=hi)
+                            if not isaset(got_s):
+                                self.assertEqual(list(got_s.items()),
+                                                 self._topk(want_s, 1))
+
+    def testRangesNone(self):
+        for op in self.weightedUnion(), self.weightedIntersection():
+            self.assertEqual(op(None, None, 2, 3, min=1), (0, None))
+            for A in self.As:
+                w, C = op(None, A, 42, 666, min=2, max=5)
+                self.assertEqual(w, 666)
+                self.assertEqual(list(C.keys()), [3, 5])
+                w, C = op(A, None, 42, 666, min=3, excludemin=True)
+                self.assertEqual(w, 42)
+                self.assertEqual(list(C.keys()), [5, 6])
+                self.assertEqual(isaset(C), isaset(A))
+
+    def testMultiWeightedUnionTopK(self):
+        mkbucket = self.builders()[0]
+        inputs = [mkbucket([(k, k % 7) for k in range(i, 1000, i + 1)])
+                  for i in range(20)]
+        inputs = [make(list(c.items())) for c, make in
+                  zip(inputs, self.builders() * 5)]
+        pairs = [(c, i % 3 + 1) for i, c in enumerate(inputs)]
+        want = self._mwunion(pairs)
+        for k in 1, 10, 100, 5000:
+            got = self.multiWeightedUnion()(pairs, topk=k)
+            self.assertEqual(list(got.items()), self._topk(want, k))
+
 
 # Given a set builder (like OITreeSet or OISet), return a function that
 # takes a list of (key, value) pairs and builds a set out of the keys.
@@ -3200,7 +4689,8 @@ def isaset(thing):
 
 class MultiUnion(SignedMixin):
     # Subclasses must set up (as class variables):
-    #     multiunion, union
+    #     multiunion, multiintersection, thresholdUnion, multiunionSize,
+    #     union
     #     mkset, mktreeset
     #     mkbucket, mkbtree
 
@@ -3315,6 +4805,40 @@ class MultiUnion(SignedMixin):
         self.assertEqual(output.maxKey(), N - 1)
         self.assertEqual(list(output), list(range(N)))
 
+    def testThreads(self):
+        # Enough keys that the sort is split across threads, with
+        # duplicates across inputs and within the last one.
+        N = 150000
+        if (
+            (_c_optimizations_ignored() or 'Py' in type(self).__name__) and
+            not PYPY
+        ):
+            N = N // 10
+        inputs = [self.mktreeset(range(i, N, 3)) for i in range(3)]
+        inputs.append(self.mkset(range(0, N, 2)))
+        inputs.append(list(range(N - 1, N // 2, -5)) * 2)
+        for threads in None, 2, 3, 100:
+            output = self.multiunion(inputs, threads=threads)
+            self.assertEqual(list(output), list(range(N)))
+        self.assertEqual(list(self.multiunion([], threads=4)), [])
+        for threads in 0, -1:
+            with self.assertRaises(ValueError):
+                self.multiunion(inputs, threads=threads)
+        with self.assertRaises(TypeError):
+            self.multiunion(inputs, threads='a')
+        with self.assertRaises(TypeError):
+            self.multiunion(inputs, 2)
+
+    def testUnsignedHighKeys(self):
+        # Unsigned keys with the top bit set sort after the others, also
+        # when there are enough of them for the radix sort.
+        if self.SUPPORTS_NEGATIVE_KEYS:
+            self.skipTest("keys are signed")
+        top = self.key_type.get_upper_bound()
+        keys = list(range(top - 999, top + 1)) + list(range(1000))
+        output = self.multiunion([keys])
+        self.assertEqual(list(output), sorted(keys))
+
     def testLotsOfLittleOnes(self):
         from random import shuffle
         N = 5000
@@ -3349,6 +4873,109 @@ class MultiUnion(SignedMixin):
         self.assertEqual(list(slow), list(fast))
         self.assertEqual(list(fast), list(range(N)))
 
+    def testMultiIntersectionEmpty(self):
+        self.assertEqual(len(self.multiintersection([])), 0)
+        for builder in self.mkset, self.mktreeset, list:
+            output = self.multiintersection([builder([1, 2]), builder()])
+            self.assertEqual(list(output), [])
+
+    def testMultiIntersectionOne(self):
+        for builder in self.mkset, self.mktreeset, list, tuple, set:
+            output = self.multiintersection([builder([5, 3, 1])])
+            self.assertEqual(list(output), [1, 3, 5])
+
+    def testMultiIntersectionMixed(self):
+        N = 3000
+        evens = self.mktreeset(range(0, N, 2))
+        threes = self.mkbtree([(k, 1) for k in range(0, N, 3)])
+        fives = self.mkset(range(0, N, 5))
+        sevens = list(reversed(range(0, N, 7)))
+        output = self.multiintersection([evens, threes, fives, sevens])
+        self.assertEqual(list(output), list(range(0, N, 210)))
+        self.assertEqual(list(output),
+                         list(self.multiintersection(
+                             [sevens, fives, threes, evens])))
+        # An int is a set of one key.
+        output = self.multiintersection([evens, 420, threes])
+        self.assertEqual(list(output), [420])
+        output = self.multiintersection([evens, 421])
+        self.assertEqual(list(output), [])
+
+    def testMultiIntersectionSkewed(self):
+        big = self.mktreeset(range(20000))
+        small = self.mkset([0, 7, 1999, 12345, 19999])
+        output = self.multiintersection([big, big, small, big])
+        self.assertEqual(list(output), list(small))
+
+    def testThresholdUnion(self):
+        inputs = [
+            self.mkset([1, 2, 3, 4]),
+            self.mktreeset([2, 3, 4]),
+            self.mkbtree([(3, 10), (4, 10), (5, 10)]),
+            [4, 5, 6, 4],   # the repeated 4 is only counted once
+            6,
+        ]
+        for k, want in ((1, [1, 2, 3, 4, 5, 6]),
+                        (2, [2, 3, 4, 5, 6]),
+                        (3, [3, 4]),
+                        (4, [4]),
+                        (5, []),
+                        (6, [])):
+            output = self.thresholdUnion(inputs, k)
+            self.assertIsInstance(output, self.mkset)
+            self.assertEqual(list(output), want)
+
+        output = self.thresholdUnion(inputs, 2, counts=True)
+        self.assertIsInstance(output, self.mkbucket)
+        self.assertEqual(list(output.items()),
+                         [(2, 2), (3, 3), (4, 4), (5, 2), (6, 2)])
+        self.assertEqual(len(self.thresholdUnion([], 1)), 0)
+        self.assertEqual(len(self.thresholdUnion([], 1, counts=True)), 0)
+
+    def testThresholdUnionBadK(self):
+        with self.assertRaises(ValueError):
+            self.thresholdUnion([self.mkset([1])], 0)
+
+    def testThresholdUnionBigInput(self):
+        N = 5000
+        inputs = [self.mktreeset(range(i, N, 3)) for i in range(3)]
+        inputs += [self.mkset(range(0, N, 2))]
+        output = self.thresholdUnion(inputs, 2, counts=True)
+        self.assertEqual(list(output.keys()), list(range(0, N, 2)))
+        self.assertEqual(set(output.values()), {2})
+
+    def testBigSetOperations(self):
+        # Inputs big enough that their sizes are first counted only up to
+        # a bound, both skewed and not.
+        big = self.mktreeset(range(0, 60000, 2))
+        for keys in range(1, 60000, 997), range(0, 60000, 5):
+            expected = sorted(set(keys) & set(big))
+            for small in self.mkset(keys), self.mktreeset(keys):
+                self.assertEqual(list(self.intersection()(small, big)),
+                                 expected)
+                self.assertEqual(list(self.intersection()(big, small)),
+                                 expected)
+                self.assertEqual(list(self.union(small, big)),
+                                 sorted(set(keys) | set(big)))
+
+    def testMultiunionSize(self):
+        inputs = [
+            self.mkset([1, 2, 3, 4]),
+            self.mktreeset([2, 3, 40]),
+            self.mkbtree([(3, 10), (5, 10)]),
+            [4, 6, 4],
+            7,
+        ]
+        self.assertEqual(self.multiunionSize(inputs), 8)
+        self.assertEqual(self.multiunionSize(inputs, 100), 8)
+        # The first input alone reaches these limits.
+        for limit in 0, 3, 4:
+            self.assertEqual(self.multiunionSize(inputs, limit=limit), limit)
+        self.assertEqual(self.multiunionSize(inputs, 6), 6)
+        self.assertEqual(self.multiunionSize([]), 0)
+        with self.assertRaises(ValueError):
+            self.multiunionSize(inputs, -1)
+
 
 class ConflictTestBase(SignedMixin):
     # Tests common to all types: sets, buckets, and BTrees
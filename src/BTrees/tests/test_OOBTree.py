@@ -11,7 +11,10 @@
 # FOR A PARTICULAR PURPOSE
 #
 ##############################################################################
+import unittest
+
 from BTrees import OOBTree
+from BTrees._compat import PYPY
 
 from ._test_builder import update_module
 from .common import BTreeTests
@@ -172,5 +175,59 @@ class OOBTreeTest(BTreeTests):
         self.assertNotIn(bad_key, t)
         self.assertEqual(list(t), [])
 
+    def testHomogeneousKeyOrdering(self):
+        # str, bytes, int and tuple keys are compared without rich
+        # comparison in C; the order must be Python's.
+        import random
+        rand = random.Random(9)
+        big = 2 ** 70
+        keysets = [
+            ['', 'a', 'ab', 'b', 'z\xe9', '\u20ac', '\U0001f600', 'a\x00',
+             'Z', 'aa' * 50],
+            [b'', b'a', b'ab', b'a\x00', b'\xff', b'\x00\x01', b'b' * 99],
+            [0, 1, -1, big, -big, big + 1, 2 ** 63 - 1, -2 ** 63, 2 ** 63,
+             True, 7],
+            [(), (1,), (1, 'a'), (1, 'b'), (2,), (1, 'a', b'x'), (big, 'a'),
+             (3, (1, 2)), (3, (1, 3)), (-1, 'z')],
+        ]
+        for keys in keysets:
+            keys = list(keys)
+            rand.shuffle(keys)
+            t = self._makeOne()
+            for k in keys:
+                t[k] = k
+            self.assertEqual(list(t), sorted(set(keys)))
+            for k in keys:
+                self.assertEqual(t[k], k)
+            t._check()
+        # Mixed tuples still compare (and fail) the way Python does.
+        t = self._makeOne({(1, 'a'): 1})
+        self.assertRaises(TypeError, t.__setitem__, (1, 2), 2)
+        self.assertEqual(list(t), [(1, 'a')])
+
+    @unittest.skipIf(PYPY, "No refcounts on PyPy")
+    def testDeleteRangeReleasesKeys(self):
+        import sys
+        keys = ['k%05d' % i for i in range(3000)]
+
+        def build():
+            t = self._makeOne()
+            for k in keys:
+                t[k] = 1
+            return t
+
+        t = build()
+        sep = t.__getstate__()[0][3]
+        hi = keys[keys.index(sep) + 3]
+        del t
+        before = sys.getrefcount(sep)
+        # The first two children go; the trimmed third one moves into
+        # slot 0, where its key is no longer held.
+        t = build()
+        t.deleteRange(keys[0], hi)
+        self.assertEqual(list(t), keys[keys.index(hi) + 1:])
+        del t
+        self.assertEqual(sys.getrefcount(sep), before)
+
 
 update_module(globals(), OOBTree, btree_tests_base=OOBTreeTest)
@@ -2171,7 +2171,7 @@ class Test_Tree(unittest.TestCase):
 
     def test__p_resolveConflict_invalid_state_non_1_tuple(self):
         tree = self._makeOne()
-        INVALID = ('a', 'b', 'c')
+        INVALID = ('a', 'b', 'c', 'd')
         EMPTY = None
         DEGEN = (((('a', 'b'),),),)
         self.assertRaises(TypeError, tree._p_resolveConflict,
@@ -2475,6 +2475,15 @@ class TreeTests(unittest.TestCase):
         self.assertEqual(list(tree.byValue(min=22)),
                          [(y, x) for x, y in reversed(ITEMS[22:])])
 
+    def test_nlargest_nsmallest(self):
+        ITEMS = [(y, x % 5)
+                 for x, y in enumerate('abcdefghijklmnopqrstuvwxyz')]
+        tree = self._makeOne(ITEMS)
+        self.assertEqual(tree.nlargest(3), [(4, 'e'), (4, 'j'), (4, 'o')])
+        self.assertEqual(tree.nsmallest(2), [(0, 'a'), (0, 'f')])
+        self.assertEqual(tree.nlargest(0), [])
+        self.assertEqual(len(tree.nsmallest(100)), 26)
+
     def test_insert_new_key(self):
         tree = self._makeOne()
         self.assertTrue(tree.insert('a', 0))
@@ -2876,6 +2885,21 @@ class Test_weightedUnion(unittest.TestCase, _SetObBase):
         self.assertEqual(weight, 1)
         self.assertEqual(list(result), [1, 2, 3, 4])
 
+    def test_both_mappings_w_topk(self):
+        lhs = self._makeMapping({'a': 13, 'c': 12, 'e': 11})
+        rhs = self._makeMapping({'a': 10, 'b': 22, 'd': 12})
+        weight, result = self._callFUT(lhs.__class__, lhs, rhs, topk=3)
+        self.assertEqual(weight, 1)
+        self.assertEqual(list(result), ['a', 'b', 'c'])
+        self.assertEqual(result['a'], 23)
+        self.assertEqual(result['b'], 22)
+        self.assertEqual(result['c'], 12)
+
+    def test_w_bad_topk(self):
+        lhs = self._makeMapping({'a': 13})
+        with self.assertRaises(ValueError):
+            self._callFUT(lhs.__class__, None, lhs, topk=0)
+
     # TODO:  test non-default weights
 
 
@@ -2967,6 +2991,170 @@ class Test_weightedIntersection(unittest.TestCase, _SetObBase):
     # TODO:  test non-default weights
 
 
+class Test_multiWeightedUnion(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from .._base import multiWeightedUnion
+        return multiWeightedUnion(*args, **kw)
+
+    def test_no_pairs(self):
+        from BTrees.IIBTree import IISetPy
+        result = self._callFUT(IISetPy, ())
+        self.assertEqual(list(result.items()), [])
+
+    def test_w_mix(self):
+        from BTrees.IIBTree import IIBucketPy
+        from BTrees.IIBTree import IISetPy
+        pairs = [(IISetPy([1, 2]), 3), (None, 7),
+                 (IIBucketPy({2: 5, 4: 6}), 2), (IISetPy([4]),)]
+        result = self._callFUT(IISetPy, pairs)
+        self.assertIsInstance(result, IIBucketPy)
+        self.assertEqual(list(result.items()), [(1, 3), (2, 13), (4, 13)])
+
+    def test_w_topk(self):
+        from BTrees.IIBTree import IIBucketPy
+        from BTrees.IIBTree import IISetPy
+        pairs = [(IISetPy([1, 2, 3]), 3), (IIBucketPy({2: 5, 4: 6}), 2)]
+        result = self._callFUT(IISetPy, pairs, topk=2)
+        self.assertEqual(list(result.items()), [(2, 13), (4, 12)])
+
+    def test_w_bad_pair(self):
+        from BTrees.IIBTree import IISetPy
+        with self.assertRaises(TypeError):
+            self._callFUT(IISetPy, [IISetPy([1])])
+
+
+class Test_set_operation_sizes(unittest.TestCase, _SetObBase):
+
+    def test_w_none(self):
+        from BTrees.IIBTree import IISetPy
+
+        from .._base import differenceSize
+        from .._base import intersectionSize
+        from .._base import unionSize
+        lhs = IISetPy([1, 2, 3])
+        self.assertEqual(differenceSize(IISetPy, None, lhs), 0)
+        self.assertEqual(differenceSize(IISetPy, lhs, None, 2), 2)
+        self.assertEqual(unionSize(IISetPy, None, None), 0)
+        self.assertEqual(unionSize(IISetPy, None, lhs), 3)
+        self.assertEqual(intersectionSize(IISetPy, lhs, None), 3)
+
+    def test_w_sets(self):
+        from .._base import differenceSize
+        from .._base import intersectionSize
+        from .._base import unionSize
+        lhs = self._makeSet('a', 'b', 'c', 'd')
+        rhs = self._makeSet('b', 'd', 'e')
+        self.assertEqual(differenceSize(_Set, lhs, rhs), 2)
+        self.assertEqual(unionSize(_Set, lhs, rhs), 5)
+        self.assertEqual(unionSize(_Set, lhs, rhs, limit=4), 4)
+        self.assertEqual(intersectionSize(_Set, lhs, rhs), 2)
+        self.assertEqual(intersectionSize(_Set, lhs, rhs, 1), 1)
+        self.assertEqual(intersectionSize(_Set, lhs, rhs, 0), 0)
+
+    def test_w_bad_limit(self):
+        from .._base import unionSize
+        lhs = self._makeSet('a')
+        with self.assertRaises(ValueError):
+            unionSize(_Set, lhs, lhs, -1)
+
+
+class Test_set_operation_ranges(unittest.TestCase):
+
+    def test_range_search(self):
+        from .._base import _range_search
+        self.assertIsNone(_range_search(None, None, True, True))
+        self.assertEqual(_range_search(1, None, True, True),
+                         dict(min=1, max=None,
+                              excludemin=True, excludemax=False))
+
+    def test_w_sets(self):
+        from BTrees.IIBTree import IISetPy
+        from BTrees.IIBTree import IITreeSetPy
+
+        from .._base import difference
+        from .._base import intersection
+        from .._base import union
+        lhs = IITreeSetPy(range(10))
+        rhs = IISetPy(range(5, 15))
+        self.assertEqual(list(union(IISetPy, lhs, rhs, min=8, max=11)),
+                         [8, 9, 10, 11])
+        self.assertEqual(list(intersection(IISetPy, lhs, [9, 7, 6],
+                                           min=6, excludemin=True)),
+                         [7, 9])
+        self.assertEqual(list(difference(IISetPy, lhs, rhs, max=5,
+                                         excludemax=True)),
+                         [0, 1, 2, 3, 4])
+
+    def test_w_none(self):
+        from BTrees.IIBTree import IIBTreePy
+        from BTrees.IIBTree import IISetPy
+
+        from .._base import difference
+        from .._base import union
+        lhs = IIBTreePy({1: 2, 3: 4, 5: 6})
+        result = union(IISetPy, None, lhs, min=2)
+        self.assertEqual(list(result.items()), [(3, 4), (5, 6)])
+        self.assertIsNone(difference(IISetPy, None, lhs, min=2))
+        self.assertIs(union(IISetPy, lhs, None, excludemin=True), lhs)
+
+    def test_weighted(self):
+        from BTrees.IIBTree import IIBucketPy
+        from BTrees.IIBTree import IISetPy
+
+        from .._base import weightedIntersection
+        from .._base import weightedUnion
+        lhs = IIBucketPy({1: 2, 3: 4, 5: 6})
+        rhs = IISetPy([3, 4, 5])
+        w, result = weightedUnion(IISetPy, lhs, rhs, 1, 10, max=4)
+        self.assertEqual(w, 1)
+        self.assertEqual(list(result.items()), [(1, 2), (3, 14), (4, 10)])
+        w, result = weightedIntersection(IISetPy, lhs, rhs, min=4)
+        self.assertEqual(list(result.items()), [(5, 7)])
+
+
+class Test_iset_operations(unittest.TestCase):
+
+    def test_lazy(self):
+        from .._base import _imerge
+        consumed = []
+
+        def keys(seq):
+            for k in seq:
+                consumed.append(k)
+                yield k
+        it = _imerge(keys([1, 3, 5, 7]), keys([2, 3, 8]), 0, 1, 0)
+        self.assertEqual(next(it), 3)
+        self.assertEqual(consumed, [1, 2, 3, 3])
+        self.assertEqual(list(it), [])
+
+    def test_w_sets(self):
+        from BTrees.IIBTree import IISetPy
+        from BTrees.IIBTree import IITreeSetPy
+
+        from .._base import idifference
+        from .._base import iintersection
+        from .._base import iunion
+        lhs = IITreeSetPy(range(10))
+        rhs = IISetPy(range(5, 15))
+        self.assertEqual(list(iunion(IISetPy, lhs, [12, 11], min=8)),
+                         [8, 9, 11, 12])
+        self.assertEqual(list(iintersection(IISetPy, lhs, rhs)),
+                         [5, 6, 7, 8, 9])
+        self.assertEqual(list(idifference(IISetPy, lhs, rhs, max=6)),
+                         [0, 1, 2, 3, 4])
+
+    def test_w_none(self):
+        from BTrees.IIBTree import IISetPy
+
+        from .._base import idifference
+        from .._base import iintersection
+        lhs = IISetPy([1, 2])
+        self.assertEqual(list(iintersection(IISetPy, None, lhs)), [1, 2])
+        self.assertEqual(list(idifference(IISetPy, None, lhs)), [])
+        self.assertEqual(list(idifference(IISetPy, lhs, None)), [1, 2])
+
+
 class Test_multiunion(unittest.TestCase, _SetObBase):
 
     def _callFUT(self, *args, **kw):
@@ -2990,6 +3178,69 @@ class Test_multiunion(unittest.TestCase, _SetObBase):
         self.assertEqual(list(result), [1, 2])
 
 
+class Test_multiunionSize(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from .._base import multiunionSize
+        return multiunionSize(*args, **kw)
+
+    def test_w_mix(self):
+        from BTrees.IIBTree import IISetPy
+        self.assertEqual(self._callFUT(IISetPy, [1, (2, 3), (1,)]), 3)
+        self.assertEqual(self._callFUT(IISetPy, [1, (2, 3)], limit=2), 2)
+        self.assertEqual(self._callFUT(IISetPy, ()), 0)
+
+
+class Test_multiintersection(unittest.TestCase, _SetObBase):
+
+    def _callFUT(self, *args, **kw):
+        from .._base import multiintersection
+        return multiintersection(*args, **kw)
+
+    def test_no_seqs(self):
+        result = self._callFUT(_Set, ())
+        self.assertEqual(list(result), [])
+
+    def test_w_non_iterable_seq(self):
+        result = self._callFUT(_Set, (1, [1, 2]))
+        self.assertEqual(list(result), [1])
+
+    def test_w_iterable_seqs(self):
+        result = self._callFUT(_Set, [(1, 2, 3), (3, 2), (2, 4)])
+        self.assertEqual(list(result), [2])
+
+    def test_w_empty_seq(self):
+        result = self._callFUT(_Set, [(1, 2), ()])
+        self.assertEqual(list(result), [])
+
+
+class Test_thresholdUnion(unittest.TestCase, _SetObBase):
+
+    def _callFUT(self, *args, **kw):
+        from .._base import thresholdUnion
+        return thresholdUnion(*args, **kw)
+
+    def test_no_seqs(self):
+        result = self._callFUT(_Set, (), 1)
+        self.assertEqual(list(result), [])
+
+    def test_w_mix(self):
+        result = self._callFUT(_Set, [1, (1, 2), (2, 3, 1)], 2)
+        self.assertEqual(list(result), [1, 2])
+
+    def test_w_counts(self):
+        from BTrees.IIBTree import IIBucketPy
+        from BTrees.IIBTree import IISetPy
+        result = self._callFUT(IISetPy, [1, (1, 2), (2, 3, 1)], 2,
+                               counts=True)
+        self.assertIsInstance(result, IIBucketPy)
+        self.assertEqual(list(result.items()), [(1, 3), (2, 2)])
+
+    def test_w_bad_k(self):
+        with self.assertRaises(ValueError):
+            self._callFUT(_Set, [(1,)], 0)
+
+
 class Test_helpers(unittest.TestCase):
 
     def test_MERGE(self):